@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
-from .models import User, UserProfile, FavoriteProperty
+from .models import User, UserProfile, FavoriteProperty, NotificationOutbox
 
 @admin.register(User)
 class UserAdmin(BaseUserAdmin):
@@ -61,3 +61,14 @@ class FavoritePropertyAdmin(admin.ModelAdmin):
         ('User & Property', {'fields': ('user', 'property_id', 'property_title', 'property_price')}),
         ('Timestamp', {'fields': ('added_at',)}),
     )
+
+@admin.register(NotificationOutbox)
+class NotificationOutboxAdmin(admin.ModelAdmin):
+    """
+    Admin configuration for NotificationOutbox model
+    """
+    list_display = ('user', 'kind', 'search_id', 'property_id', 'created_at', 'sent_at')
+    list_filter = ('kind', 'created_at', 'sent_at')
+    search_fields = ('user__email', 'search_id', 'property_id')
+    readonly_fields = ('created_at',)
+    raw_id_fields = ('user',)
@@ -0,0 +1,266 @@
+"""
+JWT authentication without a User query on every request.
+
+CachedJWTAuthentication validates the access token like simplejwt's
+JWTAuthentication, then resolves the user from ``user_cache``, an
+in-process LRU of User rows. Every user has a version in a shared cache
+that changes whenever the user is saved (password changes, deactivation
+and demotion included) or deleted; it is read on every request and a row
+cached under another version is read again. Only that case, and a miss,
+read the database.
+
+Tokens issued through ClaimsRefreshToken also carry the fields permission
+checks read (``is_active``, ``is_staff``, ``is_superuser``, ``user_type``,
+``is_verified``) and the user's version when they were read. When the user
+is not cached, the claims are used as long as that version is still
+current, so a cold authenticated GET costs one cache read and no query.
+The request then gets a ClaimsUser, which answers from the claims and
+loads the row the first time anything else of the user is read or
+written.
+"""
+import inspect
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Model
+from django.db.models.base import ModelState
+from django.utils.functional import SimpleLazyObject, empty
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+from rest_framework_simplejwt.utils import get_md5_hash_password
+from .models import User
+
+# Token claim with the user fields permission checks read, and their version
+AUTH_CLAIM = 'auth'
+CLAIM_FIELDS = ('is_active', 'is_staff', 'is_superuser', 'user_type', 'is_verified')
+
+# What the cache keeps of a user: the whole row, in column order
+ROW_FIELDS = [field.attname for field in User._meta.concrete_fields]
+
+
+class UserCache:
+    """
+    Bounded LRU of User rows, local to the process, checked against
+    versions kept in a shared Django cache (``channel``).
+
+    Entries are field values, so every request gets its own User instance.
+    Each entry is tagged with the user's version when it was read, and
+    ``get()`` only returns it while that is still the current version.
+    ``invalidate()`` replaces the version, which every process sees on its
+    next request for the user. Versions outlive the longest an entry or an
+    access token can be trusted, so none expires while something still
+    carries it; entries also expire after ``ttl`` seconds, which bounds
+    staleness for writes that bypass signals (QuerySet.update()).
+    """
+
+    def __init__(self, namespace='auth_users', max_entries=10000, ttl=300, channel=None, version_timeout=None):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.channel = channel or DEFAULT_CACHE_ALIAS
+        if version_timeout is None:
+            version_timeout = max(ttl, api_settings.ACCESS_TOKEN_LIFETIME.total_seconds())
+        self.version_timeout = int(version_timeout)
+        self._lock = threading.Lock()
+        # user id -> (expires_at, version, field values)
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _version_key(self, user_id):
+        return f'{self.namespace}:version:{user_id}'
+
+    def clear(self):
+        """Forget every user cached in this process"""
+        with self._lock:
+            self._entries.clear()
+
+    def version(self, user_id):
+        """The user's current version, created if it expired or was never set"""
+        channel = caches[self.channel]
+        key = self._version_key(user_id)
+        version = channel.get(key)
+        if version is None:
+            channel.add(key, secrets.token_hex(8), self.version_timeout)
+            version = channel.get(key)
+        return version
+
+    def issue_version(self, user_id):
+        """The current version, kept for as long as a token carrying it is valid"""
+        version = self.version(user_id)
+        caches[self.channel].touch(self._version_key(user_id), self.version_timeout)
+        return version
+
+    def get(self, user_id, version):
+        """A User built from the row cached under ``version``, or None"""
+        if self.max_entries <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires_at, entry_version, values = entry
+            if expires_at <= time.monotonic() or entry_version != version:
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+        return User.from_db(DEFAULT_DB_ALIAS, ROW_FIELDS, values)
+
+    def set(self, user, version):
+        """Store ``user``, read after ``version`` was current"""
+        if self.max_entries <= 0 or user.get_deferred_fields():
+            return
+        values = tuple(getattr(user, field) for field in ROW_FIELDS)
+        with self._lock:
+            self._entries[user.pk] = (time.monotonic() + self.ttl, version, values)
+            self._entries.move_to_end(user.pk)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id, using=DEFAULT_DB_ALIAS):
+        """Give ``user_id`` a new version, so no process uses what it cached before"""
+        self._replace_version(user_id)
+        if transaction.get_connection(using).in_atomic_block:
+            # ... and again once the change commits: a request may read the
+            # old row under the new version in between
+            transaction.on_commit(lambda: self._replace_version(user_id), using=using)
+
+    def _replace_version(self, user_id):
+        with self._lock:
+            self._entries.pop(int(user_id), None)
+        caches[self.channel].set(self._version_key(user_id), secrets.token_hex(8), self.version_timeout)
+
+
+# Users behind CachedJWTAuthentication
+user_cache = UserCache(
+    max_entries=settings.AUTH_USER_CACHE.get('max_entries', 10000),
+    ttl=settings.AUTH_USER_CACHE.get('ttl', 300),
+    channel=settings.AUTH_USER_CACHE.get('channel'),
+)
+
+
+def user_claims(user):
+    claims = {field: getattr(user, field) for field in CLAIM_FIELDS}
+    claims['v'] = user_cache.issue_version(user.pk)
+    return claims
+
+
+class ClaimsUser(SimpleLazyObject):
+    """
+    Stand-in for the User a token's claims describe.
+
+    The claimed fields, the primary key and the User properties computed
+    from them are answered from the claims. Any other attribute, and any
+    write, loads the row once (and caches it under ``version``); from then
+    on this is that User.
+    """
+
+    # isinstance() checks (related-object assignment, lookups) need no row
+    __class__ = property(lambda self: User if self._wrapped is empty else type(self._wrapped))
+
+    def __init__(self, user_id, claims, version):
+        def load():
+            user = User.objects.get(pk=user_id)
+            user_cache.set(user, version)
+            return user
+
+        known = {field: claims[field] for field in CLAIM_FIELDS}
+        # A fetched row's state, so related assignments route to its database
+        state = ModelState()
+        state.adding, state.db = False, DEFAULT_DB_ALIAS
+        known.update(id=user_id, pk=user_id, _state=state)
+        self.__dict__['_claims'] = known
+        super().__init__(load)
+
+    def __bool__(self):
+        return True
+
+    # Compared and hashed by primary key, like any User
+    __eq__ = Model.__eq__
+    __hash__ = Model.__hash__
+
+    def __getattr__(self, name):
+        if self._wrapped is empty:
+            if name in self._claims:
+                return self._claims[name]
+            if name == '_meta':
+                return User._meta
+            if name in ('_get_pk_val', '_is_pk_set'):
+                # What the ORM asks of a model instance used in a filter
+                return getattr(Model, name).__get__(self)
+            attribute = inspect.getattr_static(User, name, empty)
+            if isinstance(attribute, property):
+                return attribute.fget(self)
+            if attribute is empty:
+                # Nor would the row have it: answer hasattr() probes without loading it
+                raise AttributeError(f"'User' object has no attribute '{name}'")
+        return super().__getattr__(name)
+
+
+class ClaimsRefreshToken(RefreshToken):
+    """RefreshToken whose access tokens carry the user's permission fields"""
+
+    @classmethod
+    def for_user(cls, user):
+        token = super().for_user(user)
+        if settings.AUTH_USER_CACHE.get('claims', True):
+            token[AUTH_CLAIM] = user_claims(user)
+        return token
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication resolving users through ``user_cache``.
+
+    Accepts and rejects the same tokens as JWTAuthentication; a change to a
+    user applies to the next request in every process.
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = int(validated_token[api_settings.USER_ID_CLAIM])
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+        except (TypeError, ValueError):
+            raise AuthenticationFailed(_('User not found'), code='user_not_found')
+
+        version = user_cache.version(user_id)
+        user = user_cache.get(user_id, version)
+        if user is None:
+            user = self.get_claims_user(user_id, validated_token, version)
+            if user is not None:
+                return user
+            try:
+                user = self.user_model.objects.get(**{api_settings.USER_ID_FIELD: user_id})
+            except self.user_model.DoesNotExist:
+                raise AuthenticationFailed(_('User not found'), code='user_not_found')
+            user_cache.set(user, version)
+
+        if not user.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(_("The user's password has been changed."), code='password_changed')
+
+        return user
+
+    def get_claims_user(self, user_id, validated_token, version):
+        """The user described by the token's claims, if they are still ``version``"""
+        if not settings.AUTH_USER_CACHE.get('claims', True) or api_settings.CHECK_REVOKE_TOKEN:
+            # Revocation compares the password hash, which only the row has
+            return None
+        claims = validated_token.get(AUTH_CLAIM)
+        if not isinstance(claims, dict) or any(field not in claims for field in CLAIM_FIELDS):
+            return None
+        if claims.get('v') != version or not claims['is_active']:
+            return None
+        return ClaimsUser(user_id, claims, version)
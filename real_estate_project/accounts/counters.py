@@ -0,0 +1,96 @@
+from collections import Counter
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+from webapp.mongodb_models import PropertyMongoDB
+from .models import UserProfile
+
+# UserProfile statistics kept up to date by the API
+PROFILE_COUNTERS = ('properties_posted', 'properties_sold', 'inquiries_received')
+
+# The counters reconcile_profile_counters() can recompute from the listings
+LISTING_COUNTERS = ('properties_posted', 'properties_sold')
+
+SOLD_STATUS = 'sold'
+
+
+def adjust_profile_counters(user_id, **deltas):
+    """
+    Add ``deltas`` (e.g. ``properties_posted=1``) to a user's profile counters.
+
+    One UPDATE computed by the database, so concurrent requests cannot lose
+    each other's changes, and only the touched columns are written. Counters
+    never go below zero. Returns the number of profiles updated.
+    """
+    changes = {}
+    for field, delta in deltas.items():
+        if field not in PROFILE_COUNTERS:
+            raise ValueError(f'{field} is not a profile counter')
+        if delta:
+            changes[field] = Greatest(F(field) + delta, Value(0))
+    if not changes or not user_id:
+        return 0
+    return UserProfile.objects.filter(user_id=user_id).update(**changes)
+
+
+def record_listing_created(prop):
+    """Count a new PropertyMongoDB in its owner's profile"""
+    return adjust_profile_counters(
+        prop.owner_id, properties_posted=1, properties_sold=int(prop.status == SOLD_STATUS)
+    )
+
+
+def record_listing_deleted(prop):
+    """Take a deleted PropertyMongoDB out of its owner's profile counts"""
+    return adjust_profile_counters(
+        prop.owner_id, properties_posted=-1, properties_sold=-int(prop.status == SOLD_STATUS)
+    )
+
+
+def count_listings_per_owner():
+    """``{user_id: Counter(properties_posted=..., properties_sold=...)}`` from one $group"""
+    pipeline = [
+        {'$match': {'owner_id': {'$nin': [None, '']}}},
+        {'$group': {'_id': {'owner_id': '$owner_id', 'status': '$status'}, 'count': {'$sum': 1}}},
+    ]
+    counts = {}
+    for row in PropertyMongoDB.get_collection().aggregate(pipeline):
+        owner_id = str(row['_id']['owner_id'])
+        if not owner_id.isdigit():
+            continue
+        owner = counts.setdefault(int(owner_id), Counter())
+        owner['properties_posted'] += row['count']
+        if row['_id'].get('status') == SOLD_STATUS:
+            owner['properties_sold'] += row['count']
+    return counts
+
+
+def reconcile_profile_counters(batch_size=1000, dry_run=False):
+    """
+    Recompute ``properties_posted`` and ``properties_sold`` from the listings.
+
+    Listings are counted with one aggregation; profiles whose counters
+    drifted are fixed with a batched UPDATE (one statement per
+    ``batch_size`` profiles). Writes made while it runs may be counted
+    twice or not at all, so run it when drift is suspected, not on every
+    write. Returns the profiles that were (or, with ``dry_run``, would be)
+    changed, as ``{user_id: {field: (old, new)}}``.
+    """
+    counts = count_listings_per_owner()
+    drifted = []
+    changes = {}
+    profiles = UserProfile.objects.order_by('pk').only('id', 'user_id', *LISTING_COUNTERS)
+    for profile in profiles.iterator(chunk_size=batch_size):
+        expected = counts.get(profile.user_id, Counter())
+        changed = {
+            field: (getattr(profile, field), expected[field])
+            for field in LISTING_COUNTERS if getattr(profile, field) != expected[field]
+        }
+        if changed:
+            for field, (_, value) in changed.items():
+                setattr(profile, field, value)
+            drifted.append(profile)
+            changes[profile.user_id] = changed
+
+    if drifted and not dry_run:
+        UserProfile.objects.bulk_update(drifted, LISTING_COUNTERS, batch_size=batch_size)
+    return changes
@@ -0,0 +1,219 @@
+import logging
+import secrets
+from decimal import Decimal, InvalidOperation
+from django.core.cache import cache, caches
+from django.db import DatabaseError
+from webapp.mongodb_models import PropertyMongoDB
+from .models import FavoriteProperty
+
+logger = logging.getLogger(__name__)
+
+# Listing fields shown next to a favorite; fetched live for each page
+LISTING_FIELDS = (
+    'title', 'property_type', 'status', 'price', 'bedrooms', 'bathrooms',
+    'area', 'city', 'state', 'image', 'featured', 'updated_at'
+)
+LISTING_PROJECTION = {field: 1 for field in LISTING_FIELDS}
+
+# What a favorite keeps a copy of, so it can be listed without MongoDB
+SNAPSHOT_FIELDS = {'title', 'price'}
+SNAPSHOT_PROJECTION = {field: 1 for field in SNAPSHOT_FIELDS}
+
+# Users with at most this many favorites have the whole id set cached in
+# each process; listing pages for everyone else are checked with one query
+# per page
+FAVORITE_IDS_CACHE_MAX = 500
+# Adding and removing favorites through the API changes the user's version
+# in this shared cache, which every process checks before using its set; the
+# timeout only bounds how long other writes (e.g. the admin) go unseen
+FAVORITE_VERSIONS_CACHE = 'invalidation'
+FAVORITE_IDS_CACHE_TIMEOUT = 300
+
+
+def snapshot_values(doc):
+    """``property_title`` and ``property_price`` for a listing document"""
+    try:
+        price = Decimal(str(doc.get('price') or 0)).quantize(Decimal('0.01'))
+    except InvalidOperation:
+        price = Decimal('0.00')
+    title = FavoriteProperty._meta.get_field('property_title').max_length
+    return {
+        'property_title': (doc.get('title') or '')[:title],
+        'property_price': price,
+    }
+
+
+def get_listings(property_ids):
+    """Current listing-card data for ``property_ids``, from one ``$in`` query"""
+    return PropertyMongoDB.find_many(property_ids, LISTING_PROJECTION)
+
+
+def update_snapshots(snapshots, batch_size=500):
+    """
+    Write ``{property_id: snapshot_values(...)}`` into the favorites of
+    those listings that differ: one SELECT and at most one bulk UPDATE.
+    Returns the number of favorites updated.
+    """
+    stale = []
+    for favorite in FavoriteProperty.objects.filter(property_id__in=list(snapshots)).order_by().only(
+        'id', 'property_id', 'property_title', 'property_price'
+    ):
+        values = snapshots[favorite.property_id]
+        if (favorite.property_title, favorite.property_price) != (values['property_title'], values['property_price']):
+            favorite.property_title = values['property_title']
+            favorite.property_price = values['property_price']
+            stale.append(favorite)
+    if stale:
+        FavoriteProperty.objects.bulk_update(stale, ['property_title', 'property_price'], batch_size=batch_size)
+    return len(stale)
+
+
+def refresh_favorite_snapshots(property_ids=None, batch_size=500):
+    """
+    Rewrite the title and price copied into favorites whose listing changed.
+
+    Works through the favorited listings (or only ``property_ids``) in
+    batches: one ``$in`` query, one SELECT and at most one bulk UPDATE per
+    batch. Favorites of deleted listings are left as they are. Returns the
+    number of favorites updated.
+
+    Saves through PropertyMongoDB keep favorites current (see
+    sync_favorite_snapshots); this catches up after writes that bypass it,
+    e.g. straight to the collection.
+    """
+    if property_ids is None:
+        property_ids = (
+            FavoriteProperty.objects.order_by('property_id')
+            .values_list('property_id', flat=True).distinct()
+        )
+    property_ids = list(property_ids)
+
+    updated = 0
+    for start in range(0, len(property_ids), batch_size):
+        batch = property_ids[start:start + batch_size]
+        snapshots = {
+            property_id: snapshot_values(doc)
+            for property_id, doc in PropertyMongoDB.find_many(batch, SNAPSHOT_PROJECTION).items()
+        }
+        if snapshots:
+            updated += update_snapshots(snapshots, batch_size)
+
+    return updated
+
+
+def sync_favorite_snapshots(properties, changed_fields=None, created=False, batch_size=500):
+    """
+    Receiver body for webapp's properties_saved signal.
+
+    Copies the title and price of the saved listings into their favorites,
+    from the instances just written; nothing is read from MongoDB. New
+    listings and updates that leave both fields alone cost nothing. The
+    listing is already written when this runs, so a database error is
+    logged instead of failing the write.
+    """
+    if created or (changed_fields is not None and not changed_fields & SNAPSHOT_FIELDS):
+        return 0
+    snapshots = {
+        prop.id: snapshot_values({'title': prop.title, 'price': prop.price})
+        for prop in properties if prop.id
+    }
+    snapshots = list(snapshots.items())
+    updated = 0
+    try:
+        for start in range(0, len(snapshots), batch_size):
+            updated += update_snapshots(dict(snapshots[start:start + batch_size]), batch_size)
+    except DatabaseError:
+        logger.exception('Updating favorite snapshots failed for %d listing(s)', len(properties))
+    return updated
+
+
+def favorite_ids_cache_key(user_id):
+    return f'favorite_ids:{user_id}'
+
+
+def favorite_version_key(user_id):
+    return f'favorite_ids:version:{user_id}'
+
+
+def get_favorites_version(user_id):
+    """The user's current favorites version, shared by every process"""
+    versions = caches[FAVORITE_VERSIONS_CACHE]
+    key = favorite_version_key(user_id)
+    version = versions.get(key)
+    if version is None:
+        versions.add(key, secrets.token_hex(8), FAVORITE_IDS_CACHE_TIMEOUT)
+        version = versions.get(key)
+    return version
+
+
+def get_favorite_state(user):
+    """
+    The cached favorites of ``user``: ``{'ids': set or None, 'version': str}``.
+
+    ``ids`` is None for users with more than FAVORITE_IDS_CACHE_MAX favorites.
+    ``version`` changes whenever the favorites do, for use in ETags; a set
+    cached under an older version is read again. A miss costs one query over
+    the (user, property_id) index.
+    """
+    version = get_favorites_version(user.pk)
+    key = favorite_ids_cache_key(user.pk)
+    state = cache.get(key)
+    if state is None or state['version'] != version:
+        ids = set(FavoriteProperty.objects.filter(user=user).order_by().values_list(
+            'property_id', flat=True
+        )[:FAVORITE_IDS_CACHE_MAX + 1])
+        state = {
+            'ids': ids if len(ids) <= FAVORITE_IDS_CACHE_MAX else None,
+            'version': version,
+        }
+        cache.set(key, state, FAVORITE_IDS_CACHE_TIMEOUT)
+    return state
+
+
+def favorited_ids(user, property_ids, state=None):
+    """The subset of ``property_ids`` that ``user`` has favorited"""
+    property_ids = {str(property_id) for property_id in property_ids if property_id}
+    if not property_ids or not user.is_authenticated:
+        return set()
+    if state is None:
+        state = get_favorite_state(user)
+    if state['ids'] is not None:
+        return property_ids & state['ids']
+    return set(FavoriteProperty.objects.filter(user=user, property_id__in=property_ids).values_list(
+        'property_id', flat=True
+    ))
+
+
+def update_favorite_ids(user_id, added=(), removed=()):
+    """
+    Give ``user_id`` a new favorites version, so every process reads the set
+    again, and apply the change to this process's set, if cached
+    """
+    versions = caches[FAVORITE_VERSIONS_CACHE]
+    previous = versions.get(favorite_version_key(user_id))
+    version = secrets.token_hex(8)
+    versions.set(favorite_version_key(user_id), version, FAVORITE_IDS_CACHE_TIMEOUT)
+    key = favorite_ids_cache_key(user_id)
+    state = cache.get(key)
+    if state is None:
+        return
+    if state['version'] != previous:
+        # Another process changed them since this set was read
+        cache.delete(key)
+        return
+    ids = state['ids']
+    if ids is not None:
+        ids = (ids | set(added)) - set(removed)
+        if len(ids) > FAVORITE_IDS_CACHE_MAX:
+            ids = None
+    cache.set(key, {'ids': ids, 'version': version}, FAVORITE_IDS_CACHE_TIMEOUT)
+
+
+def annotate_favorites(user, items, state=None):
+    """Set ``is_favorited`` on serialized listings (dicts with an ``id``) for an authenticated user"""
+    if not user.is_authenticated:
+        return items
+    favorited = favorited_ids(user, (item['id'] for item in items), state)
+    for item in items:
+        item['is_favorited'] = item['id'] in favorited
+    return items
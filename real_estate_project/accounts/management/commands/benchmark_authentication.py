@@ -0,0 +1,72 @@
+import random
+import time
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import setup_databases, teardown_databases
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.tokens import RefreshToken
+from accounts.authentication import CachedJWTAuthentication, ClaimsRefreshToken, user_cache
+from accounts.models import User
+
+
+class Command(BaseCommand):
+    help = 'Compare JWTAuthentication with CachedJWTAuthentication on a throwaway database'
+
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000, help='Users to create')
+        parser.add_argument('--requests', type=int, default=20000, help='Requests authenticated per run')
+        parser.add_argument('--active', type=int, default=200,
+                            help='Users sending the requests; fewer than --users makes a hotter cache')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            password = make_password('benchmark-pass-123')
+            User.objects.bulk_create([
+                User(username=f'bench{i}', email=f'bench{i}@example.com', password=password,
+                     first_name='Bench', last_name=str(i), user_type=rng.choice(('buyer', 'seller', 'agent')))
+                for i in range(options['users'])
+            ], batch_size=1000)
+            users = list(User.objects.order_by('id')[:max(options['active'], 1)])
+            senders = [rng.randrange(len(users)) for _ in range(options['requests'])]
+
+            runs = [
+                ('JWTAuthentication', JWTAuthentication(), RefreshToken),
+                ('CachedJWTAuthentication', CachedJWTAuthentication(), RefreshToken),
+                ('CachedJWTAuthentication, claims', CachedJWTAuthentication(), ClaimsRefreshToken),
+            ]
+            self.stdout.write(
+                f'{options["requests"]} requests from {len(users)} of {options["users"]} users'
+            )
+            for label, authentication, token_class in runs:
+                # Cold cache
+                user_cache.clear()
+                factory = RequestFactory()
+                headers = [f'Bearer {token_class.for_user(user).access_token}' for user in users]
+                requests = [factory.get('/', HTTP_AUTHORIZATION=headers[sender]) for sender in senders]
+                self.run(label, authentication, requests)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+    def run(self, label, authentication, requests):
+        queries = []
+
+        def count(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count):
+            start = time.perf_counter()
+            for request in requests:
+                authentication.authenticate(request)
+            elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f'  {label:<34} {len(requests) / elapsed:>9,.0f} requests/s  '
+            f'{elapsed / len(requests) * 1e6:>7.1f} us/request  {len(queries) / len(requests):.3f} SQL/request'
+        )
@@ -0,0 +1,129 @@
+import random
+import time
+from datetime import datetime
+from django.core.management.base import BaseCommand
+from accounts.saved_searches import SavedSearchIndex, compile_search, listing_keys, listing_values, search_matches
+from api import seeding
+
+
+def district(rng, city, districts):
+    """Split the seed cities into ``districts`` markets each, as a bigger catalogue would have"""
+    return f'{city} {rng.randint(1, districts)}' if districts > 1 else city
+
+
+def generate_search(rng, index, districts=1):
+    """A saved search as users tend to write them: a place, usually a type, a budget and a size"""
+    city, state, _, _, median_price = rng.choices(seeding.CITIES, weights=seeding.CITY_WEIGHTS)[0]
+    property_type, _, type_multiplier, (min_beds, max_beds) = rng.choices(
+        seeding.PROPERTY_TYPES, weights=[weight for _, weight, _, _ in seeding.PROPERTY_TYPES]
+    )[0]
+    status = rng.choices(seeding.STATUSES[:2], weights=seeding.STATUS_WEIGHTS[:2])[0]
+    search = {'id': f's{index}', 'status': status}
+    if rng.random() < 0.97:
+        search['city'] = district(rng, city, districts)
+    else:
+        search['state'] = state
+    if rng.random() < 0.8:
+        search['property_type'] = property_type
+    if rng.random() < 0.9:
+        budget = median_price * type_multiplier * (0.005 if status == 'rent' else 1) * rng.lognormvariate(0, 0.35)
+        search['max_price'] = round(budget * 1.1, -3 if status == 'sale' else 1)
+        if rng.random() < 0.7:
+            search['min_price'] = round(budget * 0.8, -3 if status == 'sale' else 1)
+    if rng.random() < 0.6 and max_beds:
+        search['min_bedrooms'] = rng.randint(max(min_beds, 1), max_beds)
+    return search
+
+
+class Command(BaseCommand):
+    help = 'Measure saved-search matching throughput against a scan over every search'
+
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--searches', type=int, default=1000000, help='Saved searches to index')
+        parser.add_argument('--per-user', type=int, default=3, help='Saved searches per user')
+        parser.add_argument('--listings', type=int, default=20000, help='Listings to match')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Listings matched at a time')
+        parser.add_argument('--shards', type=int, default=1,
+                            help='Workers the users are split between; each matches every listing')
+        parser.add_argument('--scan-listings', type=int, default=20,
+                            help='Listings also matched by scanning every search, to compare and verify')
+        parser.add_argument('--districts', type=int, default=1,
+                            help='Markets per seed city; every listing matches about 1/districts as many searches')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        per_user = max(options['per_user'], 1)
+
+        self.stdout.write(f'Generating {options["searches"]} saved searches...')
+        profiles = {}
+        for index in range(options['searches']):
+            profiles.setdefault(index // per_user + 1, []).append(generate_search(rng, index, options['districts']))
+        now = datetime.now()
+        listings = []
+        for index in range(options['listings']):
+            prop = seeding.generate_property(rng, index, 0, now)
+            data = prop.to_dict()
+            data['id'] = f'p{index}'
+            data['city'] = district(rng, data['city'], options['districts'])
+            listings.append(data)
+
+        shards = max(options['shards'], 1)
+        indexes = [SavedSearchIndex(shard=shard, shards=shards) for shard in range(shards)]
+        start = time.perf_counter()
+        for index in indexes:
+            index.load(profiles.items())
+        build = time.perf_counter() - start
+        searches = sum(len(index) for index in indexes)
+        self.stdout.write(
+            f'Index: {searches} searches in {build:.2f}s ({searches / build:,.0f} searches/s), {shards} shard(s)'
+        )
+
+        # Batched like process_match_jobs(), so the matches never pile up.
+        # Shards run in parallel workers: the slowest one sets the pace
+        batch_size = options['batch_size']
+        matches = 0
+        elapsed = 0
+        for index in indexes:
+            start = time.perf_counter()
+            for offset in range(0, len(listings), batch_size):
+                matches += len(index.match(listings[offset:offset + batch_size]))
+            elapsed = max(elapsed, time.perf_counter() - start)
+        self.stdout.write(
+            f'Indexed: {len(listings)} listings in {elapsed:.2f}s '
+            f'({len(listings) / elapsed:,.0f} listings/s, {matches / max(len(listings), 1):.1f} matches per listing, '
+            f'{matches / elapsed:,.0f} matches/s)'
+        )
+
+        # The alternative: test every search against every listing
+        sample = listings[:options['scan_listings']]
+        if not sample:
+            return
+        compiled = [
+            compiled
+            for user_id, searches in profiles.items() for search in searches
+            for compiled in [compile_search(user_id, search)] if compiled is not None
+        ]
+        start = time.perf_counter()
+        scanned = set()
+        for listing in sample:
+            keys = set(listing_keys(listing))
+            values = listing_values(listing)
+            for search_keys, search in compiled:
+                if any(key in keys for key in search_keys) and search_matches(search, values):
+                    scanned.add((search.user_id, search.search_id, listing['id']))
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f'Scan: {len(sample)} listings in {elapsed:.2f}s ({len(sample) / elapsed:,.1f} listings/s)')
+
+        indexed = {
+            (search.user_id, search.search_id, listing['id'])
+            for index in indexes for search, listing in index.match(sample)
+        }
+        if indexed == scanned:
+            self.stdout.write(self.style.SUCCESS(f'Same {len(indexed)} matches from both'))
+        else:
+            self.stdout.write(self.style.ERROR(
+                f'Results differ: {len(indexed - scanned)} only indexed, {len(scanned - indexed)} only scanned'
+            ))
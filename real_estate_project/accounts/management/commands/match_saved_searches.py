@@ -0,0 +1,62 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from accounts.saved_searches import SavedSearchIndex, process_match_jobs, prune_match_jobs, record_worker
+
+
+class Command(BaseCommand):
+    help = 'Match queued listings against the saved searches of one shard of users and queue notifications'
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--shard', type=int, default=0,
+            help='Shard this worker matches, from 0 to SAVED_SEARCH_MATCHING["shards"] - 1 (default: 0)'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=settings.SAVED_SEARCH_MATCHING.get('batch_size', 1000),
+            help='Listings matched per transaction'
+        )
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Exit once the queue is empty instead of waiting for more listings'
+        )
+    
+    def handle(self, *args, **options):
+        shards = max(settings.SAVED_SEARCH_MATCHING.get('shards', 1), 1)
+        if not 0 <= options['shard'] < shards:
+            raise CommandError(f'--shard must be between 0 and {shards - 1}')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        
+        index = SavedSearchIndex(
+            channel=settings.SAVED_SEARCH_MATCHING.get('channel'),
+            poll_interval=settings.SAVED_SEARCH_MATCHING.get('poll_interval', 1.0),
+            rebuild_interval=settings.SAVED_SEARCH_MATCHING.get('rebuild_interval', 3600),
+            shard=options['shard'],
+            shards=shards,
+        )
+        # Listings are only queued for shards with a worker checked in
+        record_worker(options['shard'])
+        start = time.perf_counter()
+        index.ensure_current()
+        self.stdout.write(
+            f'Shard {options["shard"]}/{shards}: {len(index)} saved searches loaded in '
+            f'{time.perf_counter() - start:.1f}s'
+        )
+        
+        # Jobs left from before an outage are too old to be worth a notification
+        pruned = prune_match_jobs(options['shard'])
+        if pruned:
+            self.stdout.write(f'Dropped {pruned} stale job(s)')
+        
+        processed = 0
+        while True:
+            record_worker(options['shard'])
+            count = process_match_jobs(index, options['batch_size'])
+            processed += count
+            if count:
+                continue
+            if options['once']:
+                break
+            time.sleep(settings.SAVED_SEARCH_MATCHING.get('poll_interval', 1.0))
+        self.stdout.write(self.style.SUCCESS(f'Matched {processed} listing(s)'))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+from accounts.counters import reconcile_profile_counters
+
+
+class Command(BaseCommand):
+    help = 'Recompute properties_posted and properties_sold on every profile from the MongoDB listings'
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Report the profiles that drifted without changing them'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Profiles read and updated per statement (default: 1000)'
+        )
+    
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        
+        changes = reconcile_profile_counters(batch_size=options['batch_size'], dry_run=options['dry_run'])
+        for user_id, fields in sorted(changes.items()):
+            details = ', '.join(f'{field} {old} -> {new}' for field, (old, new) in fields.items())
+            self.stdout.write(f'user {user_id}: {details}')
+        
+        verb = 'would be fixed' if options['dry_run'] else 'fixed'
+        self.stdout.write(self.style.SUCCESS(f'{len(changes)} profile(s) {verb}'))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+from accounts.favorites import refresh_favorite_snapshots
+
+
+class Command(BaseCommand):
+    help = 'Copy the current title and price of favorited listings into FavoriteProperty rows that are out of date'
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'property_ids', nargs='*',
+            help='Only refresh favorites of these listings (default: every favorited listing)'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Listings looked up per MongoDB query (default: 500)'
+        )
+    
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        
+        updated = refresh_favorite_snapshots(options['property_ids'] or None, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Refreshed {updated} favorite snapshot(s)'))
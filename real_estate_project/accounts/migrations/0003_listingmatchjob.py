@@ -0,0 +1,27 @@
+# Generated by Django 5.2.4 on 2026-10-17 04:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_notificationoutbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ListingMatchJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField(default=0)),
+                ('property_id', models.CharField(max_length=50)),
+                ('listing', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'accounts_listing_match_job',
+                'indexes': [models.Index(fields=['shard', 'id'], name='match_job_shard_idx')],
+            },
+        ),
+    ]
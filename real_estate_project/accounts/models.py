@@ -154,3 +154,52 @@ class FavoriteProperty(models.Model):
     
     def __str__(self):
         return f"{self.user.get_full_name()}'s favorite: {self.property_title}"
+
+class NotificationOutbox(models.Model):
+    """
+    Notifications waiting to be delivered to a user
+    Written by saved-search matching; a sender marks rows with sent_at
+    """
+    KIND_CHOICES = [
+        ('saved_search_match', 'Saved search match'),
+    ]
+    
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications')
+    kind = models.CharField(max_length=30, choices=KIND_CHOICES, default='saved_search_match')
+    search_id = models.CharField(max_length=64)  # Id of the entry in UserProfile.saved_searches
+    property_id = models.CharField(max_length=50)  # MongoDB ObjectId as string
+    payload = models.JSONField(default=dict, blank=True)  # What the message shows: listing title, price, city
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        db_table = 'accounts_notification_outbox'
+        # A listing is announced once per saved search, however often it is updated
+        unique_together = ['user', 'kind', 'search_id', 'property_id']
+        indexes = [
+            models.Index(fields=['sent_at', 'created_at'], name='outbox_pending_idx'),
+        ]
+        ordering = ['created_at']
+    
+    def __str__(self):
+        return f"{self.get_kind_display()} for {self.user_id}: {self.property_id}"
+
+class ListingMatchJob(models.Model):
+    """
+    A new or updated listing waiting to be matched against saved searches
+    Written when the listing is saved; the match_saved_searches worker for
+    ``shard`` matches it and deletes the row
+    """
+    shard = models.PositiveSmallIntegerField(default=0)  # Worker that matches it; one row per shard
+    property_id = models.CharField(max_length=50)  # MongoDB ObjectId as string
+    listing = models.JSONField(default=dict)  # The listing fields matching reads, as saved
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        db_table = 'accounts_listing_match_job'
+        indexes = [
+            models.Index(fields=['shard', 'id'], name='match_job_shard_idx'),
+        ]
+    
+    def __str__(self):
+        return f"Match {self.property_id} (shard {self.shard})"
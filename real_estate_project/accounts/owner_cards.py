@@ -0,0 +1,81 @@
+import secrets
+from django.core.cache import cache, caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+from .models import User
+from .serializers import PublicUserSerializer
+
+# Owner cards change rarely and are invalidated on User save/delete,
+# so a short TTL only bounds how long a missed invalidation can linger
+OWNER_CARD_CACHE_TIMEOUT = 300
+
+# Cards are cached in each process under a version shared through this
+# cache, so a change made in one process reaches all of them
+OWNER_CARD_VERSIONS_CACHE = 'invalidation'
+OWNER_CARD_VERSION_KEY = 'owner_card:version'
+
+# User fields PublicUserSerializer reads; a save limited to other fields
+# (last_login on sign-in) leaves the cards alone
+CARD_FIELDS = frozenset((
+    'id', 'username', 'first_name', 'last_name', 'user_type', 'avatar', 'bio', 'location',
+    'company_name', 'website', 'is_verified', 'show_contact_info', 'email', 'phone', 'preferred_contact',
+))
+
+
+def owner_card_cache_key(user_id, version):
+    return f'owner_card:{version}:{user_id}'
+
+
+def get_owner_cards_version():
+    """The current version of the owner cards, shared by every process"""
+    versions = caches[OWNER_CARD_VERSIONS_CACHE]
+    version = versions.get(OWNER_CARD_VERSION_KEY)
+    if version is None:
+        versions.add(OWNER_CARD_VERSION_KEY, secrets.token_hex(8), None)
+        version = versions.get(OWNER_CARD_VERSION_KEY)
+    return version
+
+
+def get_owner_cards(owner_ids):
+    """
+    Return public owner cards keyed by owner id (as a string).
+    
+    Cards come from the cache when possible; the rest are loaded with a single
+    ``in_bulk`` query and serialized once. Unknown owners map to ``None``.
+    """
+    owner_ids = {str(owner_id) for owner_id in owner_ids if owner_id}
+    if not owner_ids:
+        return {}
+    
+    version = get_owner_cards_version()
+    keys = {owner_card_cache_key(owner_id, version): owner_id for owner_id in owner_ids}
+    cards = {keys[key]: card for key, card in cache.get_many(keys).items()}
+    
+    missing = [owner_id for owner_id in owner_ids if owner_id not in cards]
+    if missing:
+        users = User.objects.in_bulk([int(owner_id) for owner_id in missing if owner_id.isdigit()])
+        loaded = {}
+        for owner_id in missing:
+            user = users.get(int(owner_id)) if owner_id.isdigit() else None
+            loaded[owner_id] = dict(PublicUserSerializer(user).data) if user else None
+        cache.set_many(
+            {owner_card_cache_key(owner_id, version): card for owner_id, card in loaded.items()},
+            OWNER_CARD_CACHE_TIMEOUT
+        )
+        cards.update(loaded)
+    
+    return cards
+
+
+def invalidate_owner_cards(update_fields=None, using=DEFAULT_DB_ALIAS):
+    """Retire every cached card, in every process, unless ``update_fields`` shows no card changed"""
+    if update_fields is not None and not CARD_FIELDS.intersection(update_fields):
+        return
+    _replace_version()
+    if transaction.get_connection(using).in_atomic_block:
+        # ... and again once the change commits: a request may cache the old
+        # row under the new version in between
+        transaction.on_commit(_replace_version, using=using)
+
+
+def _replace_version():
+    caches[OWNER_CARD_VERSIONS_CACHE].set(OWNER_CARD_VERSION_KEY, secrets.token_hex(8), None)
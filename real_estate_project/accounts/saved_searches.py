@@ -0,0 +1,527 @@
+"""
+Percolator-style matching of listings against UserProfile.saved_searches.
+
+A saved search is a dict of criteria named like the property list filters,
+all optional:
+
+    {"id": "beach-condos", "name": "Beach condos", "property_type": "condo",
+     "status": "sale", "city": "Miami", "state": "FL", "min_price": 300000,
+     "max_price": 600000, "min_bedrooms": 2, "featured": false}
+
+Without an ``id``, a digest of the criteria identifies the search.
+
+Rather than running every search against the collection, SavedSearchIndex
+files each search under the (place, status, property_type, price band) it
+requires, with None for criteria it leaves open; the place is the city, or
+the state for searches without one. A listing only looks up the 24
+combinations of its own values and None, and only the searches found there
+are checked in full, so the cost of a listing depends on how many
+searches could match it, not on how many there are.
+
+Nothing is matched while the listing is written: the write queues a
+ListingMatchJob per shard, and one match_saved_searches worker per shard
+matches the queue against the searches of its users. Jobs are only queued
+for shards whose worker has checked in recently, so without workers (or
+with matching disabled, the default) nothing piles up; workers drop jobs
+older than job_max_age they find on start or after an outage.
+"""
+import hashlib
+import json
+import logging
+import math
+import threading
+import time
+from collections import namedtuple
+from itertools import product
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DatabaseError, connection, transaction
+from django.db.models.functions import Mod
+from django.utils import timezone
+from webapp.mongodb_cache import InvalidationLog
+from .models import ListingMatchJob, NotificationOutbox, User, UserProfile
+
+logger = logging.getLogger('accounts.saved_searches')
+
+CRITERIA = (
+    'property_type', 'status', 'city', 'state', 'min_price', 'max_price',
+    'min_bedrooms', 'featured'
+)
+
+# Listing fields the criteria test; an update that changes none of them is
+# not matched again
+MATCH_FIELDS = frozenset((
+    'property_type', 'status', 'city', 'state', 'price', 'bedrooms',
+    'featured', 'is_public'
+))
+
+# Prices are banded in half powers of two. A price range spanning more bands
+# than MAX_PRICE_BANDS is filed under every band (None) and checked in full.
+PRICE_BANDS_PER_OCTAVE = 2
+MAX_PRICE_BANDS = 8
+
+# What the index keeps of a search; place, status, type and the price band are
+# implied by the bucket it is filed in, and the state is checked again when
+# the search names a city too
+SavedSearch = namedtuple(
+    'SavedSearch', 'user_id search_id name min_price max_price min_bedrooms state featured'
+)
+
+
+def normalize(value):
+    """Case- and whitespace-insensitive form of a text criterion, None when empty"""
+    if value is None:
+        return None
+    value = ' '.join(str(value).split()).lower()
+    return value or None
+
+
+def to_number(value):
+    try:
+        return float(value) if value not in (None, '') else None
+    except (TypeError, ValueError):
+        return None
+
+
+def price_band(price):
+    return int(math.log2(price) * PRICE_BANDS_PER_OCTAVE) if price >= 1 else 0
+
+
+def get_search_id(search):
+    if search.get('id'):
+        return str(search['id'])[:64]
+    criteria = {field: search[field] for field in CRITERIA if search.get(field) not in (None, '')}
+    return hashlib.md5(json.dumps(criteria, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def compile_search(user_id, search):
+    """The bucket keys and SavedSearch for one saved search, or None if it is not valid"""
+    if not isinstance(search, dict):
+        return None
+    min_price = to_number(search.get('min_price'))
+    max_price = to_number(search.get('max_price'))
+    min_bedrooms = to_number(search.get('min_bedrooms'))
+    compiled = SavedSearch(
+        user_id=user_id,
+        search_id=get_search_id(search),
+        name=str(search.get('name') or '')[:200],
+        min_price=min_price,
+        max_price=max_price,
+        min_bedrooms=min_bedrooms,
+        state=normalize(search.get('state')),
+        featured=search.get('featured') is True,
+    )
+
+    bands = [None]
+    if max_price is not None:
+        low = price_band(min_price or 0)
+        high = price_band(max_price)
+        if high < low:
+            # An empty price range matches nothing
+            return None
+        if high - low < MAX_PRICE_BANDS:
+            bands = range(low, high + 1)
+
+    place = normalize(search.get('city'))
+    if place is None and compiled.state is not None:
+        place = ('state', compiled.state)
+    status = search.get('status') or None
+    property_type = search.get('property_type') or None
+    return [(place, status, property_type, band) for band in bands], compiled
+
+
+def listing_keys(listing):
+    """Every bucket a search matching ``listing`` can be filed in"""
+    city = normalize(listing.get('city'))
+    state = normalize(listing.get('state'))
+    places = [place for place in (city, ('state', state) if state else None) if place is not None]
+    values = (
+        listing.get('status') or None,
+        listing.get('property_type') or None,
+        price_band(listing.get('price') or 0),
+    )
+    return product(places + [None], *[(value, None) if value is not None else (None,) for value in values])
+
+
+def listing_values(listing):
+    """What search_matches() tests of a listing, worked out once per listing"""
+    return (
+        listing.get('price') or 0,
+        listing.get('bedrooms') or 0,
+        normalize(listing.get('state')),
+        bool(listing.get('featured')),
+    )
+
+
+def search_matches(search, values):
+    """Check the criteria the bucket does not imply against listing_values()"""
+    price, bedrooms, state, featured = values
+    return (
+        (search.min_price is None or price >= search.min_price)
+        and (search.max_price is None or price <= search.max_price)
+        and (search.min_bedrooms is None or bedrooms >= search.min_bedrooms)
+        and (search.state is None or state == search.state)
+        and (featured or not search.featured)
+    )
+
+
+def bucket_entry(search):
+    """What SavedSearchIndex.match() unpacks for each search in a bucket; open bounds are infinite"""
+    return (
+        -math.inf if search.min_price is None else search.min_price,
+        math.inf if search.max_price is None else search.max_price,
+        -math.inf if search.min_bedrooms is None else search.min_bedrooms,
+        search.state,
+        search.featured,
+        str(search.user_id),
+        search,
+    )
+
+
+class SavedSearchIndex:
+    """
+    Inverted index of the saved searches of one shard of users, local to
+    the process.
+
+    Users are split into ``shards`` by id; the index holds the searches of
+    those whose id modulo ``shards`` is ``shard``, so each of several
+    workers matches every listing against a fraction of the searches.
+
+    The first ensure_current() builds the index; after ``rebuild_interval``
+    seconds it is rebuilt in a background thread while the old one keeps
+    serving, and swapped in once loaded. Profile changes made in this
+    process are applied at once and published to an InvalidationLog
+    (``channel``); the other processes reload the users it names at most
+    once per ``poll_interval``.
+    """
+
+    def __init__(self, namespace='saved_searches', channel=None, poll_interval=1.0, rebuild_interval=3600,
+                 shard=0, shards=1):
+        self.namespace = namespace
+        self.rebuild_interval = rebuild_interval
+        self.shard = shard
+        self.shards = max(shards, 1)
+        self._log = InvalidationLog(namespace, channel, poll_interval) if channel else None
+        self._lock = threading.RLock()
+        # Users reloaded while a rebuild runs, reloaded again into the new index
+        self._reloaded_during_rebuild = None
+        self._rebuild_thread = None
+        self._rebuild_again = False
+        self.clear()
+
+    def __len__(self):
+        """Number of saved searches indexed"""
+        return self._size
+
+    def clear(self):
+        """Forget every search; the next ensure_current() builds the index again"""
+        with self._lock:
+            # (place, status, property_type, band) -> {(user_id, search_id): SavedSearch}
+            self._buckets = {}
+            # user_id -> [(bucket key, entry key)], to take a user's searches out again
+            self._entries = {}
+            self._size = 0
+            self._built_at = None
+
+    def owns(self, user_id):
+        return user_id % self.shards == self.shard
+
+    def load(self, profiles):
+        """Replace the index with ``(user_id, saved_searches)`` pairs"""
+        with self._lock:
+            self.clear()
+            for user_id, searches in profiles:
+                self._index_user(user_id, searches)
+            self._built_at = time.monotonic()
+
+    def profiles(self):
+        profiles = UserProfile.objects.exclude(saved_searches=[]).order_by()
+        if self.shards > 1:
+            profiles = profiles.annotate(shard=Mod('user_id', self.shards)).filter(shard=self.shard)
+        return profiles.values_list('user_id', 'saved_searches').iterator(chunk_size=2000)
+
+    def rebuild(self):
+        """Load a new index from UserProfile, then swap it in"""
+        with self._lock:
+            self._reloaded_during_rebuild = set()
+            self._rebuild_again = False
+            if self._log is not None:
+                # Changes published from here on are replayed after the load
+                self._log.mark()
+        try:
+            fresh = SavedSearchIndex(shard=self.shard, shards=self.shards)
+            fresh.load(self.profiles())
+        except BaseException:
+            with self._lock:
+                self._reloaded_during_rebuild = None
+            raise
+        with self._lock:
+            self._buckets, self._entries, self._size = fresh._buckets, fresh._entries, fresh._size
+            # Due again at once if another rebuild was asked for meanwhile
+            self._built_at = -math.inf if self._rebuild_again else fresh._built_at
+            reloaded, self._reloaded_during_rebuild = self._reloaded_during_rebuild, None
+        if reloaded:
+            # The new index may have read these before they changed
+            self.reload_users(reloaded)
+
+    def _rebuild_in_background(self):
+        try:
+            self.rebuild()
+        except Exception:
+            logger.exception('Rebuilding the saved-search index failed')
+            with self._lock:
+                # Keep serving the old index; try again after another interval
+                self._built_at = time.monotonic()
+        finally:
+            connection.close()
+
+    def ensure_current(self):
+        """
+        Build the index on first use, start a background rebuild when it is
+        due, and apply the changes other processes published.
+        """
+        with self._lock:
+            if self._built_at is None:
+                self.rebuild()
+                return
+            if time.monotonic() - self._built_at > self.rebuild_interval:
+                self.start_rebuild()
+            if self._log is None:
+                return
+            changed = self._log.poll()
+            if changed is InvalidationLog.ALL:
+                self.start_rebuild()
+            elif changed:
+                self.reload_users(changed)
+
+    def start_rebuild(self):
+        """Rebuild in a background thread, unless a rebuild is already running"""
+        with self._lock:
+            if self._rebuild_thread is not None and self._rebuild_thread.is_alive():
+                # It may have read profiles before the change that asked for this one
+                self._rebuild_again = True
+                return
+            self._rebuild_thread = threading.Thread(
+                target=self._rebuild_in_background, name=f'{self.namespace}-rebuild', daemon=True
+            )
+            self._rebuild_thread.start()
+
+    def reload_users(self, user_ids):
+        user_ids = {int(user_id) for user_id in user_ids if self.owns(int(user_id))}
+        if not user_ids:
+            return
+        profiles = dict(UserProfile.objects.filter(user_id__in=user_ids).values_list('user_id', 'saved_searches'))
+        with self._lock:
+            for user_id in user_ids:
+                self._index_user(user_id, profiles.get(user_id))
+            if self._reloaded_during_rebuild is not None:
+                self._reloaded_during_rebuild.update(user_ids)
+
+    def user_changed(self, user_id, saved_searches):
+        """Reindex a user's searches here (None once the profile is gone) and tell the other processes"""
+        with self._lock:
+            if self._built_at is not None and self.owns(user_id):
+                self._index_user(user_id, saved_searches)
+                if self._reloaded_during_rebuild is not None:
+                    self._reloaded_during_rebuild.add(user_id)
+        if self._log is not None:
+            self._log.publish(str(user_id))
+
+    def _index_user(self, user_id, searches):
+        if not self.owns(user_id):
+            return
+        old_entries = self._entries.pop(user_id, ())
+        for key, entry_key in old_entries:
+            bucket = self._buckets[key]
+            bucket.pop(entry_key, None)
+            if not bucket:
+                del self._buckets[key]
+        self._size -= len({entry_key for _, entry_key in old_entries})
+
+        entries = []
+        for search in searches if isinstance(searches, list) else ():
+            compiled = compile_search(user_id, search)
+            if compiled is None:
+                continue
+            keys, saved_search = compiled
+            entry_key = (user_id, saved_search.search_id)
+            entry = bucket_entry(saved_search)
+            for key in keys:
+                self._buckets.setdefault(key, {})[entry_key] = entry
+                entries.append((key, entry_key))
+        if entries:
+            self._entries[user_id] = entries
+            self._size += len({entry_key for _, entry_key in entries})
+
+    def match(self, listings):
+        """
+        ``(search, listing)`` for every saved search each listing matches.
+
+        Listings are dicts of listing fields plus ``owner_id``; private
+        listings and owners' own searches never match.
+        """
+        matches = []
+        with self._lock:
+            buckets = self._buckets
+            for listing in listings:
+                if not listing.get('is_public', True):
+                    continue
+                owner_id = str(listing.get('owner_id'))
+                price, bedrooms, state, featured = listing_values(listing)
+                for key in listing_keys(listing):
+                    bucket = buckets.get(key)
+                    if not bucket:
+                        continue
+                    # search_matches(), unrolled over bucket_entry() tuples
+                    for entry in bucket.values():
+                        min_price, max_price, min_bedrooms, search_state, search_featured, user_id, search = entry
+                        if (
+                            min_price <= price <= max_price
+                            and bedrooms >= min_bedrooms
+                            and (search_state is None or search_state == state)
+                            and (featured or not search_featured)
+                            and user_id != owner_id
+                        ):
+                            matches.append((search, listing))
+        return matches
+
+
+# Saved searches of the first shard, in front of match_listings(); workers
+# for the other shards build their own (see match_saved_searches). Web
+# processes only publish profile changes through it and never build it.
+saved_search_index = SavedSearchIndex(
+    channel=settings.SAVED_SEARCH_MATCHING.get('channel'),
+    poll_interval=settings.SAVED_SEARCH_MATCHING.get('poll_interval', 1.0),
+    rebuild_interval=settings.SAVED_SEARCH_MATCHING.get('rebuild_interval', 3600),
+    shards=settings.SAVED_SEARCH_MATCHING.get('shards', 1),
+)
+
+
+def listing_data(prop):
+    """What matching and the notification need of a PropertyMongoDB"""
+    data = {field: getattr(prop, field) for field in MATCH_FIELDS}
+    data.update(id=prop.id, title=prop.title, owner_id=prop.owner_id)
+    return data
+
+
+def match_listings(listings, index=None, batch_size=None):
+    """
+    Queue a notification for every saved search in ``index`` that
+    ``listings`` match.
+
+    Listings are matched ``batch_size`` at a time; each batch with matches
+    costs one query to drop users deleted since the index was loaded and
+    one bulk INSERT. A search is notified once per listing, however often
+    the listing is updated. Returns the number of matches queued.
+    """
+    index = saved_search_index if index is None else index
+    batch_size = batch_size or settings.SAVED_SEARCH_MATCHING.get('batch_size', 1000)
+    listings = list(listings)
+    if not listings:
+        return 0
+    index.ensure_current()
+
+    total = 0
+    for start in range(0, len(listings), batch_size):
+        matches = index.match(listings[start:start + batch_size])
+        if not matches:
+            continue
+        users = set(User.objects.filter(
+            id__in={search.user_id for search, _ in matches}, is_active=True
+        ).values_list('id', flat=True))
+        notifications = [
+            NotificationOutbox(
+                user_id=search.user_id,
+                kind='saved_search_match',
+                search_id=search.search_id,
+                property_id=listing['id'],
+                payload={
+                    'search_name': search.name,
+                    'title': listing.get('title'),
+                    'price': listing.get('price'),
+                    'city': listing.get('city'),
+                    'status': listing.get('status'),
+                },
+            )
+            for search, listing in matches if search.user_id in users
+        ]
+        NotificationOutbox.objects.bulk_create(notifications, batch_size=batch_size, ignore_conflicts=True)
+        total += len(notifications)
+    return total
+
+
+def process_match_jobs(index=None, batch_size=None):
+    """
+    Match up to ``batch_size`` queued listings of ``index``'s shard and
+    delete their jobs. Returns how many jobs were processed.
+    """
+    index = saved_search_index if index is None else index
+    batch_size = batch_size or settings.SAVED_SEARCH_MATCHING.get('batch_size', 1000)
+    index.ensure_current()
+    with transaction.atomic():
+        jobs = list(ListingMatchJob.objects.filter(shard=index.shard).order_by('id')[:batch_size])
+        if not jobs:
+            return 0
+        match_listings([job.listing for job in jobs], index, batch_size)
+        ListingMatchJob.objects.filter(id__in=[job.id for job in jobs]).delete()
+    return len(jobs)
+
+
+def worker_key(shard):
+    return f'saved_search_worker:{shard}'
+
+
+def record_worker(shard):
+    """Mark ``shard``'s worker as running for the next worker_timeout seconds"""
+    caches[settings.SAVED_SEARCH_MATCHING.get('channel')].set(
+        worker_key(shard), time.time(), settings.SAVED_SEARCH_MATCHING.get('worker_timeout', 60)
+    )
+
+
+def live_shards():
+    """Shards whose worker has checked in within worker_timeout seconds"""
+    shards = max(settings.SAVED_SEARCH_MATCHING.get('shards', 1), 1)
+    running = caches[settings.SAVED_SEARCH_MATCHING.get('channel')].get_many(
+        [worker_key(shard) for shard in range(shards)]
+    )
+    return [shard for shard in range(shards) if worker_key(shard) in running]
+
+
+def prune_match_jobs(shard, max_age=None):
+    """Delete ``shard``'s jobs older than ``max_age`` seconds; returns how many"""
+    max_age = settings.SAVED_SEARCH_MATCHING.get('job_max_age', 3600) if max_age is None else max_age
+    cutoff = timezone.now() - timedelta(seconds=max_age)
+    deleted, _ = ListingMatchJob.objects.filter(shard=shard, created_at__lt=cutoff).delete()
+    return deleted
+
+
+def match_saved_properties(properties, changed_fields=None):
+    """
+    Receiver body for webapp's properties_saved signal.
+
+    Queues the listings for the match_saved_searches workers, one job per
+    shard with a running worker, in one INSERT. The listing is already
+    written when this runs, so a database error is logged instead of
+    failing the write.
+    """
+    if not settings.SAVED_SEARCH_MATCHING.get('enabled', False):
+        return 0
+    if changed_fields is not None and not changed_fields & MATCH_FIELDS:
+        return 0
+    properties = [prop for prop in properties if prop.id]
+    if not properties:
+        return 0
+    jobs = [
+        ListingMatchJob(shard=shard, property_id=prop.id, listing=listing_data(prop))
+        for shard in live_shards()
+        for prop in properties
+    ]
+    if not jobs:
+        return 0
+    try:
+        ListingMatchJob.objects.bulk_create(jobs)
+    except DatabaseError:
+        logger.exception('Queueing saved-search matching failed for %d listing(s)', len(properties))
+        return 0
+    return len(jobs)
@@ -1,6 +1,10 @@
 from rest_framework import serializers
 from django.contrib.auth import authenticate
 from django.contrib.auth.password_validation import validate_password
+from django.contrib.auth.validators import UnicodeUsernameValidator
+from django.db.models import Q
+from datetime import datetime
+from .favorites import LISTING_FIELDS
 from .models import User, UserProfile, FavoriteProperty
 
 class UserRegistrationSerializer(serializers.ModelSerializer):
@@ -18,7 +22,10 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
             'location', 'company_name', 'license_number', 'website'
         ]
         extra_kwargs = {
-            'username': {'required': True},
+            # Uniqueness of email and username is checked in validate() with
+            # one query instead of a query per field
+            'email': {'validators': []},
+            'username': {'required': True, 'validators': [UnicodeUsernameValidator()]},
             'first_name': {'required': True},
             'last_name': {'required': True},
         }
@@ -26,25 +33,25 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
     def validate(self, attrs):
         if attrs['password'] != attrs['password_confirm']:
             raise serializers.ValidationError("Password and confirm password do not match.")
+        
+        errors = {}
+        taken = User.objects.filter(
+            Q(email=attrs['email']) | Q(username=attrs['username'])
+        ).values_list('email', 'username')
+        for email, username in taken:
+            if email == attrs['email']:
+                errors['email'] = ["A user with this email already exists."]
+            if username == attrs['username']:
+                errors['username'] = ["A user with this username already exists."]
+        if errors:
+            raise serializers.ValidationError(errors)
         return attrs
     
-    def validate_email(self, value):
-        if User.objects.filter(email=value).exists():
-            raise serializers.ValidationError("A user with this email already exists.")
-        return value
-    
-    def validate_username(self, value):
-        if User.objects.filter(username=value).exists():
-            raise serializers.ValidationError("A user with this username already exists.")
-        return value
-    
     def create(self, validated_data):
         validated_data.pop('password_confirm')
-        password = validated_data.pop('password')
         
+        # create_user hashes the password, so the user is saved once
         user = User.objects.create_user(**validated_data)
-        user.set_password(password)
-        user.save()
         
         # Create extended profile
         UserProfile.objects.create(user=user)
@@ -153,10 +160,28 @@ class FavoritePropertySerializer(serializers.ModelSerializer):
     """
     Serializer for favorite properties
     """
+    property = serializers.SerializerMethodField()
+    
     class Meta:
         model = FavoriteProperty
-        fields = ['id', 'property_id', 'property_title', 'property_price', 'added_at']
-        read_only_fields = ['id', 'added_at']
+        fields = ['id', 'property_id', 'property_title', 'property_price', 'property', 'added_at']
+        # Title and price are copied from the listing when the favorite is added
+        read_only_fields = ['id', 'property_title', 'property_price', 'added_at']
+    
+    def get_property(self, obj):
+        """
+        The listing as it is now, from the ``listings`` the view loaded for
+        the page; None when it was deleted or not loaded
+        """
+        doc = self.context.get('listings', {}).get(obj.property_id)
+        if doc is None:
+            return None
+        data = {'id': obj.property_id}
+        for field in LISTING_FIELDS:
+            if field in doc:
+                value = doc[field]
+                data[field] = value.isoformat() if isinstance(value, datetime) else value
+        return data
 
 class PublicUserSerializer(serializers.ModelSerializer):
     """
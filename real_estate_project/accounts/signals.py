@@ -0,0 +1,36 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from webapp.mongodb_models import properties_saved
+from .authentication import user_cache
+from .favorites import sync_favorite_snapshots
+from .models import User, UserProfile
+from .owner_cards import invalidate_owner_cards
+from .saved_searches import match_saved_properties, saved_search_index
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_caches(sender, instance, using, update_fields=None, **kwargs):
+    """Drop cached data derived from a user when the user changes"""
+    invalidate_owner_cards(update_fields, using)
+    user_cache.invalidate(instance.pk, using)
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def reindex_saved_searches(sender, instance, signal, **kwargs):
+    """Keep the saved-search index in step with the profile"""
+    saved_searches = instance.saved_searches if signal is post_save else None
+    saved_search_index.user_changed(instance.user_id, saved_searches)
+
+
+@receiver(properties_saved)
+def match_saved_searches(sender, properties, changed_fields=None, **kwargs):
+    """Queue notifications for the saved searches new and updated listings match"""
+    match_saved_properties(properties, changed_fields)
+
+
+@receiver(properties_saved)
+def update_favorite_snapshots(sender, properties, changed_fields=None, created=False, **kwargs):
+    """Copy new titles and prices into the favorites of updated listings"""
+    sync_favorite_snapshots(properties, changed_fields, created)
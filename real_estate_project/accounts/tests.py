@@ -1,3 +1,642 @@
-from django.test import TestCase
+"""
+Query budgets for every endpoint in accounts/urls.py.
 
-# Create your tests here.
+Each test requests an endpoint at every size in DATA_SIZES (existing users,
+favorites of the requesting user) and fails when it runs more SQL queries
+than its budget. Tokens carry the user's permission claims, so
+authentication runs no query until a view reads the rest of the user.
+Favorites are checked against listings in the test MongoDB engine.
+"""
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from bson import ObjectId
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.test import RequestFactory, TestCase, override_settings
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.tokens import RefreshToken
+from api.testing import DATA_SIZES, MongoTestCase, QueryBudgetMixin
+from webapp.mongodb_models import PropertyMongoDB
+from .authentication import CachedJWTAuthentication, ClaimsRefreshToken, user_cache
+from .counters import adjust_profile_counters, reconcile_profile_counters
+from .favorites import refresh_favorite_snapshots
+from .models import FavoriteProperty, ListingMatchJob, NotificationOutbox, User, UserProfile
+from .owner_cards import get_owner_cards, invalidate_owner_cards
+from .saved_searches import SavedSearchIndex, live_shards, process_match_jobs, prune_match_jobs, record_worker, worker_key
+
+PASSWORD = 'secret-pass-123'
+
+
+def make_user(name, user_type='buyer'):
+    user = User.objects.create_user(
+        username=name, email=f'{name}@example.com', password=PASSWORD,
+        first_name=name.title(), last_name='Tester', user_type=user_type
+    )
+    UserProfile.objects.create(user=user)
+    return user
+
+
+# Hashing is what login and registration spend their time on, not what is measured
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class AccountEndpointQueryTests(QueryBudgetMixin, TestCase):
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = make_user('member')
+
+    def setUp(self):
+        super().setUp()
+        self.refresh = ClaimsRefreshToken.for_user(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.refresh.access_token}')
+
+    def grow_users(self, total):
+        existing = User.objects.count()
+        for i in range(existing, total):
+            make_user(f'user{i}')
+
+    def test_register(self):
+        self.client.credentials()
+        for size in DATA_SIZES:
+            with self.subTest(size=size):
+                self.grow_users(size)
+                response = self.client.post('/api/auth/register/', {
+                    'email': f'new{size}@example.com', 'username': f'new{size}',
+                    'password': PASSWORD, 'password_confirm': PASSWORD,
+                    'first_name': 'New', 'last_name': 'Member',
+                }, format='json')
+                self.assertEqual(response.status_code, 201)
+                # One uniqueness check, the user and its profile
+                self.assertQueryBudget(response, sql=3)
+
+    def test_register_taken(self):
+        self.client.credentials()
+        response = self.client.post('/api/auth/register/', {
+            'email': self.user.email, 'username': self.user.username,
+            'password': PASSWORD, 'password_confirm': PASSWORD,
+            'first_name': 'New', 'last_name': 'Member',
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.data), {'email', 'username'})
+        self.assertQueryBudget(response, sql=1)
+
+    def test_login(self):
+        self.client.credentials()
+        for size in DATA_SIZES:
+            with self.subTest(size=size):
+                self.grow_users(size)
+                response = self.client.post('/api/auth/login/', {
+                    'email': self.user.email, 'password': PASSWORD,
+                }, format='json')
+                self.assertEqual(response.status_code, 200)
+                self.assertQueryBudget(response, sql=1)
+
+    def test_logout(self):
+        response = self.client.post('/api/auth/logout/', {}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertQueryBudget(response, sql=0)
+
+    def test_token_refresh(self):
+        self.client.credentials()
+        response = self.client.post('/api/auth/token/refresh/', {'refresh': str(self.refresh)}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertQueryBudget(response, sql=0)
+
+    def test_profile(self):
+        response = self.client.get('/api/auth/profile/')
+        self.assertEqual(response.status_code, 200)
+        # The rest of the user's row, which the claims do not cover
+        self.assertQueryBudget(response, sql=1)
+
+        response = self.client.patch('/api/auth/profile/', {'phone': '+15125550100'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        # The rest of the user's row, the phone uniqueness check and the update
+        self.assertQueryBudget(response, sql=3)
+
+    def test_extended_profile(self):
+        response = self.client.get('/api/auth/profile/extended/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['user']['email'], self.user.email)
+        self.assertQueryBudget(response, sql=2)
+
+        response = self.client.patch('/api/auth/profile/extended/', {'preferences': {'city': 'Austin'}}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertQueryBudget(response, sql=3)
+
+    def test_change_password(self):
+        response = self.client.post('/api/auth/change-password/', {
+            'current_password': PASSWORD, 'new_password': 'another-pass-456',
+            'new_password_confirm': 'another-pass-456',
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertQueryBudget(response, sql=2)
+
+    def test_password_reset(self):
+        self.client.credentials()
+        response = self.client.post('/api/auth/password-reset/', {'email': self.user.email}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertQueryBudget(response, sql=1)
+
+    def test_verify_email(self):
+        self.client.credentials()
+        response = self.client.get('/api/auth/verify-email/', {'token': 'token'})
+        self.assertEqual(response.status_code, 200)
+        self.assertQueryBudget(response, sql=0)
+
+    def test_public_user(self):
+        for size in DATA_SIZES:
+            with self.subTest(size=size):
+                self.grow_users(size)
+                response = self.client.get(f'/api/auth/users/{self.user.id}/')
+                self.assertEqual(response.status_code, 200)
+                self.assertQueryBudget(response, sql=1)
+
+
+class FavoriteEndpointQueryTests(MongoTestCase):
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = make_user('member')
+        cls.owner = make_user('owner', user_type='agent')
+
+    def setUp(self):
+        super().setUp()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {ClaimsRefreshToken.for_user(self.user).access_token}')
+
+    def grow_favorites(self, total):
+        """Favorite listings, each with a stale title and price, until there are ``total``"""
+        property_ids = self.grow_listings(total, [self.owner])
+        favorited = set(self.user.favorites.values_list('property_id', flat=True))
+        FavoriteProperty.objects.bulk_create([
+            FavoriteProperty(
+                user=self.user, property_id=property_id, property_title='Old title',
+                property_price=Decimal('1.00')
+            )
+            for property_id in property_ids if property_id not in favorited
+        ])
+        return list(self.user.favorites.values_list('id', flat=True))
+
+    def test_favorites(self):
+        for size in DATA_SIZES:
+            with self.subTest(size=size):
+                self.grow_favorites(size)
+                response = self.client.get('/api/auth/favorites/', {'page_size': 50})
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(all(item['property']['title'] != 'Old title' for item in response.data['results']))
+                # Authentication, page count and the page; the listings in one $in query
+                self.assertQueryBudget(response, sql=2, mongo=1)
+
+    def test_add_favorite(self):
+        for size in DATA_SIZES:
+            with self.subTest(size=size):
+                self.grow_favorites(size)
+                doc = PropertyMongoDB.get_collection().insert_one({'title': f'Listing {size}', 'price': 250000.5})
+                response = self.client.post('/api/auth/favorites/', {
+                    'property_id': str(doc.inserted_id), 'property_title': 'Ignored', 'property_price': '1.00',
+                }, format='json')
+                self.assertEqual(response.status_code, 201)
+                self.assertEqual(response.data['property_title'], f'Listing {size}')
+                self.assertEqual(response.data['property_price'], '250000.50')
+                # The insert
+                self.assertQueryBudget(response, sql=1, mongo=1)
+
+    def test_add_unknown_favorite(self):
+        response = self.client.post('/api/auth/favorites/', {'property_id': f'{0:024x}'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('property_id', response.data)
+
+    def test_remove_favorite(self):
+        for size in DATA_SIZES:
+            with self.subTest(size=size):
+                ids = self.grow_favorites(size)
+                response = self.client.delete(f'/api/auth/favorites/{ids[0]}/')
+                self.assertEqual(response.status_code, 204)
+                self.assertQueryBudget(response, sql=2, mongo=0)
+
+    def test_bulk_favorites(self):
+        for size in DATA_SIZES:
+            with self.subTest(size=size):
+                self.grow_favorites(size)
+                favorited = list(self.user.favorites.values_list('property_id', flat=True))
+                new_ids = [str(doc.inserted_id) for doc in (
+                    PropertyMongoDB.get_collection().insert_one({'title': f'Listing {size}-{i}', 'price': 1000.0})
+                    for i in range(2)
+                )]
+                response = self.client.post('/api/auth/favorites/bulk/', {
+                    'add': new_ids + favorited[2:3] + [f'{0:024x}'],
+                    'remove': favorited[:2],
+                    'check': new_ids + favorited[:3],
+                }, format='json')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.data['added'], new_ids)
+                self.assertEqual(response.data['removed'], favorited[:2])
+                self.assertEqual(response.data['favorited'], new_ids + favorited[2:3])
+                self.assertEqual(response.data['not_found'], [f'{0:024x}'])
+                # Existing favorites, the insert and the delete
+                self.assertQueryBudget(response, sql=3, mongo=1)
+
+    def test_bulk_favorites_invalid(self):
+        response = self.client.post('/api/auth/favorites/bulk/', {'add': 'not-a-list'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_bulk_favorites_overlap(self):
+        self.grow_favorites(2)
+        favorited = list(self.user.favorites.values_list('property_id', flat=True))
+        response = self.client.post('/api/auth/favorites/bulk/', {
+            'add': favorited, 'remove': favorited[:1],
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['ids'], favorited[:1])
+        # Nothing was changed
+        self.assertEqual(set(self.user.favorites.values_list('property_id', flat=True)), set(favorited))
+
+    def test_refresh_snapshots(self):
+        self.grow_favorites(DATA_SIZES[-1])
+        # Favorited ids, the favorites of the batch and one UPDATE
+        with self.assertNumQueries(3):
+            self.assertEqual(refresh_favorite_snapshots(), DATA_SIZES[-1])
+        self.assertFalse(FavoriteProperty.objects.filter(property_title='Old title').exists())
+        self.assertEqual(refresh_favorite_snapshots(), 0)
+
+    def test_snapshot_follows_listing(self):
+        favorite = FavoriteProperty.objects.get(id=self.grow_favorites(1)[0])
+        prop = PropertyMongoDB.find_by_id(favorite.property_id)
+        prop.price = 345000
+        prop.save()
+        favorite.refresh_from_db()
+        self.assertEqual((favorite.property_title, favorite.property_price), (prop.title, Decimal('345000.00')))
+
+        # Fields a favorite does not copy are not looked up
+        prop.description = 'Updated'
+        with self.assertNumQueries(0):
+            prop.save()
+
+
+class ProfileCounterTests(MongoTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = make_user('owner', user_type='agent')
+        cls.owner.is_verified = True
+        cls.owner.save()
+        cls.other = make_user('other', user_type='agent')
+
+    def counters(self, user):
+        return UserProfile.objects.values_list('properties_posted', 'properties_sold').get(user=user)
+
+    def test_create_update_delete(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {ClaimsRefreshToken.for_user(self.owner).access_token}')
+        response = client.post('/api/properties/', {'title': 'New listing', 'price': 250000}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.counters(self.owner), (1, 0))
+
+        client.patch(f'/api/properties/{response.data["id"]}/', {'status': 'sold'}, format='json')
+        self.assertEqual(self.counters(self.owner), (1, 1))
+
+        client.delete(f'/api/properties/{response.data["id"]}/')
+        self.assertEqual(self.counters(self.owner), (0, 0))
+
+        # Counters never go negative
+        adjust_profile_counters(self.owner.id, properties_posted=-5)
+        self.assertEqual(self.counters(self.owner), (0, 0))
+
+    def test_reconcile(self):
+        ids = self.grow_listings(DATA_SIZES[-1], [self.owner])
+        collection = PropertyMongoDB.get_collection()
+        collection.update_many({}, {'$set': {'status': 'sale'}})
+        collection.update_many({'_id': {'$in': [ObjectId(property_id) for property_id in ids[:3]]}},
+                               {'$set': {'status': 'sold'}})
+        sold = 3
+        UserProfile.objects.filter(user=self.other).update(properties_posted=7, properties_sold=2)
+
+        self.assertEqual(reconcile_profile_counters(dry_run=True), {
+            self.owner.id: {'properties_posted': (0, DATA_SIZES[-1]), 'properties_sold': (0, sold)},
+            self.other.id: {'properties_posted': (7, 0), 'properties_sold': (2, 0)},
+        })
+        self.assertEqual(self.counters(self.other), (7, 2))
+
+        # The aggregation, the profiles and one UPDATE
+        with self.assertNumQueries(2):
+            self.assertEqual(len(reconcile_profile_counters()), 2)
+        self.assertEqual(self.counters(self.owner), (DATA_SIZES[-1], sold))
+        self.assertEqual(self.counters(self.other), (0, 0))
+        self.assertEqual(reconcile_profile_counters(), {})
+
+
+MATCHING = dict(settings.SAVED_SEARCH_MATCHING, enabled=True)
+
+
+@override_settings(SAVED_SEARCH_MATCHING=MATCHING)
+class SavedSearchMatchingTests(MongoTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = make_user('owner', user_type='agent')
+        cls.buyer = make_user('buyer')
+        cls.buyer.profile_extended.saved_searches = [
+            {'id': 'austin', 'name': 'Austin under 400k', 'city': 'austin ', 'status': 'sale', 'max_price': 400000},
+            {'name': 'Big houses', 'property_type': 'house', 'min_bedrooms': 4},
+            'not a search',
+        ]
+        cls.buyer.profile_extended.save()
+        cls.owner.profile_extended.saved_searches = [{'id': 'own', 'city': 'Austin'}]
+        cls.owner.profile_extended.save()
+
+    def listing(self, **fields):
+        fields = dict({
+            'title': 'Listing', 'city': 'Austin', 'state': 'TX', 'status': 'sale', 'property_type': 'condo',
+            'price': 350000.0, 'bedrooms': 2, 'owner_id': str(self.owner.id),
+        }, **fields)
+        return PropertyMongoDB(**fields)
+
+    def setUp(self):
+        super().setUp()
+        # Workers running on both shards the tests use
+        for shard in range(2):
+            record_worker(shard)
+        self.addCleanup(caches[MATCHING['channel']].delete_many, [worker_key(shard) for shard in range(2)])
+
+    def notified(self):
+        # What the worker queues once it has drained the jobs
+        while process_match_jobs():
+            pass
+        return sorted(NotificationOutbox.objects.filter(user=self.buyer).values_list('search_id', 'property_id'))
+
+    def test_queued(self):
+        # The write only queues the listing; matching happens in the worker
+        with self.assertNumQueries(1):
+            prop = self.listing().save()
+        self.assertEqual(list(ListingMatchJob.objects.values_list('property_id', flat=True)), [prop.id])
+        self.assertFalse(NotificationOutbox.objects.exists())
+        self.assertEqual(self.notified(), [('austin', prop.id)])
+        self.assertFalse(ListingMatchJob.objects.exists())
+
+    def test_save(self):
+        prop = self.listing().save()
+        self.assertEqual(self.notified(), [('austin', prop.id)])
+        self.assertEqual(NotificationOutbox.objects.get().payload['search_name'], 'Austin under 400k')
+
+        # Matches are announced once, and only fields the searches test are looked at
+        prop.description = 'Updated'
+        with self.assertNumQueries(0):
+            prop.save()
+        prop.price = 360000.0
+        prop.save()
+        self.assertEqual(len(self.notified()), 1)
+
+        prop.property_type, prop.bedrooms = 'house', 5
+        prop.save()
+        self.assertEqual(len(self.notified()), 2)
+
+    def test_worker(self):
+        prop = self.listing().save()
+        call_command('match_saved_searches', '--once', stdout=StringIO())
+        self.assertFalse(ListingMatchJob.objects.exists())
+        self.assertEqual(list(NotificationOutbox.objects.values_list('property_id', flat=True)), [prop.id])
+
+    def test_no_match(self):
+        self.listing(price=450000.0).save()
+        self.listing(city='Dallas').save()
+        self.listing(is_public=False).save()
+        self.assertEqual(self.notified(), [])
+
+    def test_bulk_save(self):
+        props = [self.listing(price=300000.0 + i * 50000, title=f'Listing {i}') for i in range(4)]
+        PropertyMongoDB.bulk_save(props)
+        self.assertEqual(self.notified(), sorted(('austin', prop.id) for prop in props[:3]))
+
+    def test_bulk_update(self):
+        # Importing a feed again updates listings through their external_id
+        original = self.listing(city='Dallas', external_id='feed-1').save()
+        update = self.listing(external_id='feed-1')
+        self.assertEqual(PropertyMongoDB.bulk_save([update]), [{'status': 'updated'}])
+        self.assertEqual(update.id, original.id)
+        self.assertEqual(self.notified(), [('austin', original.id)])
+
+    def test_profile_change(self):
+        self.listing(city='Denver').save()
+        self.assertEqual(self.notified(), [])
+        profile = UserProfile.objects.get(user=self.buyer)
+        profile.saved_searches = [{'id': 'denver', 'city': 'Denver'}]
+        profile.save()
+        prop = self.listing(city='Denver').save()
+        self.listing().save()
+        self.assertEqual(self.notified(), [('denver', prop.id)])
+
+    def test_index(self):
+        index = SavedSearchIndex()
+        index.load([
+            (1, [{'id': 'wide', 'min_price': 1, 'max_price': 10 ** 9}]),
+            (2, [{'id': 'narrow', 'status': 'rent', 'min_price': 1000, 'max_price': 2000, 'state': 'tx'}]),
+        ])
+        self.assertEqual(len(index), 2)
+        listing = {'status': 'rent', 'price': 1500.0, 'state': 'TX', 'owner_id': '3'}
+        self.assertEqual(sorted(search.search_id for search, _ in index.match([listing])), ['narrow', 'wide'])
+        self.assertEqual([search.search_id for search, _ in index.match([dict(listing, price=2500.0)])], ['wide'])
+
+        index.user_changed(2, None)
+        self.assertEqual(len(index), 1)
+
+    def test_no_worker(self):
+        # Nothing drains the queue without a worker, so nothing is queued
+        caches[MATCHING['channel']].delete(worker_key(0))
+        self.assertEqual(live_shards(), [])
+        for i in range(5):
+            self.listing(title=f'Listing {i}').save()
+        PropertyMongoDB.bulk_save([self.listing(title='Bulk')])
+        self.assertFalse(ListingMatchJob.objects.exists())
+
+        # A worker that stops checking in stops the queueing once worker_timeout passes
+        with override_settings(SAVED_SEARCH_MATCHING=dict(MATCHING, worker_timeout=-1)):
+            record_worker(0)
+        self.listing().save()
+        self.assertFalse(ListingMatchJob.objects.exists())
+
+        record_worker(0)
+        self.listing().save()
+        self.assertEqual(ListingMatchJob.objects.count(), 1)
+
+    @override_settings(SAVED_SEARCH_MATCHING=dict(MATCHING, enabled=False))
+    def test_disabled(self):
+        self.listing().save()
+        self.assertFalse(ListingMatchJob.objects.exists())
+
+    def test_prune(self):
+        self.listing().save()
+        stale = self.listing().save()
+        ListingMatchJob.objects.filter(property_id=stale.id).update(
+            created_at=ListingMatchJob.objects.get(property_id=stale.id).created_at - timedelta(hours=2)
+        )
+        self.assertEqual(prune_match_jobs(1), 0)
+        self.assertEqual(prune_match_jobs(0), 1)
+        self.assertEqual(ListingMatchJob.objects.count(), 1)
+        self.assertEqual(prune_match_jobs(0, max_age=-1), 1)
+        self.assertFalse(ListingMatchJob.objects.exists())
+
+    @override_settings(SAVED_SEARCH_MATCHING=dict(MATCHING, shards=2))
+    def test_shards(self):
+        indexes = [SavedSearchIndex(shard=shard, shards=2) for shard in range(2)]
+        self.listing(property_type='house', bedrooms=5).save()
+        self.assertEqual(ListingMatchJob.objects.count(), 2)
+        for index in indexes:
+            process_match_jobs(index)
+        # Each shard indexes the searches of its own users
+        self.assertEqual(len(indexes[self.buyer.id % 2]), 2)
+        self.assertEqual(len(indexes[self.owner.id % 2]), 1)
+        self.assertEqual(len(self.notified()), 2)
+        self.assertFalse(ListingMatchJob.objects.exists())
+
+    def test_background_rebuild(self):
+        index = SavedSearchIndex()
+        index.ensure_current()
+        self.assertEqual(len(index), 3)
+        # Due again: the old index keeps serving until the new one is loaded
+        index.rebuild_interval = 0
+        index.profiles = lambda: iter([(self.buyer.id, [{'id': 'denver', 'city': 'Denver'}])])
+        index.ensure_current()
+        index._rebuild_thread.join()
+        self.assertEqual(len(index), 1)
+
+class OwnerCardTests(QueryBudgetMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = make_user('owner', user_type='agent')
+
+    def card(self):
+        return get_owner_cards([self.owner.pk])[str(self.owner.pk)]
+
+    def test_cached(self):
+        self.assertEqual(self.card()['bio'], '')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.card()['bio'], '')
+
+    def test_user_saved(self):
+        self.card()
+        self.owner.bio = 'Austin realtor'
+        self.owner.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.card()['bio'], 'Austin realtor')
+
+        # Saves that no card shows keep the cached cards
+        self.owner.save(update_fields=['last_login'])
+        with self.assertNumQueries(0):
+            self.card()
+
+    def test_changed_elsewhere(self):
+        self.card()
+        User.objects.filter(pk=self.owner.pk).update(bio='Changed')
+        # Another process announcing the change through the shared version
+        invalidate_owner_cards()
+        self.assertEqual(self.card()['bio'], 'Changed')
+
+
+class CachedAuthenticationTests(QueryBudgetMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = make_user('member', user_type='agent')
+
+    def authenticate(self, token):
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION=f'Bearer {token.access_token}')
+        user, _ = CachedJWTAuthentication().authenticate(request)
+        return user
+
+    def test_cached_user(self):
+        token = RefreshToken.for_user(self.user)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.authenticate(token), self.user)
+        with self.assertNumQueries(0):
+            user = self.authenticate(token)
+            self.assertEqual(user.email, self.user.email)
+        self.assertEqual(len(user_cache), 1)
+
+    def test_claims(self):
+        with self.assertNumQueries(0):
+            user = self.authenticate(ClaimsRefreshToken.for_user(self.user))
+            self.assertEqual(user.pk, self.user.pk)
+            self.assertFalse(user.is_staff)
+            self.assertFalse(user.can_post_properties)
+        # Anything else loads the rest of the row, once
+        with self.assertNumQueries(1):
+            self.assertEqual((user.email, user.bio, user.phone), (self.user.email, '', ''))
+
+    def test_claims_user(self):
+        with self.assertNumQueries(0):
+            user = self.authenticate(ClaimsRefreshToken.for_user(self.user))
+            self.assertIsInstance(user, User)
+            self.assertEqual(user, self.user)
+            self.assertEqual(hash(user), hash(self.user))
+            self.assertFalse(hasattr(user, 'resolve_expression'))
+            favorites = FavoriteProperty.objects.filter(user=user)
+            favorite = FavoriteProperty(user=user, property_id='p1')
+        self.assertEqual(favorite.user_id, self.user.pk)
+        self.assertFalse(favorites.exists())
+
+        # A write loads the row first, so saving it writes the whole row back
+        with self.assertNumQueries(1):
+            user.first_name = 'Renamed'
+        user.save()
+        saved = User.objects.get(pk=self.user.pk)
+        self.assertEqual((saved.first_name, saved.email), ('Renamed', self.user.email))
+        self.assertGreater(saved.updated_at, self.user.updated_at)
+
+    def test_user_saved(self):
+        plain, claims = RefreshToken.for_user(self.user), ClaimsRefreshToken.for_user(self.user)
+        self.authenticate(plain)
+        user = User.objects.get(pk=self.user.pk)
+        user.is_verified = True
+        user.save()
+        # The claims predate the change, so the row is read again
+        with self.assertNumQueries(1):
+            self.assertTrue(self.authenticate(claims).can_post_properties)
+        with self.assertNumQueries(0):
+            self.assertTrue(self.authenticate(plain).can_post_properties)
+
+        user.is_active = False
+        user.save()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(claims)
+
+    def test_password_changed(self):
+        token = ClaimsRefreshToken.for_user(self.user)
+        user = User.objects.get(pk=self.user.pk)
+        user.set_password('another-pass-456')
+        user.save()
+        with self.assertNumQueries(1):
+            self.assertTrue(self.authenticate(token).check_password('another-pass-456'))
+
+    def test_claims_after_change(self):
+        # Demoted in another process: the claims name an older version
+        token = ClaimsRefreshToken.for_user(self.user)
+        User.objects.filter(pk=self.user.pk).update(is_staff=True)
+        user_cache.invalidate(self.user.pk)
+        with self.assertNumQueries(1):
+            self.assertTrue(self.authenticate(token).is_staff)
+
+    def test_deactivated(self):
+        plain, claims = RefreshToken.for_user(self.user), ClaimsRefreshToken.for_user(self.user)
+        self.authenticate(plain)
+        user = User.objects.get(pk=self.user.pk)
+        user.is_active = False
+        user.save()
+        for token in (plain, claims):
+            with self.assertRaises(AuthenticationFailed):
+                self.authenticate(token)
+
+    def test_version_lost(self):
+        token = ClaimsRefreshToken.for_user(self.user)
+        caches[user_cache.channel].clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.authenticate(token), self.user)
+
+    def test_stale_read(self):
+        version = user_cache.version(self.user.pk)
+        user = User.objects.get(pk=self.user.pk)
+        user_cache.invalidate(self.user.pk)
+        user_cache.set(user, version)
+        with self.assertNumQueries(1):
+            self.authenticate(RefreshToken.for_user(self.user))
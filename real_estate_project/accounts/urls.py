@@ -20,6 +20,7 @@ urlpatterns = [
     
     # Favorite properties
     path('favorites/', views.FavoritePropertyListView.as_view(), name='favorite_properties'),
+    path('favorites/bulk/', views.favorites_bulk, name='favorite_properties_bulk'),
     path('favorites/<int:pk>/', views.FavoritePropertyDetailView.as_view(), name='favorite_property_detail'),
     
     # Public user information
@@ -1,5 +1,6 @@
 from rest_framework import status, generics, permissions
 from rest_framework.decorators import api_view, permission_classes
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
@@ -7,6 +8,9 @@ from django.contrib.auth import authenticate
 from django.core.mail import send_mail
 from django.conf import settings
 
+from webapp.mongodb_models import PropertyMongoDB
+from .authentication import ClaimsRefreshToken
+from .favorites import SNAPSHOT_PROJECTION, get_listings, snapshot_values, update_favorite_ids
 from .models import User, UserProfile, FavoriteProperty
 from .serializers import (
     UserRegistrationSerializer, UserLoginSerializer, UserProfileSerializer,
@@ -28,7 +32,7 @@ class UserRegistrationView(generics.CreateAPIView):
         user = serializer.save()
         
         # Generate JWT tokens
-        refresh = RefreshToken.for_user(user)
+        refresh = ClaimsRefreshToken.for_user(user)
         
         return Response({
             'user': UserProfileSerializer(user).data,
@@ -50,7 +54,7 @@ class UserLoginView(TokenObtainPairView):
         serializer.is_valid(raise_exception=True)
         
         user = serializer.validated_data['user']
-        refresh = RefreshToken.for_user(user)
+        refresh = ClaimsRefreshToken.for_user(user)
         
         return Response({
             'user': UserProfileSerializer(user).data,
@@ -103,8 +107,12 @@ class UserExtendedProfileView(generics.RetrieveUpdateAPIView):
     permission_classes = [permissions.IsAuthenticated]
     
     def get_object(self):
-        profile, created = UserProfile.objects.get_or_create(user=self.request.user)
-        return profile
+        # Profiles are created at registration; the reverse accessor loads it
+        # with its user already attached, so serializing it does not query again
+        try:
+            return self.request.user.profile_extended
+        except UserProfile.DoesNotExist:
+            return UserProfile.objects.create(user=self.request.user)
 
 class FavoritePropertyListView(generics.ListCreateAPIView):
     """
@@ -116,9 +124,30 @@ class FavoritePropertyListView(generics.ListCreateAPIView):
     def get_queryset(self):
         return FavoriteProperty.objects.filter(user=self.request.user)
     
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        favorites = page if page is not None else list(queryset)
+        
+        # Load the current state of every listing on the page at once
+        listings = get_listings(favorite.property_id for favorite in favorites)
+        serializer = self.get_serializer(
+            favorites, many=True, context=dict(self.get_serializer_context(), listings=listings)
+        )
+        if page is not None:
+            return self.get_paginated_response(serializer.data)
+        return Response(serializer.data)
+    
     def perform_create(self, serializer):
-        # TODO: Fetch property details from MongoDB to cache title and price
-        serializer.save(user=self.request.user)
+        # Copy title and price from the listing instead of trusting the client
+        listings = get_listings([serializer.validated_data['property_id']])
+        if not listings:
+            raise ValidationError({'property_id': ['Property not found.']})
+        # Store the id in the canonical form listings are keyed by
+        (property_id, doc), = listings.items()
+        serializer.context['listings'] = listings
+        serializer.save(user=self.request.user, property_id=property_id, **snapshot_values(doc))
+        update_favorite_ids(self.request.user.pk, added=[property_id])
 
 class FavoritePropertyDetailView(generics.DestroyAPIView):
     """
@@ -129,6 +158,72 @@ class FavoritePropertyDetailView(generics.DestroyAPIView):
     
     def get_queryset(self):
         return FavoriteProperty.objects.filter(user=self.request.user)
+    
+    def perform_destroy(self, instance):
+        instance.delete()
+        update_favorite_ids(self.request.user.pk, removed=[instance.property_id])
+
+MAX_BULK_FAVORITES = 500
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def favorites_bulk(request):
+    """
+    Add, remove and check many favorites in one request.
+    
+    Takes ``{"add": [...], "remove": [...], "check": [...]}`` lists of
+    property ids, all optional; an id cannot be both added and removed.
+    Returns the ids actually added and removed, the checked ids that are
+    favorites after the changes, and added ids that match no listing.
+    """
+    id_lists = {}
+    for action in ('add', 'remove', 'check'):
+        ids = request.data.get(action, [])
+        if not isinstance(ids, list) or not all(isinstance(property_id, str) for property_id in ids):
+            return Response({'error': f'"{action}" must be a list of property ids'},
+                          status=status.HTTP_400_BAD_REQUEST)
+        id_lists[action] = list(dict.fromkeys(ids))
+    if sum(len(ids) for ids in id_lists.values()) > MAX_BULK_FAVORITES:
+        return Response({'error': f'At most {MAX_BULK_FAVORITES} property ids per request'},
+                      status=status.HTTP_400_BAD_REQUEST)
+    overlap = set(id_lists['add']) & set(id_lists['remove'])
+    if overlap:
+        return Response({'error': 'Property ids cannot be both added and removed',
+                         'ids': sorted(overlap)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    user = request.user
+    # One query for which of the ids are favorites already
+    existing = set(FavoriteProperty.objects.filter(
+        user=user, property_id__in=set().union(*id_lists.values())
+    ).values_list('property_id', flat=True))
+    
+    # New favorites copy their listing's title and price, like single adds
+    listings = PropertyMongoDB.find_many(
+        [property_id for property_id in id_lists['add'] if property_id not in existing], SNAPSHOT_PROJECTION
+    )
+    added = [property_id for property_id in listings if property_id not in existing]
+    FavoriteProperty.objects.bulk_create([
+        FavoriteProperty(user=user, property_id=property_id, **snapshot_values(listings[property_id]))
+        for property_id in added
+    ], ignore_conflicts=True)
+    
+    removed = [property_id for property_id in id_lists['remove'] if property_id in existing]
+    if removed:
+        FavoriteProperty.objects.filter(user=user, property_id__in=removed).delete()
+    
+    if added or removed:
+        update_favorite_ids(user.pk, added=added, removed=removed)
+    
+    favorited = (existing | set(added)) - set(removed)
+    return Response({
+        'added': added,
+        'removed': removed,
+        'favorited': [property_id for property_id in id_lists['check'] if property_id in favorited],
+        'not_found': [
+            property_id for property_id in id_lists['add']
+            if property_id not in existing and property_id not in listings
+        ],
+    })
 
 @api_view(['POST'])
 @permission_classes([permissions.AllowAny])
@@ -4,3 +4,14 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from pymongo import monitoring
+        from webapp.mongodb_storage import register_command_listener
+        from . import checks  # noqa: F401
+        from .instrumentation import mongo_command_listener
+
+        # Global, so it applies to every MongoClient created from here on
+        monitoring.register(mongo_command_listener)
+        # Commands of the in-process storage engine
+        register_command_listener(mongo_command_listener.record_command)
@@ -0,0 +1,199 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_http_methods
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+from webapp import geo
+from webapp.mongodb_async import AsyncPropertyMongoDB
+from accounts.counters import record_listing_created
+from accounts.favorites import annotate_favorites, get_favorite_state
+from accounts.owner_cards import get_owner_cards, get_owner_cards_version
+from .bulk import build_property
+from .conditional import is_conditional, list_etag, not_modified, property_etag, set_validators
+from .mongodb_views import (
+    build_geo_filters, build_property_filters, document_to_dict, geo_query_errors,
+    get_property_ordering
+)
+from .pagination import MongoCursorPagination
+
+# Async versions of the list, detail and stats endpoints in mongodb_views,
+# for ASGI servers, with the same validators and 304 responses.
+# MongoDB is queried with the native async driver; the few ORM calls left
+# (authentication, owner cards, profile counters) run on a small dedicated
+# thread pool so a slow database cannot tie up an unbounded number of threads.
+orm_executor = ThreadPoolExecutor(
+    max_workers=settings.ASYNC_ORM_MAX_WORKERS,
+    thread_name_prefix='async-orm'
+)
+
+
+def _run_with_connection_cleanup(func, *args):
+    try:
+        return func(*args)
+    finally:
+        # Pool threads never see request_finished, so close connections here
+        close_old_connections()
+
+
+async def run_orm(func, *args):
+    """Run a blocking ORM call on the bounded executor"""
+    return await sync_to_async(
+        _run_with_connection_cleanup, thread_sensitive=False, executor=orm_executor
+    )(func, *args)
+
+
+def authenticate(request):
+    """Resolve the user with the DRF authentication classes the sync views use"""
+    authenticators = [auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES]
+    return Request(request, authenticators=authenticators).user
+
+
+def error_response(exc):
+    """Render a DRF exception the way the DRF views would"""
+    detail = exc.detail if isinstance(exc.detail, (dict, list)) else {'detail': exc.detail}
+    return JsonResponse(detail, status=exc.status_code, safe=False)
+
+
+@csrf_exempt
+@require_http_methods(['GET', 'POST'])
+async def property_list_async(request):
+    """Async version of property_list_mongodb"""
+    try:
+        # CSRF is enforced by SessionAuthentication, as in the DRF views
+        request.user = await run_orm(authenticate, request)
+
+        if request.method == 'POST':
+            return await create_property(request)
+
+        # Same validators as property_list_mongodb
+        favorites = None
+        if request.user.is_authenticated:
+            favorites = await run_orm(get_favorite_state, request.user)
+        etag = list_etag(
+            request, await AsyncPropertyMongoDB.generation(), favorites and favorites['version'],
+            await run_orm(get_owner_cards_version)
+        )
+        response = not_modified(request, etag, vary_on_user=True)
+        if response is not None:
+            return response
+
+        filters = build_property_filters(request.GET)
+
+        # Search functionality, combined with the other filters
+        search = request.GET.get('search')
+        if search:
+            filters.update(AsyncPropertyMongoDB.model.search_filters(search))
+        ordering = get_property_ordering(request.GET, searching=bool(search))
+
+        # Map query modes, also combined with the other filters
+        geo_filters, geo_count_filters, near_point = build_geo_filters(request.GET)
+        if near_point:
+            if search:
+                raise ValidationError({'detail': 'Radius search cannot be combined with text search.'})
+            ordering = MongoCursorPagination.distance_ordering
+        count_filters = dict(filters, **geo_count_filters)
+        filters.update(geo_filters)
+
+        paginator = MongoCursorPagination()
+        with geo_query_errors():
+            documents = await paginator.apaginate(
+                AsyncPropertyMongoDB, filters, ordering, request,
+                projection=AsyncPropertyMongoDB.LIST_PROJECTION, count_filters=count_filters
+            )
+            count = await paginator.aget_count()
+        owner_cards = await run_orm(get_owner_cards, [doc.get('owner_id') for doc in documents])
+    except APIException as e:
+        return error_response(e)
+
+    properties_data = [
+        document_to_dict(doc, include_owner_info=True, request_user=request.user, owner_cards=owner_cards)
+        for doc in documents
+    ]
+    if request.user.is_authenticated:
+        await run_orm(annotate_favorites, request.user, properties_data, favorites)
+
+    if near_point:
+        for doc, data in zip(documents, properties_data):
+            data['distance_km'] = round(geo.haversine_km(*near_point, doc['latitude'], doc['longitude']), 3)
+
+    return set_validators(
+        JsonResponse(paginator.get_paginated_data(properties_data, count)), etag, vary_on_user=True
+    )
+
+
+async def create_property(request):
+    if not request.user.is_authenticated:
+        return JsonResponse({'error': 'Authentication required to create properties'},
+                            status=status.HTTP_401_UNAUTHORIZED)
+
+    if not request.user.can_post_properties:
+        return JsonResponse({
+            'error': 'Only verified sellers and agents can post properties. Please verify your account.'
+        }, status=status.HTTP_403_FORBIDDEN)
+
+    try:
+        data = json.loads(request.body or b'{}')
+        property_obj = build_property(data, request.user)
+        await AsyncPropertyMongoDB.insert(property_obj)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    # Update the owner's property counts
+    await run_orm(record_listing_created, property_obj)
+
+    owner_cards = await run_orm(get_owner_cards, [property_obj.owner_id])
+    data = document_to_dict(property_obj.to_dict(), include_owner_info=True,
+                            request_user=request.user, owner_cards=owner_cards)
+    return JsonResponse(data, status=status.HTTP_201_CREATED)
+
+
+@require_GET
+async def property_detail_async(request, pk):
+    """Async version of the GET branch of property_detail_mongodb"""
+    try:
+        request.user = await run_orm(authenticate, request)
+    except APIException as e:
+        return error_response(e)
+
+    favorites = None
+    if request.user.is_authenticated:
+        favorites = await run_orm(get_favorite_state, request.user)
+    favorites_version = favorites and favorites['version']
+
+    # Same validators as property_detail_mongodb
+    if is_conditional(request):
+        validators = await AsyncPropertyMongoDB.find_validators(pk)
+        if validators:
+            response = not_modified(
+                request, property_etag(validators, favorites_version), validators.get('updated_at'),
+                vary_on_user=True
+            )
+            if response is not None:
+                return response
+
+    property_obj = await AsyncPropertyMongoDB.find_by_id(pk)
+    if not property_obj:
+        return JsonResponse({'error': 'Property not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    owner_cards = await run_orm(get_owner_cards, [property_obj.owner_id])
+    data = document_to_dict(property_obj.to_dict(), include_owner_info=True,
+                            request_user=request.user, owner_cards=owner_cards)
+    if request.user.is_authenticated:
+        await run_orm(annotate_favorites, request.user, [data], favorites)
+    return set_validators(
+        JsonResponse(data), property_etag(property_obj.to_dict(), favorites_version), property_obj.updated_at,
+        vary_on_user=True
+    )
+
+
+@require_GET
+async def property_stats_async(request):
+    """Async version of property_stats_mongodb"""
+    return JsonResponse(await AsyncPropertyMongoDB.stats())
@@ -0,0 +1,189 @@
+from collections import Counter
+from accounts.counters import SOLD_STATUS, adjust_profile_counters
+from accounts.models import User
+from webapp.mongodb_models import PropertyMongoDB
+
+# Most rows accepted by one bulk API request; larger feeds go through
+# manage.py import_properties
+MAX_BULK_ROWS = 1000
+
+TRUE_VALUES = ('true', '1', 'yes', 'on')
+
+# Fields owners may edit, grouped by how incoming values are parsed
+TEXT_FIELDS = (
+    'title', 'description', 'property_type', 'status',
+    'address', 'city', 'state', 'zip_code', 'image'
+)
+NUMBER_FIELDS = {
+    'price': float, 'bedrooms': int, 'bathrooms': int, 'area': int,
+    'latitude': float, 'longitude': float
+}
+BOOLEAN_FIELDS = ('featured', 'is_public')
+
+
+def parse_bool(value, default):
+    """Booleans arrive as JSON booleans or as strings from CSV files"""
+    if value is None or value == '':
+        return default
+    if isinstance(value, str):
+        return value.strip().lower() in TRUE_VALUES
+    return bool(value)
+
+
+def parse_number(data, field, cast, default):
+    value = data.get(field)
+    if value is None or value == '':
+        return default
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{field}: expected a number, got {value!r}')
+
+
+def contact_info_for(user):
+    """Contact details copied onto a listing, honouring the owner's privacy setting"""
+    contact_info = {}
+    if user.show_contact_info:
+        if user.email:
+            contact_info['email'] = user.email
+        if user.phone:
+            contact_info['phone'] = user.phone
+        contact_info['preferred_contact'] = user.preferred_contact
+    return contact_info
+
+
+def build_property(data, owner):
+    """Build an unsaved PropertyMongoDB owned by ``owner`` from request or import data"""
+    external_id = data.get('external_id')
+    return PropertyMongoDB(
+        title=data.get('title', ''),
+        description=data.get('description', ''),
+        property_type=data.get('property_type', 'house'),
+        status=data.get('status', 'sale'),
+        price=parse_number(data, 'price', float, 0.0),
+        bedrooms=parse_number(data, 'bedrooms', int, 0),
+        bathrooms=parse_number(data, 'bathrooms', int, 0),
+        area=parse_number(data, 'area', int, 0),
+        address=data.get('address', ''),
+        city=data.get('city', ''),
+        state=data.get('state', ''),
+        zip_code=data.get('zip_code', ''),
+        latitude=parse_number(data, 'latitude', float, 0.0),
+        longitude=parse_number(data, 'longitude', float, 0.0),
+        image=data.get('image', ''),
+        featured=parse_bool(data.get('featured'), False),
+        owner_id=str(owner.id),
+        created_by_id=str(owner.id),
+        is_public=parse_bool(data.get('is_public'), True),
+        contact_info=contact_info_for(owner),
+        external_id=str(external_id) if external_id not in (None, '') else None
+    )
+
+
+def apply_changes(prop, data):
+    """Copy the editable fields present in ``data`` onto ``prop``"""
+    for field in TEXT_FIELDS:
+        if field in data:
+            setattr(prop, field, data[field])
+    for field, cast in NUMBER_FIELDS.items():
+        if field in data:
+            setattr(prop, field, parse_number(data, field, cast, getattr(prop, field)))
+    for field in BOOLEAN_FIELDS:
+        if field in data:
+            setattr(prop, field, parse_bool(data[field], getattr(prop, field)))
+
+
+def save_rows(rows, default_owner=None, allow_row_owner=False, offset=0):
+    """
+    Validate ``rows`` and write the valid ones with a single bulk_save.
+    
+    Rows belong to ``default_owner`` unless ``allow_row_owner`` is set and the
+    row names an ``owner_id``. ``offset`` is added to the reported row indexes
+    so batches of a larger import report positions in the whole file.
+    
+    Returns ``(report, counter_deltas)``; the caller applies the owner
+    counters with ``apply_counter_deltas`` once it is done.
+    """
+    owners = {}
+    if allow_row_owner:
+        owner_ids = {
+            str(row['owner_id']) for row in rows
+            if isinstance(row, dict) and str(row.get('owner_id') or '').isdigit()
+        }
+        owners = {str(pk): user for pk, user in User.objects.in_bulk([int(pk) for pk in owner_ids]).items()}
+    
+    errors = []
+    properties = []
+    positions = []
+    for index, row in enumerate(rows, start=offset):
+        if not isinstance(row, dict):
+            errors.append({'index': index, 'error': 'Expected an object.'})
+            continue
+        
+        owner = default_owner
+        if allow_row_owner and row.get('owner_id'):
+            owner = owners.get(str(row['owner_id']))
+        if owner is None or not owner.can_post_properties:
+            errors.append({'index': index, 'error': 'Owner cannot post properties.'})
+            continue
+        
+        try:
+            properties.append(build_property(row, owner))
+            positions.append(index)
+        except ValueError as e:
+            errors.append({'index': index, 'error': str(e)})
+    
+    # Upserts overwrite the status; read it first so moves to and from
+    # 'sold' reach properties_sold
+    statuses = upserted_statuses(properties)
+    counter_deltas = {}
+    created = updated = 0
+    for index, prop, result in zip(positions, properties, PropertyMongoDB.bulk_save(properties)):
+        if result['status'] == 'error':
+            errors.append({'index': index, 'error': result['error']})
+            continue
+        deltas = counter_deltas.setdefault(prop.owner_id, Counter())
+        key = (prop.owner_id, prop.external_id)
+        is_sold = prop.status == SOLD_STATUS
+        if result['status'] == 'created':
+            created += 1
+            deltas['properties_posted'] += 1
+            deltas['properties_sold'] += int(is_sold)
+        else:
+            updated += 1
+            if key in statuses and (statuses[key] == SOLD_STATUS) != is_sold:
+                deltas['properties_sold'] += 1 if is_sold else -1
+        if prop.external_id:
+            # A later row with the same external_id updates this one
+            statuses[key] = prop.status
+    
+    errors.sort(key=lambda error: error['index'])
+    report = {
+        'received': len(rows),
+        'created': created,
+        'updated': updated,
+        'failed': len(errors),
+        'errors': errors,
+    }
+    return report, counter_deltas
+
+
+def upserted_statuses(properties):
+    """``{(owner_id, external_id): status}`` of the stored listings ``properties`` will upsert"""
+    external_ids = {}
+    for prop in properties:
+        if prop.external_id:
+            external_ids.setdefault(prop.owner_id, set()).add(prop.external_id)
+    if not external_ids:
+        return {}
+    filters = {'$or': [
+        {'owner_id': owner_id, 'external_id': {'$in': sorted(ids)}} for owner_id, ids in external_ids.items()
+    ]}
+    documents = PropertyMongoDB.find_documents(filters, projection={'owner_id': 1, 'external_id': 1, 'status': 1})
+    return {(doc['owner_id'], doc['external_id']): doc.get('status') for doc in documents}
+
+
+def apply_counter_deltas(counter_deltas):
+    """Add new and newly sold listings to each owner's profile counters, one UPDATE per owner"""
+    for owner_id, deltas in counter_deltas.items():
+        adjust_profile_counters(owner_id, **deltas)
@@ -0,0 +1,26 @@
+import os
+import tempfile
+from django.core.checks import Error, register
+from .metrics import get_config
+
+
+@register('metrics', deploy=True)
+def check_metrics_directory(app_configs, **kwargs):
+    """
+    Require METRICS['directory'] outside the temporary directory in production.
+    
+    Without it every worker reports only its own requests; under /tmp the
+    files can be cleaned away, or shared with another deployment.
+    """
+    config = get_config()
+    if not config['enabled']:
+        return []
+    directory = config['directory']
+    temporary = os.path.realpath(tempfile.gettempdir())
+    if directory and os.path.commonpath([os.path.realpath(directory), temporary]) != temporary:
+        return []
+    return [Error(
+        'METRICS["directory"] is not set to a directory of this deployment.',
+        hint='Set METRICS_DIR to a directory the workers share, or METRICS_ENABLED=0.',
+        id='api.E001',
+    )]
@@ -0,0 +1,64 @@
+import hashlib
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+
+
+def _digest(*parts):
+    return hashlib.md5(':'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def property_etag(doc, favorites_version=None):
+    """
+    Strong validator for one property document.
+    
+    Every save changes ``updated_at`` and ``version``, so the tag changes
+    whenever the stored document does. Responses carrying the user's
+    ``is_favorited`` flag also pass the version of their favorites.
+    """
+    updated_at = doc.get('updated_at')
+    parts = [doc['_id'], updated_at.isoformat() if updated_at else '', doc.get('version', 0)]
+    if favorites_version is not None:
+        parts.append(favorites_version)
+    return '"%s"' % _digest(*parts)
+
+
+def list_etag(request, generation, favorites_version=None, owner_cards_version=None):
+    """
+    Weak validator for a page of the property list.
+    
+    Covers the query string, the requesting user (owners and staff see extra
+    fields, and their own ``is_favorited`` flags, hence ``favorites_version``),
+    the owner cards shown on each listing (``owner_cards_version``) and the
+    collection ``generation``, which every write through PropertyMongoDB
+    moves on. All of them come from caches, so checking a client's copy
+    costs no MongoDB query.
+    """
+    user_id = request.user.pk if request.user.is_authenticated else ''
+    return 'W/"%s"' % _digest(
+        request.get_full_path(), user_id, generation,
+        '' if favorites_version is None else favorites_version, owner_cards_version or ''
+    )
+
+
+def is_conditional(request):
+    return 'HTTP_IF_NONE_MATCH' in request.META or 'HTTP_IF_MODIFIED_SINCE' in request.META
+
+
+def not_modified(request, etag, last_modified=None, vary_on_user=False):
+    """Return a 304 response when the client's copy is still current, otherwise None"""
+    # HTTP dates have one-second resolution
+    response = get_conditional_response(
+        request, etag=etag, last_modified=int(last_modified.timestamp()) if last_modified else None
+    )
+    if response is not None:
+        set_validators(response, etag, last_modified, vary_on_user)
+    return response
+
+
+def set_validators(response, etag, last_modified=None, vary_on_user=False):
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    if vary_on_user:
+        patch_vary_headers(response, ('Authorization', 'Cookie'))
+    return response
@@ -0,0 +1,326 @@
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from django.conf import settings
+from pymongo import monitoring
+
+logger = logging.getLogger('api.instrumentation')
+
+# Profile of the request being handled in the current thread or task
+current_profile = ContextVar('request_profile', default=None)
+
+# Driver bookkeeping sent with every command; not part of what was asked
+DRIVER_FIELDS = ('lsid', '$db', '$clusterTime', '$readPreference', 'txnNumber', 'readConcern', 'writeConcern')
+
+# Commands that explain() accepts and PropertyMongoDB issues
+EXPLAINABLE_COMMANDS = ('find', 'aggregate', 'count', 'distinct')
+
+
+def get_config():
+    config = {
+        'enabled': True,
+        'server_timing': False,
+        'slow_query_ms': 100,
+        'explain_slow_queries': False,
+        'explain_collections': ('properties',),
+        'explain_backlog': 100,
+        'slowest': 5,
+        'log_sql_params': False,
+    }
+    config.update(getattr(settings, 'REQUEST_INSTRUMENTATION', {}))
+    return config
+
+
+class QueryStats:
+    """Count, total time and slowest operations against one store"""
+
+    def __init__(self, keep):
+        self.keep = keep
+        self.count = 0
+        self.errors = 0
+        self.duration_ms = 0.0
+        self.slowest = []
+
+    def record(self, duration_ms, description, failed=False):
+        self.count += 1
+        self.duration_ms += duration_ms
+        if failed:
+            self.errors += 1
+        if len(self.slowest) < self.keep or duration_ms > self.slowest[-1][0]:
+            self.slowest.append((duration_ms, description))
+            self.slowest.sort(key=lambda item: item[0], reverse=True)
+            del self.slowest[self.keep:]
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'duration_ms': round(self.duration_ms, 3),
+            'slowest': [
+                {'duration_ms': round(duration_ms, 3), 'operation': description}
+                for duration_ms, description in self.slowest
+            ],
+        }
+
+
+class RequestProfile:
+    """Timings collected while one request is handled"""
+
+    def __init__(self, config):
+        self.config = config
+        self.started = time.perf_counter()
+        self.route = None
+        self.view_started = None
+        self.view_finished = None
+        self.mongo = QueryStats(config['slowest'])
+        self.sql = QueryStats(config['slowest'])
+        self.slow_queries = []
+        self._pending = {}
+
+    @property
+    def slow_query_ms(self):
+        return self.config['slow_query_ms']
+
+    def breakdown(self):
+        """Split the request time into database, view code and rendering, in ms"""
+        total = (time.perf_counter() - self.started) * 1000
+        render = 0.0
+        view = total
+        if self.view_started is not None:
+            finished = self.view_finished or time.perf_counter()
+            view = (finished - self.view_started) * 1000
+            if self.view_finished is not None:
+                render = (time.perf_counter() - self.view_finished) * 1000
+        return {
+            'total': total,
+            'mongo': self.mongo.duration_ms,
+            'sql': self.sql.duration_ms,
+            # Database time is spent inside the view, so it is taken out here
+            'app': max(view - self.mongo.duration_ms - self.sql.duration_ms, 0.0),
+            'render': render,
+        }
+
+    def server_timing(self):
+        timings = self.breakdown()
+        return ', '.join([
+            f'mongo;dur={timings["mongo"]:.1f};desc="{self.mongo.count} commands"',
+            f'sql;dur={timings["sql"]:.1f};desc="{self.sql.count} queries"',
+            f'app;dur={timings["app"]:.1f}',
+            f'render;dur={timings["render"]:.1f}',
+            f'total;dur={timings["total"]:.1f}',
+        ])
+
+    def as_dict(self):
+        return {
+            'route': self.route,
+            'timings_ms': {name: round(value, 3) for name, value in self.breakdown().items()},
+            'mongo': self.mongo.as_dict(),
+            'sql': self.sql.as_dict(),
+            'slow_queries': self.slow_queries,
+        }
+
+
+def describe_command(command_name, collection, command):
+    """Short description of a MongoDB command for the slowest-operations list"""
+    description = f'{command_name} {collection}'
+    query = command.get('filter', command.get('query'))
+    if query:
+        description += f' {query}'
+    elif command_name == 'aggregate':
+        description += f' {[next(iter(stage)) for stage in command.get("pipeline", [])]}'
+    return description
+
+
+def explainable(command):
+    """Strip the driver fields from a command so it can be sent to explain"""
+    return {key: value for key, value in command.items() if key not in DRIVER_FIELDS}
+
+
+def summarize_plan(plan):
+    """Render a winning plan as a chain of stages, e.g. LIMIT > FETCH > IXSCAN(price_id)"""
+    stages = []
+    while plan:
+        stage = plan.get('stage', '?')
+        if plan.get('indexName'):
+            stage += f'({plan["indexName"]})'
+        stages.append(stage)
+        # Only the first branch of OR / SORT_MERGE plans is followed
+        plan = plan.get('inputStage') or (plan.get('inputStages') or [None])[0]
+    return ' > '.join(stages)
+
+
+def find_winning_plan(explained):
+    """Winning plan of a find or aggregate explain output"""
+    if 'queryPlanner' in explained:
+        return explained['queryPlanner'].get('winningPlan', {})
+    for stage in explained.get('stages', []):
+        if '$cursor' in stage:
+            return stage['$cursor'].get('queryPlanner', {}).get('winningPlan', {})
+    return {}
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """
+    Records each MongoDB command against the profile of the current request.
+
+    Registered globally, so it sees commands from every client created after
+    startup. Outside a profiled request it returns immediately. Storage
+    engines without a driver report their commands through record_command()
+    (see webapp/mongodb_storage.py).
+    """
+
+    def started(self, event):
+        profile = current_profile.get()
+        if profile is None:
+            return
+        command = event.command
+        profile._pending[event.request_id] = (
+            event.command_name, command.get(event.command_name), command, event.database_name
+        )
+
+    def succeeded(self, event):
+        self.record(event)
+
+    def failed(self, event):
+        self.record(event, failed=True)
+
+    def record(self, event, failed=False):
+        profile = current_profile.get()
+        if profile is None:
+            return
+        pending = profile._pending.pop(event.request_id, None)
+        if pending is None:
+            return
+        command_name, collection, command, database_name = pending
+        self.record_command(command_name, collection, command, event.duration_micros / 1000, failed, database_name)
+
+    def record_command(self, command_name, collection, command, duration_ms, failed=False, database_name=None):
+        """Record one command; slow ones are only explained when ``database_name`` is on a server"""
+        profile = current_profile.get()
+        if profile is None:
+            return
+        profile.mongo.record(duration_ms, describe_command(command_name, collection, command), failed)
+
+        if duration_ms >= profile.slow_query_ms:
+            slow_query = {
+                'store': 'mongo',
+                'duration_ms': round(duration_ms, 3),
+                'command': command_name,
+                'collection': collection,
+                'filter': command.get('filter', command.get('query')),
+            }
+            if command_name == 'aggregate':
+                slow_query['pipeline'] = command.get('pipeline')
+            profile.slow_queries.append(slow_query)
+            if (database_name is not None and command_name in EXPLAINABLE_COMMANDS and
+                    collection in profile.config['explain_collections']):
+                # explain() runs once the response is ready, not from inside
+                # the driver's callback
+                slow_query['_explain'] = (database_name, explainable(command))
+
+
+def explain_slow_queries(slow_queries):
+    """Attach the winning plan to each slow MongoDB query that can be explained"""
+    from webapp.mongodb_models import MongoDBConnection
+
+    for slow_query in slow_queries:
+        target = slow_query.pop('_explain', None)
+        if target is None:
+            continue
+        database_name, command = target
+        try:
+            explained = MongoDBConnection().get_client()[database_name].command(
+                {'explain': command, 'verbosity': 'queryPlanner'}
+            )
+            slow_query['plan'] = summarize_plan(find_winning_plan(explained))
+        except Exception as e:
+            slow_query['plan'] = f'explain failed: {e.__class__.__name__}'
+
+
+def log_slow_queries(slow_queries):
+    for slow_query in slow_queries:
+        slow_query.pop('_explain', None)
+        logger.warning(json.dumps(slow_query, default=str))
+
+
+class SlowQueryExplainer:
+    """
+    Explains slow queries on a background thread and logs them with their plan.
+
+    explain() is a round trip to the server per query, so it never runs on
+    the request path. At most ``backlog`` requests wait to be explained;
+    beyond that slow queries are logged straight away without a plan.
+    """
+
+    def __init__(self, backlog):
+        self.slots = threading.BoundedSemaphore(backlog)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='explain')
+
+    def submit(self, slow_queries):
+        if not self.slots.acquire(blocking=False):
+            log_slow_queries(slow_queries)
+            return None
+        return self.executor.submit(self.run, slow_queries)
+
+    def run(self, slow_queries):
+        from django.db import close_old_connections
+
+        try:
+            explain_slow_queries(slow_queries)
+            log_slow_queries(slow_queries)
+        except Exception:
+            logger.exception('Could not explain slow queries')
+        finally:
+            self.slots.release()
+            close_old_connections()
+
+
+_explainer = None
+_explainer_lock = threading.Lock()
+
+
+def get_explainer(config):
+    global _explainer
+    with _explainer_lock:
+        if _explainer is None:
+            _explainer = SlowQueryExplainer(config['explain_backlog'])
+        return _explainer
+
+
+def sql_execute_wrapper(execute, sql, params, many, context):
+    """connection.execute_wrapper() hook timing each SQL query of the request"""
+    profile = current_profile.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+
+    started = time.perf_counter()
+    failed = False
+    try:
+        return execute(sql, params, many, context)
+    except Exception:
+        failed = True
+        raise
+    finally:
+        duration_ms = (time.perf_counter() - started) * 1000
+        profile.sql.record(duration_ms, sql, failed)
+        if duration_ms >= profile.slow_query_ms:
+            slow_query = {
+                'store': 'sql',
+                'duration_ms': round(duration_ms, 3),
+                'sql': sql,
+            }
+            if not many:
+                params = list(params or [])
+                # Values can be passwords, tokens or personal data; they are
+                # only written out when asked for
+                slow_query['param_count'] = len(params)
+                slow_query['param_types'] = [type(param).__name__ for param in params][:20]
+                if profile.config['log_sql_params']:
+                    slow_query['params'] = [str(param) for param in params][:20]
+            profile.slow_queries.append(slow_query)
+
+
+mongo_command_listener = MongoCommandListener()
@@ -0,0 +1,98 @@
+import asyncio
+import random
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, Client
+from django.test.utils import override_settings
+from webapp.mongodb_async import AsyncMongoDBConnection
+from webapp.mongodb_storage import get_engine
+from .benchmark_read_path import Command as ReadPathBenchmark
+
+
+class Command(BaseCommand):
+    help = 'Compare throughput and latency of the sync (WSGI) and async (ASGI) property endpoints under concurrent load'
+
+    requires_system_checks = []
+
+    # Sync endpoint and its async twin
+    ENDPOINTS = {
+        'list': ('/api/properties/?page_size=24', '/api/async/properties/?page_size=24'),
+        'stats': ('/api/stats/', '/api/async/stats/'),
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=5000, help='Listings seeded into the scratch database')
+        parser.add_argument('--requests', type=int, default=500, help='Requests sent per run')
+        parser.add_argument('--concurrency', type=int, default=50, help='Requests in flight at once')
+        parser.add_argument('--wsgi-threads', type=int, default=8,
+                            help='Worker threads serving the WSGI path, as in one gunicorn gthread worker')
+        parser.add_argument('--endpoint', choices=sorted(self.ENDPOINTS), default='list')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--keep', action='store_true', help='Keep the scratch database afterwards')
+
+    def handle(self, *args, **options):
+        # Same scratch database as benchmark_read_path, so real listings are untouched
+        scratch_db = settings.MONGODB_SETTINGS['db'] + '_benchmark'
+        mongo_settings = dict(settings.MONGODB_SETTINGS, db=scratch_db)
+        allowed_hosts = list(settings.ALLOWED_HOSTS) + ['testserver']
+
+        with override_settings(MONGODB_SETTINGS=mongo_settings, ALLOWED_HOSTS=allowed_hosts):
+            try:
+                ReadPathBenchmark().seed(options['rows'], random.Random(options['seed']))
+                sync_path, async_path = self.ENDPOINTS[options['endpoint']]
+
+                self.report(
+                    f'WSGI, {options["wsgi_threads"]} threads',
+                    *self.run_wsgi(sync_path, options['requests'], options['wsgi_threads'])
+                )
+                self.report(
+                    f'ASGI, {options["concurrency"]} in flight',
+                    *asyncio.run(self.run_asgi(async_path, options['requests'], options['concurrency']))
+                )
+            finally:
+                if not options['keep']:
+                    get_engine().drop_database(scratch_db)
+
+    def run_wsgi(self, path, requests, threads):
+        # Requests beyond the thread count queue up, as they would in front
+        # of a WSGI worker, and that wait is part of their latency
+        def timed_request(queued_at):
+            status_code = Client().get(path).status_code
+            return time.perf_counter() - queued_at, status_code
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = [executor.submit(timed_request, time.perf_counter()) for _ in range(requests)]
+            results = [future.result() for future in futures]
+        return results, time.perf_counter() - start
+
+    async def run_asgi(self, path, requests, concurrency):
+        client = AsyncClient()
+        slots = asyncio.Semaphore(concurrency)
+
+        async def timed_request():
+            queued_at = time.perf_counter()
+            async with slots:
+                response = await client.get(path)
+            return time.perf_counter() - queued_at, response.status_code
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(timed_request() for _ in range(requests)))
+        elapsed = time.perf_counter() - start
+        # The async client is bound to this event loop, which ends with the run
+        if get_engine().name == 'mongo':
+            await AsyncMongoDBConnection.get_client().close()
+        return results, elapsed
+
+    def report(self, label, results, elapsed):
+        latencies = sorted(latency * 1000 for latency, _ in results)
+        failed = sum(1 for _, status_code in results if status_code != 200)
+        percentiles = statistics.quantiles(latencies, n=100)
+        self.stdout.write(
+            f'{label:24} {len(results) / elapsed:8.1f} req/s   '
+            f'p50 {percentiles[49]:7.1f} ms   p95 {percentiles[94]:7.1f} ms   '
+            f'p99 {percentiles[98]:7.1f} ms   failed {failed}'
+        )
@@ -0,0 +1,90 @@
+import random
+import statistics
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from webapp.mongodb_models import PropertyMongoDB
+from webapp.mongodb_storage import get_engine
+from api.mongodb_views import document_to_dict, property_to_dict
+
+
+class Command(BaseCommand):
+    help = 'Compare time and memory of the model and raw-document read paths for property lists'
+    
+    requires_system_checks = []
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000, help='Rows read per run')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per path')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--keep', action='store_true', help='Keep the scratch database afterwards')
+    
+    def handle(self, *args, **options):
+        # Run against a scratch database so PropertyMongoDB reads seeded data
+        # without touching real listings
+        scratch_db = settings.MONGODB_SETTINGS['db'] + '_benchmark'
+        mongo_settings = dict(settings.MONGODB_SETTINGS, db=scratch_db)
+        
+        with override_settings(MONGODB_SETTINGS=mongo_settings):
+            try:
+                self.seed(options['rows'], random.Random(options['seed']))
+                rows = options['rows']
+                
+                self.run_path('model objects, all fields', self.model_path, rows, options['repeat'])
+                self.run_path('raw documents, list projection', self.raw_path, rows, options['repeat'])
+            finally:
+                if not options['keep']:
+                    get_engine().drop_database(scratch_db)
+    
+    def model_path(self, rows):
+        return [property_to_dict(prop) for prop in PropertyMongoDB.find_all(limit=rows)]
+    
+    def raw_path(self, rows):
+        return [
+            document_to_dict(doc)
+            for doc in PropertyMongoDB.find_documents(limit=rows, projection=PropertyMongoDB.LIST_PROJECTION)
+        ]
+    
+    def run_path(self, label, path, rows, repeat):
+        timings = []
+        peaks = []
+        for _ in range(repeat):
+            tracemalloc.start()
+            start = time.perf_counter()
+            path(rows)
+            timings.append((time.perf_counter() - start) * 1000)
+            peaks.append(tracemalloc.get_traced_memory()[1] / (1024 * 1024))
+            tracemalloc.stop()
+        
+        self.stdout.write(
+            f'{label:32} median {statistics.median(timings):8.1f} ms   '
+            f'peak memory {statistics.median(peaks):7.1f} MiB   per {rows} rows'
+        )
+    
+    def seed(self, rows, rng):
+        collection = PropertyMongoDB.get_collection()
+        collection.drop()
+        now = datetime.now()
+        collection.insert_many([
+            dict(PropertyMongoDB(
+                title=f'Listing {i}',
+                description=' '.join(rng.choice(['bright', 'quiet', 'spacious', 'renovated']) for _ in range(120)),
+                price=round(rng.uniform(50000, 2000000), -3),
+                bedrooms=rng.randint(0, 6),
+                bathrooms=rng.randint(1, 4),
+                area=rng.randint(300, 6000),
+                city='Austin',
+                state='TX',
+                latitude=rng.uniform(30.1, 30.5),
+                longitude=rng.uniform(-97.9, -97.5),
+                owner_id=str(rng.randint(1, 500)),
+                created_by_id=str(rng.randint(1, 500)),
+                contact_info={'email': 'agent@example.com', 'phone': '+15125550100'},
+                created_at=now - timedelta(minutes=i),
+                updated_at=now - timedelta(minutes=i),
+            ).to_dict())
+            for i in range(rows)
+        ])
@@ -0,0 +1,84 @@
+import csv
+import json
+import sys
+from collections import Counter
+from itertools import islice
+from django.core.management.base import BaseCommand, CommandError
+from accounts.models import User
+from api.bulk import apply_counter_deltas, save_rows
+
+
+class Command(BaseCommand):
+    help = 'Stream properties from a CSV or NDJSON file into MongoDB in fixed-size batches'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV or NDJSON file, or "-" for stdin')
+        parser.add_argument('--format', choices=['csv', 'ndjson'],
+                            help='Input format (default: from the file extension)')
+        parser.add_argument('--owner', help='Email of the user who owns rows without an owner_id column')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per bulk write')
+        parser.add_argument('--errors-file', help='Write rejected rows as NDJSON here instead of stderr')
+    
+    def handle(self, *args, **options):
+        input_format = options['format'] or ('csv' if options['path'].endswith('.csv') else 'ndjson')
+        
+        default_owner = None
+        if options['owner']:
+            try:
+                default_owner = User.objects.get(email=options['owner'])
+            except User.DoesNotExist:
+                raise CommandError(f'No user with email {options["owner"]}')
+        
+        errors_out = open(options['errors_file'], 'w') if options['errors_file'] else sys.stderr
+        stream = sys.stdin if options['path'] == '-' else open(options['path'], newline='', encoding='utf-8')
+        
+        totals = {'received': 0, 'created': 0, 'updated': 0, 'failed': 0}
+        counter_deltas = {}
+        try:
+            rows = self.read_rows(stream, input_format)
+            while True:
+                # Only one batch is held in memory at a time
+                batch = list(islice(rows, options['batch_size']))
+                if not batch:
+                    break
+                
+                report, deltas = save_rows(
+                    batch, default_owner=default_owner, allow_row_owner=True, offset=totals['received']
+                )
+                for key in totals:
+                    totals[key] += report[key]
+                for owner_id, owner_deltas in deltas.items():
+                    counter_deltas.setdefault(owner_id, Counter()).update(owner_deltas)
+                for error in report['errors']:
+                    errors_out.write(json.dumps(error) + '\n')
+                
+                self.stdout.write(
+                    f'{totals["received"]} rows: {totals["created"]} created, '
+                    f'{totals["updated"]} updated, {totals["failed"]} failed'
+                )
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+            if errors_out is not sys.stderr:
+                errors_out.close()
+        
+        # Profile counters are bumped once per owner for the whole import
+        apply_counter_deltas(counter_deltas)
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {totals["created"] + totals["updated"]} of {totals["received"]} rows'
+        ))
+    
+    def read_rows(self, stream, input_format):
+        if input_format == 'csv':
+            yield from csv.DictReader(stream)
+            return
+        
+        for line in stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # Reported by save_rows as a row that is not an object
+                yield None
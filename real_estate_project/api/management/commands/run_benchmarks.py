@@ -0,0 +1,220 @@
+import json
+import random
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.test.utils import override_settings, setup_databases, teardown_databases
+from accounts.authentication import ClaimsRefreshToken
+from accounts.models import FavoriteProperty, User
+from api import seeding
+from webapp.mongodb_cache import property_cache
+from webapp.mongodb_indexes import PROPERTY_INDEXES, create_index
+from webapp.mongodb_models import PropertyMongoDB
+from webapp.mongodb_storage import get_engine
+
+# Search box queries, matching words the seeder puts in titles and descriptions
+SEARCH_TERMS = ('pool', 'renovated', 'city views', 'Denver', 'hardwood floors', 'Spacious condo')
+
+
+class Command(BaseCommand):
+    help = 'Seed listings at several sizes and measure latency and throughput of the main endpoints'
+
+    requires_system_checks = []
+
+    SCENARIOS = ('list', 'search', 'detail', 'stats', 'login', 'favorites')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10000,100000,1000000',
+                            help='Comma-separated listing counts to seed and measure')
+        parser.add_argument('--requests', type=int, default=200, help='Requests sent per scenario')
+        parser.add_argument('--concurrency', type=int, default=8, help='Requests in flight at once')
+        parser.add_argument('--scenario', action='append', choices=self.SCENARIOS,
+                            help='Scenario to run; repeat for several (default: all)')
+        parser.add_argument('--backend', choices=('mongo', 'memory'),
+                            help='Storage engine to run against (default: MONGODB_SETTINGS["engine"])')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--compare', help='Results JSON of an earlier run to compare against')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Allowed p95 slowdown against --compare before a scenario is flagged')
+        parser.add_argument('--keep', action='store_true', help='Keep the scratch database afterwards')
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError('--sizes must be comma-separated integers')
+        scenarios = options['scenario'] or list(self.SCENARIOS)
+        baseline = self.load(options['compare']) if options['compare'] else None
+
+        # Seeded users live in a throwaway SQL database, listings in a scratch
+        # Mongo database, so real data is untouched
+        scratch_db = settings.MONGODB_SETTINGS['db'] + '_benchmark'
+        backend = options['backend'] or settings.MONGODB_SETTINGS.get('engine', 'mongo')
+        mongo_settings = dict(settings.MONGODB_SETTINGS, db=scratch_db, engine=backend)
+        allowed_hosts = list(settings.ALLOWED_HOSTS) + ['testserver']
+
+        results = {'backend': backend, 'concurrency': options['concurrency'], 'sizes': {}}
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            with override_settings(MONGODB_SETTINGS=mongo_settings, ALLOWED_HOSTS=allowed_hosts):
+                try:
+                    for size in sizes:
+                        self.stdout.write(f'\n{size} listings ({backend})')
+                        results['sizes'][str(size)] = self.run_size(
+                            size, scenarios, options['requests'], options['concurrency'],
+                            random.Random(options['seed'])
+                        )
+                finally:
+                    if not options['keep']:
+                        get_engine().drop_database(scratch_db)
+                    property_cache.clear()
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f'\nResults written to {options["output"]}')
+        if baseline is not None:
+            self.compare(results, baseline, options['tolerance'])
+
+    def load(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            raise CommandError(f'Cannot read {path}: {e}')
+
+    def run_size(self, size, scenarios, requests, concurrency, rng):
+        collection = PropertyMongoDB.get_collection()
+        collection.drop()
+        seeding.clear()
+        property_cache.clear()
+
+        start = time.perf_counter()
+        created = seeding.seed(size, seed=rng.randint(0, 2 ** 32))
+        for spec in PROPERTY_INDEXES:
+            create_index(collection, spec)
+        seed_seconds = time.perf_counter() - start
+        self.stdout.write(
+            f'  seeded {created["properties"]} listings, {created["users"]} users and '
+            f'{created["favorites"]} favorites in {seed_seconds:.1f} s ({size / seed_seconds:.0f} listings/s)'
+        )
+
+        fixtures = self.fixtures(rng)
+        measured = {'seed_seconds': round(seed_seconds, 3), 'scenarios': {}}
+        for scenario in scenarios:
+            results, elapsed = self.run_scenario(scenario, fixtures, requests, concurrency, rng)
+            measured['scenarios'][scenario] = summary = self.summarize(results, elapsed)
+            self.report(scenario, summary)
+        return measured
+
+    def fixtures(self, rng):
+        """Ids, credentials and tokens the scenarios pick from"""
+        ids = [str(doc['_id']) for doc in PropertyMongoDB.find_documents(projection={'_id': 1}, limit=5000)]
+        emails = list(
+            User.objects.filter(email__endswith='@' + seeding.SEED_EMAIL_DOMAIN).values_list('email', flat=True)[:500]
+        )
+        # Favorites are read by the buyers who actually have some
+        fans = list(User.objects.filter(id__in=FavoriteProperty.objects.values('user_id')).order_by('id')[:50])
+        return {
+            'ids': ids,
+            'emails': emails,
+            'tokens': [str(ClaimsRefreshToken.for_user(user).access_token) for user in fans],
+        }
+
+    def run_scenario(self, scenario, fixtures, requests, concurrency, rng):
+        # Requests are drawn up front so every run sends the same sequence
+        make_request = getattr(self, f'{scenario}_request')
+        before = getattr(self, f'{scenario}_before', None)
+        calls = [make_request(fixtures, rng) for _ in range(requests)]
+
+        def timed_request(call):
+            method, path, kwargs = call
+            if before is not None:
+                before()
+            # A failing request counts as an error instead of ending the run
+            client = Client(raise_request_exception=False)
+            started = time.perf_counter()
+            status_code = getattr(client, method)(path, **kwargs).status_code
+            return time.perf_counter() - started, status_code
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(timed_request, calls))
+        return results, time.perf_counter() - start
+
+    def list_request(self, fixtures, rng):
+        params = {'page_size': 24, 'ordering': rng.choice(('-created_at', 'price', '-price', '-area'))}
+        if rng.random() < 0.5:
+            params['property_type'] = rng.choice(seeding.PROPERTY_TYPES)[0]
+        if rng.random() < 0.5:
+            params['status'] = rng.choice(('sale', 'rent'))
+        if rng.random() < 0.3:
+            low = rng.choice((100000, 250000, 500000))
+            params.update(min_price=low, max_price=low * 2)
+        return 'get', '/api/properties/', {'data': params}
+
+    def search_request(self, fixtures, rng):
+        return 'get', '/api/properties/', {'data': {'search': rng.choice(SEARCH_TERMS), 'page_size': 24}}
+
+    def detail_request(self, fixtures, rng):
+        return 'get', f'/api/properties/{rng.choice(fixtures["ids"])}/', {}
+
+    def stats_request(self, fixtures, rng):
+        return 'get', '/api/stats/', {}
+
+    def stats_before(self):
+        # Every request recomputes the aggregation; a cached answer measures nothing
+        PropertyMongoDB.invalidate_stats()
+
+    def login_request(self, fixtures, rng):
+        credentials = {'email': rng.choice(fixtures['emails']), 'password': seeding.SEED_PASSWORD}
+        return 'post', '/api/auth/login/', {'data': credentials, 'content_type': 'application/json'}
+
+    def favorites_request(self, fixtures, rng):
+        return 'get', '/api/auth/favorites/', {'HTTP_AUTHORIZATION': f'Bearer {rng.choice(fixtures["tokens"])}'}
+
+    def summarize(self, results, elapsed):
+        latencies = sorted(latency * 1000 for latency, _ in results)
+        percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+        return {
+            'requests': len(results),
+            'errors': sum(1 for _, status_code in results if status_code >= 400),
+            'throughput': round(len(results) / elapsed, 1),
+            'p50_ms': round(percentiles[49], 2),
+            'p95_ms': round(percentiles[94], 2),
+            'p99_ms': round(percentiles[98], 2),
+        }
+
+    def report(self, label, summary):
+        self.stdout.write(
+            f'  {label:10} {summary["throughput"]:8.1f} req/s   p50 {summary["p50_ms"]:7.1f} ms   '
+            f'p95 {summary["p95_ms"]:7.1f} ms   p99 {summary["p99_ms"]:7.1f} ms   errors {summary["errors"]}'
+        )
+
+    def compare(self, results, baseline, tolerance):
+        """Flag scenarios whose p95 grew by more than ``tolerance`` over the baseline"""
+        regressions = []
+        self.stdout.write(f'\nAgainst baseline (p95, tolerance {tolerance:.0%})')
+        for size, measured in results['sizes'].items():
+            previous = baseline.get('sizes', {}).get(size, {}).get('scenarios', {})
+            for scenario, summary in measured['scenarios'].items():
+                if scenario not in previous:
+                    continue
+                before = previous[scenario]['p95_ms']
+                change = (summary['p95_ms'] - before) / before if before else 0.0
+                line = f'  {size:>8} {scenario:10} {before:7.1f} -> {summary["p95_ms"]:7.1f} ms ({change:+.0%})'
+                if change > tolerance:
+                    regressions.append(line)
+                    self.stdout.write(self.style.ERROR(line))
+                else:
+                    self.stdout.write(line)
+
+        if regressions:
+            raise CommandError(f'{len(regressions)} scenario(s) slower than the baseline')
+        self.stdout.write(self.style.SUCCESS('No regressions'))
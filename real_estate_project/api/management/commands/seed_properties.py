@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from api import seeding
+
+
+class Command(BaseCommand):
+    help = 'Bulk-load realistic, reproducible listings, users and favorites for benchmarks and local testing'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=10000, help='Listings to create')
+        parser.add_argument('--users', type=int, help='Users to create (default: one per 20 listings)')
+        parser.add_argument('--favorites-per-user', type=int, default=3, help='Average favorites per buyer')
+        parser.add_argument('--seed', type=int, default=42, help='Random seed; the same seed gives the same data')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Listings per insert_many')
+        parser.add_argument('--clear', action='store_true', help='Remove previously seeded data first')
+    
+    def handle(self, *args, **options):
+        if options['clear']:
+            removed = seeding.clear()
+            self.stdout.write(f'Removed {removed["properties"]} seeded listings and {removed["users"]} users')
+        
+        created = seeding.seed(
+            options['count'], users=options['users'], favorites_per_user=options['favorites_per_user'],
+            seed=options['seed'], batch_size=options['batch_size']
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {created["properties"]} listings, {created["users"]} users '
+            f'and {created["favorites"]} favorites (password for all users: {seeding.SEED_PASSWORD})'
+        ))
@@ -0,0 +1,458 @@
+import atexit
+import json
+import logging
+import math
+import os
+import threading
+import time
+from django.conf import settings
+from django.http import Http404, HttpResponse
+
+try:
+    import fcntl
+except ImportError:  # Windows: snapshots of exited processes are kept, not folded
+    fcntl = None
+
+logger = logging.getLogger('api.metrics')
+
+# Request latency buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Counters and histograms of processes that have exited, summed
+TOTAL_FILE = 'total.json'
+
+
+def get_config():
+    config = {
+        'enabled': True,
+        'directory': None,
+        'flush_interval': 5,
+        'allowed_ips': ('127.0.0.1', '::1'),
+    }
+    config.update(getattr(settings, 'METRICS', {}))
+    return config
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def samples(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_total(self, value, **labels):
+        """Mirror a counter kept elsewhere (e.g. by the driver's pool listener)"""
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        # Non-cumulative bucket counts, then sum and count; made cumulative on export
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+
+
+class Registry:
+    """
+    Process-local metrics, shared with sibling workers through files.
+
+    Every process that serves requests writes a snapshot of its metrics to
+    ``<directory>/<pid>-<start time>.json`` every ``flush_interval`` seconds,
+    from a background thread, and on exit; the start time tells a process apart from a later
+    one given the same pid. A scrape folds the counters and histograms of
+    processes that have exited into ``total.json`` and removes their files,
+    then merges what is left: counters and histograms are summed, and
+    gauges are summed over the processes still running.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+        self.used = False
+        self._flush_lock = threading.Lock()
+        self._flusher_lock = threading.Lock()
+        self._flusher_pid = None
+        self._process = None
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector):
+        """Register a callable that refreshes metrics mirrored from other components"""
+        self.collectors.append(collector)
+        return collector
+
+    def reset(self):
+        for metric in self.metrics.values():
+            metric.reset()
+
+    @property
+    def directory(self):
+        return get_config()['directory']
+
+    def snapshot(self):
+        for collector in self.collectors:
+            collector()
+        return {
+            name: {
+                'type': metric.type,
+                'help': metric.documentation,
+                'labelnames': list(metric.labelnames),
+                'buckets': list(getattr(metric, 'buckets', ())),
+                'samples': metric.samples(),
+            }
+            for name, metric in self.metrics.items()
+        }
+
+    def start_flushing(self):
+        """Flush on a background thread from now on; cheap once it is running in this process"""
+        self.used = True
+        pid = os.getpid()
+        if self._flusher_pid == pid:
+            return
+        with self._flusher_lock:
+            # A forked child has the attribute but not the thread
+            if self._flusher_pid != pid:
+                threading.Thread(target=self.flush_periodically, name='metrics-flush', daemon=True).start()
+                self._flusher_pid = pid
+
+    def flush_periodically(self):
+        while True:
+            time.sleep(get_config()['flush_interval'])
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Could not write the metrics snapshot')
+
+    @property
+    def process(self):
+        """``<pid>-<start time>`` of this process, recomputed after a fork"""
+        pid = os.getpid()
+        if self._process is None or self._process[0] != pid:
+            start = process_start(pid)
+            if start is None:
+                start = int(time.time() * 1000)
+            self._process = (pid, f'{pid}-{start}')
+        return self._process[1]
+
+    def flush(self):
+        directory = self.directory
+        if not directory:
+            return
+        with self._flush_lock:
+            os.makedirs(directory, exist_ok=True)
+            write_snapshot(os.path.join(directory, f'{self.process}.json'), self.snapshot())
+
+    def fold_exited(self):
+        """Add the counters and histograms of exited processes to total.json and remove their files"""
+        directory = self.directory
+        if fcntl is None:
+            return
+        # Scrapes from several workers fold one at a time
+        with open(os.path.join(directory, 'total.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                exited = [
+                    filename for filename in os.listdir(directory)
+                    if filename.endswith('.json') and filename != TOTAL_FILE and not snapshot_alive(filename)
+                ]
+                if not exited:
+                    return
+                snapshots = [read_snapshot(os.path.join(directory, name)) for name in [TOTAL_FILE] + exited]
+                total = merge_snapshots((snapshot, False) for snapshot in snapshots if snapshot is not None)
+                write_snapshot(os.path.join(directory, TOTAL_FILE), total)
+                for filename in exited:
+                    try:
+                        os.remove(os.path.join(directory, filename))
+                    except FileNotFoundError:
+                        pass
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def collect(self):
+        """Merged metrics of every process, or of this one without a directory"""
+        if not self.directory:
+            return self.snapshot()
+
+        self.flush()
+        self.fold_exited()
+        snapshots = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.json'):
+                continue
+            snapshot = read_snapshot(os.path.join(self.directory, filename))
+            if snapshot is not None:
+                snapshots.append((snapshot, filename != TOTAL_FILE and snapshot_alive(filename)))
+        return merge_snapshots(snapshots)
+
+    def render(self):
+        """Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        for name, data in sorted(self.collect().items()):
+            lines.append(f'# HELP {name} {escape_help(data["help"])}')
+            lines.append(f'# TYPE {name} {data["type"]}')
+            labelnames = data['labelnames']
+            for labels, value in sorted(data['samples']):
+                if data['type'] == 'histogram':
+                    cumulative = 0
+                    for bound, count in zip(list(data['buckets']) + [math.inf], value):
+                        cumulative += count
+                        le = '+Inf' if bound == math.inf else format_value(bound)
+                        lines.append(f'{name}_bucket{format_labels(labelnames + ["le"], labels + [le])} {cumulative}')
+                    lines.append(f'{name}_sum{format_labels(labelnames, labels)} {format_value(value[-2])}')
+                    lines.append(f'{name}_count{format_labels(labelnames, labels)} {value[-1]}')
+                else:
+                    lines.append(f'{name}{format_labels(labelnames, labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def merge_snapshots(snapshots):
+    """
+    Sum ``(snapshot, alive)`` pairs into one snapshot; gauges are only
+    taken from processes that are alive
+    """
+    merged = {}
+    for snapshot, alive in snapshots:
+        for name, data in snapshot.items():
+            if data['type'] == 'gauge' and not alive:
+                continue
+            target = merged.setdefault(name, dict(data, samples={}))
+            for labels, value in data['samples']:
+                key = tuple(labels)
+                if data['type'] == 'histogram':
+                    current = target['samples'].get(key)
+                    target['samples'][key] = (
+                        value if current is None else [a + b for a, b in zip(current, value)]
+                    )
+                else:
+                    target['samples'][key] = target['samples'].get(key, 0) + value
+    for data in merged.values():
+        data['samples'] = [[list(key), value] for key, value in data['samples'].items()]
+    return merged
+
+
+def read_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_snapshot(path, snapshot):
+    temporary = f'{path}.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(temporary, path)
+
+
+def process_start(pid):
+    """Start time of a process in clock ticks since boot, or None without /proc"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # Fields after the command name, which is in parentheses and may contain spaces
+    return int(stat.rsplit(')', 1)[1].split()[19])
+
+
+def snapshot_alive(filename):
+    """Whether the process that wrote ``<pid>-<start time>.json`` is still running"""
+    pid, _, start = filename[:-len('.json')].partition('-')
+    try:
+        pid = int(pid)
+    except ValueError:
+        return False
+    if pid == os.getpid():
+        return start == registry.process.partition('-')[2]
+    current = process_start(pid)
+    if current is not None:
+        return str(current) == start
+    return pid_alive(pid)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def escape_help(text):
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(str(value))}"' for name, value in zip(names, values)) + '}'
+
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
+
+
+registry = Registry()
+
+# Request metrics, recorded by RequestMetricsMiddleware
+http_requests = registry.counter(
+    'http_requests_total', 'Requests handled, by route, method and status code.',
+    ('route', 'method', 'status')
+)
+http_request_duration = registry.histogram(
+    'http_request_duration_seconds', 'Request latency by route.', ('route', 'method')
+)
+http_exceptions = registry.counter(
+    'http_request_exceptions_total', 'Requests that raised an unhandled exception, by route.', ('route',)
+)
+db_queries = registry.counter(
+    'db_queries_total', 'Queries sent while handling requests, by store and route.', ('store', 'route')
+)
+db_query_duration = registry.counter(
+    'db_query_duration_seconds_total', 'Time spent in queries while handling requests, by store and route.',
+    ('store', 'route')
+)
+
+# Mirrored from the MongoDB pool listener and the document cache at each flush
+mongo_pool_checked_out = registry.gauge(
+    'mongo_pool_checked_out_connections', 'MongoDB connections currently checked out of the pool.'
+)
+mongo_pool_open = registry.gauge(
+    'mongo_pool_open_connections', 'MongoDB connections currently open.'
+)
+mongo_pool_checkouts = registry.counter(
+    'mongo_pool_checkouts_total', 'Successful MongoDB connection checkouts.'
+)
+mongo_pool_checkout_failures = registry.counter(
+    'mongo_pool_checkout_failures_total', 'Failed MongoDB connection checkouts, by reason.', ('reason',)
+)
+mongo_pool_wait = registry.counter(
+    'mongo_pool_wait_seconds_total', 'Time spent waiting to check out a MongoDB connection.'
+)
+cache_requests = registry.counter(
+    'document_cache_requests_total', 'Property document cache lookups, by result.', ('result',)
+)
+cache_evictions = registry.counter(
+    'document_cache_evictions_total', 'Property documents evicted from the cache to make room.'
+)
+
+
+@registry.add_collector
+def collect_mongo_and_cache():
+    from webapp.mongodb_cache import property_cache
+    from webapp.mongodb_pool import pool_stats
+
+    pool = pool_stats.snapshot()
+    mongo_pool_checked_out.set(pool['checked_out'])
+    mongo_pool_open.set(pool['connections_open'])
+    mongo_pool_checkouts.set_total(pool['checkouts'])
+    for reason, count in pool['checkout_failures'].items():
+        mongo_pool_checkout_failures.set_total(count, reason=reason)
+    mongo_pool_wait.set_total(pool_stats.wait_time_total)
+
+    cache = property_cache.stats()
+    cache_requests.set_total(cache['hits'], result='hit')
+    cache_requests.set_total(cache['misses'], result='miss')
+    cache_evictions.set_total(cache['evictions'])
+
+
+def record_request(route, method, status, duration, profile=None):
+    route = route or 'unmatched'
+    http_requests.inc(route=route, method=method, status=status)
+    http_request_duration.observe(duration, route=route, method=method)
+    if profile is not None:
+        for store, stats in (('mongo', profile.mongo), ('sql', profile.sql)):
+            if stats.count:
+                db_queries.inc(stats.count, store=store, route=route)
+                db_query_duration.inc(stats.duration_ms / 1000, store=store, route=route)
+    registry.start_flushing()
+
+
+# A forked worker starts from zero; its parent's numbers are in the parent's file
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=registry.reset)
+# Processes that served no request (management commands) leave no file
+atexit.register(lambda: registry.used and registry.flush())
+
+
+def metrics_view(request):
+    """
+    Prometheus scrape endpoint, merged across the workers on this host.
+    
+    Internal only: answered for METRICS['allowed_ips'] (matched against
+    REMOTE_ADDR, so do not route it through a public proxy) and a 404
+    for everyone else.
+    """
+    config = get_config()
+    if not config['enabled'] or request.META.get('REMOTE_ADDR') not in config['allowed_ips']:
+        raise Http404
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,151 @@
+import json
+import logging
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db import connections
+from contextlib import ExitStack
+from .metrics import get_config as get_metrics_config, http_exceptions, record_request
+from .instrumentation import (
+    current_profile, get_config, get_explainer, log_slow_queries, logger, RequestProfile, sql_execute_wrapper
+)
+
+
+class QueryInstrumentationMiddleware:
+    """
+    Profile MongoDB and SQL queries per request.
+
+    Logs one JSON line per request to ``api.instrumentation``. Queries slower
+    than ``REQUEST_INSTRUMENTATION['slow_query_ms']`` are logged as warnings;
+    with ``explain_slow_queries`` on, MongoDB ones are logged from a
+    background thread with the winning plan from explain().
+
+    Staff users get a ``Server-Timing`` header splitting the response time
+    into mongo, sql, app (view code outside the databases), render and
+    total. ``server_timing`` sends it to everyone, for debugging only: it
+    tells any client how long the databases took.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.config = get_config()
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.config['enabled']:
+            return self.get_response(request)
+
+        profile = RequestProfile(self.config)
+        token = current_profile.set(profile)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(sql_execute_wrapper))
+                request._query_profile = profile
+                response = self.get_response(request)
+        finally:
+            current_profile.reset(token)
+
+        return self.finish(request, response, profile)
+
+    async def __acall__(self, request):
+        if not self.config['enabled']:
+            return await self.get_response(request)
+
+        # SQL run through sync_to_async happens in other threads and is not
+        # seen here; MongoDB commands from the async driver are
+        profile = RequestProfile(self.config)
+        token = current_profile.set(profile)
+        try:
+            request._query_profile = profile
+            response = await self.get_response(request)
+        finally:
+            current_profile.reset(token)
+
+        return self.finish(request, response, profile)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        profile = getattr(request, '_query_profile', None)
+        if profile is not None:
+            profile.route = request.resolver_match.view_name if request.resolver_match else None
+            profile.view_started = time.perf_counter()
+
+    def process_template_response(self, request, response):
+        # Called between the view returning and its response being rendered
+        profile = getattr(request, '_query_profile', None)
+        if profile is not None:
+            profile.view_finished = time.perf_counter()
+        return response
+
+    def finish(self, request, response, profile):
+        # DRF authenticates inside the view and sets request.user as it goes
+        if self.config['server_timing'] or getattr(getattr(request, 'user', None), 'is_staff', False):
+            response['Server-Timing'] = profile.server_timing()
+
+        if logger.isEnabledFor(logging.INFO):
+            data = profile.as_dict()
+            data.update(method=request.method, path=request.path, status=response.status_code)
+            logger.info(json.dumps(data, default=str))
+        if profile.slow_queries:
+            slow_queries = [dict(slow_query, route=profile.route, path=request.path)
+                            for slow_query in profile.slow_queries]
+            if self.config['explain_slow_queries'] and any('_explain' in each for each in slow_queries):
+                get_explainer(self.config).submit(slow_queries)
+            else:
+                log_slow_queries(slow_queries)
+        return response
+
+
+class RequestMetricsMiddleware:
+    """
+    Record throughput, status codes, latency and query counts per route.
+
+    Goes after QueryInstrumentationMiddleware so that it can read the
+    request's query profile. Metrics are served by api.metrics.metrics_view.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = get_metrics_config()['enabled']
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.enabled:
+            return self.get_response(request)
+
+        started = time.perf_counter()
+        response = self.get_response(request)
+        self.record(request, response, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        if not self.enabled:
+            return await self.get_response(request)
+
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        self.record(request, response, time.perf_counter() - started)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # Named routes keep the label set small; unnamed ones fall back to the URL pattern
+        match = request.resolver_match
+        request._metrics_route = match.view_name or match.route if match else None
+
+    def process_exception(self, request, exception):
+        http_exceptions.inc(route=getattr(request, '_metrics_route', None) or 'unmatched')
+
+    def record(self, request, response, duration):
+        record_request(
+            getattr(request, '_metrics_route', None), request.method, response.status_code,
+            duration, getattr(request, '_query_profile', None)
+        )
@@ -1,129 +1,282 @@
 from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnly
+from rest_framework.permissions import IsAdminUser, IsAuthenticated, IsAuthenticatedOrReadOnly
 from rest_framework.response import Response
 from rest_framework import status
-from webapp.mongodb_models import PropertyMongoDB
-from accounts.models import User
-from accounts.serializers import PublicUserSerializer
+from rest_framework.exceptions import ValidationError
+from webapp import geo
+from webapp.mongodb_models import PropertyMongoDB, VersionConflict
+from webapp.mongodb_cache import property_cache
+from webapp.mongodb_pool import pool_stats
+from webapp.mongodb_storage import get_engine
+from pymongo.errors import OperationFailure, PyMongoError
+from django.conf import settings
+from accounts.counters import SOLD_STATUS, adjust_profile_counters, record_listing_created, record_listing_deleted
+from accounts.favorites import annotate_favorites, get_favorite_state
+from accounts.owner_cards import get_owner_cards, get_owner_cards_version
+from .conditional import is_conditional, list_etag, not_modified, property_etag, set_validators
+from .bulk import MAX_BULK_ROWS, apply_changes, apply_counter_deltas, build_property, save_rows
+from .pagination import MongoCursorPagination
+from django.http import StreamingHttpResponse
 from datetime import datetime
 from bson import ObjectId
+from bson.errors import InvalidId
+from contextlib import contextmanager
+import csv
+import json
+import os
+import time
 
-def property_to_dict(prop, include_owner_info=False, request_user=None):
-    """Convert PropertyMongoDB instance to dictionary for serialization"""
+# Fields returned to clients, in response order
+PROPERTY_FIELDS = (
+    'title', 'description', 'property_type', 'status', 'price',
+    'bedrooms', 'bathrooms', 'area', 'address', 'city', 'state',
+    'zip_code', 'latitude', 'longitude', 'image', 'featured',
+    'created_at', 'updated_at', 'is_public', 'version'
+)
+
+def document_to_dict(doc, include_owner_info=False, request_user=None, owner_cards=None):
+    """
+    Convert a raw MongoDB property document to a dictionary for serialization.
+    
+    Fields missing from the document (e.g. left out by a projection) are
+    omitted from the result. List views pass ``owner_cards`` preloaded with
+    ``get_owner_cards`` so owners are not looked up row by row.
+    """
+    property_id = str(doc['_id']) if doc.get('_id') else None
     data = {
-        'id': prop.id,
-        '_id': prop.id,
-        'title': prop.title,
-        'description': prop.description,
-        'property_type': prop.property_type,
-        'status': prop.status,
-        'price': prop.price,
-        'bedrooms': prop.bedrooms,
-        'bathrooms': prop.bathrooms,
-        'area': prop.area,
-        'address': prop.address,
-        'city': prop.city,
-        'state': prop.state,
-        'zip_code': prop.zip_code,
-        'latitude': prop.latitude,
-        'longitude': prop.longitude,
-        'image': prop.image,
-        'featured': prop.featured,
-        'created_at': prop.created_at.isoformat() if prop.created_at else None,
-        'updated_at': prop.updated_at.isoformat() if prop.updated_at else None,
-        'is_public': prop.is_public
+        'id': property_id,
+        '_id': property_id,
     }
+    for field in PROPERTY_FIELDS:
+        if field in doc:
+            value = doc[field]
+            if isinstance(value, datetime):
+                value = value.isoformat()
+            data[field] = value
+    
+    owner_id = doc.get('owner_id')
     
     # Add owner information if requested or if user is the owner
     if include_owner_info or (request_user and request_user.is_authenticated and 
-                             (str(request_user.id) == str(prop.owner_id) or request_user.is_staff)):
-        data['owner_id'] = prop.owner_id
-        data['created_by_id'] = prop.created_by_id
+                             (str(request_user.id) == str(owner_id) or request_user.is_staff)):
+        data['owner_id'] = owner_id
+        data['created_by_id'] = doc.get('created_by_id')
+        if doc.get('external_id'):
+            data['external_id'] = doc['external_id']
         
         # Add owner contact info if available and user has permission
-        if prop.contact_info:
-            data['contact_info'] = prop.contact_info
+        if doc.get('contact_info'):
+            data['contact_info'] = doc['contact_info']
         
-        # Try to get owner details
-        if prop.owner_id:
-            try:
-                owner = User.objects.get(id=prop.owner_id)
-                data['owner'] = PublicUserSerializer(owner).data
-            except User.DoesNotExist:
-                data['owner'] = None
+        # Attach the owner's public card
+        if owner_id:
+            if owner_cards is None:
+                owner_cards = get_owner_cards([owner_id])
+            data['owner'] = owner_cards.get(str(owner_id))
     
     return data
 
+def property_to_dict(prop, include_owner_info=False, request_user=None):
+    """Convert PropertyMongoDB instance to dictionary for serialization"""
+    return document_to_dict(prop.to_dict(), include_owner_info, request_user)
+
+# Fields the list endpoint may be ordered by
+ORDERING_FIELDS = ('created_at', 'price', 'area')
+DEFAULT_ORDERING = '-created_at'
+
+def build_property_filters(params):
+    """Build a MongoDB filter from property list query parameters"""
+    filters = {}
+    
+    # Filter by property type
+    property_type = params.get('property_type')
+    if property_type:
+        filters['property_type'] = property_type
+    
+    # Filter by status
+    property_status = params.get('status')
+    if property_status:
+        filters['status'] = property_status
+    
+    # Filter by featured
+    featured = params.get('featured')
+    if featured and featured.lower() == 'true':
+        filters['featured'] = True
+    
+    # Filter by price range
+    min_price = params.get('min_price')
+    max_price = params.get('max_price')
+    if min_price or max_price:
+        price_filter = {}
+        if min_price:
+            price_filter['$gte'] = float(min_price)
+        if max_price:
+            price_filter['$lte'] = float(max_price)
+        filters['price'] = price_filter
+    
+    return filters
+
+# Radius search defaults and limits, in kilometres
+DEFAULT_RADIUS_KM = 10
+MAX_RADIUS_KM = 500
+# Polygons are checked for self-intersection edge by edge
+MAX_POLYGON_POINTS = 500
+# MongoDB's error code for geometries it cannot use
+BAD_VALUE = 2
+
+def parse_coordinates(value, count, param):
+    """Parse ``count`` comma-separated numbers from a query parameter"""
+    try:
+        numbers = [float(number) for number in value.split(',')]
+    except ValueError:
+        numbers = []
+    if len(numbers) != count:
+        raise ValidationError({param: f'Expected {count} comma-separated numbers.'})
+    return numbers
+
+def build_geo_filters(params):
+    """
+    Build the location filter for the map query modes.
+    
+    ``near=lat,lng&radius=km`` finds listings within a radius, nearest first;
+    ``bbox=min_lng,min_lat,max_lng,max_lat`` finds listings inside a viewport;
+    ``polygon=lng,lat;lng,lat;...`` finds listings inside a polygon.
+    
+    Returns ``(filters, count_filters, near_point)``. ``count_filters`` is the
+    equivalent unsorted filter usable with count_documents, and ``near_point``
+    is the ``(lat, lng)`` centre of a radius search.
+    """
+    near = params.get('near')
+    bbox = params.get('bbox')
+    polygon = params.get('polygon')
+    if len([mode for mode in (near, bbox, polygon) if mode]) > 1:
+        raise ValidationError({'detail': 'Use only one of near, bbox or polygon.'})
+    
+    if near:
+        latitude, longitude = parse_coordinates(near, 2, 'near')
+        center = geo.point(latitude, longitude)
+        if center is None:
+            raise ValidationError({'near': 'Invalid coordinates.'})
+        try:
+            radius_km = float(params.get('radius', DEFAULT_RADIUS_KM))
+        except ValueError:
+            radius_km = -1
+        if not 0 < radius_km <= MAX_RADIUS_KM:
+            raise ValidationError({'radius': f'Radius must be between 0 and {MAX_RADIUS_KM} km.'})
+        
+        near_filter = {'location': {'$nearSphere': {'$geometry': center, '$maxDistance': radius_km * 1000}}}
+        count_filter = {'location': {'$geoWithin': {
+            '$centerSphere': [center['coordinates'], radius_km / geo.EARTH_RADIUS_KM]
+        }}}
+        return near_filter, count_filter, (latitude, longitude)
+    
+    if bbox:
+        min_lng, min_lat, max_lng, max_lat = parse_coordinates(bbox, 4, 'bbox')
+        if not (geo.is_valid_coordinate(min_lat, min_lng) and geo.is_valid_coordinate(max_lat, max_lng)
+                and min_lng < max_lng and min_lat < max_lat):
+            raise ValidationError({'bbox': 'Expected min_lng,min_lat,max_lng,max_lat within valid ranges.'})
+        bbox_filter = {'location': {'$geoWithin': {'$geometry': geo.bbox_polygon(min_lng, min_lat, max_lng, max_lat)}}}
+        return bbox_filter, bbox_filter, None
+    
+    if polygon:
+        points = [parse_coordinates(point, 2, 'polygon') for point in polygon.split(';') if point]
+        if len(points) < 3 or not all(geo.is_valid_coordinate(lat, lng) for lng, lat in points):
+            raise ValidationError({'polygon': 'Expected at least three valid lng,lat points separated by ";".'})
+        if len(points) > MAX_POLYGON_POINTS:
+            raise ValidationError({'polygon': f'A polygon can have at most {MAX_POLYGON_POINTS} points.'})
+        shape = geo.polygon(points)
+        error = geo.ring_error(shape['coordinates'][0])
+        if error:
+            raise ValidationError({'polygon': error})
+        polygon_filter = {'location': {'$geoWithin': {'$geometry': shape}}}
+        return polygon_filter, polygon_filter, None
+    
+    return {}, {}, None
+
+@contextmanager
+def geo_query_errors():
+    """
+    Answer 400 when MongoDB rejects a geometry build_geo_filters() let
+    through (its checks are planar, MongoDB's are spherical)
+    """
+    try:
+        yield
+    except OperationFailure as e:
+        if e.code != BAD_VALUE:
+            raise
+        raise ValidationError({'detail': f'Invalid geo query: {(e.details or {}).get("errmsg", "bad geometry")}'})
+
+def get_property_ordering(params, searching=False):
+    """Return the requested ordering; searches default to best matches first"""
+    default = MongoCursorPagination.relevance_ordering if searching else DEFAULT_ORDERING
+    ordering = params.get('ordering', default)
+    if searching and ordering == MongoCursorPagination.relevance_ordering:
+        return ordering
+    if ordering.lstrip('-') not in ORDERING_FIELDS:
+        return default
+    return ordering
+
 @api_view(['GET', 'POST'])
 @permission_classes([IsAuthenticatedOrReadOnly])
 def property_list_mongodb(request):
     """MongoDB-based property list endpoint"""
     
     if request.method == 'GET':
-        # Build filters from query parameters
-        filters = {}
-        
-        # Filter by property type
-        property_type = request.GET.get('property_type')
-        if property_type:
-            filters['property_type'] = property_type
-        
-        # Filter by status
-        property_status = request.GET.get('status')
-        if property_status:
-            filters['status'] = property_status
-        
-        # Filter by featured
-        featured = request.GET.get('featured')
-        if featured and featured.lower() == 'true':
-            filters['featured'] = True
+        # The list ETag only depends on cached versions, so a client holding
+        # the current page gets a 304 before MongoDB is queried at all.
+        # No Last-Modified: a generation has no date.
+        favorites = get_favorite_state(request.user) if request.user.is_authenticated else None
+        etag = list_etag(
+            request, PropertyMongoDB.generation(), favorites and favorites['version'], get_owner_cards_version()
+        )
+        response = not_modified(request, etag, vary_on_user=True)
+        if response is not None:
+            return response
         
-        # Filter by price range
-        min_price = request.GET.get('min_price')
-        max_price = request.GET.get('max_price')
-        if min_price or max_price:
-            price_filter = {}
-            if min_price:
-                price_filter['$gte'] = float(min_price)
-            if max_price:
-                price_filter['$lte'] = float(max_price)
-            filters['price'] = price_filter
+        filters = build_property_filters(request.GET)
         
-        # Search functionality
+        # Search functionality, combined with the other filters
         search = request.GET.get('search')
         if search:
-            properties = PropertyMongoDB.search(search)
-        else:
-            # Sorting
-            sort_by = request.GET.get('ordering', '-created_at')
-            sort_field = sort_by.lstrip('-')
-            sort_direction = -1 if sort_by.startswith('-') else 1
-            
-            # Convert Django field names to MongoDB field names
-            if sort_field == 'created_at':
-                sort_field = 'created_at'
-            elif sort_field == 'price':
-                sort_field = 'price'
-            elif sort_field == 'area':
-                sort_field = 'area'
-            
-            properties = PropertyMongoDB.find_all(
-                filters=filters,
-                sort=[(sort_field, sort_direction)]
+            filters.update(PropertyMongoDB.search_filters(search))
+        ordering = get_property_ordering(request.GET, searching=bool(search))
+        
+        # Map query modes, also combined with the other filters
+        geo_filters, geo_count_filters, near_point = build_geo_filters(request.GET)
+        if near_point:
+            if search:
+                raise ValidationError({'detail': 'Radius search cannot be combined with text search.'})
+            ordering = MongoCursorPagination.distance_ordering
+        count_filters = dict(filters, **geo_count_filters)
+        filters.update(geo_filters)
+        
+        # Fetch raw documents with only the listing-card fields
+        paginator = MongoCursorPagination()
+        with geo_query_errors():
+            documents = paginator.paginate(
+                PropertyMongoDB, filters, ordering, request,
+                projection=PropertyMongoDB.LIST_PROJECTION, count_filters=count_filters
             )
         
+        # Load every owner on the page at once
+        owner_cards = get_owner_cards(doc.get('owner_id') for doc in documents)
+        
         # Convert to dictionaries with appropriate permissions
-        properties_data = [property_to_dict(prop, include_owner_info=True, request_user=request.user) for prop in properties]
+        properties_data = [
+            document_to_dict(doc, include_owner_info=True, request_user=request.user, owner_cards=owner_cards)
+            for doc in documents
+        ]
         
-        # Simple pagination response format to match DRF pagination
-        total_count = len(properties_data)
+        # Flag the user's favorites on the page from their cached id set
+        annotate_favorites(request.user, properties_data, favorites)
         
-        return Response({
-            'count': total_count,
-            'next': None,  # Simple implementation - no pagination for now
-            'previous': None,
-            'results': properties_data
-        })
+        if near_point:
+            for doc, data in zip(documents, properties_data):
+                data['distance_km'] = round(geo.haversine_km(*near_point, doc['latitude'], doc['longitude']), 3)
+        
+        with geo_query_errors():
+            response = paginator.get_paginated_response(properties_data)
+        return set_validators(response, etag, vary_on_user=True)
     
     elif request.method == 'POST':
         # Create new property - requires authentication
@@ -138,47 +291,11 @@ def property_list_mongodb(request):
             }, status=status.HTTP_403_FORBIDDEN)
         
         try:
-            data = request.data
-            
-            # Set owner and creator information
-            contact_info = {}
-            if request.user.show_contact_info:
-                if request.user.email:
-                    contact_info['email'] = request.user.email
-                if request.user.phone:
-                    contact_info['phone'] = request.user.phone
-                contact_info['preferred_contact'] = request.user.preferred_contact
-            
-            property_obj = PropertyMongoDB(
-                title=data.get('title', ''),
-                description=data.get('description', ''),
-                property_type=data.get('property_type', 'house'),
-                status=data.get('status', 'sale'),
-                price=float(data.get('price', 0)),
-                bedrooms=int(data.get('bedrooms', 0)),
-                bathrooms=int(data.get('bathrooms', 0)),
-                area=int(data.get('area', 0)),
-                address=data.get('address', ''),
-                city=data.get('city', ''),
-                state=data.get('state', ''),
-                zip_code=data.get('zip_code', ''),
-                latitude=float(data.get('latitude', 0)),
-                longitude=float(data.get('longitude', 0)),
-                image=data.get('image', ''),
-                featured=bool(data.get('featured', False)),
-                owner_id=str(request.user.id),
-                created_by_id=str(request.user.id),
-                is_public=bool(data.get('is_public', True)),
-                contact_info=contact_info
-            )
-            
+            property_obj = build_property(request.data, request.user)
             property_obj.save()
             
-            # Update user's property count
-            if hasattr(request.user, 'profile_extended'):
-                profile = request.user.profile_extended
-                profile.properties_posted += 1
-                profile.save()
+            # Update the owner's property counts
+            record_listing_created(property_obj)
             
             return Response(
                 property_to_dict(property_obj, include_owner_info=True, request_user=request.user), 
@@ -188,11 +305,141 @@ def property_list_mongodb(request):
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-@api_view(['GET', 'PUT', 'DELETE'])
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def property_bulk_mongodb(request):
+    """
+    Create or update many properties in one request.
+    
+    Takes a list of property objects (or ``{"properties": [...]}``). Rows with
+    an ``external_id`` are upserted on it. Staff may set ``owner_id`` per row.
+    Returns counts plus an error entry, by row index, for each rejected row.
+    """
+    if not request.user.can_post_properties and not request.user.is_staff:
+        return Response({
+            'error': 'Only verified sellers and agents can post properties. Please verify your account.'
+        }, status=status.HTTP_403_FORBIDDEN)
+    
+    rows = request.data
+    if isinstance(rows, dict):
+        rows = rows.get('properties')
+    if not isinstance(rows, list):
+        return Response({'error': 'Expected a list of properties'}, status=status.HTTP_400_BAD_REQUEST)
+    if len(rows) > MAX_BULK_ROWS:
+        return Response({'error': f'At most {MAX_BULK_ROWS} properties per request'},
+                      status=status.HTTP_400_BAD_REQUEST)
+    
+    report, counter_deltas = save_rows(
+        rows, default_owner=request.user, allow_row_owner=request.user.is_staff
+    )
+    apply_counter_deltas(counter_deltas)
+    
+    return Response(report)
+
+# Export formats: content type and file extension
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'csv': ('text/csv', 'csv'),
+}
+EXPORT_BATCH_SIZE = 1000
+MAX_EXPORT_BATCH_SIZE = 5000
+EXPORT_COLUMNS = ('id',) + PROPERTY_FIELDS
+
+class Echo:
+    """File-like object that hands back what csv.writer writes to it"""
+    def write(self, value):
+        return value
+
+def export_chunks(documents, output, batch_size):
+    """Render documents as NDJSON or CSV text, one chunk per batch_size rows"""
+    if output == 'csv':
+        writer = csv.writer(Echo())
+        render = lambda data: writer.writerow([data.get(column, '') for column in EXPORT_COLUMNS])
+        lines = [writer.writerow(EXPORT_COLUMNS)]
+    else:
+        render = lambda data: json.dumps(data, separators=(',', ':')) + '\n'
+        lines = []
+    
+    for doc in documents:
+        data = document_to_dict(doc)
+        data.pop('_id')
+        lines.append(render(data))
+        if len(lines) >= batch_size:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def property_export_mongodb(request):
+    """
+    Stream every listing matching the list filters as NDJSON or CSV.
+    
+    ``output=ndjson`` (default) or ``output=csv``. Rows come in ``_id`` order;
+    pass the ``id`` of the last row received as ``after`` to resume an
+    interrupted export. Owner details are never exported.
+    """
+    output = request.GET.get('output', 'ndjson')
+    if output not in EXPORT_FORMATS:
+        raise ValidationError({'output': f'Expected one of: {", ".join(EXPORT_FORMATS)}.'})
+    
+    try:
+        batch_size = min(int(request.GET.get('batch_size', EXPORT_BATCH_SIZE)), MAX_EXPORT_BATCH_SIZE)
+        if batch_size < 1:
+            raise ValueError
+    except ValueError:
+        raise ValidationError({'batch_size': f'Expected a number between 1 and {MAX_EXPORT_BATCH_SIZE}.'})
+    
+    # Same filters as the list view; radius searches use their unsorted
+    # $geoWithin form so the export can run in _id order
+    filters = build_property_filters(request.GET)
+    search = request.GET.get('search')
+    if search:
+        filters.update(PropertyMongoDB.search_filters(search))
+    _, geo_filters, _ = build_geo_filters(request.GET)
+    filters.update(geo_filters)
+    
+    after = request.GET.get('after')
+    if after:
+        try:
+            filters['_id'] = {'$gt': ObjectId(after)}
+        except InvalidId:
+            raise ValidationError({'after': 'Expected a property id.'})
+    
+    documents = PropertyMongoDB.iter_documents(
+        filters, sort=[('_id', 1)], batch_size=batch_size,
+        projection={field: 1 for field in PROPERTY_FIELDS}
+    )
+    content_type, extension = EXPORT_FORMATS[output]
+    response = StreamingHttpResponse(export_chunks(documents, output, batch_size), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="properties.{extension}"'
+    # Let proxies pass chunks through as they are produced
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+@api_view(['GET', 'PUT', 'PATCH', 'DELETE'])
 @permission_classes([IsAuthenticatedOrReadOnly])
 def property_detail_mongodb(request, pk):
     """MongoDB-based property detail endpoint"""
     
+    # Answer revalidation from updated_at/version alone, without loading
+    # and serializing the document
+    favorites = None
+    if request.method == 'GET' and request.user.is_authenticated:
+        favorites = get_favorite_state(request.user)
+    favorites_version = favorites and favorites['version']
+    
+    if request.method == 'GET' and is_conditional(request):
+        validators = PropertyMongoDB.find_validators(pk)
+        if validators:
+            response = not_modified(
+                request, property_etag(validators, favorites_version), validators.get('updated_at'),
+                vary_on_user=True
+            )
+            if response is not None:
+                return response
+    
     try:
         property_obj = PropertyMongoDB.find_by_id(pk)
         if not property_obj:
@@ -201,9 +448,14 @@ def property_detail_mongodb(request, pk):
         return Response({'error': 'Invalid property ID'}, status=status.HTTP_400_BAD_REQUEST)
     
     if request.method == 'GET':
-        return Response(property_to_dict(property_obj, include_owner_info=True, request_user=request.user))
+        data = property_to_dict(property_obj, include_owner_info=True, request_user=request.user)
+        annotate_favorites(request.user, [data], favorites)
+        return set_validators(
+            Response(data), property_etag(property_obj.to_dict(), favorites_version), property_obj.updated_at,
+            vary_on_user=True
+        )
     
-    elif request.method == 'PUT':
+    elif request.method in ('PUT', 'PATCH'):
         # Check ownership for updates
         if not request.user.is_authenticated:
             return Response({'error': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
@@ -215,31 +467,34 @@ def property_detail_mongodb(request, pk):
             return Response({'error': 'You can only edit your own properties'}, 
                           status=status.HTTP_403_FORBIDDEN)
         
+        # Clients that send back the version they read get lost-update
+        # protection; without it the last write wins
+        expected_version = request.data.get('version')
+        if expected_version is not None:
+            try:
+                if isinstance(expected_version, bool) or (
+                    isinstance(expected_version, float) and not expected_version.is_integer()
+                ):
+                    raise ValueError(expected_version)
+                expected_version = int(expected_version)
+            except (TypeError, ValueError):
+                return Response({'version': 'Expected the integer version the property was read at.'},
+                              status=status.HTTP_400_BAD_REQUEST)
+        
         try:
-            data = request.data
-            
-            # Update fields
-            property_obj.title = data.get('title', property_obj.title)
-            property_obj.description = data.get('description', property_obj.description)
-            property_obj.property_type = data.get('property_type', property_obj.property_type)
-            property_obj.status = data.get('status', property_obj.status)
-            property_obj.price = float(data.get('price', property_obj.price))
-            property_obj.bedrooms = int(data.get('bedrooms', property_obj.bedrooms))
-            property_obj.bathrooms = int(data.get('bathrooms', property_obj.bathrooms))
-            property_obj.area = int(data.get('area', property_obj.area))
-            property_obj.address = data.get('address', property_obj.address)
-            property_obj.city = data.get('city', property_obj.city)
-            property_obj.state = data.get('state', property_obj.state)
-            property_obj.zip_code = data.get('zip_code', property_obj.zip_code)
-            property_obj.latitude = float(data.get('latitude', property_obj.latitude))
-            property_obj.longitude = float(data.get('longitude', property_obj.longitude))
-            property_obj.image = data.get('image', property_obj.image)
-            property_obj.featured = bool(data.get('featured', property_obj.featured))
-            property_obj.is_public = bool(data.get('is_public', property_obj.is_public))
+            # Only the fields present in the request are changed and written
+            was_sold = property_obj.status == SOLD_STATUS
+            apply_changes(property_obj, request.data)
+            property_obj.save(expected_version=expected_version)
             
-            property_obj.save()
+            is_sold = property_obj.status == SOLD_STATUS
+            if is_sold != was_sold:
+                adjust_profile_counters(property_obj.owner_id, properties_sold=1 if is_sold else -1)
             return Response(property_to_dict(property_obj, include_owner_info=True, request_user=request.user))
-            
+        
+        except VersionConflict:
+            return Response({'error': 'This property was changed by someone else. Reload it and try again.'},
+                          status=status.HTTP_409_CONFLICT)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
     
@@ -257,12 +512,8 @@ def property_detail_mongodb(request, pk):
         
         property_obj.delete()
         
-        # Update user's property count
-        if hasattr(request.user, 'profile_extended'):
-            profile = request.user.profile_extended
-            if profile.properties_posted > 0:
-                profile.properties_posted -= 1
-                profile.save()
+        # Update the owner's property counts
+        record_listing_deleted(property_obj)
         
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -270,14 +521,88 @@ def property_detail_mongodb(request, pk):
 def property_stats_mongodb(request):
     """MongoDB-based property statistics endpoint"""
     
-    total_properties = PropertyMongoDB.count()
-    for_sale = PropertyMongoDB.count({'status': 'sale'})
-    for_rent = PropertyMongoDB.count({'status': 'rent'})
-    featured = PropertyMongoDB.count({'featured': True})
+    return Response(PropertyMongoDB.stats())
+
+# Geohash prefix length used to bucket markers at each map zoom level (0-20);
+# a cell is roughly a quarter of the visible tile
+ZOOM_GEOHASH_PRECISION = [1, 1, 1, 2, 2, 3, 3, 4, 4, 4, 5, 5, 5, 6, 6, 7, 7, 8, 8, 8, 8]
+
+# Clusters this small are returned as individual markers
+CLUSTER_POINT_THRESHOLD = 5
+
+# Most clusters (and small-cluster groups of markers) in one response; the
+# smallest are dropped past it and the response says so with ``truncated``
+CLUSTER_LIMIT = 1000
+
+@api_view(['GET'])
+def property_clusters_mongodb(request):
+    """MongoDB-based map marker clustering endpoint"""
+    
+    if not (request.GET.get('bbox') or request.GET.get('polygon')):
+        raise ValidationError({'bbox': 'A bbox (or polygon) is required.'})
+    try:
+        zoom = int(request.GET.get('zoom', ''))
+    except ValueError:
+        zoom = -1
+    if not 0 <= zoom < len(ZOOM_GEOHASH_PRECISION):
+        raise ValidationError({'zoom': f'Zoom must be an integer between 0 and {len(ZOOM_GEOHASH_PRECISION) - 1}.'})
+    
+    filters = build_property_filters(request.GET)
+    geo_filters, _, near_point = build_geo_filters(request.GET)
+    if near_point:
+        raise ValidationError({'near': 'Clustering takes a bbox or polygon, not a radius.'})
+    filters.update(geo_filters)
+    
+    precision = ZOOM_GEOHASH_PRECISION[zoom]
+    clusters = []
+    points = []
+    with geo_query_errors():
+        rows, truncated = PropertyMongoDB.clusters(filters, precision, CLUSTER_POINT_THRESHOLD, CLUSTER_LIMIT)
+    for row in rows:
+        if row['count'] <= CLUSTER_POINT_THRESHOLD:
+            for point in row['points']:
+                marker = {'id': str(point['_id'])}
+                marker.update((field, value) for field, value in point.items() if field != '_id')
+                points.append(marker)
+        else:
+            clusters.append({
+                'geohash': row['_id'],
+                'count': row['count'],
+                'latitude': round(row['latitude'], 6),
+                'longitude': round(row['longitude'], 6),
+                'min_price': row['min_price'],
+                'max_price': row['max_price'],
+            })
     
     return Response({
-        'total_properties': total_properties,
-        'for_sale': for_sale,
-        'for_rent': for_rent,
-        'featured': featured
-    })
\ No newline at end of file
+        'zoom': zoom,
+        'precision': precision,
+        'clusters': clusters,
+        'points': points,
+        'truncated': truncated,
+    })
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def mongodb_health(request):
+    """Ping MongoDB and report this worker's pool and cache counters (staff only)"""
+    engine = get_engine()
+    data = {
+        'pid': os.getpid(),
+        'engine': engine.name,
+        'max_pool_size': settings.MONGODB_SETTINGS.get('max_pool_size'),
+    }
+    started = time.perf_counter()
+    try:
+        engine.ping()
+        data['status'] = 'ok'
+        data['ping_ms'] = round((time.perf_counter() - started) * 1000, 3)
+        response_status = status.HTTP_200_OK
+    except PyMongoError as e:
+        data['status'] = 'unavailable'
+        data['error'] = e.__class__.__name__
+        response_status = status.HTTP_503_SERVICE_UNAVAILABLE
+    data['pool'] = pool_stats.snapshot()
+    data['document_cache'] = property_cache.stats()
+    return Response(data, status=response_status)
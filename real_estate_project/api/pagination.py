@@ -0,0 +1,228 @@
+import base64
+import hashlib
+from bson import ObjectId, json_util
+from bson.errors import InvalidId
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class MongoCursorPagination:
+    """
+    Keyset pagination for PropertyMongoDB queries.
+
+    Pages are addressed by an opaque cursor holding the sort value and ``_id``
+    of the boundary document, so every page is an indexed range scan instead
+    of a skip over all previous rows. ``?page=N`` switches to page-number mode
+    for clients that need to jump to an arbitrary page. Text search results
+    ordered by relevance and radius searches ordered by distance are always
+    page-numbered, since neither ranking can be used as a keyset.
+    """
+    page_size = settings.REST_FRAMEWORK.get('PAGE_SIZE', 12)
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    page_query_param = 'page'
+    page_size_query_param = 'page_size'
+    invalid_cursor_message = 'Invalid cursor'
+    invalid_page_message = 'Invalid page.'
+    relevance_ordering = 'relevance'
+    distance_ordering = 'distance'
+
+    # Totals are only indicative, so they are cached instead of being
+    # recounted on every page request
+    count_cache_timeout = 60
+
+    def paginate(self, model, filters, ordering, request, projection=None, count_filters=None):
+        """
+        Return one page of raw ``model`` documents matching ``filters``.
+        
+        ``count_filters`` replaces ``filters`` for the total when the query
+        uses an operator count_documents rejects, such as $nearSphere.
+        """
+        query = self.prepare(model, filters, ordering, request, projection, count_filters)
+        return self.process_results(model.find_documents(**query))
+
+    async def apaginate(self, model, filters, ordering, request, projection=None, count_filters=None):
+        """paginate() for an async data layer such as AsyncPropertyMongoDB"""
+        query = self.prepare(model, filters, ordering, request, projection, count_filters)
+        return self.process_results(await model.find_documents(**query))
+
+    def prepare(self, model, filters, ordering, request, projection, count_filters):
+        """Record the request and return the find_documents() arguments for the page"""
+        self.request = request
+        # Plain Django requests (the async views) have no DRF query_params
+        self.query_params = getattr(request, 'query_params', request.GET)
+        self.model = model
+        self.filters = filters or {}
+        self.count_filters = self.filters if count_filters is None else count_filters
+        self.projection = projection
+        self.page_size = self.get_page_size(request)
+
+        self.relevance = ordering == self.relevance_ordering
+        self.distance = ordering == self.distance_ordering
+        self.sort_field = ordering.lstrip('-')
+        self.sort_direction = -1 if ordering.startswith('-') else 1
+        self.next_url = None
+        self.previous_url = None
+
+        self.by_page_number = (
+            self.relevance or self.distance or self.page_query_param in self.query_params
+        )
+        if self.by_page_number:
+            return self.get_page_number_query()
+        return self.get_cursor_query()
+
+    def process_results(self, results):
+        if self.by_page_number:
+            return self.process_page_number_results(results)
+        return self.process_cursor_results(results)
+
+    def get_page_size(self, request):
+        page_size = getattr(request, 'query_params', request.GET).get(self.page_size_query_param)
+        if page_size:
+            try:
+                page_size = int(page_size)
+                if page_size > 0:
+                    return min(page_size, self.max_page_size)
+            except ValueError:
+                pass
+        return self.page_size
+
+    def get_sort(self, direction):
+        if self.relevance:
+            return [('score', {'$meta': 'textScore'}), ('_id', -1)]
+        if self.distance:
+            # $nearSphere already returns the nearest documents first
+            return None
+        return [(self.sort_field, direction), ('_id', direction)]
+
+    def get_page_number_query(self):
+        try:
+            self.page_number = int(self.query_params.get(self.page_query_param, 1))
+            if self.page_number < 1:
+                raise ValueError
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_page_message)
+
+        return {
+            'filters': self.filters,
+            'sort': self.get_sort(self.sort_direction),
+            'skip': (self.page_number - 1) * self.page_size,
+            'limit': self.page_size + 1,
+            'projection': self.projection,
+        }
+
+    def process_page_number_results(self, results):
+        url = remove_query_param(self.request.build_absolute_uri(), self.cursor_query_param)
+        if len(results) > self.page_size:
+            results = results[:self.page_size]
+            self.next_url = replace_query_param(url, self.page_query_param, self.page_number + 1)
+        if self.page_number > 1:
+            self.previous_url = replace_query_param(url, self.page_query_param, self.page_number - 1)
+
+        return results
+
+    def get_cursor_query(self):
+        encoded = self.query_params.get(self.cursor_query_param)
+        self.position, self.reverse = self.decode_cursor(encoded) if encoded else (None, False)
+
+        # Walking backwards means scanning the index in the opposite direction
+        # and flipping the page back afterwards
+        direction = -self.sort_direction if self.reverse else self.sort_direction
+        filters = self.filters
+        if self.position is not None:
+            filters = {'$and': [self.filters, self.get_keyset_filter(self.position, direction)]}
+
+        return {
+            'filters': filters,
+            'sort': self.get_sort(direction),
+            'limit': self.page_size + 1,
+            'projection': self.projection,
+        }
+
+    def process_cursor_results(self, results):
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if self.reverse:
+            results.reverse()
+
+        if results:
+            if self.reverse:
+                has_next, has_previous = True, has_more
+            else:
+                has_next, has_previous = has_more, self.position is not None
+            if has_next:
+                self.next_url = self.encode_cursor(results[-1], reverse=False)
+            if has_previous:
+                self.previous_url = self.encode_cursor(results[0], reverse=True)
+
+        return results
+
+    def get_keyset_filter(self, position, direction):
+        value, object_id = position
+        operator = '$gt' if direction == 1 else '$lt'
+        return {'$or': [
+            {self.sort_field: {operator: value}},
+            {self.sort_field: value, '_id': {operator: object_id}},
+        ]}
+
+    def encode_cursor(self, document, reverse):
+        payload = json_util.dumps({
+            'v': document.get(self.sort_field),
+            'id': document['_id'],
+            'r': reverse,
+        })
+        encoded = base64.urlsafe_b64encode(payload.encode('ascii')).decode('ascii')
+        url = remove_query_param(self.request.build_absolute_uri(), self.page_query_param)
+        return replace_query_param(url, self.cursor_query_param, encoded)
+
+    def decode_cursor(self, encoded):
+        try:
+            payload = json_util.loads(base64.urlsafe_b64decode(encoded.encode('ascii')))
+            object_id = payload['id']
+            if not isinstance(object_id, ObjectId):
+                object_id = ObjectId(object_id)
+            return (payload['v'], object_id), bool(payload.get('r', False))
+        except (TypeError, ValueError, KeyError, InvalidId):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_count_cache_key(self):
+        return 'properties:count:' + hashlib.md5(
+            json_util.dumps(self.count_filters, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+
+    def get_count(self):
+        """Return a cached total, estimated from metadata when unfiltered"""
+        if not self.count_filters:
+            return self.model.estimated_count()
+
+        key = self.get_count_cache_key()
+        count = cache.get(key)
+        if count is None:
+            count = self.model.count(self.count_filters)
+            cache.set(key, count, self.count_cache_timeout)
+        return count
+
+    async def aget_count(self):
+        if not self.count_filters:
+            return await self.model.estimated_count()
+
+        key = self.get_count_cache_key()
+        count = await cache.aget(key)
+        if count is None:
+            count = await self.model.count(self.count_filters)
+            await cache.aset(key, count, self.count_cache_timeout)
+        return count
+
+    def get_paginated_data(self, data, count):
+        return {
+            'count': count,
+            'next': self.next_url,
+            'previous': self.previous_url,
+            'results': data
+        }
+
+    def get_paginated_response(self, data):
+        return Response(self.get_paginated_data(data, self.get_count()))
@@ -0,0 +1,235 @@
+"""
+Synthetic, deterministic data for benchmarks and local load testing.
+
+Listings follow the shape of a real marketplace rather than uniform noise:
+a few large metros hold most of the inventory (Zipf-distributed cities),
+prices are log-normal around each metro's median and scale with size, and
+coordinates cluster around city centres. The same seed always produces the
+same users, listings and favorites.
+"""
+import math
+import random
+from collections import Counter
+from datetime import datetime, timedelta
+from django.contrib.auth.hashers import make_password
+from accounts.models import FavoriteProperty, User, UserProfile
+from webapp.mongodb_models import PropertyMongoDB
+
+# Seeded rows are tagged so they can be found and removed again
+SEED_EMAIL_DOMAIN = 'seed.example.com'
+SEED_EXTERNAL_ID_PREFIX = 'seed-'
+SEED_PASSWORD = 'seed-password'
+
+# (city, state, latitude, longitude, median sale price), largest market first
+CITIES = (
+    ('New York', 'NY', 40.7128, -74.0060, 780000),
+    ('Los Angeles', 'CA', 34.0522, -118.2437, 950000),
+    ('Chicago', 'IL', 41.8781, -87.6298, 330000),
+    ('Houston', 'TX', 29.7604, -95.3698, 310000),
+    ('Phoenix', 'AZ', 33.4484, -112.0740, 420000),
+    ('Philadelphia', 'PA', 39.9526, -75.1652, 260000),
+    ('San Antonio', 'TX', 29.4241, -98.4936, 280000),
+    ('San Diego', 'CA', 32.7157, -117.1611, 900000),
+    ('Dallas', 'TX', 32.7767, -96.7970, 390000),
+    ('Austin', 'TX', 30.2672, -97.7431, 520000),
+    ('Seattle', 'WA', 47.6062, -122.3321, 850000),
+    ('Denver', 'CO', 39.7392, -104.9903, 590000),
+    ('Boston', 'MA', 42.3601, -71.0589, 820000),
+    ('Miami', 'FL', 25.7617, -80.1918, 600000),
+    ('Atlanta', 'GA', 33.7490, -84.3880, 400000),
+    ('Portland', 'OR', 45.5152, -122.6784, 540000),
+    ('Nashville', 'TN', 36.1627, -86.7816, 470000),
+    ('Minneapolis', 'MN', 44.9778, -93.2650, 330000),
+    ('Raleigh', 'NC', 35.7796, -78.6382, 430000),
+    ('Boise', 'ID', 43.6150, -116.2023, 480000),
+)
+CITY_WEIGHTS = [1 / (rank ** 1.1) for rank in range(1, len(CITIES) + 1)]
+
+# (property type, weight, price multiplier, (min, max) bedrooms)
+PROPERTY_TYPES = (
+    ('house', 45, 1.0, (2, 6)),
+    ('apartment', 30, 0.55, (0, 3)),
+    ('condo', 15, 0.7, (1, 3)),
+    ('townhouse', 8, 0.8, (2, 4)),
+    ('land', 2, 0.35, (0, 0)),
+)
+
+STATUSES = ('sale', 'rent', 'sold', 'rented')
+STATUS_WEIGHTS = (60, 30, 7, 3)
+
+ADJECTIVES = ('Bright', 'Spacious', 'Renovated', 'Charming', 'Modern', 'Quiet', 'Sunny', 'Historic', 'Cozy', 'Luxury')
+FEATURES = (
+    'hardwood floors', 'an open kitchen', 'a large backyard', 'city views', 'a two-car garage',
+    'a walk-in closet', 'new appliances', 'a private balcony', 'a finished basement', 'a pool',
+)
+STREETS = ('Main St', 'Oak Ave', 'Maple Dr', 'Cedar Ln', 'Park Blvd', 'Lake Rd', 'Hill St', 'River Way')
+
+
+def user_email(index):
+    return f'user{index}@{SEED_EMAIL_DOMAIN}'
+
+
+def generate_property(rng, index, owner_id, now):
+    """One realistic listing as a PropertyMongoDB instance"""
+    city, state, latitude, longitude, median_price = rng.choices(CITIES, weights=CITY_WEIGHTS)[0]
+    property_type, _, type_multiplier, (min_beds, max_beds) = rng.choices(
+        PROPERTY_TYPES, weights=[weight for _, weight, _, _ in PROPERTY_TYPES]
+    )[0]
+    status = rng.choices(STATUSES, weights=STATUS_WEIGHTS)[0]
+
+    bedrooms = rng.randint(min_beds, max_beds)
+    bathrooms = max(1, bedrooms - rng.randint(0, 1)) if property_type != 'land' else 0
+    area = int(rng.gauss(450 + 420 * bedrooms, 180)) if property_type != 'land' else rng.randint(5000, 80000)
+    area = max(area, 250)
+
+    # Log-normal around the metro median, scaled by type and size
+    size_factor = (area / 1500) ** 0.6 if property_type != 'land' else 0.5
+    price = median_price * type_multiplier * size_factor * math.exp(rng.gauss(0, 0.35))
+    if status in ('rent', 'rented'):
+        # Monthly rent, roughly 0.5% of the sale value
+        price = round(price * 0.005, -1)
+    else:
+        price = round(price, -3)
+
+    created_at = now - timedelta(minutes=rng.randint(0, 2 * 365 * 24 * 60))
+    adjective = rng.choice(ADJECTIVES)
+    return PropertyMongoDB(
+        title=f'{adjective} {bedrooms}-bed {property_type} in {city}' if bedrooms else f'{adjective} {property_type} in {city}',
+        description=(
+            f'{adjective} {property_type} with {rng.choice(FEATURES)} and {rng.choice(FEATURES)}. '
+            f'Close to downtown {city}, schools and transit.'
+        ),
+        property_type=property_type,
+        status=status,
+        price=float(price),
+        bedrooms=bedrooms,
+        bathrooms=bathrooms,
+        area=area,
+        address=f'{rng.randint(1, 9999)} {rng.choice(STREETS)}',
+        city=city,
+        state=state,
+        zip_code=f'{rng.randint(10000, 99999)}',
+        # Listings cluster around the centre, thinning out towards the suburbs
+        latitude=round(latitude + rng.gauss(0, 0.08), 6),
+        longitude=round(longitude + rng.gauss(0, 0.1), 6),
+        featured=rng.random() < 0.03,
+        owner_id=str(owner_id),
+        created_by_id=str(owner_id),
+        contact_info={'email': user_email(owner_id), 'phone': '+15555550100'},
+        external_id=f'{SEED_EXTERNAL_ID_PREFIX}{index}',
+        created_at=created_at,
+        updated_at=created_at,
+        version=1,
+    )
+
+
+def seed_users(rng, count):
+    """
+    Create ``count`` users: one in five a verified agent or seller.
+
+    Returns ``(sellers, buyers)`` as lists of user ids. Every user's password
+    is SEED_PASSWORD; it is hashed once and shared to keep seeding fast.
+    """
+    password = make_password(SEED_PASSWORD)
+    existing = User.objects.filter(email__endswith='@' + SEED_EMAIL_DOMAIN).count()
+    users = []
+    for i in range(existing, existing + count):
+        user_type = rng.choices(('buyer', 'seller', 'agent'), weights=(80, 8, 12))[0]
+        users.append(User(
+            username=f'seed_user{i}',
+            email=user_email(i),
+            password=password,
+            first_name=f'Seed{i}',
+            last_name='User',
+            user_type=user_type,
+            is_verified=user_type != 'buyer',
+        ))
+    User.objects.bulk_create(users, batch_size=1000)
+
+    created = User.objects.filter(email__endswith='@' + SEED_EMAIL_DOMAIN).order_by('id')[existing:]
+    sellers = []
+    buyers = []
+    for user_id, user_type in created.values_list('id', 'user_type'):
+        (buyers if user_type == 'buyer' else sellers).append(user_id)
+    UserProfile.objects.bulk_create(
+        [UserProfile(user_id=user_id) for user_id in sellers + buyers], batch_size=1000
+    )
+    return sellers, buyers
+
+
+def seed_properties(rng, count, owner_ids, batch_size=5000, start=None):
+    """
+    Insert ``count`` listings, owned with a skew towards a few busy agents.
+
+    Returns the listings posted per owner id.
+    """
+    collection = PropertyMongoDB.get_collection()
+    start = collection.count_documents({'external_id': {'$regex': f'^{SEED_EXTERNAL_ID_PREFIX}'}}) if start is None else start
+    owner_weights = [1 / (rank ** 0.8) for rank in range(1, len(owner_ids) + 1)]
+    now = datetime.now()
+    posted = Counter()
+
+    for batch_start in range(start, start + count, batch_size):
+        batch_end = min(batch_start + batch_size, start + count)
+        owners = rng.choices(owner_ids, weights=owner_weights, k=batch_end - batch_start)
+        posted.update(owners)
+        collection.insert_many(
+            [generate_property(rng, index, owner, now).to_dict() for index, owner in zip(range(batch_start, batch_end), owners)],
+            ordered=False
+        )
+    return posted
+
+
+def seed_favorites(rng, buyer_ids, per_user, sample_size=5000):
+    """Give each buyer about ``per_user`` favorites, with snapshots of title and price"""
+    if not buyer_ids or per_user <= 0:
+        return 0
+    listings = list(PropertyMongoDB.get_collection().aggregate([
+        {'$sample': {'size': sample_size}},
+        {'$project': {'title': 1, 'price': 1}},
+    ]))
+    if not listings:
+        return 0
+
+    # Popular listings collect most of the favorites
+    weights = [1 / (rank ** 0.9) for rank in range(1, len(listings) + 1)]
+    favorites = []
+    for user_id in buyer_ids:
+        picks = {str(doc['_id']): doc for doc in rng.choices(listings, weights=weights, k=rng.randint(0, per_user * 2))}
+        favorites.extend(
+            FavoriteProperty(user_id=user_id, property_id=property_id,
+                             property_title=doc['title'][:200], property_price=doc['price'])
+            for property_id, doc in picks.items()
+        )
+    FavoriteProperty.objects.bulk_create(favorites, batch_size=1000, ignore_conflicts=True)
+    return len(favorites)
+
+
+def seed(count, users=None, favorites_per_user=3, seed=42, batch_size=5000):
+    """Seed users, listings and favorites; returns the counts created"""
+    rng = random.Random(seed)
+    users = users if users is not None else max(count // 20, 10)
+
+    sellers, buyers = seed_users(rng, users)
+    if not sellers:
+        sellers, buyers = buyers[:1], buyers[1:]
+        User.objects.filter(id=sellers[0]).update(user_type='agent', is_verified=True)
+
+    posted = seed_properties(rng, count, sellers, batch_size)
+    for owner_id, listings in posted.items():
+        UserProfile.objects.filter(user_id=owner_id).update(properties_posted=listings)
+    PropertyMongoDB.invalidate_stats()
+
+    favorites = seed_favorites(rng, buyers, favorites_per_user)
+    return {'users': len(sellers) + len(buyers), 'properties': count, 'favorites': favorites}
+
+
+def clear():
+    """Remove everything seed() created"""
+    deleted = PropertyMongoDB.get_collection().delete_many(
+        {'external_id': {'$regex': f'^{SEED_EXTERNAL_ID_PREFIX}'}}
+    ).deleted_count
+    # Profiles and favorites go with their users
+    _, deleted_by_model = User.objects.filter(email__endswith='@' + SEED_EMAIL_DOMAIN).delete()
+    PropertyMongoDB.invalidate_stats()
+    return {'properties': deleted, 'users': deleted_by_model.get(User._meta.label, 0)}
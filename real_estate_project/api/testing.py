@@ -0,0 +1,129 @@
+"""
+Test helpers for asserting how many queries an endpoint runs.
+
+Counts come from the request profile QueryInstrumentationMiddleware
+attaches to each request, so they cover SQL and MongoDB alike.
+"""
+import functools
+import random
+import unittest
+from datetime import datetime
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from accounts.authentication import user_cache
+from accounts.saved_searches import saved_search_index
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+from webapp.mongodb_cache import property_cache
+from webapp.mongodb_indexes import PROPERTY_INDEXES, create_index
+from webapp.mongodb_models import PropertyMongoDB
+from webapp.mongodb_storage import get_engine
+from . import seeding
+
+# Every budget is checked at each of these data sizes; a budget that holds
+# at all of them is a constant, not a count that grows with the data
+DATA_SIZES = (3, 30)
+
+
+@functools.lru_cache(maxsize=None)
+def mongo_available():
+    client = MongoClient(settings.MONGODB_SETTINGS['host'], serverSelectionTimeoutMS=1000, connect=False)
+    try:
+        client.admin.command('ping')
+        return True
+    except PyMongoError:
+        return False
+    finally:
+        client.close()
+
+
+class QueryBudgetMixin:
+    """
+    ``assertQueryBudget(response, sql=..., mongo=...)`` fails when the
+    request behind ``response`` ran more queries than budgeted.
+    """
+
+    def setUp(self):
+        super().setUp()
+        # Budgets are for a cold request: nothing served from a cache
+        for each in caches.all():
+            each.clear()
+        property_cache.clear()
+        saved_search_index.clear()
+        user_cache.clear()
+
+    def assertQueryBudget(self, response, sql=None, mongo=None):
+        request = getattr(response, 'wsgi_request', None) or response.asgi_request
+        profile = request._query_profile
+        if sql is not None:
+            self.assertLessEqual(
+                profile.sql.count, sql,
+                f'{request.method} {request.path} ran {profile.sql.count} SQL queries, budget is {sql}: '
+                f'{[operation for _, operation in profile.sql.slowest]}'
+            )
+        if mongo is not None:
+            self.assertLessEqual(
+                profile.mongo.count, mongo,
+                f'{request.method} {request.path} ran {profile.mongo.count} MongoDB commands, budget is {mongo}: '
+                f'{[operation for _, operation in profile.mongo.slowest]}'
+            )
+
+
+class MongoTestMixin(QueryBudgetMixin):
+    """
+    Listings in a scratch database of MONGODB_SETTINGS['test_engine'].
+
+    The in-memory engine (the default) always runs; with 'mongo' the tests
+    are skipped when MONGODB_SETTINGS['host'] does not answer. Each test
+    starts from an empty, indexed collection.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        engine = settings.MONGODB_SETTINGS.get('test_engine', 'memory')
+        if engine == 'mongo' and not mongo_available():
+            raise unittest.SkipTest(f'MongoDB is not reachable at {settings.MONGODB_SETTINGS["host"]}')
+        cls._mongo_settings = override_settings(MONGODB_SETTINGS=dict(
+            settings.MONGODB_SETTINGS, engine=engine, db=settings.MONGODB_SETTINGS['db'] + '_test'
+        ))
+        cls._mongo_settings.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        get_engine().drop_database()
+        cls._mongo_settings.disable()
+
+    def setUp(self):
+        super().setUp()
+        collection = PropertyMongoDB.get_collection()
+        collection.drop()
+        for spec in PROPERTY_INDEXES:
+            create_index(collection, spec)
+        self.rng = random.Random(42)
+
+    def grow_listings(self, total, owners):
+        """Add listings, spread over ``owners``, until there are ``total``"""
+        existing = PropertyMongoDB.count()
+        now = datetime.now()
+        docs = [
+            seeding.generate_property(self.rng, index, owners[index % len(owners)].id, now).to_dict()
+            for index in range(existing, total)
+        ]
+        if docs:
+            PropertyMongoDB.get_collection().insert_many(docs)
+        cache.clear()
+        property_cache.clear()
+        PropertyMongoDB.invalidate_stats()
+        return [str(doc['_id']) for doc in PropertyMongoDB.find_documents(projection={'_id': 1})]
+
+
+class MongoTestCase(MongoTestMixin, TestCase):
+    pass
+
+
+class MongoTransactionTestCase(MongoTestMixin, TransactionTestCase):
+    """For views that run their SQL in other threads, where a TestCase's uncommitted data is not visible"""
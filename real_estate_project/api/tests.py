@@ -1,3 +1,1108 @@
-from django.test import TestCase
+"""
+Query budgets for every endpoint in api/urls.py, then what the listing
+endpoints return.
 
-# Create your tests here.
+Each budget test requests an endpoint at every size in DATA_SIZES and fails
+when a request runs more SQL queries or MongoDB commands than its budget, so
+a per-row lookup (N+1) shows up as soon as the data grows. Budgets are for a
+cold request; tokens carry the user's permission claims, so authentication
+itself runs no SQL query. The ListingTestCase classes check behaviour on a
+few hand-placed listings.
+"""
+import csv
+import json
+import os
+import sys
+import tempfile
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.http import Http404
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+from rest_framework.test import APIClient
+from accounts.authentication import ClaimsRefreshToken
+from accounts.favorites import favorite_ids_cache_key
+from accounts.models import User, UserProfile
+from webapp import geo
+from webapp.models import Property
+from webapp.mongodb_cache import property_cache
+from webapp.mongodb_models import PropertyMongoDB
+from .bulk import MAX_BULK_ROWS
+from .checks import check_metrics_directory
+from .instrumentation import RequestProfile, current_profile, get_config, sql_execute_wrapper
+from .metrics import (
+    http_request_duration, http_requests, metrics_view, process_start, record_request, registry, TOTAL_FILE
+)
+from .mongodb_views import CLUSTER_POINT_THRESHOLD, EXPORT_COLUMNS
+from .testing import DATA_SIZES, MongoTestCase, MongoTransactionTestCase, QueryBudgetMixin
+
+
+def make_user(name, user_type='agent', **extra):
+    user = User.objects.create_user(
+        username=name, email=f'{name}@example.com', password='secret-pass-123',
+        first_name=name.title(), last_name='Tester', user_type=user_type,
+        is_verified=user_type != 'buyer', **extra
+    )
+    UserProfile.objects.create(user=user)
+    return user
+
+
+def bearer(user):
+    return {'HTTP_AUTHORIZATION': f'Bearer {ClaimsRefreshToken.for_user(user).access_token}'}
+
+
+class PropertyEndpointQueryTests(MongoTestCase):
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owners = [make_user(f'owner{i}') for i in range(5)]
+        cls.agent = cls.owners[0]
+        cls.buyer = make_user('buyer', user_type='buyer')
+        cls.admin = make_user('admin', is_staff=True)
+
+    def test_list(self):
+        for size in DATA_SIZES:
+            with self.subTest(size=size):
+                self.grow_listings(size, self.owners)
+                response = self.client.get('/api/properties/', {'page_size': 50})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(len(response.data['results']), size)
+                # Owner cards for the whole page in one query
+                self.assertQueryBudget(response, sql=1, mongo=2)
+
+    def test_list_authenticated(self):
+        for size in DATA_SIZES:
+            with self.subTest(size=size):
+                self.grow_listings(size, self.owners)
+                response = self.client.get('/api/properties/', {'page_size': 50}, **bearer(self.buyer))
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(all(item['is_favorited'] is False for item in response.data['results']))
+                # Owner cards and the user's favorite ids
+                self.assertQueryBudget(response, sql=2, mongo=2)
+
+    def test_list_favorited(self):
+        ids = self.grow_listings(DATA_SIZES[-1], self.owners)
+        self.client.get('/api/properties/', {'page_size': 50}, **bearer(self.buyer))
+        self.client.post('/api/auth/favorites/bulk/', {'add': ids[:2]}, format='json', **bearer(self.buyer))
+        response = self.client.get('/api/properties/', {'page_size': 50}, **bearer(self.buyer))
+        self.assertEqual({item['id'] for item in response.data['results'] if item['is_favorited']}, set(ids[:2]))
+        # Owner cards and favorite ids are cached; the bulk endpoint updated the ids
+        self.assertQueryBudget(response, sql=0)
+
+        # Favoriting another listing changes the tag of every page
+        etag = response['ETag']
+        self.client.post('/api/auth/favorites/bulk/', {'add': ids[2:3]}, format='json', **bearer(self.buyer))
+        response = self.client.get('/api/properties/', {'page_size': 50}, HTTP_IF_NONE_MATCH=etag, **bearer(self.buyer))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sum(item['is_favorited'] for item in response.data['results']), 3)
+
+    def test_list_favorited_elsewhere(self):
+        ids = self.grow_listings(DATA_SIZES[0], self.owners)
+        response = self.client.get('/api/properties/', **bearer(self.buyer))
+        etag = response['ETag']
+        stale = cache.get(favorite_ids_cache_key(self.buyer.pk))
+        # Favorited through another process, whose cached set this one does not see
+        self.client.post('/api/auth/favorites/bulk/', {'add': ids[:1]}, format='json', **bearer(self.buyer))
+        cache.set(favorite_ids_cache_key(self.buyer.pk), stale)
+        response = self.client.get('/api/properties/', HTTP_IF_NONE_MATCH=etag, **bearer(self.buyer))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['id'] for item in response.data['results'] if item['is_favorited']], ids[:1])
+
+    def test_polygon_invalid(self):
+        self.grow_listings(DATA_SIZES[0], self.owners)
+        for polygon in (
+            '-98,30;-97,31;-97,30;-98,31',  # Bowtie: the edges cross
+            '-98,30;-97,30;-96,30',  # All on one line
+            '-98,30;-97,30;-97,31;-97,30;-98,31',  # Visits a point twice
+        ):
+            with self.subTest(polygon=polygon):
+                for url in ('/api/properties/', '/api/properties/clusters/', '/api/async/properties/'):
+                    response = self.client.get(url, {'polygon': polygon, 'zoom': 5})
+                    self.assertEqual(response.status_code, 400)
+                    self.assertIn('polygon', response.json())
+                    # Rejected before any listing is queried
+                    self.assertQueryBudget(response, mongo=0)
+
+    def test_geo_query_rejected(self):
+        # A geometry MongoDB refuses that the planar checks let through
+        self.grow_listings(DATA_SIZES[0], self.owners)
+        rejected = OperationFailure('Loop is not valid', 2, {'errmsg': 'Loop is not valid'})
+        with mock.patch('webapp.mongodb_memory.check_geometry', side_effect=rejected):
+            for url in ('/api/properties/', '/api/properties/clusters/', '/api/async/properties/'):
+                with self.subTest(url=url):
+                    response = self.client.get(url, {'polygon': '-98,30;-97,30;-97,31', 'zoom': 5})
+                    self.assertEqual(response.status_code, 400)
+                    self.assertEqual(response.json(), {'detail': 'Invalid geo query: Loop is not valid'})
+
+    def test_list_search(self):
+        for size in DATA_SIZES:
+            with self.subTest(size=size):
+                self.grow_listings(size, self.owners)
+                response = self.client.get('/api/properties/', {'search': 'downtown', 'page_size': 50})
+                self.assertEqual(response.status_code, 200)
+                self.assertQueryBudget(response, sql=1, mongo=2)
+
+    def test_list_not_modified(self):
+        for size in DATA_SIZES:
+            with self.subTest(size=size):
+                self.grow_listings(size, self.owners)
+                etag = self.client.get('/api/properties/')['ETag']
+                response = self.client.get('/api/properties/', HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 304)
+                # The validators all come from caches
+                self.assertQueryBudget(response, sql=0, mongo=0)
+
+    def test_create(self):
+        for size in DATA_SIZES:
+            with self.subTest(size=size):
+                self.grow_listings(size, self.owners)
+                response = self.client.post('/api/properties/', {
+                    'title': 'New listing', 'price': 250000, 'city': 'Austin', 'state': 'TX',
+                }, format='json', **bearer(self.agent))
+                self.assertEqual(response.status_code, 201)
+                # The owner's row for the contact info, the counter UPDATE,
+                # the owner card and the saved-search match job
+                self.assertQueryBudget(response, sql=4, mongo=1)
+
+    def test_bulk(self):
+        for size in DATA_SIZES:
+            with self.subTest(size=size):
+                rows = [
+                    {'title': f'Bulk {i}', 'price': 100000 + i, 'external_id': f'bulk-{i}'}
+                    for i in range(size)
+                ]
+                response = self.client.post('/api/properties/bulk/', rows, format='json', **bearer(self.agent))
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.data['failed'], 0)
+                # The owner's row for the contact info, the counter UPDATE,
+                # the saved-search match jobs in one INSERT and the favorites
+                # of updated rows; the statuses the upserts overwrite, the
+                # bulk write, then the ids of rows updated through their
+                # external_id
+                self.assertQueryBudget(response, sql=4, mongo=3)
+
+    def test_export(self):
+        for size in DATA_SIZES:
+            with self.subTest(size=size):
+                self.grow_listings(size, self.owners)
+                response = self.client.get('/api/properties/export/', {'batch_size': 10}, **bearer(self.buyer))
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(len(b''.join(response.streaming_content).splitlines()), size)
+                # Listings are read while the body streams, after the profile
+                # is closed; only the request itself is counted here
+                self.assertQueryBudget(response, sql=0, mongo=0)
+
+    def test_clusters(self):
+        for size in DATA_SIZES:
+            with self.subTest(size=size):
+                self.grow_listings(size, self.owners)
+                response = self.client.get('/api/properties/clusters/', {'bbox': '-180,-85,180,85', 'zoom': 3})
+                self.assertEqual(response.status_code, 200)
+                self.assertQueryBudget(response, sql=0, mongo=1)
+
+    def test_detail(self):
+        for size in DATA_SIZES:
+            with self.subTest(size=size):
+                ids = self.grow_listings(size, self.owners)
+                response = self.client.get(f'/api/properties/{ids[-1]}/')
+                self.assertEqual(response.status_code, 200)
+                self.assertQueryBudget(response, sql=1, mongo=1)
+
+    def test_detail_not_modified(self):
+        for size in DATA_SIZES:
+            with self.subTest(size=size):
+                ids = self.grow_listings(size, self.owners)
+                etag = self.client.get(f'/api/properties/{ids[-1]}/')['ETag']
+                response = self.client.get(f'/api/properties/{ids[-1]}/', HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 304)
+                self.assertQueryBudget(response, sql=0, mongo=1)
+
+    def test_update(self):
+        for size in DATA_SIZES:
+            with self.subTest(size=size):
+                ids = self.grow_listings(size, [self.agent])
+                for method in ('put', 'patch'):
+                    response = getattr(self.client, method)(
+                        f'/api/properties/{ids[-1]}/', {'price': 123000}, format='json', **bearer(self.agent)
+                    )
+                    self.assertEqual(response.status_code, 200)
+                    # A new price queues the listing for saved-search
+                    # matching and is copied into its favorites
+                    self.assertQueryBudget(response, sql=3, mongo=2)
+
+    def test_delete(self):
+        for size in DATA_SIZES:
+            with self.subTest(size=size):
+                ids = self.grow_listings(size, [self.agent])
+                response = self.client.delete(f'/api/properties/{ids[-1]}/', **bearer(self.agent))
+                self.assertEqual(response.status_code, 204)
+                # The counter UPDATE
+                self.assertQueryBudget(response, sql=1, mongo=2)
+
+    def test_stats(self):
+        for size in DATA_SIZES:
+            with self.subTest(size=size):
+                self.grow_listings(size, self.owners)
+                response = self.client.get('/api/stats/')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.data['total_properties'], size)
+                self.assertQueryBudget(response, sql=0, mongo=1)
+
+    def test_stats_after_write(self):
+        self.grow_listings(DATA_SIZES[0], self.owners)
+        self.assertEqual(self.client.get('/api/stats/').data['total_properties'], DATA_SIZES[0])
+        PropertyMongoDB(title='New', price=1000, owner_id=str(self.agent.id)).save()
+        # The write moves the shared stats generation on
+        self.assertEqual(self.client.get('/api/stats/').data['total_properties'], DATA_SIZES[0] + 1)
+
+    def test_health(self):
+        response = self.client.get('/api/health/mongodb/', **bearer(self.admin))
+        self.assertEqual(response.status_code, 200)
+        # The staff check reads the token claims
+        self.assertQueryBudget(response, sql=0, mongo=1)
+
+    def test_server_timing(self):
+        self.grow_listings(DATA_SIZES[0], self.owners)
+        self.assertNotIn('Server-Timing', self.client.get('/api/properties/', **bearer(self.buyer)))
+        response = self.client.get('/api/properties/', **bearer(self.admin))
+        self.assertIn('mongo;dur=', response['Server-Timing'])
+
+    @override_settings(REQUEST_INSTRUMENTATION={'slow_query_ms': 0, 'explain_slow_queries': True})
+    def test_slow_queries_logged(self):
+        self.grow_listings(DATA_SIZES[0], self.owners)
+        with self.assertLogs('api.instrumentation', 'WARNING') as logs:
+            response = self.client.get('/api/properties/')
+        self.assertEqual(response.status_code, 200)
+        # The in-memory engine cannot explain, so nothing waits for a plan
+        self.assertTrue(all('"store": "mongo"' in line or '"store": "sql"' in line for line in logs.output))
+
+    def test_slow_sql_params(self):
+        def run(**config):
+            profile = RequestProfile(dict(get_config(), slow_query_ms=0, **config))
+            token = current_profile.set(profile)
+            try:
+                sql_execute_wrapper(lambda *args: None, 'SELECT %s, %s', ['hunter2', 7], False, {})
+            finally:
+                current_profile.reset(token)
+            return profile.slow_queries[0]
+
+        slow_query = run()
+        self.assertEqual((slow_query['param_count'], slow_query['param_types']), (2, ['str', 'int']))
+        self.assertNotIn('params', slow_query)
+        self.assertNotIn('hunter2', json.dumps(slow_query))
+        self.assertEqual(run(log_sql_params=True)['params'], ['hunter2', '7'])
+
+
+
+class ListingTestCase(MongoTestCase):
+    """Behaviour of the listing endpoints, on a few hand-placed listings"""
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owners = [make_user(f'owner{i}') for i in range(2)]
+        cls.agent = cls.owners[0]
+        cls.buyer = make_user('buyer', user_type='buyer')
+
+    def add_listings(self, total, **fields):
+        """Add ``total`` listings with ``fields`` set (callables get the index); returns their ids"""
+        ids = self.grow_listings(PropertyMongoDB.count() + total, self.owners)[-total:]
+        collection = PropertyMongoDB.get_collection()
+        for index, property_id in enumerate(ids):
+            values = {field: value(index) if callable(value) else value for field, value in fields.items()}
+            if values:
+                collection.update_one({'_id': ObjectId(property_id)}, {'$set': values})
+        cache.clear()
+        property_cache.clear()
+        return ids
+
+    def listing_ids(self, response):
+        self.assertEqual(response.status_code, 200, response.content)
+        return [item['id'] for item in response.data['results']]
+
+    def walk(self, params, link='next', response=None):
+        """Pages of ids from following ``link`` from the first page (or ``response``)"""
+        response = response or self.client.get('/api/properties/', params)
+        pages = [self.listing_ids(response)]
+        while response.data[link]:
+            response = self.client.get(response.data[link])
+            pages.append(self.listing_ids(response))
+        return pages, response
+
+
+class PaginationTests(ListingTestCase):
+
+    def expected(self, ids, reverse=False):
+        prices = {
+            str(doc['_id']): doc['price']
+            for doc in PropertyMongoDB.get_collection().find({}, {'price': 1})
+        }
+        return sorted(ids, key=lambda property_id: (prices[property_id], ObjectId(property_id)), reverse=reverse)
+
+    def test_cursor_round_trip(self):
+        # Four prices over 23 listings: most pages split a run of equal prices
+        ids = self.add_listings(23, price=lambda index: 100000 + index % 4 * 1000)
+        for ordering, reverse in (('price', False), ('-price', True)):
+            with self.subTest(ordering=ordering):
+                pages, last = self.walk({'ordering': ordering, 'page_size': 5})
+                self.assertEqual([len(page) for page in pages], [5, 5, 5, 5, 3])
+                self.assertEqual(sum(pages, []), self.expected(ids, reverse))
+                self.assertIn('cursor=', last.data['previous'])
+
+                # Back from the last page through the same pages
+                back, first = self.walk(None, 'previous', last)
+                self.assertEqual(back, pages[::-1])
+                self.assertIsNone(first.data['previous'])
+
+    def test_cursor_skips_new_listings_behind_it(self):
+        ids = self.add_listings(6, price=lambda index: 1000 * index)
+        first = self.client.get('/api/properties/', {'ordering': 'price', 'page_size': 3})
+        # Cheaper than everything on the first page: the next page is unaffected
+        self.add_listings(1, price=0)
+        second = self.client.get(first.data['next'])
+        self.assertEqual(self.listing_ids(second), self.expected(ids)[3:])
+
+    def test_invalid_cursor(self):
+        self.add_listings(2)
+        for cursor in ('not-base64!', 'e30=', ''):
+            with self.subTest(cursor=cursor):
+                response = self.client.get('/api/properties/', {'cursor': cursor})
+                self.assertEqual(response.status_code, 404 if cursor else 200)
+
+    def test_page_numbers(self):
+        ids = self.add_listings(7, price=lambda index: 1000 * index)
+        response = self.client.get('/api/properties/', {'ordering': '-price', 'page_size': 3, 'page': 2})
+        self.assertEqual(self.listing_ids(response), self.expected(ids, reverse=True)[3:6])
+        self.assertIn('page=3', response.data['next'])
+        self.assertIn('page=1', response.data['previous'])
+        self.assertEqual(self.client.get('/api/properties/', {'page': 0}).status_code, 404)
+
+    def test_relevance_and_distance_use_page_numbers(self):
+        self.add_listings(5, title='Sunny loft with pool', latitude=30.2672, longitude=-97.7431,
+                          location={'type': 'Point', 'coordinates': [-97.7431, 30.2672]})
+        for params in ({'search': 'pool'}, {'near': '30.2672,-97.7431', 'radius': 5}):
+            with self.subTest(params=params):
+                pages, _ = self.walk(dict(params, page_size=2))
+                self.assertEqual([len(page) for page in pages], [2, 2, 1])
+                self.assertEqual(len(set(sum(pages, []))), 5)
+                response = self.client.get('/api/properties/', dict(params, page_size=2))
+                self.assertIn('page=2', response.data['next'])
+                self.assertNotIn('cursor=', response.data['next'])
+
+    def test_cached_count(self):
+        self.add_listings(4, price=5000)
+        params = {'min_price': 1000}
+        first = self.client.get('/api/properties/', params)
+        self.assertEqual(first.data['count'], 4)
+        PropertyMongoDB.get_collection().insert_one({'title': 'Direct', 'price': 6000})
+        second = self.client.get('/api/properties/', params)
+        # The total is reused until it expires; the page itself is current
+        self.assertEqual((second.data['count'], len(second.data['results'])), (4, 5))
+        profiles = [response.wsgi_request._query_profile for response in (first, second)]
+        self.assertEqual(profiles[1].mongo.count, profiles[0].mongo.count - 1)
+
+
+
+class SearchTests(ListingTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.add_listings(10)
+
+    def search(self, **params):
+        return self.listing_ids(self.client.get('/api/properties/', params))
+
+    def test_title_outranks_description(self):
+        in_description, in_title = self.add_listings(2, title=lambda index: ['Quiet flat', 'Gazebo cottage'][index],
+                                                     description=lambda index: ['Garden gazebo', 'Quiet'][index])
+        self.assertEqual(self.search(search='gazebo'), [in_title, in_description])
+
+    def test_words_are_stemmed(self):
+        ids = self.add_listings(2, title=lambda index: ['Two gazebos', 'Gazebo'][index])
+        self.assertEqual(sorted(self.search(search='gazebos')), sorted(ids))
+        response = self.client.get('/api/properties/', {'search': 'zeppelin'})
+        self.assertEqual((self.listing_ids(response), response.data['count']), ([], 0))
+
+    def test_filters_apply(self):
+        cheap, _, house = self.add_listings(
+            3, title='Gazebo', price=lambda index: [1000, 900000, 5000][index],
+            property_type=lambda index: ['condo', 'condo', 'house'][index]
+        )
+        self.assertEqual(sorted(self.search(search='gazebo', max_price=10000)), sorted([cheap, house]))
+        self.assertEqual(self.search(search='gazebo', max_price=10000, property_type='house'), [house])
+
+    def test_ordering(self):
+        ids = self.add_listings(4, title='Gazebo', price=lambda index: [3000, 1000, 4000, 2000][index])
+        by_price = [ids[1], ids[3], ids[0], ids[2]]
+        self.assertEqual(self.search(search='gazebo', ordering='price'), by_price)
+        # Ordered by a field, search results page by cursor like any list
+        pages, _ = self.walk({'search': 'gazebo', 'ordering': '-price', 'page_size': 3})
+        self.assertEqual(pages, [by_price[::-1][:3], by_price[:1]])
+
+    def test_model_search(self):
+        in_description, in_title = self.add_listings(2, title=lambda index: ['Quiet flat', 'Gazebo cottage'][index],
+                                                     description=lambda index: ['Garden gazebo', 'Quiet'][index])
+        self.assertEqual([prop.id for prop in PropertyMongoDB.search('gazebo')], [in_title, in_description])
+        self.assertEqual([prop.id for prop in PropertyMongoDB.search('gazebo', limit=1)], [in_title])
+
+
+
+class GeoQueryTests(ListingTestCase):
+    # Due north of the first, about 5.6 km, 33 km and 111 km away
+    PLACES = [(30.0, -97.0), (30.05, -97.0), (30.3, -97.0), (31.0, -97.0)]
+
+    def setUp(self):
+        super().setUp()
+        self.ids = self.add_listings(
+            len(self.PLACES), property_type=lambda index: ['house', 'condo'][index % 2],
+            price=lambda index: 1000 * (index + 1),
+            latitude=lambda index: self.PLACES[index][0], longitude=lambda index: self.PLACES[index][1],
+            location=lambda index: geo.point(*self.PLACES[index])
+        )
+
+    def find(self, **params):
+        return self.listing_ids(self.client.get('/api/properties/', params))
+
+    def test_near(self):
+        response = self.client.get('/api/properties/', {'near': '30.0,-97.0', 'radius': 40})
+        # Nearest first, with the distance
+        self.assertEqual(self.listing_ids(response), self.ids[:3])
+        self.assertEqual(response.data['count'], 3)
+        self.assertAlmostEqual(response.data['results'][1]['distance_km'], 5.56, places=1)
+        self.assertEqual(self.find(near='30.0,-97.0', radius=40, min_price=1500), self.ids[1:3])
+
+    def test_bbox(self):
+        self.assertEqual(sorted(self.find(bbox='-97.1,29.9,-96.9,30.1')), sorted(self.ids[:2]))
+        self.assertEqual(self.find(bbox='-97.1,29.9,-96.9,30.1', property_type='condo'), [self.ids[1]])
+
+    def test_polygon(self):
+        triangle = '-97.2,29.9;-96.8,29.9;-97.0,30.4'
+        self.assertEqual(sorted(self.find(polygon=triangle)), sorted(self.ids[:3]))
+        self.assertEqual(sorted(self.find(polygon=triangle, max_price=2000)), sorted(self.ids[:2]))
+
+    def test_invalid(self):
+        for params in (
+            {'near': '30.0'}, {'near': '95.0,-97.0'}, {'near': '30.0,-97.0', 'radius': 0},
+            {'near': '30.0,-97.0', 'radius': 501}, {'near': '30.0,-97.0', 'search': 'house'},
+            {'bbox': '-97.1,29.9,-96.9'}, {'bbox': '-97.1,29.9,-96.9,100'},
+            {'polygon': '-97.2,29.9;-96.8,29.9'},
+            {'bbox': '-97.1,29.9,-96.9,30.1', 'polygon': '-97.2,29.9;-96.8,29.9;-97.0,30.4'},
+        ):
+            with self.subTest(params=params):
+                self.assertEqual(self.client.get('/api/properties/', params).status_code, 400)
+
+    def test_location_follows_coordinates(self):
+        prop = PropertyMongoDB(title='Moved', latitude=40.0, longitude=-100.0, owner_id=str(self.agent.id)).save()
+        prop = PropertyMongoDB.find_by_id(prop.id)
+        prop.latitude = 30.0
+        prop.longitude = -97.0
+        prop.save()
+        self.assertIn(prop.id, self.find(bbox='-97.1,29.9,-96.9,30.1'))
+
+    def test_backfill(self):
+        object_id = PropertyMongoDB.get_collection().insert_one({
+            'title': 'Before locations', 'price': 1000, 'latitude': 30.0, 'longitude': -97.0,
+        }).inserted_id
+        call_command('backfill_property_locations', stdout=StringIO())
+        self.assertIn(str(object_id), self.find(bbox='-97.1,29.9,-96.9,30.1'))
+
+
+
+class BulkImportTests(ListingTestCase):
+
+    def posted(self, user):
+        return UserProfile.objects.get(user=user).properties_posted
+
+    def sold(self, user):
+        return UserProfile.objects.get(user=user).properties_sold
+
+    def bulk(self, rows, user=None):
+        return self.client.post('/api/properties/bulk/', rows, format='json', **bearer(user or self.agent))
+
+    def test_create_then_upsert(self):
+        response = self.bulk([
+            {'title': 'Feed 1', 'price': 1000, 'external_id': 'feed-1'},
+            {'title': 'Feed 2', 'price': 2000, 'external_id': 'feed-2'},
+            {'title': 'Walk-in', 'price': 3000},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['created'], response.data['updated'], response.data['failed']), (3, 0, 0))
+
+        response = self.bulk({'properties': [{'title': 'Feed 1', 'price': 1500, 'external_id': 'feed-1'}]})
+        self.assertEqual((response.data['created'], response.data['updated']), (0, 1))
+        docs = list(PropertyMongoDB.get_collection().find({'external_id': 'feed-1'}))
+        self.assertEqual([doc['price'] for doc in docs], [1500])
+        # Only new listings count, once per owner per request
+        self.assertEqual(self.posted(self.agent), 3)
+
+    def test_sold_counts(self):
+        self.bulk([
+            {'title': 'Feed 1', 'external_id': 'feed-1', 'status': 'sold'},
+            {'title': 'Feed 2', 'external_id': 'feed-2'},
+            {'title': 'Walk-in', 'status': 'sold'},
+        ])
+        self.assertEqual((self.posted(self.agent), self.sold(self.agent)), (3, 2))
+        # Updates move listings to and from sold
+        self.bulk([
+            {'title': 'Feed 1', 'external_id': 'feed-1', 'status': 'rent'},
+            {'title': 'Feed 2', 'external_id': 'feed-2', 'status': 'sold'},
+        ])
+        self.assertEqual((self.posted(self.agent), self.sold(self.agent)), (3, 2))
+        # A listing that stays sold is not counted again
+        self.bulk([{'title': 'Feed 2', 'external_id': 'feed-2', 'status': 'sold'}])
+        self.assertEqual(self.sold(self.agent), 2)
+        # The same listing twice in one request: the second row updates the first
+        self.bulk([
+            {'title': 'Feed 3', 'external_id': 'feed-3', 'status': 'sold'},
+            {'title': 'Feed 3', 'external_id': 'feed-3'},
+        ])
+        self.assertEqual((self.posted(self.agent), self.sold(self.agent)), (4, 2))
+
+        rows = [json.dumps({'title': 'Feed 1', 'external_id': 'feed-1', 'status': 'sold'}),
+                json.dumps({'title': 'Feed 4', 'external_id': 'feed-4', 'status': 'sold'})]
+        self.import_file('\n'.join(rows), '.ndjson', '--owner', self.agent.email)
+        self.assertEqual((self.posted(self.agent), self.sold(self.agent)), (5, 4))
+
+    def test_row_errors(self):
+        response = self.bulk([
+            {'title': 'Good', 'price': 1000}, 'not an object', {'title': 'Bad', 'price': 'a lot'}, {'title': 'Good'},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['created'], response.data['failed']), (2, 2))
+        self.assertEqual([error['index'] for error in response.data['errors']], [1, 2])
+        self.assertIn('price', response.data['errors'][1]['error'])
+
+    def test_rejected_requests(self):
+        self.assertEqual(self.bulk([{'title': 'Mine'}], user=self.buyer).status_code, 403)
+        self.assertEqual(self.bulk({'title': 'Not a list'}).status_code, 400)
+        self.assertEqual(self.bulk([{}] * (MAX_BULK_ROWS + 1)).status_code, 400)
+        self.assertEqual(PropertyMongoDB.count(), 0)
+
+    def test_row_owners(self):
+        staff = make_user('staff', is_staff=True)
+        response = self.bulk([
+            {'title': 'For an agent', 'owner_id': self.owners[1].id},
+            {'title': 'For a buyer', 'owner_id': self.buyer.id},
+            {'title': 'Unowned'},
+        ], user=staff)
+        self.assertEqual([error['index'] for error in response.data['errors']], [1])
+        owners = sorted(doc['owner_id'] for doc in PropertyMongoDB.get_collection().find({}, {'owner_id': 1}))
+        self.assertEqual(owners, sorted([str(self.owners[1].id), str(staff.id)]))
+        # Agents cannot post for someone else; owner_id is ignored
+        self.bulk([{'title': 'Not theirs', 'owner_id': self.owners[1].id}])
+        self.assertEqual(PropertyMongoDB.get_collection().find_one({'title': 'Not theirs'})['owner_id'], str(self.agent.id))
+
+    def import_file(self, content, suffix, *args):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, f'feed{suffix}')
+        errors = os.path.join(directory.name, 'errors.ndjson')
+        with open(path, 'w') as f:
+            f.write(content)
+        out = StringIO()
+        call_command('import_properties', path, '--errors-file', errors, *args, stdout=out)
+        with open(errors) as f:
+            return out.getvalue(), [json.loads(line) for line in f]
+
+    def test_import_ndjson(self):
+        rows = [json.dumps({'title': f'Feed {i}', 'price': 1000 + i, 'external_id': f'feed-{i}'}) for i in range(5)]
+        rows.insert(2, '{not json')
+        rows.append(json.dumps({'title': 'Elsewhere', 'owner_id': self.owners[1].id}))
+        out, errors = self.import_file('\n'.join(rows) + '\n', '.ndjson', '--owner', self.agent.email,
+                                       '--batch-size', '2')
+        self.assertIn('Imported 6 of 7 rows', out)
+        # Positions in the whole file, not in the batch
+        self.assertEqual([error['index'] for error in errors], [2])
+        self.assertEqual((self.posted(self.agent), self.posted(self.owners[1])), (5, 1))
+
+        # Importing the feed again updates the same listings
+        out, _ = self.import_file('\n'.join(rows), '.ndjson', '--owner', self.agent.email)
+        self.assertEqual(PropertyMongoDB.count(), 7)
+        self.assertEqual(self.posted(self.agent), 5)
+
+    def test_import_csv(self):
+        content = (
+            'title,price,bedrooms,featured,owner_id\n'
+            f'Loft,250000,2,yes,{self.agent.id}\n'
+            f'Cabin,n/a,1,no,{self.agent.id}\n'
+            f'Barn,90000,,0,{self.buyer.id}\n'
+        )
+        out, errors = self.import_file(content, '.csv')
+        self.assertIn('Imported 1 of 3 rows', out)
+        self.assertEqual([error['index'] for error in errors], [1, 2])
+        doc = PropertyMongoDB.get_collection().find_one({'title': 'Loft'})
+        self.assertEqual((doc['price'], doc['bedrooms'], doc['featured']), (250000.0, 2, True))
+        with self.assertRaises(CommandError):
+            self.import_file(content, '.csv', '--owner', 'nobody@example.com')
+
+
+
+class ClusterTests(ListingTestCase):
+    # One cluster above the marker threshold, one at it and a lone listing,
+    # each in its own two-character geohash cell (zoom 3)
+    PLACES = [(30.27 + 0.01 * i, -97.74) for i in range(6)] + [(39.74, -104.99 + 0.01 * i) for i in range(5)] + [
+        (40.71, -74.0)
+    ]
+
+    def setUp(self):
+        super().setUp()
+        self.ids = self.add_listings(
+            len(self.PLACES), price=lambda index: 1000 * (index + 1),
+            latitude=lambda index: self.PLACES[index][0], longitude=lambda index: self.PLACES[index][1],
+            location=lambda index: geo.point(*self.PLACES[index]),
+            geohash=lambda index: geo.encode_geohash(*self.PLACES[index], PropertyMongoDB.GEOHASH_PRECISION)
+        )
+
+    def clusters(self, **params):
+        response = self.client.get('/api/properties/clusters/', dict({'bbox': '-180,-85,180,85', 'zoom': 3}, **params))
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.data
+
+    def test_clusters(self):
+        data = self.clusters()
+        self.assertEqual((data['precision'], data['truncated']), (2, False))
+        # Only the group above the threshold stays a cluster
+        [cluster] = data['clusters']
+        self.assertEqual(cluster['count'], 6)
+        self.assertEqual(cluster['geohash'], geo.encode_geohash(30.27, -97.74, 2))
+        self.assertAlmostEqual(cluster['latitude'], 30.295, places=6)
+        self.assertAlmostEqual(cluster['longitude'], -97.74, places=6)
+        self.assertEqual((cluster['min_price'], cluster['max_price']), (1000, 6000))
+        # ... the rest come back as markers
+        self.assertEqual(sorted(point['id'] for point in data['points']), sorted(self.ids[6:]))
+        marker = next(point for point in data['points'] if point['id'] == self.ids[-1])
+        self.assertEqual(
+            {field: marker[field] for field in ('price', 'latitude', 'longitude')},
+            {'price': 12000, 'latitude': 40.71, 'longitude': -74.0}
+        )
+        self.assertEqual(set(marker), {'id', 'title', 'property_type', 'status', 'price', 'latitude', 'longitude'})
+
+    def test_filters(self):
+        data = self.clusters(max_price=5000)
+        self.assertEqual(data['clusters'], [])
+        self.assertEqual(sorted(point['id'] for point in data['points']), sorted(self.ids[:5]))
+        # Zoomed in far enough, the first group splits up
+        self.assertEqual(len(self.clusters(zoom=12)['clusters']), 0)
+
+    def test_sample_points(self):
+        rows, truncated = PropertyMongoDB.clusters({}, 2, CLUSTER_POINT_THRESHOLD)
+        self.assertFalse(truncated)
+        self.assertEqual([row['count'] for row in rows], [6, 5, 1])
+        # At most max_points members ride along with each cluster
+        self.assertEqual([len(row['points']) for row in rows], [5, 5, 1])
+        self.assertTrue({str(point['_id']) for point in rows[0]['points']} <= set(self.ids[:6]))
+
+    def test_truncated(self):
+        # The smallest clusters are left out, and that is reported
+        rows, truncated = PropertyMongoDB.clusters({}, 2, CLUSTER_POINT_THRESHOLD, limit=2)
+        self.assertEqual(([row['count'] for row in rows], truncated), ([6, 5], True))
+        rows, truncated = PropertyMongoDB.clusters({}, 2, CLUSTER_POINT_THRESHOLD, limit=3)
+        self.assertEqual((len(rows), truncated), (3, False))
+        with mock.patch('api.mongodb_views.CLUSTER_LIMIT', 1):
+            data = self.clusters()
+        self.assertEqual((len(data['clusters']), data['points'], data['truncated']), (1, [], True))
+
+
+class PropertyUpdateTests(ListingTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.property_id = PropertyMongoDB(
+            title='Corner house', price=100000, city='Austin', owner_id=str(self.agent.id),
+            created_by_id=str(self.agent.id)
+        ).save().id
+        self.url = f'/api/properties/{self.property_id}/'
+
+    def stored(self):
+        return PropertyMongoDB.get_collection().find_one({'_id': ObjectId(self.property_id)})
+
+    def test_changed_fields(self):
+        prop = PropertyMongoDB.find_by_id(self.property_id)
+        self.assertEqual(prop.changed_fields, set())
+        prop.price = 100000
+        prop.title = 'Corner house, renovated'
+        self.assertEqual(prop.changed_fields, {'title'})
+        prop.save()
+        self.assertEqual(prop.changed_fields, set())
+
+    def test_patch_writes_only_sent_fields(self):
+        # Changed by someone else after this client loaded the listing
+        PropertyMongoDB.get_collection().update_one({'_id': ObjectId(self.property_id)}, {'$set': {'city': 'Dallas'}})
+        for method in ('patch', 'put'):
+            with self.subTest(method=method):
+                response = getattr(self.client, method)(self.url, {'price': 95000}, format='json', **bearer(self.agent))
+                self.assertEqual(response.status_code, 200)
+                stored = self.stored()
+                self.assertEqual((stored['price'], stored['city'], stored['title']), (95000, 'Dallas', 'Corner house'))
+
+    def test_version_conflict(self):
+        version = self.client.get(self.url).data['version']
+        response = self.client.patch(self.url, {'price': 90000, 'version': version}, format='json', **bearer(self.agent))
+        self.assertEqual((response.status_code, response.data['version']), (200, version + 1))
+
+        # A second client still holding the old version
+        response = self.client.patch(self.url, {'price': 80000, 'version': version}, format='json', **bearer(self.agent))
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual((self.stored()['price'], self.stored()['version']), (90000, version + 1))
+
+    def test_unchanged_with_old_version(self):
+        version = self.stored()['version']
+        PropertyMongoDB.get_collection().update_one({'_id': ObjectId(self.property_id)}, {'$inc': {'version': 1}})
+        # Nothing to write, but the client's copy is still out of date
+        response = self.client.patch(self.url, {'price': 100000, 'version': version}, format='json', **bearer(self.agent))
+        self.assertEqual(response.status_code, 409)
+        # Form data sends it as a string
+        response = self.client.patch(self.url, {'price': 100000, 'version': str(version + 1)}, **bearer(self.agent))
+        self.assertEqual((response.status_code, self.stored()['version']), (200, version + 1))
+
+    def test_invalid_version(self):
+        for version in ('abc', '1.5', 1.5, True, [1], {}):
+            with self.subTest(version=version):
+                response = self.client.patch(
+                    self.url, {'price': 90000, 'version': version}, format='json', **bearer(self.agent)
+                )
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('version', response.data)
+        self.assertEqual(self.stored()['price'], 100000)
+
+    def test_bulk_save_changed_fields(self):
+        prop = PropertyMongoDB.find_by_id(self.property_id)
+        unchanged = PropertyMongoDB.find_by_id(self.property_id)
+        PropertyMongoDB.get_collection().update_one({'_id': ObjectId(self.property_id)}, {'$set': {'city': 'Dallas'}})
+        prop.price = 95000
+        self.assertEqual(PropertyMongoDB.bulk_save([unchanged, prop]), [{'status': 'updated'}] * 2)
+        # Only the changed field was written, once
+        stored = self.stored()
+        self.assertEqual((stored['price'], stored['city'], stored['version']), (95000, 'Dallas', 2))
+        self.assertEqual(prop.changed_fields, set())
+
+    def test_version_of_older_documents(self):
+        # Written before versioning: no version field, read as 0
+        PropertyMongoDB.get_collection().update_one({'_id': ObjectId(self.property_id)}, {'$unset': {'version': ''}})
+        response = self.client.patch(self.url, {'price': 90000, 'version': 0}, format='json', **bearer(self.agent))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.stored()['version'], 1)
+
+    def test_not_allowed(self):
+        self.assertEqual(self.client.patch(self.url, {'price': 1}, format='json').status_code, 401)
+        response = self.client.patch(self.url, {'price': 1}, format='json', **bearer(self.owners[1]))
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.stored()['price'], 100000)
+
+
+
+class ConditionalRequestTests(ListingTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.ids = self.add_listings(3)
+        self.url = f'/api/properties/{self.ids[0]}/'
+
+    def test_detail(self):
+        response = self.client.get(self.url)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        self.assertFalse(etag.startswith('W/'))
+        self.assertIn('Authorization', response['Vary'])
+
+        for headers in ({'HTTP_IF_NONE_MATCH': etag}, {'HTTP_IF_MODIFIED_SINCE': last_modified}):
+            with self.subTest(headers=headers):
+                # Answered from the validators alone
+                with mock.patch.object(PropertyMongoDB, 'find_by_id') as find_by_id:
+                    response = self.client.get(self.url, **headers)
+                self.assertEqual((response.status_code, response.content), (304, b''))
+                self.assertEqual(response['ETag'], etag)
+                find_by_id.assert_not_called()
+
+        self.client.patch(self.url, {'price': 1234}, format='json', **bearer(self.agent))
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response.data['price']), (200, 1234))
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_detail_old_copy(self):
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE='Mon, 01 Jan 2001 00:00:00 GMT')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(f'/api/properties/{0:024x}/', HTTP_IF_NONE_MATCH='"stale"')
+        self.assertEqual(response.status_code, 404)
+
+    def test_list(self):
+        response = self.client.get('/api/properties/', {'ordering': 'price'})
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        response = self.client.get('/api/properties/', {'ordering': 'price'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response.content), (304, b''))
+        # Another query, another user or a changed collection each get a new tag
+        self.assertNotEqual(self.client.get('/api/properties/', {'ordering': '-price'})['ETag'], etag)
+        self.assertNotEqual(self.client.get('/api/properties/', {'ordering': 'price'}, **bearer(self.buyer))['ETag'], etag)
+        self.client.delete(f'/api/properties/{self.ids[1]}/', **bearer(self.owners[1]))
+        response = self.client.get('/api/properties/', {'ordering': 'price'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, len(response.data['results'])), (200, 2))
+
+        # So does a change to an owner card shown on the page
+        etag = response['ETag']
+        owner = User.objects.get(pk=self.owners[0].pk)
+        owner.bio = 'Now with a bio'
+        owner.save()
+        response = self.client.get('/api/properties/', {'ordering': 'price'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Now with a bio', {item['owner']['bio'] for item in response.data['results']})
+
+
+
+class ExportTests(ListingTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.ids = self.add_listings(5, price=lambda index: 1000 * (index + 1))
+
+    def export(self, **params):
+        response = self.client.get('/api/properties/export/', params, **bearer(self.buyer))
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def rows(self, response):
+        return [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+    def test_ndjson(self):
+        response = self.export(batch_size=2)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        # One chunk per batch, not one document
+        chunks = list(response.streaming_content)
+        self.assertEqual(len(chunks), 3)
+        rows = [json.loads(line) for line in b''.join(chunks).splitlines()]
+        self.assertEqual([row['id'] for row in rows], sorted(self.ids, key=ObjectId))
+        self.assertFalse({'owner_id', 'contact_info', '_id'} & set(rows[0]))
+
+    def test_resume(self):
+        everything = self.rows(self.export())
+        # The connection dropped after the second row
+        rest = self.rows(self.export(after=everything[1]['id']))
+        self.assertEqual(everything[:2] + rest, everything)
+
+    def test_csv(self):
+        response = self.export(output='csv', min_price=2500)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.DictReader(b''.join(response.streaming_content).decode('utf-8').splitlines()))
+        self.assertEqual(list(rows[0]), list(EXPORT_COLUMNS))
+        self.assertEqual(sorted(float(row['price']) for row in rows), [3000, 4000, 5000])
+
+    def test_same_filters_as_list(self):
+        PropertyMongoDB.get_collection().update_one({'_id': ObjectId(self.ids[2])}, {'$set': {'title': 'Gazebo'}})
+        self.assertEqual([row['id'] for row in self.rows(self.export(search='gazebo'))], [self.ids[2]])
+        self.assertEqual(len(self.rows(self.export(max_price=2000, ordering='-price'))), 2)
+
+    def test_invalid(self):
+        self.assertEqual(self.client.get('/api/properties/export/').status_code, 401)
+        for params in ({'output': 'xml'}, {'batch_size': 0}, {'batch_size': 'all'}, {'after': 'nope'}):
+            with self.subTest(params=params):
+                response = self.client.get('/api/properties/export/', params, **bearer(self.buyer))
+                self.assertEqual(response.status_code, 400)
+
+
+class AsyncPropertyEndpointQueryTests(MongoTransactionTestCase):
+    """
+    The async views run their SQL in a thread pool, outside the request
+    profile, so only their MongoDB commands are budgeted.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.owners = [make_user(f'owner{i}') for i in range(5)]
+
+    def test_list(self):
+        for size in DATA_SIZES:
+            with self.subTest(size=size):
+                self.grow_listings(size, self.owners)
+                response = self.client.get('/api/async/properties/', {'page_size': 50})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(len(response.json()['results']), size)
+                # Count and page
+                self.assertQueryBudget(response, mongo=2)
+
+    def test_detail(self):
+        for size in DATA_SIZES:
+            with self.subTest(size=size):
+                ids = self.grow_listings(size, self.owners)
+                response = self.client.get(f'/api/async/properties/{ids[-1]}/')
+                self.assertEqual(response.status_code, 200)
+                self.assertQueryBudget(response, mongo=1)
+
+    def test_conditional(self):
+        ids = self.grow_listings(3, self.owners)
+        for path in ('/api/async/properties/', f'/api/async/properties/{ids[0]}/'):
+            with self.subTest(path=path):
+                response = self.client.get(path)
+                self.assertEqual(response.status_code, 200)
+                self.assertIn('Authorization', response['Vary'])
+                response = self.client.get(path, HTTP_IF_NONE_MATCH=response['ETag'])
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.content, b'')
+
+        # The same validators as the sync views
+        detail = self.client.get(f'/api/properties/{ids[0]}/')
+        self.assertEqual(self.client.get(f'/api/async/properties/{ids[0]}/')['ETag'], detail['ETag'])
+        response = self.client.get(f'/api/async/properties/{ids[0]}/', HTTP_IF_NONE_MATCH=detail['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertQueryBudget(response, mongo=1)
+
+    def test_stats(self):
+        for size in DATA_SIZES:
+            with self.subTest(size=size):
+                self.grow_listings(size, self.owners)
+                response = self.client.get('/api/async/stats/')
+                self.assertEqual(response.status_code, 200)
+                self.assertQueryBudget(response, mongo=1)
+
+
+class DjangoPropertyEndpointQueryTests(QueryBudgetMixin, TestCase):
+    """The SQL-backed property endpoints under /api/django/"""
+
+    def grow_properties(self, total):
+        existing = Property.objects.count()
+        Property.objects.bulk_create([
+            Property(
+                title=f'Listing {i}', description='Bright house', property_type='house',
+                price=Decimal(100000 + i), bedrooms=3, bathrooms=2, area=1500,
+                address=f'{i} Main St', city='Austin', state='TX', zip_code='78701',
+                latitude=Decimal('30.267200'), longitude=Decimal('-97.743100'),
+            )
+            for i in range(existing, total)
+        ])
+        return list(Property.objects.values_list('id', flat=True))
+
+    def test_list(self):
+        for size in DATA_SIZES:
+            with self.subTest(size=size):
+                self.grow_properties(size)
+                response = self.client.get('/api/django/properties/', {'min_price': 1000})
+                self.assertEqual(response.status_code, 200)
+                # Page count plus the page
+                self.assertQueryBudget(response, sql=2, mongo=0)
+
+    def test_detail(self):
+        for size in DATA_SIZES:
+            with self.subTest(size=size):
+                ids = self.grow_properties(size)
+                response = self.client.get(f'/api/django/properties/{ids[-1]}/')
+                self.assertEqual(response.status_code, 200)
+                self.assertQueryBudget(response, sql=1, mongo=0)
+
+    def test_stats(self):
+        for size in DATA_SIZES:
+            with self.subTest(size=size):
+                self.grow_properties(size)
+                response = self.client.get('/api/django/stats/')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.data['total_properties'], size)
+                self.assertQueryBudget(response, sql=3, mongo=0)
+
+
+class MetricsFileTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        settings = override_settings(METRICS={'directory': self.directory})
+        settings.enable()
+        self.addCleanup(settings.disable)
+        registry.reset()
+        self.addCleanup(registry.reset)
+
+    def write(self, filename, requests):
+        snapshot = registry.snapshot()
+        snapshot['http_requests_total']['samples'] = [[['properties', 'GET', '200'], requests]]
+        with open(os.path.join(self.directory, filename), 'w') as f:
+            json.dump(snapshot, f)
+
+    def requests(self):
+        samples = registry.collect()['http_requests_total']['samples']
+        return sum(value for _, value in samples)
+
+    def test_exited_process_folded(self):
+        # Same pid as this process, started earlier: a worker before a restart
+        self.write(f'{os.getpid()}-0.json', 3)
+        http_requests.inc(route='properties', method='GET', status=200)
+        self.assertEqual(self.requests(), 4)
+        self.assertEqual(sorted(os.listdir(self.directory)), [f'{registry.process}.json', TOTAL_FILE, 'total.lock'])
+        # Folded once, not on every scrape
+        self.assertEqual(self.requests(), 4)
+        self.write(f'{os.getpid()}-1.json', 2)
+        self.assertEqual(self.requests(), 6)
+
+    def test_render(self):
+        # Another worker, still running: its counter adds to this one's
+        self.write(f'{os.getppid()}-{process_start(os.getppid())}.json', 2)
+        http_requests.inc(route='properties', method='GET', status=200)
+        http_request_duration.observe(0.003, route='properties', method='GET')
+        http_request_duration.observe(0.2, route='properties', method='GET')
+        http_request_duration.observe(60, route='properties', method='GET')
+        lines = registry.render().splitlines()
+        self.assertIn('# TYPE http_request_duration_seconds histogram', lines)
+        # Buckets are cumulative, and +Inf holds every observation
+        self.assertIn('http_request_duration_seconds_bucket{route="properties",method="GET",le="0.005"} 1', lines)
+        self.assertIn('http_request_duration_seconds_bucket{route="properties",method="GET",le="0.1"} 1', lines)
+        self.assertIn('http_request_duration_seconds_bucket{route="properties",method="GET",le="0.25"} 2', lines)
+        self.assertIn('http_request_duration_seconds_bucket{route="properties",method="GET",le="10"} 2', lines)
+        self.assertIn('http_request_duration_seconds_bucket{route="properties",method="GET",le="+Inf"} 3', lines)
+        self.assertIn('http_request_duration_seconds_sum{route="properties",method="GET"} 60.203', lines)
+        self.assertIn('http_request_duration_seconds_count{route="properties",method="GET"} 3', lines)
+        self.assertIn('http_requests_total{route="properties",method="GET",status="200"} 3', lines)
+
+    def test_flushed_in_background(self):
+        with mock.patch.object(registry, 'flush') as flush, \
+                mock.patch.object(registry, '_flusher_pid', None), mock.patch('threading.Thread') as thread:
+            record_request('properties', 'GET', 200, 0.01)
+            record_request('properties', 'GET', 200, 0.01)
+        # Requests leave the writing to one thread
+        flush.assert_not_called()
+        thread.assert_called_once_with(target=registry.flush_periodically, name='metrics-flush', daemon=True)
+
+
+class MetricsViewTests(SimpleTestCase):
+
+    def scrape(self, address):
+        request = RequestFactory().get('/internal/metrics', REMOTE_ADDR=address)
+        return metrics_view(request)
+
+    @override_settings(METRICS={'directory': None})
+    def test_allowed_ips(self):
+        self.assertEqual(self.scrape('127.0.0.1').status_code, 200)
+        self.assertEqual(self.scrape('::1').status_code, 200)
+        for address in ('10.0.0.7', '', None):
+            with self.subTest(address=address), self.assertRaises(Http404):
+                self.scrape(address)
+        with override_settings(METRICS={'directory': None, 'allowed_ips': ('10.0.0.7',)}):
+            self.assertEqual(self.scrape('10.0.0.7').status_code, 200)
+            with self.assertRaises(Http404):
+                self.scrape('127.0.0.1')
+
+    def test_deploy_check(self):
+        for directory in (None, os.path.join(tempfile.gettempdir(), 'real_estate_metrics')):
+            with self.subTest(directory=directory), override_settings(METRICS={'directory': directory}):
+                self.assertEqual([error.id for error in check_metrics_directory(None)], ['api.E001'])
+        with override_settings(METRICS={'directory': '/var/lib/real_estate/metrics'}):
+            self.assertEqual(check_metrics_directory(None), [])
+        with override_settings(METRICS={'enabled': False, 'directory': None}):
+            self.assertEqual(check_metrics_directory(None), [])
+
+
+class BenchmarkCommandTests(TransactionTestCase):
+
+    def test_memory_backend(self):
+        # Runs on the built-in memory engine, with nothing beyond requirements.txt
+        out = StringIO()
+        command = 'api.management.commands.run_benchmarks'
+        with mock.patch.dict(sys.modules, {'mongomock': None}), \
+                mock.patch(f'{command}.setup_databases'), mock.patch(f'{command}.teardown_databases'):
+            call_command(
+                'run_benchmarks', '--backend', 'memory', '--sizes', '20', '--requests', '3',
+                '--concurrency', '1', '--scenario', 'list', '--scenario', 'detail', stdout=out
+            )
+        lines = [line for line in out.getvalue().splitlines() if 'req/s' in line]
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(all(line.endswith('errors 0') for line in lines), lines)
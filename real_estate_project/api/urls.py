@@ -1,11 +1,20 @@
 from django.urls import path
-from . import views, mongodb_views
+from . import async_views, views, mongodb_views
 
 urlpatterns = [
     # MongoDB-based endpoints (primary)
     path('properties/', mongodb_views.property_list_mongodb, name='api_property_list_mongodb'),
+    path('properties/bulk/', mongodb_views.property_bulk_mongodb, name='api_property_bulk_mongodb'),
+    path('properties/export/', mongodb_views.property_export_mongodb, name='api_property_export_mongodb'),
+    path('properties/clusters/', mongodb_views.property_clusters_mongodb, name='api_property_clusters_mongodb'),
     path('properties/<str:pk>/', mongodb_views.property_detail_mongodb, name='api_property_detail_mongodb'),
     path('stats/', mongodb_views.property_stats_mongodb, name='api_property_stats_mongodb'),
+    path('health/mongodb/', mongodb_views.mongodb_health, name='api_mongodb_health'),
+    
+    # Async versions of the MongoDB read endpoints, for ASGI deployments
+    path('async/properties/', async_views.property_list_async, name='api_property_list_async'),
+    path('async/properties/<str:pk>/', async_views.property_detail_async, name='api_property_detail_async'),
+    path('async/stats/', async_views.property_stats_async, name='api_property_stats_async'),
     
     # Original Django ORM endpoints (backup)
     path('django/properties/', views.PropertyListAPIView.as_view(), name='api_property_list'),
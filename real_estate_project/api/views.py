@@ -1,6 +1,7 @@
 from rest_framework import generics, filters
 from rest_framework.response import Response
 from rest_framework.decorators import api_view
+from django.db.models import Count, Q
 from webapp.models import Property
 from .serializers import PropertySerializer, PropertyListSerializer
 
@@ -44,14 +45,23 @@ class PropertyDetailAPIView(generics.RetrieveUpdateDestroyAPIView):
 
 @api_view(['GET'])
 def property_stats(request):
-    total_properties = Property.objects.count()
-    for_sale = Property.objects.filter(status='sale').count()
-    for_rent = Property.objects.filter(status='rent').count()
-    featured = Property.objects.filter(featured=True).count()
+    totals = Property.objects.aggregate(
+        total_properties=Count('id'),
+        for_sale=Count('id', filter=Q(status='sale')),
+        for_rent=Count('id', filter=Q(status='rent')),
+        featured=Count('id', filter=Q(featured=True)),
+    )
+    by_property_type = (
+        Property.objects.values('property_type')
+        .annotate(count=Count('id')).order_by('-count', 'property_type')
+    )
+    by_city = (
+        Property.objects.values('city')
+        .annotate(count=Count('id')).order_by('-count', 'city')[:20]
+    )
     
     return Response({
-        'total_properties': total_properties,
-        'for_sale': for_sale,
-        'for_rent': for_rent,
-        'featured': featured
+        **totals,
+        'by_property_type': {row['property_type']: row['count'] for row in by_property_type},
+        'by_city': {row['city']: row['count'] for row in by_city},
     })
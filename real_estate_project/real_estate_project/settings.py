@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 import os
+import tempfile
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -49,6 +50,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.QueryInstrumentationMiddleware',  # Server-Timing and per-request query log
+    'api.middleware.RequestMetricsMiddleware',  # Per-route metrics for /internal/metrics
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',  # Required for admin
@@ -97,9 +100,138 @@ MONGODB_DB = os.getenv('MONGODB_DB', 'real_estate_db')
 
 MONGODB_SETTINGS = {
     'host': MONGODB_HOST,
-    'db': MONGODB_DB
+    'db': MONGODB_DB,
+    # Storage engine behind PropertyMongoDB (see webapp/mongodb_storage.py):
+    # 'mongo' for the server above, 'memory' for an in-process store. The
+    # test suite uses test_engine.
+    'engine': os.getenv('MONGODB_ENGINE', 'mongo'),
+    'test_engine': os.getenv('MONGODB_TEST_ENGINE', 'memory'),
+    # "manage.py check --deploy" warns when a declared index is missing (see
+    # webapp/mongodb_indexes.py)
+    'check_indexes': os.getenv('MONGODB_CHECK_INDEXES', '1') == '1',
+    'index_check_timeout_ms': 2000,
+    # Connection pool, per process. Size max_pool_size to at least the number
+    # of worker threads; requests wait up to wait_queue_timeout_ms for a free
+    # connection before failing (see webapp/mongodb_pool.py for the mapping
+    # to MongoClient options)
+    'max_pool_size': int(os.getenv('MONGODB_MAX_POOL_SIZE', '100')),
+    'min_pool_size': int(os.getenv('MONGODB_MIN_POOL_SIZE', '0')),
+    'max_idle_time_ms': int(os.getenv('MONGODB_MAX_IDLE_TIME_MS', '300000')),
+    'wait_queue_timeout_ms': int(os.getenv('MONGODB_WAIT_QUEUE_TIMEOUT_MS', '5000')),
+    'server_selection_timeout_ms': int(os.getenv('MONGODB_SERVER_SELECTION_TIMEOUT_MS', '5000')),
+    'connect_timeout_ms': int(os.getenv('MONGODB_CONNECT_TIMEOUT_MS', '5000')),
+    'socket_timeout_ms': int(os.getenv('MONGODB_SOCKET_TIMEOUT_MS', '30000')),
+    # Comma separated, in order of preference: zstd, snappy, zlib
+    'compressors': os.getenv('MONGODB_COMPRESSORS', ''),
+    'read_concern': os.getenv('MONGODB_READ_CONCERN') or None,
+    'read_preference': os.getenv('MONGODB_READ_PREFERENCE') or None,
+    'write_concern': os.getenv('MONGODB_WRITE_CONCERN') or None,
+    'app_name': os.getenv('MONGODB_APP_NAME', 'real_estate_project'),
+    # Per-process LRU of property documents in front of find_by_id (see
+    # webapp/mongodb_cache.py); 0 disables it. Writes are broadcast to the
+    # other processes through the document_cache_channel cache.
+    'document_cache_size': int(os.getenv('MONGODB_DOCUMENT_CACHE_SIZE', '2000')),
+    'document_cache_ttl': int(os.getenv('MONGODB_DOCUMENT_CACHE_TTL', '60')),
+    'document_cache_channel': 'invalidation',
+    # Where PropertyMongoDB.stats() is cached; shared, so a write in one
+    # process reaches the stats every process serves
+    'stats_cache': 'invalidation',
 }
 
+# The default cache is per process. Invalidation messages need a cache every
+# worker can see whose incr() is atomic and which never evicts the sequence
+# counter (see InvalidationLog in webapp/mongodb_cache.py): Redis, at
+# REDIS_URL, in any deployment running more than one process. Configure the
+# server with a volatile-* maxmemory policy (or noeviction) so the counter,
+# stored without expiry, is never evicted. Without REDIS_URL messages stay in
+# this process, which is enough for runserver and the test suite.
+REDIS_URL = os.getenv('REDIS_URL')
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'invalidation': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+        'KEY_PREFIX': 'real_estate',
+    } if REDIS_URL else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'invalidation',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+}
+
+# Saved-search matching (see accounts/saved_searches.py), off unless
+# SAVED_SEARCH_MATCHING=1. Saving a listing through PropertyMongoDB queues
+# it, one job per shard whose worker ("manage.py match_saved_searches
+# --shard N") checked in within worker_timeout seconds; without workers
+# nothing is queued. A worker matches the queue against an in-memory index
+# of the saved searches of its users (user id modulo shards), rebuilt in
+# the background every rebuild_interval seconds, and drops jobs older than
+# job_max_age seconds. Profile changes and worker check-ins go through the
+# channel cache.
+SAVED_SEARCH_MATCHING = {
+    'enabled': os.getenv('SAVED_SEARCH_MATCHING', '0') == '1',
+    'channel': 'invalidation',
+    'poll_interval': 1.0,
+    'rebuild_interval': int(os.getenv('SAVED_SEARCH_REBUILD_INTERVAL', '3600')),
+    'shards': int(os.getenv('SAVED_SEARCH_SHARDS', '1')),
+    'batch_size': 1000,
+    'worker_timeout': 60,
+    'job_max_age': 3600,
+}
+
+# JWT authentication user cache (see accounts/authentication.py). Users are
+# kept in a per-process LRU, checked on every request against a version in
+# the channel cache that changes when the user is saved; with claims, tokens
+# also carry the permission fields and that version, so a user who is not
+# cached is resolved without a query. ttl bounds how long writes that skip
+# signals (QuerySet.update()) go unseen in the LRU; call
+# user_cache.invalidate() after such writes, since claims are trusted for
+# the access token's lifetime.
+AUTH_USER_CACHE = {
+    'max_entries': 10000,
+    'ttl': 300,
+    'channel': 'invalidation',
+    'claims': os.getenv('AUTH_USER_CLAIMS', '1') == '1',
+}
+
+# Per-request MongoDB/SQL profiling (see api/instrumentation.py). Queries
+# slower than slow_query_ms are logged to api.instrumentation, MongoDB ones
+# on the listed collections with their explain() plan when
+# explain_slow_queries is on.
+REQUEST_INSTRUMENTATION = {
+    'enabled': os.getenv('REQUEST_INSTRUMENTATION', '1') == '1',
+    # Staff always get Server-Timing; this sends it to every client
+    'server_timing': os.getenv('SERVER_TIMING_HEADER', '0') == '1',
+    'slow_query_ms': float(os.getenv('SLOW_QUERY_MS', '100')),
+    # Explained on a background thread, one extra round trip per slow query
+    'explain_slow_queries': os.getenv('EXPLAIN_SLOW_QUERIES', '0') == '1',
+    'explain_collections': ('properties',),
+    # Requests waiting to be explained before slow queries go unexplained
+    'explain_backlog': 100,
+    'slowest': 5,
+    # Slow SQL is logged with its parameter types; this adds the values,
+    # which can include credentials and personal data
+    'log_sql_params': os.getenv('LOG_SQL_PARAMS', '0') == '1',
+}
+
+# Prometheus metrics at /internal/metrics (see api/metrics.py). Worker
+# processes share their numbers through files in 'directory'; the temporary
+# directory default is for development, "manage.py check --deploy" requires
+# METRICS_DIR to be set.
+METRICS = {
+    'enabled': os.getenv('METRICS_ENABLED', '1') == '1',
+    'directory': os.getenv('METRICS_DIR') or (
+        os.path.join(tempfile.gettempdir(), 'real_estate_metrics') if DEBUG else None
+    ),
+    'flush_interval': 5,
+    'allowed_ips': ('127.0.0.1', '::1'),
+}
+
+# Threads available to the async API views for their remaining ORM calls
+ASYNC_ORM_MAX_WORKERS = int(os.getenv('ASYNC_ORM_MAX_WORKERS', '8'))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -159,7 +291,7 @@ REST_FRAMEWORK = {
         'rest_framework.parsers.MultiPartParser',
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'accounts.authentication.CachedJWTAuthentication',
         'rest_framework.authentication.SessionAuthentication',  # For Django admin
     ],
     'DEFAULT_PERMISSION_CLASSES': [
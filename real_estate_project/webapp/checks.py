@@ -0,0 +1,94 @@
+from django.conf import settings
+from django.core.checks import Warning, register
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+from .mongodb_cache import ATOMIC_CACHE_BACKENDS
+from .mongodb_indexes import INDEX_SPECS, get_index_drift
+
+
+def invalidation_channels():
+    """Cache aliases InvalidationLog publishes to"""
+    channels = [
+        settings.MONGODB_SETTINGS.get('document_cache_channel'),
+        settings.SAVED_SEARCH_MATCHING.get('channel'),
+        settings.AUTH_USER_CACHE.get('channel'),
+    ]
+    return sorted({channel for channel in channels if channel})
+
+
+@register('mongodb', deploy=True)
+def check_mongo_indexes(app_configs, **kwargs):
+    """
+    Warn when a declared MongoDB index is missing or out of date.
+    
+    Talks to the server, so it only runs with "manage.py check --deploy",
+    not before every management command.
+    """
+    mongo_settings = settings.MONGODB_SETTINGS
+    if not mongo_settings.get('check_indexes', True):
+        return []
+    # The in-process engine starts out empty; there is nothing to check yet
+    if mongo_settings.get('engine', 'mongo') != 'mongo':
+        return []
+    
+    # Use a short-lived client with a short timeout so an unreachable server
+    # delays the check by seconds rather than the driver's 30s default
+    client = MongoClient(
+        mongo_settings['host'],
+        serverSelectionTimeoutMS=mongo_settings.get('index_check_timeout_ms', 2000),
+        connect=False
+    )
+    errors = []
+    try:
+        database = client[mongo_settings['db']]
+        for collection_name, specs in INDEX_SPECS.items():
+            missing, changed, _ = get_index_drift(database[collection_name], specs)
+            for spec in missing + changed:
+                state = 'missing' if spec in missing else 'out of date'
+                errors.append(Warning(
+                    f'MongoDB index {collection_name}.{spec["name"]} is {state}.',
+                    hint='Run "manage.py ensure_mongo_indexes" to build it.',
+                    id='webapp.W001',
+                ))
+    except PyMongoError as e:
+        errors.append(Warning(
+            f'Could not verify MongoDB indexes on {mongo_settings["host"]} ({e.__class__.__name__}).',
+            hint='Check MONGODB_SETTINGS, or set MONGODB_CHECK_INDEXES=0 to skip this check.',
+            id='webapp.W002',
+        ))
+    finally:
+        client.close()
+    
+    return errors
+
+
+@register('caches')
+def check_invalidation_channels(app_configs, **kwargs):
+    """Warn when an invalidation channel cannot number messages atomically"""
+    errors = []
+    for channel in invalidation_channels():
+        backend = settings.CACHES.get(channel, {}).get('BACKEND')
+        if backend not in ATOMIC_CACHE_BACKENDS:
+            errors.append(Warning(
+                f'Cache "{channel}" ({backend}) carries invalidations but its incr() is not atomic; '
+                f'concurrent writers lose messages.',
+                hint='Point it at Redis (set REDIS_URL).',
+                id='webapp.W003',
+            ))
+    return errors
+
+
+@register('caches', deploy=True)
+def check_shared_invalidation_channels(app_configs, **kwargs):
+    """Warn on deploy when invalidations do not leave the process"""
+    errors = []
+    for channel in invalidation_channels():
+        backend = settings.CACHES.get(channel, {}).get('BACKEND')
+        if backend == 'django.core.cache.backends.locmem.LocMemCache':
+            errors.append(Warning(
+                f'Cache "{channel}" carries invalidations but is local to each process; '
+                f'other workers keep serving stale users, listings and saved searches.',
+                hint='Point it at Redis (set REDIS_URL), or run a single process.',
+                id='webapp.W004',
+            ))
+    return errors
@@ -0,0 +1,157 @@
+import math
+
+EARTH_RADIUS_KM = 6378.1
+
+# Polygons in this CRS are interpreted by their counter-clockwise winding,
+# so a viewport wider than a hemisphere still means "inside the box"
+STRICT_WINDING_CRS = {
+    'type': 'name',
+    'properties': {'name': 'urn:x-mongodb:crs:strictwinding:EPSG:4326'},
+}
+
+# Longest edge kept when densifying a box, in degrees. Polygon edges are
+# geodesics, so long east-west edges would otherwise bow towards the poles.
+MAX_EDGE_DEGREES = 10
+
+
+def is_valid_coordinate(latitude, longitude):
+    return (
+        latitude is not None and longitude is not None
+        and -90 <= latitude <= 90 and -180 <= longitude <= 180
+    )
+
+
+def point(latitude, longitude):
+    """
+    GeoJSON point for a listing, or None when the coordinates are unusable.
+    
+    0,0 is the model default for "no coordinates", so it is treated as unset
+    rather than as a listing in the Gulf of Guinea.
+    """
+    try:
+        latitude, longitude = float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        return None
+    if not is_valid_coordinate(latitude, longitude) or (latitude == 0 and longitude == 0):
+        return None
+    return {'type': 'Point', 'coordinates': [longitude, latitude]}
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Great-circle distance between two points, in kilometres"""
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def _interpolate(start, end, steps):
+    return [start + (end - start) * i / steps for i in range(steps)]
+
+
+def bbox_polygon(min_lng, min_lat, max_lng, max_lat):
+    """GeoJSON polygon covering a map viewport"""
+    steps = max(1, math.ceil((max_lng - min_lng) / MAX_EDGE_DEGREES))
+    south = [[lng, min_lat] for lng in _interpolate(min_lng, max_lng, steps)]
+    north = [[lng, max_lat] for lng in _interpolate(max_lng, min_lng, steps)]
+    ring = south + [[max_lng, min_lat]] + north + [[min_lng, max_lat], [min_lng, min_lat]]
+    return {'type': 'Polygon', 'coordinates': [ring], 'crs': STRICT_WINDING_CRS}
+
+
+def polygon(points):
+    """GeoJSON polygon from ``[lng, lat]`` points, closing the ring if needed"""
+    ring = [list(p) for p in points]
+    if ring[0] != ring[-1]:
+        ring.append(ring[0])
+    return {'type': 'Polygon', 'coordinates': [ring]}
+
+
+def _orientation(a, b, c):
+    """Sign of the turn a -> b -> c: 1 counter-clockwise, -1 clockwise, 0 collinear"""
+    cross = (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+    return (cross > 0) - (cross < 0)
+
+
+def _on_segment(a, b, c):
+    """Whether c, collinear with a and b, lies between them"""
+    return min(a[0], b[0]) <= c[0] <= max(a[0], b[0]) and min(a[1], b[1]) <= c[1] <= max(a[1], b[1])
+
+
+def segments_intersect(a, b, c, d):
+    """Whether segments ab and cd share any point, touching included"""
+    o1, o2, o3, o4 = _orientation(a, b, c), _orientation(a, b, d), _orientation(c, d, a), _orientation(c, d, b)
+    if o1 != o2 and o3 != o4:
+        return True
+    return (
+        (o1 == 0 and _on_segment(a, b, c)) or (o2 == 0 and _on_segment(a, b, d))
+        or (o3 == 0 and _on_segment(c, d, a)) or (o4 == 0 and _on_segment(c, d, b))
+    )
+
+
+def ring_error(ring):
+    """
+    Why MongoDB would reject ``ring`` as a polygon loop, or None.
+    
+    The ring must be closed, have at least three distinct vertices, enclose
+    some area and not cross or touch itself. Edges are checked as planar
+    lng/lat segments, which is what matters for rings the size of a map.
+    """
+    if len(ring) < 4 or list(ring[0]) != list(ring[-1]):
+        return 'A polygon needs at least three points and must end where it starts.'
+    vertices = [tuple(vertex[:2]) for vertex in ring[:-1]]
+    if len(set(vertices)) != len(vertices):
+        return 'A polygon cannot visit the same point twice.'
+    edges = list(zip(vertices, vertices[1:] + vertices[:1]))
+    count = len(edges)
+    for i in range(count):
+        a, b = edges[i]
+        for j in range(i + 1, count):
+            c, d = edges[j]
+            if j == i + 1 or (i == 0 and j == count - 1):
+                # Neighbours share a vertex; they only may not fold back over each other
+                shared, other = (b, d) if j == i + 1 else (a, c)
+                start = a if j == i + 1 else b
+                if _orientation(start, shared, other) == 0 and (
+                    _on_segment(start, shared, other) or _on_segment(shared, other, start)
+                ):
+                    return 'A polygon cannot double back on itself.'
+                continue
+            if segments_intersect(a, b, c, d):
+                return 'A polygon cannot cross itself.'
+    if sum(a[0] * b[1] - b[0] * a[1] for a, b in edges) == 0:
+        return 'A polygon must enclose an area.'
+    return None
+
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def encode_geohash(latitude, longitude, precision):
+    """Standard base32 geohash; each character narrows the cell by 5 bits"""
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            target, bounds = longitude, lng_range
+        else:
+            target, bounds = latitude, lat_range
+        middle = (bounds[0] + bounds[1]) / 2
+        if target >= middle:
+            value = (value << 1) | 1
+            bounds[0] = middle
+        else:
+            value <<= 1
+            bounds[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bits = 0
+            value = 0
+    return ''.join(chars)
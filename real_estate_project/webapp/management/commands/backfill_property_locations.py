@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from pymongo import UpdateOne
+from webapp.mongodb_models import PropertyMongoDB
+
+
+class Command(BaseCommand):
+    help = 'Populate the location and geohash fields of properties saved before they existed'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+    
+    def handle(self, *args, **options):
+        collection = PropertyMongoDB.get_collection()
+        batch_size = options['batch_size']
+        
+        cursor = collection.find(
+            {'$or': [{'location': {'$exists': False}}, {'geohash': {'$exists': False}}]},
+            {'latitude': 1, 'longitude': 1}
+        ).batch_size(batch_size)
+        
+        updated = 0
+        operations = []
+        for doc in cursor:
+            prop = PropertyMongoDB(latitude=doc.get('latitude'), longitude=doc.get('longitude'))
+            operations.append(UpdateOne(
+                {'_id': doc['_id']},
+                {'$set': {'location': prop.location, 'geohash': prop.geohash}}
+            ))
+            if len(operations) == batch_size:
+                updated += collection.bulk_write(operations, ordered=False).modified_count
+                operations = []
+        if operations:
+            updated += collection.bulk_write(operations, ordered=False).modified_count
+        
+        self.stdout.write(self.style.SUCCESS(f'Backfilled location and geohash on {updated} properties'))
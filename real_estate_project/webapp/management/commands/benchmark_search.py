@@ -0,0 +1,121 @@
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+from django.core.management.base import BaseCommand
+from webapp.mongodb_models import PropertyMongoDB
+from webapp.mongodb_storage import get_engine
+from webapp.mongodb_indexes import PROPERTY_INDEXES, create_index
+
+CITIES = ['Austin', 'Denver', 'Seattle', 'Portland', 'Boston', 'Chicago', 'Miami', 'Phoenix']
+STATES = ['TX', 'CO', 'WA', 'OR', 'MA', 'IL', 'FL', 'AZ']
+WORDS = [
+    'spacious', 'modern', 'cozy', 'renovated', 'sunny', 'quiet', 'luxury', 'charming',
+    'garden', 'pool', 'garage', 'view', 'downtown', 'family', 'studio', 'loft',
+    'fireplace', 'balcony', 'hardwood', 'kitchen', 'basement', 'waterfront', 'historic', 'corner',
+]
+PROPERTY_TYPES = ['house', 'apartment', 'condo', 'townhouse', 'land']
+
+# Queries as a client would type them into the search box
+SEARCH_TERMS = ['waterfront', 'Denver', 'modern loft', 'historic garden', 'pool']
+
+
+def legacy_regex_filters(search_term):
+    """The case-insensitive $regex query the search endpoint used to run"""
+    return {
+        '$or': [
+            {'title': {'$regex': search_term, '$options': 'i'}},
+            {'description': {'$regex': search_term, '$options': 'i'}},
+            {'city': {'$regex': search_term, '$options': 'i'}},
+            {'state': {'$regex': search_term, '$options': 'i'}}
+        ]
+    }
+
+
+class Command(BaseCommand):
+    help = 'Compare $regex search against the text_search index on a seeded scratch collection'
+    
+    requires_system_checks = []
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=200000, help='Number of listings to seed')
+        parser.add_argument('--repeat', type=int, default=20, help='Runs per query')
+        parser.add_argument('--collection', default='properties_benchmark', help='Scratch collection name')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--keep', action='store_true', help='Keep the scratch collection afterwards')
+    
+    def handle(self, *args, **options):
+        collection = get_engine().get_collection(options['collection'])
+        collection.drop()
+        
+        self.stdout.write(f'Seeding {options["count"]} listings into {options["collection"]}...')
+        self.seed(collection, options['count'], random.Random(options['seed']))
+        for spec in PROPERTY_INDEXES:
+            create_index(collection, spec)
+        
+        page_size = 12
+        try:
+            for term in SEARCH_TERMS:
+                filters = {'status': 'sale', 'price': {'$lte': 750000}}
+                
+                regex_query = legacy_regex_filters(term)
+                text_query = dict(filters, **PropertyMongoDB.search_filters(term))
+                
+                # The old endpoint fetched every match and dropped the filters;
+                # the new one applies them and returns one ranked page
+                regex_times = self.measure(
+                    lambda: list(collection.find(regex_query)), options['repeat']
+                )
+                text_times = self.measure(
+                    lambda: list(
+                        collection.find(text_query, {'score': {'$meta': 'textScore'}})
+                        .sort([('score', {'$meta': 'textScore'}), ('_id', -1)])
+                        .limit(page_size)
+                    ),
+                    options['repeat']
+                )
+                self.report(term, regex_times, text_times)
+        finally:
+            if not options['keep']:
+                collection.drop()
+    
+    def seed(self, collection, count, rng, batch_size=5000):
+        now = datetime.now()
+        batch = []
+        for i in range(count):
+            city_index = min(int(rng.expovariate(0.6)), len(CITIES) - 1)
+            batch.append({
+                'title': ' '.join(rng.sample(WORDS, 3)).title(),
+                'description': ' '.join(rng.choice(WORDS) for _ in range(40)),
+                'property_type': rng.choice(PROPERTY_TYPES),
+                'status': rng.choice(['sale', 'sale', 'rent', 'sold']),
+                'price': round(rng.lognormvariate(12.8, 0.5), -3),
+                'area': rng.randint(400, 5000),
+                'city': CITIES[city_index],
+                'state': STATES[city_index],
+                'featured': rng.random() < 0.05,
+                'created_at': now - timedelta(minutes=i),
+                'updated_at': now - timedelta(minutes=i),
+            })
+            if len(batch) == batch_size:
+                collection.insert_many(batch, ordered=False)
+                batch = []
+        if batch:
+            collection.insert_many(batch, ordered=False)
+    
+    def measure(self, query, repeat):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            query()
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
+    
+    def report(self, term, regex_times, text_times):
+        regex_median = statistics.median(regex_times)
+        text_median = statistics.median(text_times)
+        speedup = regex_median / text_median if text_median else float('inf')
+        self.stdout.write(
+            f'{term!r:20} regex median {regex_median:8.1f} ms   '
+            f'text median {text_median:8.1f} ms   speedup {speedup:6.1f}x'
+        )
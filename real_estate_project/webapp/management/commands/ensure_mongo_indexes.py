@@ -0,0 +1,84 @@
+from django.core.management.base import BaseCommand, CommandError
+from webapp.mongodb_storage import get_engine
+from webapp.mongodb_indexes import INDEX_SPECS, create_index, get_index_drift, rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Create the MongoDB indexes declared in webapp.mongodb_indexes and report drift'
+    
+    # The startup index check would only repeat what this command reports
+    requires_system_checks = []
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true',
+            help='Only report drift; exit with an error if any index is missing or changed'
+        )
+        parser.add_argument(
+            '--drop-unused', action='store_true',
+            help='Drop undeclared indexes that $indexStats shows no access to since server start'
+        )
+        parser.add_argument(
+            '--force', action='store_true',
+            help='With --drop-unused, also drop undeclared indexes that are in use or whose usage is unknown'
+        )
+    
+    def handle(self, *args, **options):
+        engine = get_engine()
+        drift_found = False
+        
+        for collection_name, specs in INDEX_SPECS.items():
+            collection = engine.get_collection(collection_name)
+            missing, changed, unused = get_index_drift(collection, specs)
+            usage = self.get_index_usage(collection)
+            
+            if not (missing or changed or unused):
+                self.stdout.write(self.style.SUCCESS(f'{collection_name}: all {len(specs)} indexes up to date'))
+                continue
+            
+            for spec in missing:
+                self.stdout.write(self.style.WARNING(f'{collection_name}: missing index {spec["name"]}'))
+            for spec in changed:
+                self.stdout.write(self.style.WARNING(f'{collection_name}: index {spec["name"]} differs from spec'))
+            for name in unused:
+                ops = usage.get(name)
+                ops_note = f' ({ops} accesses since server start)' if ops is not None else ''
+                self.stdout.write(self.style.WARNING(f'{collection_name}: undeclared index {name}{ops_note}'))
+            
+            drift_found = drift_found or bool(missing or changed)
+            if options['check']:
+                continue
+            
+            # The old index serves queries until its replacement is built,
+            # unless the server cannot hold both (same keys, other options)
+            for spec in changed:
+                name, in_place = rebuild_index(collection, spec)
+                how = 'after dropping the old one (same keys)' if in_place else 'before dropping the old one'
+                self.stdout.write(f'{collection_name}: rebuilt {spec["name"]} as {name}, {how}')
+            for spec in missing:
+                create_index(collection, spec)
+                self.stdout.write(f'{collection_name}: created {spec["name"]}')
+            
+            if options['drop_unused']:
+                for name in unused:
+                    # Queries may still depend on an undeclared index
+                    if usage.get(name) != 0 and not options['force']:
+                        self.stdout.write(self.style.WARNING(
+                            f'{collection_name}: kept {name}, it may be in use (--force drops it anyway)'
+                        ))
+                        continue
+                    collection.drop_index(name)
+                    self.stdout.write(f'{collection_name}: dropped {name}')
+        
+        if options['check'] and drift_found:
+            raise CommandError('MongoDB indexes are out of date; run manage.py ensure_mongo_indexes')
+    
+    def get_index_usage(self, collection):
+        """Access counts per index from $indexStats, when the server allows it"""
+        try:
+            return {
+                stat['name']: stat['accesses']['ops']
+                for stat in collection.aggregate([{'$indexStats': {}}])
+            }
+        except Exception:
+            return {}
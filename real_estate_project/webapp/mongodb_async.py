@@ -0,0 +1,170 @@
+import asyncio
+import os
+import weakref
+from bson import ObjectId
+from bson.errors import InvalidId
+from datetime import datetime
+from django.conf import settings
+from pymongo import AsyncMongoClient
+from .mongodb_cache import property_cache
+from .mongodb_models import PropertyMongoDB, new_stats_generation, properties_saved
+from .mongodb_pool import client_options, pool_stats
+from .mongodb_storage import get_engine
+
+
+class AsyncMongoDBConnection:
+    """
+    AsyncMongoClient for the running event loop.
+
+    An async client is bound to the loop it was first used on, so one is kept
+    per loop and closed when the loop shuts down (asyncio.run() and asgiref's
+    async_to_sync() both finalize async generators before closing a loop).
+    Under an ASGI server that is one client per worker process; running the
+    async views under WSGI creates, and closes, a client per request.
+    """
+    _clients = weakref.WeakKeyDictionary()
+    _pid = None
+
+    @classmethod
+    def get_client(cls):
+        # Like the sync client, never reuse sockets inherited across a fork
+        if cls._pid != os.getpid():
+            cls._clients = weakref.WeakKeyDictionary()
+            cls._pid = os.getpid()
+
+        loop = asyncio.get_running_loop()
+        entry = cls._clients.get(loop)
+        if entry is None:
+            client = AsyncMongoClient(
+                settings.MONGODB_SETTINGS['host'],
+                event_listeners=[pool_stats],
+                **client_options()
+            )
+            closer = cls._close_on_shutdown(client)
+            # Started on this loop, so its shutdown_asyncgens() runs the finally
+            asyncio.ensure_future(closer.__anext__())
+            entry = cls._clients[loop] = (client, closer)
+        return entry[0]
+
+    @classmethod
+    async def _close_on_shutdown(cls, client):
+        try:
+            yield
+        finally:
+            cls._clients.pop(asyncio.get_running_loop(), None)
+            await client.close()
+
+    @classmethod
+    def get_database(cls):
+        return cls.get_client()[settings.MONGODB_SETTINGS['db']]
+
+    @classmethod
+    def get_collection(cls, collection_name):
+        return cls.get_database()[collection_name]
+
+
+class AsyncPropertyMongoDB:
+    """
+    Async counterpart of the PropertyMongoDB query methods.
+
+    Returns the same raw documents and PropertyMongoDB instances, so the
+    sync and async views share serialization, pagination and caching.
+    """
+    model = PropertyMongoDB
+    LIST_PROJECTION = PropertyMongoDB.LIST_PROJECTION
+
+    @classmethod
+    def get_collection(cls):
+        return get_engine().get_async_collection(cls.model.collection_name)
+
+    @classmethod
+    async def find_documents(cls, filters=None, sort=None, limit=None, skip=None, projection=None):
+        """Find raw property documents with optional filters"""
+        cursor = cls.get_collection().find(filters or {}, projection)
+
+        if sort:
+            cursor = cursor.sort(sort)
+
+        if skip:
+            cursor = cursor.skip(skip)
+
+        if limit:
+            cursor = cursor.limit(limit)
+
+        return await cursor.to_list()
+
+    @classmethod
+    async def find_by_id(cls, property_id):
+        """Find property by ID, through the same document cache as the sync model"""
+        doc = property_cache.get(property_id)
+        if doc is None:
+            try:
+                object_id = ObjectId(property_id)
+            except (InvalidId, TypeError):
+                return None
+
+            doc = await cls.get_collection().find_one({'_id': object_id})
+            if doc is None:
+                return None
+            property_cache.set(doc['_id'], doc)
+
+        return cls.model.from_document(doc)
+
+    @classmethod
+    async def find_validators(cls, property_id):
+        """Fetch only ``_id``, ``updated_at`` and ``version`` of a property"""
+        try:
+            object_id = ObjectId(property_id)
+        except (InvalidId, TypeError):
+            return None
+        return await cls.get_collection().find_one({'_id': object_id}, {'updated_at': 1, 'version': 1})
+
+    @classmethod
+    async def count(cls, filters=None):
+        """Count properties with optional filters"""
+        return await cls.get_collection().count_documents(filters or {})
+
+    @classmethod
+    async def estimated_count(cls):
+        """Fast total from collection metadata, without scanning documents"""
+        return await cls.get_collection().estimated_document_count()
+
+    @classmethod
+    async def generation(cls):
+        """PropertyMongoDB.generation(), without blocking the loop"""
+        return await cls.model.stats_cache().aget_or_set(cls.model.STATS_GENERATION_KEY, new_stats_generation, None)
+
+    @classmethod
+    async def stats(cls):
+        """Same payload and cache entry as PropertyMongoDB.stats()"""
+        stats_cache = cls.model.stats_cache()
+        key = cls.model.stats_key(await cls.generation())
+        stats = await stats_cache.aget(key)
+        if stats is not None:
+            return stats
+
+        cursor = await cls.get_collection().aggregate(cls.model.stats_pipeline())
+        result = await cursor.next()
+        stats = cls.model.stats_from_result(result)
+        await stats_cache.aset(key, stats, cls.model.STATS_CACHE_TIMEOUT)
+        return stats
+
+    @classmethod
+    async def invalidate_stats(cls):
+        """PropertyMongoDB.invalidate_stats(), without blocking the loop"""
+        stats_cache = cls.model.stats_cache()
+        await stats_cache.aadd(cls.model.STATS_GENERATION_KEY, new_stats_generation(), None)
+        try:
+            await stats_cache.aincr(cls.model.STATS_GENERATION_KEY)
+        except ValueError:
+            pass
+
+    @classmethod
+    async def insert(cls, prop):
+        """Insert a new PropertyMongoDB instance, as its save() does"""
+        result = await cls.get_collection().insert_one(prop.prepare_insert(datetime.now()))
+        prop._id = result.inserted_id
+        prop._changed.clear()
+        await cls.invalidate_stats()
+        await properties_saved.asend(sender=cls.model, properties=[prop], changed_fields=None, created=True)
+        return prop
@@ -0,0 +1,247 @@
+import copy
+import random
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+
+
+class DocumentCache:
+    """
+    Bounded, TTL-aware LRU of raw MongoDB documents, local to the process.
+
+    Only stored documents are kept, never rendered responses: what a user may
+    see (owner details, contact info) is decided when the document is
+    serialized for each request. Entries are deep-copied in and out, so
+    callers can mutate what they get back.
+
+    Writes in this process drop the entry at once. They are also appended to
+    an InvalidationLog in a shared Django cache (``channel``), which every
+    process replays at most once per ``poll_interval``. When a process falls too far
+    behind to replay the log, it clears its cache instead. Entries also expire
+    after ``ttl`` seconds, which bounds staleness if a message is lost.
+    """
+
+    # Wildcard key logged by invalidate_all()
+    ALL = '*'
+
+    def __init__(self, namespace, max_entries=None, ttl=None, channel=None,
+                 poll_interval=1.0, log_timeout=300):
+        mongo_settings = settings.MONGODB_SETTINGS
+        self.namespace = namespace
+        self.max_entries = mongo_settings.get('document_cache_size', 2000) if max_entries is None else max_entries
+        self.ttl = mongo_settings.get('document_cache_ttl', 60) if ttl is None else ttl
+        self.channel = mongo_settings.get('document_cache_channel') if channel is None else channel
+        self._log = InvalidationLog(namespace, self.channel, poll_interval, log_timeout) if self.channel else None
+        self._log_marked = False
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.reset_stats()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+    def get(self, key):
+        """Return a copy of the cached document, or None"""
+        if not self.enabled:
+            return None
+        self.sync()
+        key = str(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, document = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return copy.deepcopy(document)
+
+    def set(self, key, document):
+        if not self.enabled:
+            return
+        document = copy.deepcopy(document)
+        with self._lock:
+            self._entries[str(key)] = (time.monotonic() + self.ttl, document)
+            self._entries.move_to_end(str(key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *keys):
+        """Drop ``keys`` here and tell the other processes to drop them"""
+        keys = [str(key) for key in keys if key]
+        if not keys or not self.enabled:
+            return
+        self._discard(keys)
+        for key in keys:
+            self.publish(key)
+
+    def invalidate_all(self):
+        """Empty the cache here and in the other processes"""
+        if not self.enabled:
+            return
+        self.clear()
+        self.publish(self.ALL)
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def _discard(self, keys):
+        with self._lock:
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    # Cross-process channel
+
+    def publish(self, key):
+        if self._log is not None:
+            self._log.publish(key)
+
+    def sync(self):
+        """Replay invalidations published by other processes since the last poll"""
+        if self._log is None:
+            return
+        if not self._log_marked:
+            # Before the first document is loaded: everything published
+            # from here on may concern it
+            self._log.mark()
+            self._log_marked = True
+            return
+        keys = self._log.poll()
+        if keys is InvalidationLog.ALL:
+            self.clear()
+        elif keys:
+            self._discard(keys)
+
+
+# Cache backends whose incr() is atomic, so concurrent publishers never share
+# a sequence number. Only the first two reach other processes; LocMemCache
+# is for a single process (runserver, tests).
+ATOMIC_CACHE_BACKENDS = (
+    'django.core.cache.backends.redis.RedisCache',
+    'django.core.cache.backends.memcached.PyMemcacheCache',
+    'django.core.cache.backends.locmem.LocMemCache',
+)
+
+
+class InvalidationLog:
+    """
+    Sequence log of invalidated keys in a shared Django cache.
+
+    ``publish(key)`` appends a key; ``poll()``, at most once per
+    ``poll_interval``, returns the keys other processes published since the
+    previous poll, or ``ALL`` when the log cannot be replayed key by key.
+
+    The channel must be one of ATOMIC_CACHE_BACKENDS (webapp.W003 warns
+    otherwise): publishers take sequence numbers with incr(), and a backend
+    that reads and writes the counter separately hands two of them the same
+    number, losing one message.
+    """
+
+    # Wildcard key: everything must be dropped
+    ALL = '*'
+    # Longest backlog replayed key by key; beyond it poll() returns ALL
+    max_replay = 1000
+
+    def __init__(self, namespace, channel, poll_interval=1.0, log_timeout=300):
+        self.namespace = namespace
+        self.channel = channel
+        self.poll_interval = poll_interval
+        self.log_timeout = log_timeout
+        self._seen = None
+        self._next_poll = 0
+
+    @property
+    def _sequence_key(self):
+        return f'{self.namespace}:invalidation:seq'
+
+    def _log_key(self, sequence):
+        return f'{self.namespace}:invalidation:{sequence}'
+
+    def publish(self, key):
+        channel = caches[self.channel]
+        self._ensure_counter(channel)
+        try:
+            sequence = channel.incr(self._sequence_key)
+        except ValueError:
+            # The counter was evicted between add() and incr()
+            self._ensure_counter(channel)
+            sequence = channel.incr(self._sequence_key)
+        channel.set(self._log_key(sequence), key, self.log_timeout)
+
+    def _ensure_counter(self, channel):
+        # A counter that is lost and recreated starts somewhere random, so
+        # pollers see it jump and clear everything rather than replay
+        # numbers they already saw
+        channel.add(self._sequence_key, random.randrange(1 << 48), None)
+
+    def mark(self):
+        """Skip everything published so far, e.g. before reloading from the source"""
+        channel = caches[self.channel]
+        self._ensure_counter(channel)
+        self._seen = channel.get(self._sequence_key)
+        self._next_poll = time.monotonic() + self.poll_interval
+
+    def poll(self):
+        now = time.monotonic()
+        if now < self._next_poll:
+            return None
+        self._next_poll = now + self.poll_interval
+
+        channel = caches[self.channel]
+        sequence = channel.get(self._sequence_key)
+        if sequence is None:
+            # Counter lost and nothing published since; the next message
+            # recreates it and the jump is caught then
+            return None
+        seen, self._seen = self._seen, sequence
+        if seen is None:
+            # Nothing loaded yet that an earlier message could concern
+            return None
+        if sequence == seen:
+            return None
+
+        if sequence < seen or sequence - seen > self.max_replay:
+            # Counter recreated, or too far behind to be worth replaying
+            return self.ALL
+        log_keys = [self._log_key(n) for n in range(seen + 1, sequence + 1)]
+        messages = channel.get_many(log_keys)
+        if len(messages) < len(log_keys) or self.ALL in messages.values():
+            # Log entries expired: we cannot tell what changed
+            return self.ALL
+        return list(messages.values())
+
+
+# Property documents, in front of PropertyMongoDB.find_by_id
+property_cache = DocumentCache('properties')
@@ -0,0 +1,218 @@
+from pymongo import ASCENDING, DESCENDING, GEOSPHERE, TEXT
+from pymongo.errors import OperationFailure
+
+# Declarative index specification for the MongoDB collections.
+#
+# Each entry mirrors the arguments of ``Collection.create_index``: ``keys`` is
+# the key pattern and ``options`` holds the index options. The compound
+# indexes follow the equality -> sort -> range rule for the filter and
+# ordering combinations used by ``property_list_mongodb``; ``_id`` is the
+# keyset pagination tie-breaker and is part of every sortable index.
+PROPERTY_INDEXES = [
+    # Unfiltered listing, newest first (default ordering)
+    {
+        'name': 'created_at_id',
+        'keys': [('created_at', DESCENDING), ('_id', DESCENDING)],
+    },
+    # Price ordering and price range without other filters
+    {
+        'name': 'price_id',
+        'keys': [('price', ASCENDING), ('_id', ASCENDING)],
+    },
+    # Area ordering
+    {
+        'name': 'area_id',
+        'keys': [('area', ASCENDING), ('_id', ASCENDING)],
+    },
+    # Sale/rent listings, newest first; also serves the status counters
+    {
+        'name': 'status_created_at_id',
+        'keys': [('status', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)],
+    },
+    # Sale/rent listings ordered or ranged by price
+    {
+        'name': 'status_price_id',
+        'keys': [('status', ASCENDING), ('price', ASCENDING), ('_id', ASCENDING)],
+    },
+    # Type (and optionally status) filtered listings, newest first
+    {
+        'name': 'type_status_created_at_id',
+        'keys': [
+            ('property_type', ASCENDING), ('status', ASCENDING),
+            ('created_at', DESCENDING), ('_id', DESCENDING),
+        ],
+    },
+    # Type (and optionally status) filtered listings by price
+    {
+        'name': 'type_status_price_id',
+        'keys': [
+            ('property_type', ASCENDING), ('status', ASCENDING),
+            ('price', ASCENDING), ('_id', ASCENDING),
+        ],
+    },
+    # Featured listings are a small subset, so only they are indexed
+    {
+        'name': 'featured_created_at_id',
+        'keys': [('featured', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)],
+        'options': {'partialFilterExpression': {'featured': True}},
+    },
+    # Latest change in the collection, for list ETags
+    {
+        'name': 'updated_at',
+        'keys': [('updated_at', DESCENDING)],
+    },
+    # Ownership lookups (profile counters, "my listings")
+    {
+        'name': 'owner_id',
+        'keys': [('owner_id', ASCENDING)],
+    },
+    # Upsert key for feed imports; listings created by hand have no external_id
+    {
+        'name': 'owner_external_id',
+        'keys': [('owner_id', ASCENDING), ('external_id', ASCENDING)],
+        'options': {
+            'unique': True,
+            'partialFilterExpression': {'external_id': {'$type': 'string'}},
+        },
+    },
+    # Map queries (radius, viewport, polygon) combined with the list filters.
+    # Documents without a location are left out of the index.
+    {
+        'name': 'location_2dsphere',
+        'keys': [
+            ('location', GEOSPHERE), ('property_type', ASCENDING),
+            ('status', ASCENDING), ('price', ASCENDING),
+        ],
+    },
+    # Full-text search; a match in the title outranks one in the description
+    {
+        'name': 'text_search',
+        'keys': [('title', TEXT), ('city', TEXT), ('state', TEXT), ('description', TEXT)],
+        'options': {
+            'weights': {'title': 10, 'city': 5, 'state': 5, 'description': 1},
+            'default_language': 'english',
+        },
+    },
+]
+
+INDEX_SPECS = {
+    'properties': PROPERTY_INDEXES,
+}
+
+# Options that change index behaviour and therefore count as drift when they
+# differ in either direction. Other options given in a spec (text weights,
+# language...) are compared only when declared, because the server fills in
+# defaults for them. Anything else it reports (``v``, ``background``...) is
+# ignored.
+STRICT_OPTIONS = ('unique', 'sparse', 'partialFilterExpression', 'expireAfterSeconds')
+
+
+def normalize_keys(keys):
+    """
+    Return the key pattern the way ``index_information`` reports it.
+
+    The server stores all text fields of a text index as the internal
+    ``_fts``/``_ftsx`` pair and keeps the field list in ``weights``.
+    """
+    normalized = []
+    for field, direction in keys:
+        if direction == TEXT:
+            if ('_fts', TEXT) not in normalized:
+                normalized += [('_fts', TEXT), ('_ftsx', 1)]
+        elif field != '_ftsx':
+            normalized.append((field, direction))
+    return normalized
+
+
+def index_matches(spec, info):
+    """Return True when an existing index (``index_information`` entry) matches the spec"""
+    if normalize_keys(info['key']) != normalize_keys(spec['keys']):
+        return False
+
+    options = spec.get('options', {})
+    for option in set(STRICT_OPTIONS) | set(options):
+        if options.get(option) != info.get(option):
+            return False
+    return True
+
+
+# A changed index is built again under the other of two names, so the old
+# one keeps serving queries until its replacement is ready
+REBUILD_SUFFIX = '__rebuilt'
+
+# Server codes refusing a second index on the same keys (or a second text index)
+INDEX_CONFLICT_CODES = (85, 86)
+
+
+def index_names(spec):
+    """The names an index built from ``spec`` may carry, the declared one first"""
+    return [spec['name'], spec['name'] + REBUILD_SUFFIX]
+
+
+def current_index_name(existing, spec):
+    """
+    Name of the index serving ``spec`` in ``existing`` (``index_information``):
+    the one matching the spec, else the first present, else None.
+    """
+    present = [name for name in index_names(spec) if name in existing]
+    matching = [name for name in present if index_matches(spec, existing[name])]
+    return (matching or present or [None])[0]
+
+
+def get_index_drift(collection, specs):
+    """
+    Compare the indexes of ``collection`` against ``specs``.
+
+    Returns a ``(missing, changed, unused)`` tuple: specs with no index under
+    either of their names, specs whose existing index differs, and index
+    names present on the server but serving no spec (the mandatory ``_id_``
+    index is skipped).
+    """
+    existing = collection.index_information()
+    missing, changed, serving = [], [], set()
+    for spec in specs:
+        name = current_index_name(existing, spec)
+        if name is None:
+            missing.append(spec)
+            continue
+        serving.add(name)
+        if not index_matches(spec, existing[name]):
+            changed.append(spec)
+    unused = [name for name in existing if name != '_id_' and name not in serving]
+    return missing, changed, unused
+
+
+def create_index(collection, spec):
+    options = dict(spec.get('options', {}))
+    # Ignored by MongoDB 4.2+, which always uses the non-blocking build
+    # process, but keeps older servers from locking the collection
+    options.setdefault('background', True)
+    return collection.create_index(spec['keys'], name=spec['name'], **options)
+
+
+def rebuild_index(collection, spec):
+    """
+    Replace the index serving an older version of ``spec``; returns
+    ``(name, in_place)``.
+
+    The replacement is built under the name the old index does not carry and
+    the old one is dropped once it is ready. When the server refuses both at
+    once (same keys, other options), the old index is dropped first and
+    ``in_place`` is True.
+    """
+    existing = collection.index_information()
+    old = current_index_name(existing, spec)
+    new = next(name for name in index_names(spec) if name != old)
+    if new in existing:
+        # Left over from an interrupted rebuild, and not what the spec says
+        collection.drop_index(new)
+    try:
+        create_index(collection, dict(spec, name=new))
+    except OperationFailure as e:
+        if e.code not in INDEX_CONFLICT_CODES:
+            raise
+        collection.drop_index(old)
+        create_index(collection, dict(spec, name=new))
+        return new, True
+    collection.drop_index(old)
+    return new, False
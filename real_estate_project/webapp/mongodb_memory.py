@@ -0,0 +1,2006 @@
+"""
+In-process storage engine: MongoDB collections kept in Python dicts.
+
+Selected with MONGODB_SETTINGS['engine'] = 'memory' (see mongodb_storage.py).
+It implements the part of MongoDB the models, views and management commands
+use, with the same result types and errors as pymongo:
+
+- filters: equality, $eq/$ne/$gt/$gte/$lt/$lte/$in/$nin/$exists/$regex/
+  $type/$not, $and/$or/$nor/$expr, $text, and $geoWithin ($geometry,
+  $centerSphere, $box), $geoIntersects and $nearSphere/$near on points
+- updates: $set, $unset, $inc, $setOnInsert, upserts
+- aggregation: $match, $group, $sort, $limit, $skip, $project, $addFields,
+  $unwind, $facet, $sample, $count
+- indexes: create_index builds lookup structures for the indexed fields, a
+  hash for equality, a sorted list for ranges and ordering, a grid for
+  2dsphere and postings for text, and enforces unique indexes
+
+Anything outside that raises OperationFailure instead of returning a wrong
+answer. Arrays are matched element by element, but only single-field
+conditions are; $elemMatch and array update operators are not supported.
+
+Documents are copied in and out, so a caller mutating a result does not
+change what is stored. Each collection has its own lock; one command holds
+it for its whole run, like a single-node server without yields.
+"""
+import bisect
+import functools
+import math
+import operator
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from collections.abc import Mapping
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from bson import Binary, Code, DBRef, Decimal128, Int64, MaxKey, MinKey, ObjectId, Regex, Timestamp
+from bson.errors import InvalidDocument
+from django.conf import settings
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, InvalidOperation, OperationFailure
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+from . import geo
+from .mongodb_storage import StorageEngine, command_listeners
+
+# Stands in for a field the document does not have
+MISSING = type('Missing', (), {'__repr__': lambda self: 'MISSING'})()
+
+# Types stored as they are; anything else must be a dict or list, or the
+# insert fails the way BSON encoding would
+SCALAR_TYPES = (
+    type(None), bool, int, float, str, bytes, ObjectId, datetime, Binary, Code,
+    DBRef, Decimal128, Int64, MaxKey, MinKey, Regex, Timestamp, re.Pattern,
+)
+
+# More candidates than this and a sorted, limited query walks the sort
+# field's index instead of sorting the candidates
+WALK_MIN_CANDIDATES = 512
+
+# Inserting more documents than this at once rebuilds the sorted indexes
+# on their next use instead of inserting into them one by one
+REBUILD_ORDERED_AFTER = 256
+
+# Documents copied out of the store per lock acquisition while iterating
+BATCH_SIZE = 101
+
+# Sorts after every value key
+HIGHEST = (99,)
+
+STOP_WORDS = frozenset('''
+    a about above after again against all am an and any are as at be because been before being below
+    between both but by can did do does doing down during each few for from further had has have having
+    he her here hers herself him himself his how i if in into is it its itself just me more most my
+    myself no nor not now of off on once only or other our ours ourselves out over own same she should
+    so some such than that the their theirs them themselves then there these they this those through
+    to too under until up very was we were what when where which while who whom why will with you your
+    yours yourself yourselves
+'''.split())
+
+TYPE_ALIASES = {
+    1: 'double', 2: 'string', 3: 'object', 4: 'array', 5: 'binData', 7: 'objectId', 8: 'bool',
+    9: 'date', 10: 'null', 11: 'regex', 16: 'int', 17: 'timestamp', 18: 'long', 19: 'decimal',
+}
+
+
+class _DuplicateKey(Exception):
+    def __init__(self, message, key_pattern, key_value):
+        super().__init__(message)
+        self.details = {'keyPattern': key_pattern, 'keyValue': key_value}
+
+
+# Values
+
+def type_rank(value):
+    """Position of the value's type in MongoDB's cross-type sort order"""
+    if value is None or value is MISSING:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float, Int64, Decimal128)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, Mapping):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, (bytes, Binary)):
+        return 6
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime):
+        return 9
+    return 10
+
+
+def value_key(value):
+    """Hashable key ordered like MongoDB orders values"""
+    rank = type_rank(value)
+    if rank == 1:
+        return (1, 0)
+    if rank == 2 and isinstance(value, Decimal128):
+        return (2, float(value.to_decimal()))
+    if rank in (4, 5, 10):
+        return (rank, repr(value))
+    return (rank, value)
+
+
+def to_stored(value):
+    """Copy of ``value`` as MongoDB would store it"""
+    if isinstance(value, Mapping):
+        return {key: to_stored(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_stored(item) for item in value]
+    if isinstance(value, datetime):
+        # BSON dates are UTC with millisecond precision
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.replace(microsecond=value.microsecond // 1000 * 1000)
+    if not isinstance(value, SCALAR_TYPES):
+        raise InvalidDocument(f'cannot encode object: {value!r}, of type: {type(value)}')
+    return value
+
+
+def copy_value(value):
+    if isinstance(value, dict):
+        return {key: copy_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [copy_value(item) for item in value]
+    return value
+
+
+def get_path(doc, path):
+    """Value at a dotted path, or MISSING"""
+    if '.' not in path:
+        return doc.get(path, MISSING) if isinstance(doc, Mapping) else MISSING
+    value = doc
+    for part in path.split('.'):
+        if isinstance(value, Mapping):
+            value = value.get(part, MISSING)
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return MISSING
+        if value is MISSING:
+            return MISSING
+    return value
+
+
+def set_path(doc, path, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        child = doc.get(part)
+        if child is None:
+            child = doc[part] = {}
+        elif not isinstance(child, dict):
+            raise OperationFailure(f"Cannot create field '{part}' in element {{{part}: {child!r}}}", 28)
+        doc = child
+    doc[parts[-1]] = value
+
+
+def unset_path(doc, path):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+
+def is_operator_dict(value):
+    return isinstance(value, Mapping) and bool(value) and all(
+        isinstance(key, str) and key.startswith('$') for key in value
+    )
+
+
+def normalize_sort(key_or_list, direction=None):
+    if isinstance(key_or_list, str):
+        return [(key_or_list, 1 if direction is None else direction)]
+    if isinstance(key_or_list, Mapping):
+        return list(key_or_list.items())
+    return [(key, value) for key, value in key_or_list]
+
+
+def normalize_keys(keys, direction=None):
+    if isinstance(keys, str):
+        return [(keys, 1 if direction is None else direction)]
+    if isinstance(keys, Mapping):
+        return list(keys.items())
+    return [(key, value) for key, value in keys]
+
+
+def sort_items(items, sort, text_scores=None):
+    """Sort ``(key, doc)`` pairs by a normalized sort spec, in place"""
+    # Stable sorts from the last key to the first give a multi-key sort
+    for field, direction in reversed(sort):
+        if isinstance(direction, Mapping):
+            # {'$meta': 'textScore'}: best match first
+            scores = text_scores or {}
+            items.sort(key=lambda item: scores.get(item[0], 0.0), reverse=True)
+        else:
+            items.sort(key=lambda item: value_key(get_path(item[1], field)), reverse=direction == -1)
+
+
+# Text search
+
+@functools.lru_cache(maxsize=65536)
+def stem(word):
+    """Light English suffix stripping; the same words always get the same stem"""
+    if len(word) <= 3:
+        return word
+    for suffix, replacement in (('sses', 'ss'), ('ies', 'i'), ('ss', 'ss'), ('s', '')):
+        if word.endswith(suffix):
+            word = word[:len(word) - len(suffix)] + replacement
+            break
+    for suffix in ('ingly', 'edly', 'ing', 'ed', 'ly'):
+        base = word[:-len(suffix)]
+        if word.endswith(suffix) and len(base) >= 3 and re.search('[aeiouy]', base):
+            return base
+    return word
+
+
+def text_terms(text):
+    """Stems of the words of ``text``, stop words left out"""
+    return [stem(word) for word in re.findall(r'\w+', text.lower()) if word not in STOP_WORDS]
+
+
+class TextIndex:
+    """Postings from stem to document ids for a text index"""
+
+    def __init__(self, fields, weights):
+        self.fields = fields
+        self.weights = {field: weights.get(field, 1) for field in fields}
+        self.postings = defaultdict(set)
+
+    def field_terms(self, doc):
+        terms = {}
+        for field in self.fields:
+            value = get_path(doc, field)
+            if isinstance(value, str):
+                terms[field] = text_terms(value)
+        return terms
+
+    def add(self, key, doc):
+        for terms in self.field_terms(doc).values():
+            for term in terms:
+                self.postings[term].add(key)
+
+    def remove(self, key, doc):
+        for terms in self.field_terms(doc).values():
+            for term in terms:
+                keys = self.postings.get(term)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.postings[term]
+
+    def search(self, docs, spec):
+        """``{key: score}`` of the documents matching a $text query"""
+        search = spec.get('$search', '')
+        phrases = [phrase.lower() for phrase in re.findall(r'"([^"]*)"', search) if phrase.strip()]
+        positive, negative = set(), set()
+        for chunk in re.sub(r'"[^"]*"', ' ', search).split():
+            (negative if chunk.startswith('-') else positive).update(text_terms(chunk))
+        for phrase in phrases:
+            positive.update(text_terms(phrase))
+        positive -= negative
+        if not positive:
+            return {}
+
+        candidates = set().union(*(self.postings.get(term, ()) for term in positive))
+        scores = {}
+        for key in candidates:
+            doc = docs[key]
+            if phrases:
+                text = ' '.join(
+                    value.lower() for value in (get_path(doc, field) for field in self.fields) if isinstance(value, str)
+                )
+                if not all(phrase in text for phrase in phrases):
+                    continue
+            score = 0.0
+            excluded = False
+            for field, terms in self.field_terms(doc).items():
+                if negative.intersection(terms):
+                    excluded = True
+                    break
+                counts = defaultdict(int)
+                for term in terms:
+                    counts[term] += 1
+                # Repeats add less and less; short fields weigh more
+                for term in positive.intersection(counts):
+                    count = counts[term]
+                    frequency = 2 - 2 ** (1 - count)
+                    score += self.weights[field] * frequency * (0.5 * count / len(terms) + 0.5)
+            if not excluded and score > 0:
+                scores[key] = score
+        return scores
+
+
+# Geo
+
+def geo_point(value):
+    """``(lng, lat)`` of a GeoJSON point or legacy pair, or None"""
+    if isinstance(value, Mapping) and value.get('type') == 'Point':
+        value = value.get('coordinates')
+    if isinstance(value, (list, tuple)) and len(value) >= 2:
+        try:
+            return float(value[0]), float(value[1])
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+def in_ring(lng, lat, ring):
+    inside = False
+    previous = ring[-1]
+    for current in ring:
+        x1, y1 = current[0], current[1]
+        x2, y2 = previous[0], previous[1]
+        if (y1 > lat) != (y2 > lat) and lng < (x2 - x1) * (lat - y1) / (y2 - y1) + x1:
+            inside = not inside
+        previous = current
+    return inside
+
+
+@functools.lru_cache(maxsize=256)
+def check_ring(ring):
+    """Reject loops MongoDB rejects: unclosed, degenerate or self-intersecting"""
+    error = geo.ring_error(ring)
+    if error:
+        raise OperationFailure(f'Loop is not valid: {error}', 2)
+
+
+def check_geometry(geometry):
+    kind = geometry.get('type')
+    if kind == 'Polygon':
+        polygons = [geometry['coordinates']]
+    elif kind == 'MultiPolygon':
+        polygons = geometry['coordinates']
+    else:
+        return
+    for polygon in polygons:
+        for ring in polygon:
+            check_ring(tuple(tuple(vertex) for vertex in ring))
+
+
+def in_polygon(point, coordinates):
+    """Point inside the outer ring and outside every hole; edges are planar"""
+    for ring in coordinates:
+        check_ring(tuple(tuple(vertex) for vertex in ring))
+    lng, lat = point
+    outer, *holes = coordinates
+    return in_ring(lng, lat, outer) and not any(in_ring(lng, lat, hole) for hole in holes)
+
+
+def in_geometry(point, geometry):
+    kind = geometry.get('type')
+    if kind == 'Polygon':
+        return in_polygon(point, geometry['coordinates'])
+    if kind == 'MultiPolygon':
+        return any(in_polygon(point, polygon) for polygon in geometry['coordinates'])
+    if kind == 'Point':
+        return geo_point(geometry) == point
+    raise OperationFailure(f'unsupported geometry type {kind!r}', 2)
+
+
+def distance_m(point, center):
+    return geo.haversine_km(point[1], point[0], center[1], center[0]) * 1000
+
+
+def near_spec(condition):
+    """``(center, min_m, max_m)`` of a $nearSphere/$near condition"""
+    operand = condition.get('$nearSphere', condition.get('$near'))
+    if isinstance(operand, Mapping) and '$geometry' in operand:
+        center = geo_point(operand['$geometry'])
+        return center, operand.get('$minDistance'), operand.get('$maxDistance')
+    # Legacy pair; distances are in radians
+    scale = geo.EARTH_RADIUS_KM * 1000
+    min_distance = condition.get('$minDistance')
+    max_distance = condition.get('$maxDistance')
+    return (
+        geo_point(operand),
+        min_distance * scale if min_distance is not None else None,
+        max_distance * scale if max_distance is not None else None,
+    )
+
+
+def match_geo(op, operand, value, condition):
+    point = geo_point(value)
+    if point is None:
+        return False
+    if op in ('$nearSphere', '$near'):
+        center, min_distance, max_distance = near_spec(condition)
+        if center is None:
+            raise OperationFailure(f'invalid point in {op}', 2)
+        distance = distance_m(point, center)
+        return (min_distance is None or distance >= min_distance) and (max_distance is None or distance <= max_distance)
+    if '$geometry' in operand:
+        return in_geometry(point, operand['$geometry'])
+    if '$centerSphere' in operand:
+        center, radians = operand['$centerSphere']
+        center = geo_point(center)
+        return distance_m(point, center) <= radians * geo.EARTH_RADIUS_KM * 1000
+    if '$box' in operand:
+        (min_lng, min_lat), (max_lng, max_lat) = operand['$box']
+        return min_lng <= point[0] <= max_lng and min_lat <= point[1] <= max_lat
+    if '$polygon' in operand:
+        return in_ring(point[0], point[1], operand['$polygon'])
+    raise OperationFailure(f'unsupported {op} shape {list(operand)}', 2)
+
+
+def geo_bounds(condition):
+    """``(min_lng, min_lat, max_lng, max_lat)`` enclosing what a geo condition can match, or None"""
+    operand = None
+    for op in ('$geoWithin', '$geoIntersects', '$nearSphere', '$near'):
+        if op in condition:
+            operand = condition[op]
+            break
+    if operand is None:
+        return None
+
+    if op in ('$nearSphere', '$near'):
+        center, _, max_distance = near_spec(condition)
+        if center is None or max_distance is None:
+            return None
+        return circle_bounds(center, max_distance / 1000 / geo.EARTH_RADIUS_KM)
+    if '$centerSphere' in operand:
+        center, radians = operand['$centerSphere']
+        return circle_bounds(geo_point(center), radians)
+    if '$box' in operand:
+        (min_lng, min_lat), (max_lng, max_lat) = operand['$box']
+        return min_lng, min_lat, max_lng, max_lat
+    geometry = operand.get('$geometry') or {}
+    rings = {
+        'Polygon': lambda coordinates: coordinates[:1],
+        'MultiPolygon': lambda coordinates: [polygon[0] for polygon in coordinates],
+    }.get(geometry.get('type'))
+    if rings is None:
+        return None
+    points = [point for ring in rings(geometry['coordinates']) for point in ring]
+    return (
+        min(point[0] for point in points), min(point[1] for point in points),
+        max(point[0] for point in points), max(point[1] for point in points),
+    )
+
+
+def circle_bounds(center, radians):
+    lng, lat = center
+    degrees = math.degrees(radians)
+    min_lat, max_lat = lat - degrees, lat + degrees
+    if min_lat <= -90 or max_lat >= 90:
+        return -180, max(min_lat, -90), 180, min(max_lat, 90)
+    spread = degrees / max(math.cos(math.radians(max(abs(min_lat), abs(max_lat)))), 1e-9)
+    if lng - spread < -180 or lng + spread > 180:
+        return -180, min_lat, 180, max_lat
+    return lng - spread, min_lat, lng + spread, max_lat
+
+
+def geo_cell(value):
+    point = geo_point(value)
+    if point is None:
+        return None
+    return math.floor(point[0]), math.floor(point[1])
+
+
+# Query matching
+
+COMPARISONS = {'$gt': operator.gt, '$gte': operator.ge, '$lt': operator.lt, '$lte': operator.le}
+GEO_OPERATORS = ('$geoWithin', '$geoIntersects', '$nearSphere', '$near')
+
+
+# Compared with == when value and operand share one of these types
+PLAIN_TYPES = frozenset((str, int, float, ObjectId, datetime))
+
+
+def values_equal(value, expected):
+    if value.__class__ is expected.__class__ and value.__class__ in PLAIN_TYPES:
+        return value == expected
+    if value is MISSING:
+        value = None
+    if isinstance(value, list) and not isinstance(expected, list):
+        return any(values_equal(item, expected) for item in value)
+    return value_key(value) == value_key(expected)
+
+
+def compare(value, op, operand):
+    if isinstance(value, list):
+        return any(compare(item, op, operand) for item in value)
+    if value is MISSING or value is None:
+        # Null only compares equal to null
+        return operand is None and op in ('$gte', '$lte')
+    if type_rank(value) != type_rank(operand):
+        return False
+    try:
+        return COMPARISONS[op](value_key(value), value_key(operand))
+    except TypeError:
+        return False
+
+
+def regex_matches(value, pattern, options=''):
+    if isinstance(value, list):
+        return any(regex_matches(item, pattern, options) for item in value)
+    if not isinstance(value, str):
+        return False
+    if isinstance(pattern, Regex):
+        pattern = pattern.try_compile()
+    if not isinstance(pattern, re.Pattern):
+        flags = 0
+        for option, flag in (('i', re.IGNORECASE), ('m', re.MULTILINE), ('s', re.DOTALL), ('x', re.VERBOSE)):
+            if option in (options or ''):
+                flags |= flag
+        pattern = re.compile(pattern, flags)
+    return pattern.search(value) is not None
+
+
+def type_matches(value, alias):
+    alias = TYPE_ALIASES.get(alias, alias)
+    if value is MISSING:
+        return False
+    if alias == 'number':
+        return type_rank(value) == 2
+    checks = {
+        'double': lambda v: isinstance(v, float),
+        'string': lambda v: isinstance(v, str),
+        'object': lambda v: isinstance(v, Mapping),
+        'array': lambda v: isinstance(v, list),
+        'binData': lambda v: isinstance(v, (bytes, Binary)),
+        'objectId': lambda v: isinstance(v, ObjectId),
+        'bool': lambda v: isinstance(v, bool),
+        'date': lambda v: isinstance(v, datetime),
+        'null': lambda v: v is None,
+        'regex': lambda v: isinstance(v, (re.Pattern, Regex)),
+        'int': lambda v: isinstance(v, int) and not isinstance(v, bool) and -2 ** 31 <= v < 2 ** 31,
+        'long': lambda v: isinstance(v, Int64) or (isinstance(v, int) and not isinstance(v, bool) and not -2 ** 31 <= v < 2 ** 31),
+        'timestamp': lambda v: isinstance(v, Timestamp),
+        'decimal': lambda v: isinstance(v, Decimal128),
+    }
+    if alias not in checks:
+        raise OperationFailure(f'Unknown type name alias: {alias}', 2)
+    return checks[alias](value)
+
+
+def condition_matches(value, condition):
+    """Whether a field value satisfies a filter condition"""
+    if isinstance(condition, (re.Pattern, Regex)):
+        return regex_matches(value, condition)
+    if not is_operator_dict(condition):
+        return values_equal(value, condition)
+
+    for op, operand in condition.items():
+        if op == '$eq':
+            matched = values_equal(value, operand)
+        elif op == '$ne':
+            matched = not values_equal(value, operand)
+        elif op in COMPARISONS:
+            matched = compare(value, op, operand)
+        elif op == '$in':
+            matched = any(
+                regex_matches(value, item) if isinstance(item, (re.Pattern, Regex)) else values_equal(value, item)
+                for item in operand
+            )
+        elif op == '$nin':
+            matched = not any(values_equal(value, item) for item in operand)
+        elif op == '$exists':
+            matched = (value is not MISSING) == bool(operand)
+        elif op == '$regex':
+            matched = regex_matches(value, operand, condition.get('$options', ''))
+        elif op == '$options':
+            continue
+        elif op == '$type':
+            aliases = operand if isinstance(operand, list) else [operand]
+            matched = any(type_matches(value, alias) for alias in aliases)
+        elif op == '$not':
+            matched = not condition_matches(value, operand)
+        elif op == '$size':
+            matched = isinstance(value, list) and len(value) == operand
+        elif op == '$all':
+            matched = all(values_equal(value, item) for item in operand)
+        elif op in GEO_OPERATORS:
+            matched = match_geo(op, operand, value, condition)
+        elif op in ('$maxDistance', '$minDistance'):
+            continue
+        else:
+            raise OperationFailure(f'unknown operator: {op}', 2)
+        if not matched:
+            return False
+    return True
+
+
+def matches(doc, query, text_keys=None):
+    """Whether ``doc`` matches the filter ``query``"""
+    for key, condition in query.items():
+        if key == '$and':
+            if not all(matches(doc, sub, text_keys) for sub in condition):
+                return False
+        elif key == '$or':
+            if not any(matches(doc, sub, text_keys) for sub in condition):
+                return False
+        elif key == '$nor':
+            if any(matches(doc, sub, text_keys) for sub in condition):
+                return False
+        elif key == '$text':
+            if text_keys is None or doc['_id'] not in text_keys:
+                return False
+        elif key == '$expr':
+            if not truthy(evaluate(condition, doc)):
+                return False
+        elif key == '$comment':
+            continue
+        elif key.startswith('$'):
+            raise OperationFailure(f'unknown top level operator: {key}', 2)
+        elif not condition_matches(get_path(doc, key), condition):
+            return False
+    return True
+
+
+def find_condition(query, operators):
+    """``(field, condition)`` of the first top-level condition using one of ``operators``"""
+    for key, condition in query.items():
+        if key == '$and':
+            for sub in condition:
+                found = find_condition(sub, operators)
+                if found:
+                    return found
+        elif not key.startswith('$') and is_operator_dict(condition) and any(op in condition for op in operators):
+            return key, condition
+    return None
+
+
+def find_text(query):
+    if '$text' in query:
+        return query['$text']
+    for sub in query.get('$and', ()):
+        found = find_text(sub)
+        if found is not None:
+            return found
+    return None
+
+
+def contains_operator(value, operators):
+    if isinstance(value, Mapping):
+        return any(key in operators or contains_operator(item, operators) for key, item in value.items())
+    if isinstance(value, list):
+        return any(contains_operator(item, operators) for item in value)
+    return False
+
+
+# Aggregation expressions
+
+def truthy(value):
+    if nullish(value) or value is False:
+        return False
+    return not (type_rank(value) == 2 and value == 0)
+
+
+def nullish(value):
+    return value is None or value is MISSING
+
+
+def evaluate(expr, doc):
+    """Value of an aggregation expression for ``doc``; MISSING for absent fields"""
+    return compile_expression(expr)(doc)
+
+
+def compile_expression(expr):
+    """
+    Turn an aggregation expression into a function of the document, so a
+    stage parses its expressions once rather than once per document.
+    """
+    if isinstance(expr, str):
+        if expr in ('$$ROOT', '$$CURRENT'):
+            return lambda doc: doc
+        if expr.startswith('$$'):
+            raise OperationFailure(f'Use of undefined variable: {expr[2:]}', 17276)
+        if expr.startswith('$'):
+            path = expr[1:]
+            if '.' in path:
+                return lambda doc: get_path(doc, path)
+            return lambda doc: doc.get(path, MISSING)
+        return lambda doc: expr
+    if isinstance(expr, list):
+        items = [compile_expression(item) for item in expr]
+        return lambda doc: [item(doc) for item in items]
+    if isinstance(expr, Mapping):
+        if len(expr) == 1:
+            (op, operand), = expr.items()
+            if op.startswith('$'):
+                return compile_operator(op, operand)
+        fields = [(key, compile_expression(item)) for key, item in expr.items()]
+
+        def build(doc):
+            result = {}
+            for key, item in fields:
+                value = item(doc)
+                if value is not MISSING:
+                    result[key] = value
+            return result
+        return build
+    return lambda doc: expr
+
+
+def compile_operator(op, operand):
+    if op == '$literal':
+        return lambda doc: operand
+    if op == '$meta':
+        return lambda doc: None
+    if op == '$cond':
+        parts = (operand['if'], operand['then'], operand['else']) if isinstance(operand, Mapping) else operand
+        condition, then, otherwise = (compile_expression(part) for part in parts)
+        return lambda doc: then(doc) if truthy(condition(doc)) else otherwise(doc)
+
+    args = [compile_expression(arg) for arg in (operand if isinstance(operand, list) else [operand])]
+    if op == '$ifNull':
+        def if_null(doc):
+            for arg in args:
+                value = arg(doc)
+                if not nullish(value):
+                    return value
+            return None
+        return if_null
+
+    function = EXPRESSION_OPERATORS.get(op)
+    if function is None:
+        raise OperationFailure(f"Unrecognized expression '{op}'", 168)
+    if len(args) == 2:
+        left, right = args
+        return lambda doc: function(left(doc), right(doc))
+    return lambda doc: function(*[arg(doc) for arg in args])
+
+
+def _comparison(compare):
+    def apply(left, right):
+        return compare(value_key(None if left is MISSING else left), value_key(None if right is MISSING else right))
+    return apply
+
+
+def _arithmetic(function):
+    def apply(*values):
+        if any(nullish(value) for value in values):
+            return None
+        return function(*values)
+    return apply
+
+
+def _divide(dividend, divisor):
+    if divisor == 0:
+        raise OperationFailure("can't $divide by zero", 16608)
+    return dividend / divisor
+
+
+def _substring(string, start, length):
+    string = '' if nullish(string) else str(string)
+    return string[start:start + length] if length >= 0 else string[start:]
+
+
+def _size(value):
+    if not isinstance(value, list):
+        raise OperationFailure('The argument to $size must be an array', 17124)
+    return len(value)
+
+
+def _extreme(pick):
+    def apply(*values):
+        if len(values) == 1 and isinstance(values[0], list):
+            values = values[0]
+        present = [value for value in values if not nullish(value)]
+        return pick(present, key=value_key) if present else None
+    return apply
+
+
+EXPRESSION_OPERATORS = {
+    '$eq': _comparison(operator.eq),
+    '$ne': _comparison(operator.ne),
+    '$gt': _comparison(operator.gt),
+    '$gte': _comparison(operator.ge),
+    '$lt': _comparison(operator.lt),
+    '$lte': _comparison(operator.le),
+    '$cmp': _comparison(lambda left, right: (left > right) - (left < right)),
+    '$and': lambda *values: all(truthy(value) for value in values),
+    '$or': lambda *values: any(truthy(value) for value in values),
+    '$not': lambda value: not truthy(value),
+    '$in': lambda value, array: any(value_key(value) == value_key(item) for item in array or []),
+    '$add': _arithmetic(lambda *values: sum(values[1:], values[0])),
+    '$subtract': _arithmetic(operator.sub),
+    '$multiply': _arithmetic(lambda *values: math.prod(values)),
+    '$divide': _arithmetic(_divide),
+    '$mod': _arithmetic(operator.mod),
+    '$floor': _arithmetic(math.floor),
+    '$ceil': _arithmetic(math.ceil),
+    '$abs': _arithmetic(abs),
+    '$round': _arithmetic(lambda value, places=0: round(value, places)),
+    '$substrCP': _substring,
+    '$substr': _substring,
+    '$substrBytes': _substring,
+    '$toLower': lambda value: '' if nullish(value) else str(value).lower(),
+    '$toUpper': lambda value: '' if nullish(value) else str(value).upper(),
+    '$concat': _arithmetic(lambda *values: ''.join(values)),
+    '$size': _size,
+    '$min': _extreme(min),
+    '$max': _extreme(max),
+}
+
+
+class Accumulator:
+    """One $group accumulator field: ``initial()``, then ``add(state, doc)`` per document"""
+
+    OPERATORS = ('$sum', '$avg', '$min', '$max', '$first', '$last', '$firstN', '$push', '$addToSet', '$count')
+
+    def __init__(self, op, operand):
+        if op not in self.OPERATORS:
+            raise OperationFailure(f"unknown group operator '{op}'", 15952)
+        self.op = op
+        if op == '$firstN':
+            self.n = operand['n']
+            self.value = compile_expression(operand['input'])
+        elif op != '$count':
+            self.value = compile_expression(operand)
+        self.add = getattr(self, 'add_' + op[1:].lower())
+
+    def initial(self):
+        return {
+            '$sum': 0, '$count': 0, '$avg': (0, 0), '$min': MISSING, '$max': MISSING,
+            '$first': MISSING, '$last': MISSING, '$firstN': [], '$push': [], '$addToSet': [],
+        }[self.op]
+
+    def add_count(self, state, doc):
+        return state + 1
+
+    def add_sum(self, state, doc):
+        value = self.value(doc)
+        if value.__class__ is int or value.__class__ is float:
+            return state + value
+        # Non-numeric values are ignored
+        if type_rank(value) != 2:
+            return state
+        return state + value
+
+    def add_avg(self, state, doc):
+        value = self.value(doc)
+        if type_rank(value) != 2:
+            return state
+        return state[0] + value, state[1] + 1
+
+    def add_min(self, state, doc):
+        value = self.value(doc)
+        if nullish(value):
+            return state
+        return value if state is MISSING or value_key(value) < value_key(state) else state
+
+    def add_max(self, state, doc):
+        value = self.value(doc)
+        if nullish(value):
+            return state
+        return value if state is MISSING or value_key(value) > value_key(state) else state
+
+    def add_first(self, state, doc):
+        return self.value(doc) if state is MISSING else state
+
+    def add_last(self, state, doc):
+        return self.value(doc)
+
+    def add_firstn(self, state, doc):
+        if len(state) < self.n:
+            value = self.value(doc)
+            state.append(None if value is MISSING else value)
+        return state
+
+    def add_push(self, state, doc):
+        value = self.value(doc)
+        if value is not MISSING:
+            state.append(value)
+        return state
+
+    def add_addtoset(self, state, doc):
+        value = self.value(doc)
+        if value is not MISSING and all(value_key(item) != value_key(value) for item in state):
+            state.append(value)
+        return state
+
+    def result(self, state):
+        if self.op == '$avg':
+            total, count = state
+            return total / count if count else None
+        return None if state is MISSING else state
+
+
+def group(docs, spec):
+    if '_id' not in spec:
+        raise OperationFailure('a group specification must include an _id', 15955)
+    group_id_of = compile_expression(spec['_id'])
+    accumulators = []
+    for field, accumulator in spec.items():
+        if field == '_id':
+            continue
+        (op, operand), = accumulator.items()
+        accumulators.append((field, Accumulator(op, operand)))
+    adders = [accumulator.add for _, accumulator in accumulators]
+
+    groups = {}
+    for doc in docs:
+        group_id = group_id_of(doc)
+        if group_id is MISSING:
+            group_id = None
+        key = value_key(group_id)
+        state = groups.get(key)
+        if state is None:
+            state = groups[key] = (group_id, [accumulator.initial() for _, accumulator in accumulators])
+        values = state[1]
+        for i, add in enumerate(adders):
+            values[i] = add(values[i], doc)
+
+    return [
+        dict({'_id': group_id}, **{
+            field: accumulator.result(values[i]) for i, (field, accumulator) in enumerate(accumulators)
+        })
+        for group_id, values in groups.values()
+    ]
+
+
+def project(doc, projection, text_score=None):
+    """Apply a find/$project projection to ``doc``, returning a new document"""
+    if not projection:
+        return copy_value(doc)
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+
+    computed = {}
+    included = []
+    excluded = []
+    for field, spec in projection.items():
+        if isinstance(spec, Mapping) and '$meta' in spec:
+            computed[field] = text_score
+        elif isinstance(spec, (bool, int, float)):
+            (included if spec else excluded).append(field)
+        else:
+            computed[field] = evaluate(spec, doc)
+
+    inclusion = bool(computed) or bool(included) and (any(field != '_id' for field in included) or not excluded)
+    if inclusion and any(field != '_id' for field in excluded):
+        raise OperationFailure('Cannot do exclusion on field in inclusion projection', 31254)
+
+    if inclusion:
+        result = {}
+        if '_id' not in excluded and '_id' in doc:
+            result['_id'] = copy_value(doc['_id'])
+        for field in included:
+            value = get_path(doc, field)
+            if value is not MISSING:
+                set_path(result, field, copy_value(value))
+    else:
+        result = copy_value(doc)
+        for field in excluded:
+            unset_path(result, field)
+    for field, value in computed.items():
+        if value is not MISSING:
+            set_path(result, field, copy_value(value))
+    return result
+
+
+def run_pipeline(docs, stages):
+    """Run aggregation ``stages`` over a list of documents"""
+    for stage in stages:
+        if len(stage) != 1:
+            raise OperationFailure('A pipeline stage specification object must contain exactly one field.', 40323)
+        (name, spec), = stage.items()
+        if name == '$match':
+            if find_text(spec) is not None:
+                raise OperationFailure('$match with $text is only allowed as the first pipeline stage', 17313)
+            docs = [doc for doc in docs if matches(doc, spec)]
+        elif name == '$group':
+            docs = group(docs, spec)
+        elif name == '$sort':
+            items = [(None, doc) for doc in docs]
+            sort_items(items, normalize_sort(spec))
+            docs = [doc for _, doc in items]
+        elif name == '$limit':
+            docs = docs[:spec]
+        elif name == '$skip':
+            docs = docs[spec:]
+        elif name == '$project':
+            docs = [project(doc, spec) for doc in docs]
+        elif name in ('$addFields', '$set'):
+            docs = [add_fields(doc, spec) for doc in docs]
+        elif name == '$unwind':
+            docs = list(unwind(docs, spec))
+        elif name == '$facet':
+            docs = [{field: run_pipeline(docs, pipeline) for field, pipeline in spec.items()}]
+        elif name == '$sample':
+            docs = random.sample(docs, min(spec['size'], len(docs)))
+        elif name == '$count':
+            docs = [{spec: len(docs)}] if docs else []
+        else:
+            raise OperationFailure(f'Unrecognized pipeline stage name: {name!r}', 40324)
+    return docs
+
+
+def add_fields(doc, spec):
+    result = copy_value(doc)
+    for field, expr in spec.items():
+        value = evaluate(expr, doc)
+        if value is not MISSING:
+            set_path(result, field, value)
+    return result
+
+
+def unwind(docs, spec):
+    if isinstance(spec, str):
+        spec = {'path': spec}
+    path = spec['path'][1:]
+    keep_empty = spec.get('preserveNullAndEmptyArrays', False)
+    for doc in docs:
+        value = get_path(doc, path)
+        if isinstance(value, list) and value:
+            for item in value:
+                unwound = copy_value(doc)
+                set_path(unwound, path, item)
+                yield unwound
+        elif isinstance(value, list) or nullish(value):
+            if keep_empty:
+                yield doc
+        else:
+            yield doc
+
+
+# Updates
+
+def apply_update(doc, update, inserting=False):
+    """Apply update operators to ``doc`` in place"""
+    for op, fields in update.items():
+        if op == '$set':
+            for path, value in fields.items():
+                set_path(doc, path, to_stored(value))
+        elif op == '$unset':
+            for path in fields:
+                unset_path(doc, path)
+        elif op == '$inc':
+            for path, amount in fields.items():
+                current = get_path(doc, path)
+                if current is MISSING:
+                    set_path(doc, path, amount)
+                elif type_rank(current) != 2:
+                    raise OperationFailure(
+                        f"Cannot apply $inc to a value of non-numeric type. {{_id: {doc.get('_id')!r}}} "
+                        f"has the field '{path}' of non-numeric type {type(current).__name__}", 14
+                    )
+                else:
+                    set_path(doc, path, current + amount)
+        elif op == '$setOnInsert':
+            if inserting:
+                for path, value in fields.items():
+                    set_path(doc, path, to_stored(value))
+        else:
+            raise OperationFailure(f'Unknown modifier: {op}. Expected a valid update modifier or pipeline-style update', 9)
+
+
+def upsert_document(query, update):
+    """The document an upsert inserts: the filter's equality fields plus the update"""
+    doc = {}
+
+    def seed(query):
+        for key, condition in query.items():
+            if key == '$and':
+                for sub in condition:
+                    seed(sub)
+            elif key.startswith('$'):
+                continue
+            elif is_operator_dict(condition):
+                if '$eq' in condition:
+                    set_path(doc, key, to_stored(condition['$eq']))
+            elif not isinstance(condition, (re.Pattern, Regex)):
+                set_path(doc, key, to_stored(condition))
+
+    seed(query)
+    apply_update(doc, update, inserting=True)
+    if '_id' not in doc:
+        doc = dict({'_id': ObjectId()}, **doc)
+    return doc
+
+
+def check_update(update):
+    if not update or not is_operator_dict(update):
+        raise ValueError('update only works with $ operators')
+
+
+# Cursors
+
+class MemoryCursor:
+    """Lazily run find(); the subset of pymongo.cursor.Cursor the repo uses"""
+
+    def __init__(self, collection, query, projection=None, skip=0, limit=0, sort=None, batch_size=0):
+        self._collection = collection
+        self._query = query
+        self._projection = projection
+        self._skip = skip
+        self._limit = limit
+        self._sort = normalize_sort(sort) if sort else None
+        self._batch_size = batch_size
+        self._results = None
+
+    def _check_unstarted(self):
+        if self._results is not None:
+            raise InvalidOperation('cannot set options after executing query')
+
+    def sort(self, key_or_list, direction=None):
+        self._check_unstarted()
+        self._sort = normalize_sort(key_or_list, direction)
+        return self
+
+    def skip(self, skip):
+        self._check_unstarted()
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._check_unstarted()
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size):
+        self._check_unstarted()
+        self._batch_size = batch_size
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._results is None:
+            self._results = self._collection._execute_find(
+                self._query, self._projection, self._sort, self._skip, abs(self._limit), self._batch_size
+            )
+        return next(self._results)
+
+    next = __next__
+
+    def to_list(self, length=None):
+        return [doc for _, doc in zip(range(length) if length else iter(int, 1), self)]
+
+    def close(self):
+        self._results = iter(())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MemoryCommandCursor:
+    """Results of aggregate(), like pymongo's CommandCursor"""
+
+    def __init__(self, docs):
+        self._docs = iter(docs)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._docs)
+
+    next = __next__
+
+    def to_list(self, length=None):
+        return [doc for _, doc in zip(range(length) if length else iter(int, 1), self)]
+
+    def close(self):
+        self._docs = iter(())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Collections
+
+class MemoryCollection:
+    """
+    One collection: documents by ``_id`` plus the structures its indexes
+    need. ``_id`` values must be hashable (ObjectId, str, int...).
+    """
+
+    def __init__(self, database_name, name):
+        self.database_name = database_name
+        self.name = name
+        self.full_name = f'{database_name}.{name}'
+        self._lock = threading.RLock()
+        self._indexes = {}
+        self._reset()
+
+    def _reset(self):
+        self._docs = {}
+        # Insertion order, the natural order of unsorted results
+        self._order = {}
+        self._counter = 0
+        self._equality = {}
+        self._ordered = {'_id': None}
+        self._geo = {}
+        self._text = None
+        self._unique = {}
+        for name, index in self._indexes.items():
+            self._add_index_structures(name, index)
+
+    @contextmanager
+    def _command(self, command_name, **command):
+        """Hold the lock for one command and report it to the command listeners"""
+        started = time.perf_counter()
+        failed = True
+        try:
+            with self._lock:
+                yield
+            failed = False
+        finally:
+            if command_listeners:
+                duration_ms = (time.perf_counter() - started) * 1000
+                command = dict({command_name: self.name}, **command)
+                for listener in list(command_listeners):
+                    listener(command_name, self.name, command, duration_ms, failed)
+
+    # Index structures
+
+    def _index_fields(self):
+        """Fields per kind of lookup structure, for the indexes that exist"""
+        fields = {'equality': set(), 'geo': set()}
+        for index in self._indexes.values():
+            for field, direction in index['key']:
+                if direction in ('2dsphere', '2d'):
+                    fields['geo'].add(field)
+                elif direction in (1, -1) and field != '_id':
+                    fields['equality'].add(field)
+        return fields
+
+    def _add_index_structures(self, name, index):
+        fields = self._index_fields()
+        for field in fields['equality']:
+            if field not in self._equality:
+                self._equality[field] = values = defaultdict(set)
+                self._ordered[field] = None
+                for key, doc in self._docs.items():
+                    values[value_key(get_path(doc, field))].add(key)
+        for field in fields['geo']:
+            if field not in self._geo:
+                self._geo[field] = cells = defaultdict(set)
+                for key, doc in self._docs.items():
+                    cell = geo_cell(get_path(doc, field))
+                    if cell is not None:
+                        cells[cell].add(key)
+        text_fields = [field for field, direction in index['key'] if direction == 'text']
+        if text_fields:
+            self._text = TextIndex(text_fields, index['options'].get('weights', {}))
+            for key, doc in self._docs.items():
+                self._text.add(key, doc)
+        if index['options'].get('unique'):
+            entries = self._unique[name] = {}
+            for key, doc in self._docs.items():
+                unique_key = self._unique_key(index, doc)
+                if unique_key is None:
+                    continue
+                if unique_key in entries:
+                    del self._unique[name]
+                    raise self._duplicate_error(name, index, doc)
+                entries[unique_key] = key
+
+    def _drop_index_structures(self, name):
+        fields = self._index_fields()
+        for field in list(self._equality):
+            if field not in fields['equality']:
+                del self._equality[field]
+                del self._ordered[field]
+        for field in list(self._geo):
+            if field not in fields['geo']:
+                del self._geo[field]
+        if not any(direction == 'text' for index in self._indexes.values() for _, direction in index['key']):
+            self._text = None
+        self._unique.pop(name, None)
+
+    def _unique_key(self, index, doc):
+        partial = index['options'].get('partialFilterExpression')
+        if partial is not None and not matches(doc, partial):
+            return None
+        values = [get_path(doc, field) for field, _ in index['key']]
+        if index['options'].get('sparse') and all(value is MISSING for value in values):
+            return None
+        return tuple(value_key(value) for value in values)
+
+    def _duplicate_error(self, name, index, doc):
+        key_value = {field: get_path(doc, field) for field, _ in index['key']}
+        key_value = {field: None if value is MISSING else value for field, value in key_value.items()}
+        dup_key = ', '.join(f'{field}: {value!r}' for field, value in key_value.items())
+        return _DuplicateKey(
+            f'E11000 duplicate key error collection: {self.full_name} index: {name} dup key: {{ {dup_key} }}',
+            dict(index['key']), key_value
+        )
+
+    def _check_unique(self, doc, key=None):
+        if '_id' in doc and doc['_id'] in self._docs and doc['_id'] != key:
+            raise self._duplicate_error('_id_', {'key': [('_id', 1)]}, doc)
+        for name, entries in self._unique.items():
+            index = self._indexes[name]
+            unique_key = self._unique_key(index, doc)
+            if unique_key is not None and entries.get(unique_key, key) != key:
+                raise self._duplicate_error(name, index, doc)
+
+    def _index_add(self, key, doc, bulk=False):
+        for field, values in self._equality.items():
+            values[value_key(get_path(doc, field))].add(key)
+        for field, entries in self._ordered.items():
+            if entries is not None:
+                if bulk:
+                    self._ordered[field] = None
+                else:
+                    bisect.insort(entries, (value_key(get_path(doc, field)), value_key(key)))
+        for field, cells in self._geo.items():
+            cell = geo_cell(get_path(doc, field))
+            if cell is not None:
+                cells[cell].add(key)
+        if self._text is not None:
+            self._text.add(key, doc)
+        for name, entries in self._unique.items():
+            unique_key = self._unique_key(self._indexes[name], doc)
+            if unique_key is not None:
+                entries[unique_key] = key
+
+    def _index_remove(self, key, doc):
+        for field, values in self._equality.items():
+            value = value_key(get_path(doc, field))
+            keys = values.get(value)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del values[value]
+        for field, entries in self._ordered.items():
+            if entries is not None:
+                entry = (value_key(get_path(doc, field)), value_key(key))
+                position = bisect.bisect_left(entries, entry)
+                if position < len(entries) and entries[position] == entry:
+                    del entries[position]
+        for field, cells in self._geo.items():
+            cell = geo_cell(get_path(doc, field))
+            if cell is not None and cell in cells:
+                cells[cell].discard(key)
+                if not cells[cell]:
+                    del cells[cell]
+        if self._text is not None:
+            self._text.remove(key, doc)
+        for name, entries in self._unique.items():
+            unique_key = self._unique_key(self._indexes[name], doc)
+            if unique_key is not None and entries.get(unique_key) == key:
+                del entries[unique_key]
+
+    def _ordered_entries(self, field):
+        entries = self._ordered.get(field)
+        if entries is None:
+            entries = self._ordered[field] = sorted(
+                (value_key(get_path(doc, field)), value_key(key)) for key, doc in self._docs.items()
+            )
+        return entries
+
+    # Writes
+
+    def _insert(self, doc, bulk=False):
+        if '_id' not in doc:
+            doc = dict({'_id': ObjectId()}, **doc)
+        self._check_unique(doc)
+        key = doc['_id']
+        self._docs[key] = doc
+        self._counter += 1
+        self._order[key] = self._counter
+        self._index_add(key, doc, bulk)
+        return key
+
+    def _replace(self, key, old, new):
+        if new.get('_id', MISSING) != key:
+            raise OperationFailure(
+                "Performing an update on the path '_id' would modify the immutable field '_id'", 66
+            )
+        self._check_unique(new, key)
+        self._index_remove(key, old)
+        self._docs[key] = new
+        self._index_add(key, new)
+
+    def _remove(self, key):
+        doc = self._docs.pop(key)
+        del self._order[key]
+        self._index_remove(key, doc)
+
+    def _update(self, query, update, upsert, multi, sort=None):
+        """Returns ``(matched, modified, upserted_id)``"""
+        keys, _ = self._select(query, sort=normalize_sort(sort) if sort else None, limit=0 if multi else 1)
+        modified = 0
+        for key in keys:
+            old = self._docs[key]
+            new = copy_value(old)
+            apply_update(new, update)
+            if new != old:
+                self._replace(key, old, new)
+                modified += 1
+        if not keys and upsert:
+            return 0, 0, self._insert(upsert_document(query, update))
+        return len(keys), modified, None
+
+    def _replace_one(self, query, replacement, upsert):
+        if is_operator_dict(replacement):
+            raise ValueError('replacement can not include $ operators')
+        keys, _ = self._select(query, limit=1)
+        if keys:
+            key = keys[0]
+            old = self._docs[key]
+            new = dict({'_id': key}, **to_stored(replacement))
+            if new == old:
+                return 1, 0, None
+            self._replace(key, old, new)
+            return 1, 1, None
+        if upsert:
+            return 0, 0, self._insert(upsert_document(query, {'$set': replacement}))
+        return 0, 0, None
+
+    def _delete(self, query, multi):
+        keys, _ = self._select(query, limit=0 if multi else 1, ordered=False)
+        for key in keys:
+            self._remove(key)
+        return len(keys)
+
+    # Reads
+
+    def _candidates(self, query):
+        """
+        Ids ``query`` can match, narrowed down through the _id, equality and
+        geo lookups; None when nothing narrows it down. The set returned may
+        be an index's own, so it must not be modified.
+        """
+        best = None
+        for field, condition in query.items():
+            if field == '$and':
+                found = [self._candidates(sub) for sub in condition]
+            elif field == '$or':
+                branches = [self._candidates(sub) for sub in condition]
+                found = [set().union(*branches)] if branches and None not in branches else []
+            elif field.startswith('$'):
+                continue
+            else:
+                found = [self._lookup(field, condition)]
+            for keys in found:
+                if keys is not None and (best is None or len(keys) < len(best)):
+                    best = keys
+        return best
+
+    def _exact(self, query):
+        """Whether the index lookup for ``query`` returns exactly its matches"""
+        if len(query) != 1:
+            return False
+        (field, condition), = query.items()
+        if field != '_id' and field not in self._equality:
+            return False
+        if is_operator_dict(condition):
+            if list(condition) == ['$eq']:
+                values = [condition['$eq']]
+            elif list(condition) == ['$in']:
+                values = condition['$in']
+            else:
+                return False
+        else:
+            values = [condition]
+        # Arrays and subdocuments match by element and by shape, not by key
+        return all(value.__class__ in PLAIN_TYPES or value is None or isinstance(value, bool) for value in values)
+
+    def _lookup(self, field, condition):
+        if is_operator_dict(condition):
+            if '$eq' in condition:
+                values = [condition['$eq']]
+            elif '$in' in condition and not any(isinstance(v, (re.Pattern, Regex)) for v in condition['$in']):
+                values = condition['$in']
+            else:
+                values = None
+        elif isinstance(condition, (list, re.Pattern, Regex)):
+            values = None
+        else:
+            values = [condition]
+
+        if values is not None and any(isinstance(value, list) for value in values):
+            values = None
+        if values is not None:
+            if field == '_id':
+                return {value for value in values if value is not None and value in self._docs}
+            index = self._equality.get(field)
+            if index is not None:
+                if len(values) == 1:
+                    return index.get(value_key(values[0]), set())
+                return set().union(*(index.get(value_key(value), ()) for value in values))
+
+        cells = self._geo.get(field)
+        if cells is not None and is_operator_dict(condition):
+            bounds = geo_bounds(condition)
+            if bounds is not None:
+                min_lng, min_lat, max_lng, max_lat = bounds
+                return set().union(*(
+                    keys for (lng, lat), keys in cells.items()
+                    if lng + 1 >= min_lng and lng <= max_lng and lat + 1 >= min_lat and lat <= max_lat
+                ))
+        return None
+
+    def _range(self, field, condition):
+        """``(entries, start, stop)`` of the sorted index of ``field`` a range condition covers"""
+        entries = self._ordered_entries(field)
+        start, stop = 0, len(entries)
+        if is_operator_dict(condition):
+            for op, operand in condition.items():
+                if op not in COMPARISONS or operand is None:
+                    continue
+                key = value_key(operand)
+                # Comparisons only match values of the same type
+                start = max(start, bisect.bisect_left(entries, ((key[0],),)))
+                stop = min(stop, bisect.bisect_left(entries, ((key[0] + 1,),)))
+                if op == '$gt':
+                    start = max(start, bisect.bisect_right(entries, (key, HIGHEST)))
+                elif op == '$gte':
+                    start = max(start, bisect.bisect_left(entries, (key,)))
+                elif op == '$lt':
+                    stop = min(stop, bisect.bisect_left(entries, (key,)))
+                else:
+                    stop = min(stop, bisect.bisect_right(entries, (key, HIGHEST)))
+        return entries, start, max(start, stop)
+
+    def _walkable(self, sort):
+        """The ``(field, direction)`` whose sorted index yields ``sort`` order, if any"""
+        field, direction = sort[0]
+        if field not in self._ordered or isinstance(direction, Mapping):
+            return None
+        if len(sort) == 1 or (len(sort) == 2 and sort[1] == ('_id', direction) and field != '_id'):
+            return field, direction
+        return None
+
+    def _select(self, query, sort=None, skip=0, limit=0, ordered=True):
+        """
+        Keys of the documents matching ``query``, in ``sort`` order (or
+        insertion order), with skip and limit applied; and the text scores
+        when the query has a $text clause.
+        """
+        query = query or {}
+        text_scores = None
+        text = find_text(query)
+        if text is not None:
+            if self._text is None:
+                raise OperationFailure('text index required for $text query', 27)
+            text_scores = self._text.search(self._docs, text)
+        near = find_condition(query, ('$nearSphere', '$near'))
+        if near is not None and near[0] not in self._geo:
+            raise OperationFailure(
+                'error processing query: planner returned error :: caused by :: '
+                'unable to find index for $geoNear query', 291
+            )
+        within = find_condition(query, ('$geoWithin',))
+        if within is not None and '$geometry' in within[1]['$geoWithin']:
+            # Checked before any document is read, as MongoDB parses it
+            check_geometry(within[1]['$geoWithin']['$geometry'])
+
+        candidates = self._candidates(query)
+        if text_scores is not None and (candidates is None or len(text_scores) < len(candidates)):
+            candidates = text_scores.keys()
+        wanted = skip + limit if limit else None
+
+        walk = self._walkable(sort) if sort and near is None else None
+        if walk and wanted and (candidates is None or len(candidates) > WALK_MIN_CANDIDATES):
+            # Read the sort field's index in order and stop at the limit
+            field, direction = walk
+            entries, start, stop = self._range(field, query.get(field))
+            positions = range(stop - 1, start - 1, -1) if direction == -1 else range(start, stop)
+            keys = []
+            for position in positions:
+                key = entries[position][1][1]
+                if candidates is not None and key not in candidates:
+                    continue
+                if matches(self._docs[key], query, text_scores):
+                    keys.append(key)
+                    if len(keys) >= wanted:
+                        break
+            return keys[skip:], text_scores
+
+        if candidates is None:
+            ranged = find_condition(
+                {field: condition for field, condition in query.items() if field in self._ordered},
+                tuple(COMPARISONS)
+            )
+            if ranged is not None:
+                entries, start, stop = self._range(*ranged)
+                candidates = [entries[position][1][1] for position in range(start, stop)]
+            else:
+                candidates = self._docs.keys()
+        elif ordered and near is None:
+            # Ties and unsorted results come back in insertion order
+            candidates = sorted(candidates, key=self._order.__getitem__)
+
+        if self._exact(query):
+            items = [(key, self._docs[key]) for key in candidates]
+        else:
+            items = [(key, self._docs[key]) for key in candidates if matches(self._docs[key], query, text_scores)]
+        if near is not None and not sort:
+            center = near_spec(near[1])[0]
+            items.sort(key=lambda item: distance_m(geo_point(get_path(item[1], near[0])), center))
+        elif sort:
+            sort_items(items, sort, text_scores)
+        keys = [key for key, _ in items]
+        return keys[skip:wanted] if skip or wanted else keys, text_scores
+
+    def _execute_find(self, query, projection, sort, skip, limit, batch_size):
+        with self._command('find', filter=query, sort=sort, projection=projection, skip=skip, limit=limit):
+            keys, text_scores = self._select(query, sort, skip, limit)
+        return self._fetch(keys, projection, text_scores, batch_size or BATCH_SIZE)
+
+    def _fetch(self, keys, projection, text_scores, batch_size):
+        for start in range(0, len(keys), batch_size):
+            with self._lock:
+                batch = [
+                    project(self._docs[key], projection, (text_scores or {}).get(key))
+                    for key in keys[start:start + batch_size] if key in self._docs
+                ]
+            yield from batch
+
+    # pymongo Collection API
+
+    def find(self, filter=None, projection=None, skip=0, limit=0, sort=None, batch_size=0, **kwargs):
+        return MemoryCursor(self, filter or {}, projection, skip, limit, sort, batch_size)
+
+    def find_one(self, filter=None, *args, **kwargs):
+        if filter is not None and not isinstance(filter, Mapping):
+            filter = {'_id': filter}
+        kwargs.pop('limit', None)
+        return next(self.find(filter, *args, **kwargs).limit(1), None)
+
+    def count_documents(self, filter, skip=0, limit=0, **kwargs):
+        pipeline = [{'$match': filter}, {'$group': {'_id': 1, 'n': {'$sum': 1}}}]
+        with self._command('aggregate', pipeline=pipeline):
+            if contains_operator(filter, ('$near', '$nearSphere', '$where')):
+                raise OperationFailure('$geoNear, $near, and $nearSphere are not allowed in this context', 2)
+            keys, _ = self._select(filter, skip=skip, limit=limit, ordered=False)
+            return len(keys)
+
+    def estimated_document_count(self, **kwargs):
+        with self._command('count'):
+            return len(self._docs)
+
+    def insert_one(self, document, **kwargs):
+        if '_id' not in document:
+            document['_id'] = ObjectId()
+        with self._command('insert'):
+            try:
+                self._insert(to_stored(document))
+            except _DuplicateKey as e:
+                raise DuplicateKeyError(str(e), 11000, dict(e.details, code=11000, errmsg=str(e)))
+        return InsertOneResult(document['_id'], True)
+
+    def insert_many(self, documents, ordered=True, **kwargs):
+        documents = list(documents)
+        if not documents:
+            raise TypeError('documents must be a non-empty list')
+        for document in documents:
+            if '_id' not in document:
+                document['_id'] = ObjectId()
+        result = self._bulk([InsertOne(document) for document in documents], ordered)
+        return InsertManyResult([document['_id'] for document in documents], result.acknowledged)
+
+    def update_one(self, filter, update, upsert=False, sort=None, **kwargs):
+        check_update(update)
+        with self._command('update', q=filter, u=update, upsert=upsert):
+            matched, modified, upserted_id = self._write_one(self._update, filter, update, upsert, False, sort)
+        return self._update_result(matched, modified, upserted_id)
+
+    def update_many(self, filter, update, upsert=False, **kwargs):
+        check_update(update)
+        with self._command('update', q=filter, u=update, upsert=upsert, multi=True):
+            matched, modified, upserted_id = self._write_one(self._update, filter, update, upsert, True)
+        return self._update_result(matched, modified, upserted_id)
+
+    def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        with self._command('update', q=filter, u=replacement, upsert=upsert):
+            matched, modified, upserted_id = self._write_one(self._replace_one, filter, replacement, upsert)
+        return self._update_result(matched, modified, upserted_id)
+
+    def _write_one(self, write, *args):
+        try:
+            return write(*args)
+        except _DuplicateKey as e:
+            raise DuplicateKeyError(str(e), 11000, dict(e.details, code=11000, errmsg=str(e)))
+
+    def _update_result(self, matched, modified, upserted_id):
+        raw = {'n': 1 if upserted_id is not None else matched, 'nModified': modified}
+        if upserted_id is not None:
+            raw['upserted'] = upserted_id
+        return UpdateResult(raw, True)
+
+    def delete_one(self, filter, **kwargs):
+        with self._command('delete', q=filter, limit=1):
+            return DeleteResult({'n': self._delete(filter, False)}, True)
+
+    def delete_many(self, filter, **kwargs):
+        with self._command('delete', q=filter, limit=0):
+            return DeleteResult({'n': self._delete(filter, True)}, True)
+
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        requests = list(requests)
+        if not requests:
+            raise InvalidOperation('No operations to execute')
+        return self._bulk(requests, ordered)
+
+    def _bulk(self, requests, ordered):
+        details = {
+            'writeErrors': [], 'writeConcernErrors': [], 'nInserted': 0, 'nUpserted': 0,
+            'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': [],
+        }
+        # Consecutive operations of one kind go to the server as one command
+        runs = []
+        for index, request in enumerate(requests):
+            kind = self._bulk_kind(request)
+            if runs and runs[-1][0] == kind:
+                runs[-1][1].append((index, request))
+            else:
+                runs.append((kind, [(index, request)]))
+
+        for kind, run in runs:
+            with self._command(kind, ordered=ordered, count=len(run)):
+                bulk = kind == 'insert' and len(run) > REBUILD_ORDERED_AFTER
+                for index, request in run:
+                    try:
+                        self._bulk_one(request, index, details, bulk)
+                    except _DuplicateKey as e:
+                        details['writeErrors'].append(dict(
+                            e.details, index=index, code=11000, errmsg=str(e),
+                            op=getattr(request, '_doc', None)
+                        ))
+                        if ordered:
+                            break
+            if ordered and details['writeErrors']:
+                break
+
+        if details['writeErrors']:
+            raise BulkWriteError(details)
+        return BulkWriteResult(details, True)
+
+    def _bulk_kind(self, request):
+        if isinstance(request, InsertOne):
+            return 'insert'
+        if isinstance(request, (UpdateOne, UpdateMany, ReplaceOne)):
+            return 'update'
+        if isinstance(request, (DeleteOne, DeleteMany)):
+            return 'delete'
+        raise TypeError(f'{request!r} is not a valid request')
+
+    def _bulk_one(self, request, index, details, bulk):
+        if isinstance(request, InsertOne):
+            document = request._doc
+            if '_id' not in document:
+                document['_id'] = ObjectId()
+            self._insert(to_stored(document), bulk)
+            details['nInserted'] += 1
+            return
+        if isinstance(request, (DeleteOne, DeleteMany)):
+            details['nRemoved'] += self._delete(request._filter, isinstance(request, DeleteMany))
+            return
+        if isinstance(request, ReplaceOne):
+            matched, modified, upserted_id = self._replace_one(request._filter, request._doc, request._upsert)
+        else:
+            check_update(request._doc)
+            matched, modified, upserted_id = self._update(
+                request._filter, request._doc, request._upsert, isinstance(request, UpdateMany),
+                getattr(request, '_sort', None)
+            )
+        details['nMatched'] += matched
+        details['nModified'] += modified
+        if upserted_id is not None:
+            details['nUpserted'] += 1
+            details['upserted'].append({'index': index, '_id': upserted_id})
+
+    def aggregate(self, pipeline, **kwargs):
+        pipeline = list(pipeline)
+        with self._command('aggregate', pipeline=pipeline):
+            stages = pipeline
+            if stages and '$match' in stages[0]:
+                # A leading $match (and $sort/$skip/$limit after it) runs
+                # through the indexes like find() does
+                query = stages[0]['$match']
+                sort = skip = limit = None
+                rest = stages[1:]
+                if rest and '$sort' in rest[0]:
+                    sort, rest = normalize_sort(rest[0]['$sort']), rest[1:]
+                if sort and rest and '$skip' in rest[0]:
+                    skip, rest = rest[0]['$skip'], rest[1:]
+                if sort and rest and '$limit' in rest[0]:
+                    limit, rest = rest[0]['$limit'], rest[1:]
+                keys, _ = self._select(query, sort, skip or 0, limit or 0)
+                docs = [self._docs[key] for key in keys]
+                stages = rest
+            else:
+                docs = list(self._docs.values())
+            # Stages build new documents; only those passed through are copied
+            docs = [copy_value(doc) for doc in run_pipeline(docs, stages)]
+        return MemoryCommandCursor(docs)
+
+    def create_index(self, keys, **kwargs):
+        keys = normalize_keys(keys)
+        name = kwargs.pop('name', None) or '_'.join(f'{field}_{direction}' for field, direction in keys)
+        options = {
+            option: value for option, value in kwargs.items()
+            if option not in ('background', 'session', 'comment', 'commitQuorum')
+        }
+        with self._command('createIndexes', indexes=[dict(options, key=keys, name=name)]):
+            index = {'key': keys, 'options': options}
+            existing = self._indexes.get(name)
+            if existing is not None:
+                if existing == index:
+                    return name
+                raise OperationFailure(
+                    f'An existing index has the same name as the requested index. '
+                    f'When index names are not specified, they are auto generated and can cause conflicts. '
+                    f'Requested index: {index}, existing index: {existing}', 86
+                )
+            for other_name, other in self._indexes.items():
+                if other['key'] == keys:
+                    raise OperationFailure(f'Index already exists with a different name: {other_name}', 85)
+            if self._text is not None and any(direction == 'text' for _, direction in keys):
+                raise OperationFailure('only one text index per collection allowed', 85)
+            self._indexes[name] = index
+            try:
+                self._add_index_structures(name, index)
+            except _DuplicateKey as e:
+                del self._indexes[name]
+                self._drop_index_structures(name)
+                raise DuplicateKeyError(str(e), 11000, dict(e.details, code=11000, errmsg=str(e)))
+        return name
+
+    def drop_index(self, index_or_name, **kwargs):
+        name = index_or_name
+        if not isinstance(name, str):
+            keys = normalize_keys(index_or_name)
+            name = next((n for n, index in self._indexes.items() if index['key'] == keys), None)
+        with self._command('dropIndexes', index=name):
+            if name not in self._indexes:
+                raise OperationFailure(f'index not found with name [{name}]', 27)
+            del self._indexes[name]
+            self._drop_index_structures(name)
+
+    def drop_indexes(self, **kwargs):
+        with self._command('dropIndexes', index='*'):
+            for name in list(self._indexes):
+                del self._indexes[name]
+                self._drop_index_structures(name)
+
+    def index_information(self, **kwargs):
+        """Like the server reports them: text fields as ``_fts``/``_ftsx`` plus weights"""
+        with self._command('listIndexes'):
+            info = {'_id_': {'v': 2, 'key': [('_id', 1)]}}
+            for name, index in self._indexes.items():
+                keys = []
+                entry = {'v': 2}
+                for field, direction in index['key']:
+                    if direction == 'text':
+                        if ('_fts', 'text') not in keys:
+                            keys += [('_fts', 'text'), ('_ftsx', 1)]
+                    else:
+                        keys.append((field, direction))
+                entry['key'] = keys
+                entry.update(copy_value(index['options']))
+                text_fields = [field for field, direction in index['key'] if direction == 'text']
+                if text_fields:
+                    weights = index['options'].get('weights', {})
+                    entry['weights'] = {field: weights.get(field, 1) for field in text_fields}
+                    entry.setdefault('default_language', 'english')
+                    entry.setdefault('language_override', 'language')
+                    entry['textIndexVersion'] = 3
+                if any(direction == '2dsphere' for _, direction in index['key']):
+                    entry['2dsphereIndexVersion'] = 3
+                info[name] = entry
+            return info
+
+    def drop(self, **kwargs):
+        with self._command('drop'):
+            self._indexes = {}
+            self._reset()
+
+
+class AsyncMemoryCursor:
+    """Awaitable face of a MemoryCursor or MemoryCommandCursor"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def sort(self, *args, **kwargs):
+        self._cursor.sort(*args, **kwargs)
+        return self
+
+    def skip(self, skip):
+        self._cursor.skip(skip)
+        return self
+
+    def limit(self, limit):
+        self._cursor.limit(limit)
+        return self
+
+    def batch_size(self, batch_size):
+        self._cursor.batch_size(batch_size)
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._cursor)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    next = __anext__
+
+    async def to_list(self, length=None):
+        return self._cursor.to_list(length)
+
+    async def close(self):
+        self._cursor.close()
+
+
+class AsyncMemoryCollection:
+    """
+    A MemoryCollection with the AsyncCollection interface. Commands run
+    in-process and never wait on I/O, so they are simply awaited inline.
+    """
+
+    AWAITABLE = (
+        'find_one', 'count_documents', 'estimated_document_count', 'insert_one', 'insert_many',
+        'update_one', 'update_many', 'replace_one', 'delete_one', 'delete_many', 'bulk_write',
+        'create_index', 'drop_index', 'drop_indexes', 'index_information', 'drop',
+    )
+
+    def __init__(self, collection):
+        self._collection = collection
+        self.name = collection.name
+
+    def find(self, *args, **kwargs):
+        return AsyncMemoryCursor(self._collection.find(*args, **kwargs))
+
+    async def aggregate(self, pipeline, **kwargs):
+        return AsyncMemoryCursor(self._collection.aggregate(pipeline, **kwargs))
+
+    def __getattr__(self, name):
+        if name not in self.AWAITABLE:
+            raise AttributeError(name)
+        method = getattr(self._collection, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+
+class MemoryEngine(StorageEngine):
+    """
+    Databases held in this process, named like MONGODB_SETTINGS['db'].
+    They live until drop_database() or the end of the process and are not
+    shared between processes.
+    """
+
+    name = 'memory'
+
+    def __init__(self):
+        self._databases = {}
+        self._lock = threading.Lock()
+
+    def get_collection(self, name):
+        database_name = settings.MONGODB_SETTINGS['db']
+        with self._lock:
+            database = self._databases.setdefault(database_name, {})
+            collection = database.get(name)
+            if collection is None:
+                collection = database[name] = MemoryCollection(database_name, name)
+        return collection
+
+    def get_async_collection(self, name):
+        return AsyncMemoryCollection(self.get_collection(name))
+
+    def ping(self):
+        return {'ok': 1.0}
+
+    def drop_database(self, name=None):
+        with self._lock:
+            self._databases.pop(name or settings.MONGODB_SETTINGS['db'], None)
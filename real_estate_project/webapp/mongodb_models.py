@@ -1,12 +1,24 @@
-from pymongo import MongoClient
+from pymongo import InsertOne, MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
 from django.conf import settings
+from django.core.cache import caches
+from django.dispatch import Signal
 from datetime import datetime
 from bson import ObjectId
+from bson.errors import InvalidId
+from . import geo
+from .mongodb_cache import property_cache
+from .mongodb_pool import client_options, pool_stats
+from .mongodb_storage import get_engine
 import os
+import random
 
 class MongoDBConnection:
     _instance = None
     _client = None
+    # Process that created _client; a forked worker must not reuse the
+    # parent's sockets, so it builds its own client on first use
+    _pid = None
     
     def __new__(cls):
         if cls._instance is None:
@@ -14,9 +26,15 @@ class MongoDBConnection:
         return cls._instance
     
     def get_client(self):
-        if self._client is None:
-            self._client = MongoClient(settings.MONGODB_SETTINGS['host'])
-        return self._client
+        cls = type(self)
+        if cls._client is None or cls._pid != os.getpid():
+            cls._client = MongoClient(
+                settings.MONGODB_SETTINGS['host'],
+                event_listeners=[pool_stats],
+                **client_options()
+            )
+            cls._pid = os.getpid()
+        return cls._client
     
     def get_database(self):
         client = self.get_client()
@@ -25,13 +43,69 @@ class MongoDBConnection:
     def get_collection(self, collection_name):
         db = self.get_database()
         return db[collection_name]
+    
+    @classmethod
+    def reset_after_fork(cls):
+        """Drop the client inherited from the parent process without closing it"""
+        cls._client = None
+        cls._pid = None
+        pool_stats.reset()
+
+# Pre-fork servers (gunicorn, uwsgi) fork after the app is imported; the pid
+# check in get_client() covers any fork this hook does not see
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=MongoDBConnection.reset_after_fork)
+
+class VersionConflict(Exception):
+    """Raised when a property changed since the version the caller read"""
+    pass
+
+# Sent after save() and bulk_save() write listings, with ``properties`` (the
+# PropertyMongoDB instances written), ``changed_fields`` (the fields an
+# update changed; None for inserts and bulk writes, where any field may have)
+# and ``created`` (True when every listing is new)
+properties_saved = Signal()
+
+# Random, so a stats generation counter that is evicted and recreated does
+# not reach the keys of stats cached before
+def new_stats_generation():
+    return random.randrange(1 << 48)
+
 
 class PropertyMongoDB:
     """MongoDB-based Property model"""
     
+    collection_name = 'properties'
+    
+    # Cached result of stats(), shared by every process. Writes move on the
+    # generation, which is part of the key, so no process reads stats
+    # computed before the last write
+    STATS_CACHE_KEY = 'properties:stats'
+    STATS_GENERATION_KEY = 'properties:stats:generation'
+    STATS_CACHE_TIMEOUT = 300
+    STATS_TOP_CITIES = 20
+    
+    # Stored geohash length (~5m cells); clustering groups on its prefixes
+    GEOHASH_PRECISION = 9
+    
+    # Stored fields, in document order. ``location`` and ``geohash`` are also
+    # stored, but they are derived from latitude/longitude by to_dict().
+    FIELDS = (
+        'title', 'description', 'property_type', 'status', 'price',
+        'bedrooms', 'bathrooms', 'area', 'address', 'city', 'state',
+        'zip_code', 'latitude', 'longitude', 'image', 'featured',
+        'created_at', 'updated_at', 'owner_id', 'created_by_id',
+        'is_public', 'contact_info', 'external_id', 'version'
+    )
+    
+    # Fields needed to render a listing card; long text and contact
+    # details are only fetched by the detail endpoint
+    LIST_FIELDS = tuple(
+        field for field in FIELDS if field not in ('description', 'contact_info')
+    )
+    LIST_PROJECTION = {field: 1 for field in LIST_FIELDS}
+    
     def __init__(self, **kwargs):
-        self.collection = MongoDBConnection().get_collection('properties')
-        
         # Initialize fields
         self._id = kwargs.get('_id')
         self.title = kwargs.get('title', '')
@@ -58,35 +132,234 @@ class PropertyMongoDB:
         self.created_by_id = kwargs.get('created_by_id', None)  # User ID who created this listing
         self.is_public = kwargs.get('is_public', True)  # Whether property is publicly visible
         self.contact_info = kwargs.get('contact_info', {})  # Owner contact details
+        self.external_id = kwargs.get('external_id', None)  # Listing key in the owner's feed, for re-imports
+        self.version = kwargs.get('version', 0)  # Incremented on every update, for optimistic concurrency
+        
+        # Start tracking assignments only once the loaded state is in place
+        self._changed = set()
+    
+    def __setattr__(self, name, value):
+        changed = self.__dict__.get('_changed')
+        if changed is not None and name in self.FIELDS and self.__dict__.get(name) != value:
+            changed.add(name)
+        super().__setattr__(name, value)
+    
+    @property
+    def changed_fields(self):
+        """
+        Fields assigned a different value since the property was loaded or saved.
+        
+        Mutating a dict field in place (e.g. ``contact_info``) is not noticed;
+        assign a new value instead.
+        """
+        return set(self._changed)
     
     @property
     def id(self):
         return str(self._id) if self._id else None
     
-    def save(self):
-        """Save the property to MongoDB"""
-        data = self.to_dict()
+    @property
+    def location(self):
+        """GeoJSON point backing the location_2dsphere index"""
+        return geo.point(self.latitude, self.longitude)
+    
+    @property
+    def geohash(self):
+        """Geohash of the location, used to bucket listings into map clusters"""
+        location = self.location
+        if location is None:
+            return None
+        longitude, latitude = location['coordinates']
+        return geo.encode_geohash(latitude, longitude, self.GEOHASH_PRECISION)
+    
+    @property
+    def collection(self):
+        return self.get_collection()
+    
+    @classmethod
+    def get_collection(cls):
+        return get_engine().get_collection(cls.collection_name)
+    
+    @classmethod
+    def from_document(cls, doc):
+        """Build an instance from a raw MongoDB document"""
+        doc['_id'] = str(doc['_id'])
+        return cls(**doc)
+    
+    def save(self, expected_version=None):
+        """
+        Save the property to MongoDB.
+        
+        Updates only ``$set`` the fields changed since load and bump
+        ``version``. With ``expected_version``, the update only applies if
+        the stored version still matches, otherwise VersionConflict is raised.
+        """
+        now = datetime.now()
         
         if self._id:
             # Update existing document
-            data['updated_at'] = datetime.now()
-            self.collection.update_one(
-                {'_id': ObjectId(self._id)},
-                {'$set': data}
-            )
+            changes = self.pending_changes()
+            query = {'_id': ObjectId(self._id)}
+            if expected_version is not None:
+                # Documents written before versioning have no version field
+                query['version'] = expected_version if expected_version else {'$in': [0, None]}
+            
+            if not changes:
+                # Nothing to write, but a stale version is still a conflict
+                if expected_version is not None and not self.collection.count_documents(query, limit=1):
+                    raise VersionConflict(f'Property {self.id} was modified after version {expected_version}')
+                return self
+            changes['updated_at'] = now
+            
+            result = self.collection.update_one(query, {'$set': changes, '$inc': {'version': 1}})
+            if expected_version is not None and result.matched_count == 0:
+                raise VersionConflict(f'Property {self.id} was modified after version {expected_version}')
+            
+            self.updated_at = now
+            self.version += 1
+            property_cache.invalidate(self.id)
+            changed_fields = set(changes)
+            created = False
         else:
             # Create new document
-            data['created_at'] = datetime.now()
-            data['updated_at'] = datetime.now()
-            result = self.collection.insert_one(data)
+            result = self.collection.insert_one(self.prepare_insert(now))
             self._id = result.inserted_id
+            changed_fields = None
+            created = True
         
+        self._changed.clear()
+        self.invalidate_stats()
+        properties_saved.send(sender=type(self), properties=[self], changed_fields=changed_fields, created=created)
         return self
     
+    def pending_changes(self):
+        """``$set`` fields for what changed since load, with the derived location and geohash"""
+        changes = {field: getattr(self, field) for field in self._changed if field != 'version'}
+        if 'latitude' in changes or 'longitude' in changes:
+            changes['location'] = self.location
+            changes['geohash'] = self.geohash
+        return changes
+    
+    def prepare_insert(self, now):
+        """Stamp a new property and return the document to insert"""
+        self.created_at = now
+        self.updated_at = now
+        self.version = 1
+        return self.to_dict()
+    
+    @classmethod
+    def bulk_save(cls, properties):
+        """
+        Insert or update many properties with one unordered bulk_write.
+        
+        Properties with an ``_id`` are updated like save() does, with only
+        the fields changed since load; unchanged ones are not written.
+        Properties with an ``external_id`` are upserted on (owner_id,
+        external_id), so importing the same feed again updates listings in
+        place. The rest are inserted.
+        
+        Returns one ``{'status': 'created' | 'updated' | 'error'}`` entry per
+        property, in order; failed rows also carry an ``error`` message.
+        """
+        properties = list(properties)
+        now = datetime.now()
+        documents = []
+        operations = []
+        # Index in ``properties`` of each operation
+        positions = []
+        for index, prop in enumerate(properties):
+            if prop._id:
+                data = prop.pending_changes()
+                if not data:
+                    continue
+                data['updated_at'] = now
+                operations.append(UpdateOne(
+                    {'_id': ObjectId(prop._id)},
+                    {'$set': data, '$inc': {'version': 1}}
+                ))
+                documents.append(data)
+                positions.append(index)
+                continue
+            data = prop.to_dict()
+            data['updated_at'] = now
+            if prop.external_id:
+                data.pop('created_at')
+                data.pop('version')
+                operations.append(UpdateOne(
+                    {'owner_id': prop.owner_id, 'external_id': prop.external_id},
+                    {'$set': data, '$setOnInsert': {'created_at': now}, '$inc': {'version': 1}},
+                    upsert=True
+                ))
+            else:
+                data['created_at'] = now
+                data['version'] = 1
+                operations.append(InsertOne(data))
+            documents.append(data)
+            positions.append(index)
+        
+        if not properties:
+            return []
+        
+        results = [{'status': 'updated'} for _ in properties]
+        for index, operation in zip(positions, operations):
+            if isinstance(operation, InsertOne):
+                results[index]['status'] = 'created'
+        if not operations:
+            return results
+        
+        try:
+            upserted = cls.get_collection().bulk_write(operations, ordered=False).upserted_ids
+        except BulkWriteError as e:
+            # Unordered writes carry on past failures; only the reported rows failed
+            upserted = {item['index']: item['_id'] for item in e.details.get('upserted', [])}
+            for error in e.details.get('writeErrors', []):
+                results[positions[error['index']]] = {
+                    'status': 'error', 'error': error.get('errmsg', 'Write failed')
+                }
+        
+        for index, object_id in upserted.items():
+            results[positions[index]]['status'] = 'created'
+            properties[positions[index]]._id = object_id
+        for data, index in zip(documents, positions):
+            # The driver assigns _id to inserted documents in place
+            if results[index]['status'] == 'created' and not properties[index]._id:
+                properties[index]._id = data['_id']
+        
+        saved = [properties[index] for index in positions if results[index]['status'] != 'error']
+        updated = [properties[index] for index in positions if results[index]['status'] == 'updated']
+        cls.resolve_ids([prop for prop in updated if not prop._id])
+        property_cache.invalidate(*[prop.id for prop in updated])
+        for prop in saved:
+            prop._changed.clear()
+        
+        cls.invalidate_stats()
+        properties_saved.send(
+            sender=cls, changed_fields=None, properties=saved,
+            created=all(results[index]['status'] != 'updated' for index in positions)
+        )
+        return results
+    
+    @classmethod
+    def resolve_ids(cls, properties):
+        """Set the _id of properties updated through their external_id, in one query"""
+        if not properties:
+            return
+        keys = [{'owner_id': prop.owner_id, 'external_id': prop.external_id} for prop in properties]
+        found = {
+            (document['owner_id'], document['external_id']): document['_id']
+            for document in cls.get_collection().find(
+                {'$or': keys}, {'owner_id': 1, 'external_id': 1}
+            )
+        }
+        for prop in properties:
+            prop._id = found.get((prop.owner_id, prop.external_id))
+    
     def delete(self):
         """Delete the property from MongoDB"""
         if self._id:
             self.collection.delete_one({'_id': ObjectId(self._id)})
+            property_cache.invalidate(self.id)
+            self.invalidate_stats()
             return True
         return False
     
@@ -114,7 +387,11 @@ class PropertyMongoDB:
             'owner_id': self.owner_id,
             'created_by_id': self.created_by_id,
             'is_public': self.is_public,
-            'contact_info': self.contact_info
+            'contact_info': self.contact_info,
+            'external_id': self.external_id,
+            'version': self.version,
+            'location': self.location,
+            'geohash': self.geohash
         }
         
         if self._id:
@@ -123,63 +400,247 @@ class PropertyMongoDB:
         return data
     
     @classmethod
-    def find_all(cls, filters=None, sort=None, limit=None):
-        """Find all properties with optional filters"""
-        collection = MongoDBConnection().get_collection('properties')
+    def find_documents(cls, filters=None, sort=None, limit=None, skip=None, projection=None):
+        """
+        Find raw property documents with optional filters.
         
-        query = filters or {}
-        cursor = collection.find(query)
+        Returns the documents as decoded by the driver, without building model
+        instances. Pass ``projection`` (e.g. ``LIST_PROJECTION``) to fetch only
+        the fields the caller renders.
+        """
+        cursor = cls.get_collection().find(filters or {}, projection)
         
         if sort:
             cursor = cursor.sort(sort)
         
+        if skip:
+            cursor = cursor.skip(skip)
+        
         if limit:
             cursor = cursor.limit(limit)
         
-        properties = []
-        for doc in cursor:
-            doc['_id'] = str(doc['_id'])
-            properties.append(cls(**doc))
+        return list(cursor)
+    
+    @classmethod
+    def iter_documents(cls, filters=None, sort=None, projection=None, batch_size=1000):
+        """
+        Iterate over raw property documents without materializing them.
         
-        return properties
+        The driver fetches ``batch_size`` documents per round trip, so memory
+        stays flat however many documents match.
+        """
+        cursor = cls.get_collection().find(filters or {}, projection, batch_size=batch_size)
+        if sort:
+            cursor = cursor.sort(sort)
+        try:
+            yield from cursor
+        finally:
+            # Release the server-side cursor if the consumer stops early
+            cursor.close()
+    
+    @classmethod
+    def find_all(cls, filters=None, sort=None, limit=None, skip=None):
+        """Find all properties with optional filters"""
+        return [
+            cls.from_document(doc)
+            for doc in cls.find_documents(filters, sort=sort, limit=limit, skip=skip)
+        ]
     
     @classmethod
     def find_by_id(cls, property_id):
-        """Find property by ID"""
-        collection = MongoDBConnection().get_collection('properties')
+        """Find property by ID, served from the process-local document cache when possible"""
+        doc = property_cache.get(property_id)
+        if doc is None:
+            try:
+                doc = cls.get_collection().find_one({'_id': ObjectId(property_id)})
+            except:
+                doc = None
+            if doc is None:
+                return None
+            property_cache.set(doc['_id'], doc)
         
+        return cls.from_document(doc)
+    
+    @classmethod
+    def find_many(cls, property_ids, projection=None):
+        """
+        Fetch many properties with a single ``$in`` query.
+    
+        Returns raw documents keyed by their id as a string. Invalid and
+        unknown ids are left out.
+        """
+        object_ids = set()
+        for property_id in property_ids:
+            try:
+                object_ids.add(ObjectId(property_id))
+            except (InvalidId, TypeError):
+                continue
+        if not object_ids:
+            return {}
+        return {
+            str(doc['_id']): doc
+            for doc in cls.get_collection().find({'_id': {'$in': list(object_ids)}}, projection)
+        }
+    
+    @classmethod
+    def find_validators(cls, property_id):
+        """
+        Fetch only ``_id``, ``updated_at`` and ``version`` of a property.
+        
+        Enough to answer a conditional GET without loading the document.
+        """
         try:
-            doc = collection.find_one({'_id': ObjectId(property_id)})
-            if doc:
-                doc['_id'] = str(doc['_id'])
-                return cls(**doc)
+            return cls.get_collection().find_one(
+                {'_id': ObjectId(property_id)}, {'updated_at': 1, 'version': 1}
+            )
         except:
-            pass
-        
-        return None
+            return None
     
     @classmethod
     def count(cls, filters=None):
         """Count properties with optional filters"""
-        collection = MongoDBConnection().get_collection('properties')
-        return collection.count_documents(filters or {})
+        return cls.get_collection().count_documents(filters or {})
     
     @classmethod
-    def search(cls, search_term):
-        """Search properties by title, description, city, or state"""
-        if not search_term:
-            return cls.find_all()
-        
-        filters = {
-            '$or': [
-                {'title': {'$regex': search_term, '$options': 'i'}},
-                {'description': {'$regex': search_term, '$options': 'i'}},
-                {'city': {'$regex': search_term, '$options': 'i'}},
-                {'state': {'$regex': search_term, '$options': 'i'}}
-            ]
+    def estimated_count(cls):
+        """Fast total from collection metadata, without scanning documents"""
+        return cls.get_collection().estimated_document_count()
+    
+    @classmethod
+    def stats(cls):
+        """
+        Listing counters plus breakdowns by property type and city.
+        
+        Computed with a single $facet aggregation and cached until the next
+        write, in this process or any other.
+        """
+        stats_cache = cls.stats_cache()
+        key = cls.stats_key(cls.generation())
+        stats = stats_cache.get(key)
+        if stats is not None:
+            return stats
+        
+        result = next(cls.get_collection().aggregate(cls.stats_pipeline()))
+        stats = cls.stats_from_result(result)
+        stats_cache.set(key, stats, cls.STATS_CACHE_TIMEOUT)
+        return stats
+    
+    @classmethod
+    def generation(cls):
+        """
+        Collection generation, shared by every process.
+        
+        Every write through this model moves it on (see invalidate_stats), so
+        it keys the stats cache and the list ETags without a MongoDB query.
+        """
+        return cls.stats_cache().get_or_set(cls.STATS_GENERATION_KEY, new_stats_generation, None)
+    
+    @classmethod
+    def stats_cache(cls):
+        return caches[settings.MONGODB_SETTINGS.get('stats_cache', 'default')]
+    
+    @classmethod
+    def stats_key(cls, generation):
+        return f'{cls.STATS_CACHE_KEY}:{generation}'
+    
+    @classmethod
+    def stats_pipeline(cls):
+        """Aggregation behind stats(), shared with the async data layer"""
+        return [{'$facet': {
+            'totals': [{'$group': {
+                '_id': None,
+                'total_properties': {'$sum': 1},
+                'for_sale': {'$sum': {'$cond': [{'$eq': ['$status', 'sale']}, 1, 0]}},
+                'for_rent': {'$sum': {'$cond': [{'$eq': ['$status', 'rent']}, 1, 0]}},
+                'featured': {'$sum': {'$cond': [{'$eq': ['$featured', True]}, 1, 0]}},
+            }}],
+            'by_property_type': [
+                {'$group': {'_id': '$property_type', 'count': {'$sum': 1}}},
+                {'$sort': {'count': -1, '_id': 1}},
+            ],
+            'by_city': [
+                {'$group': {'_id': '$city', 'count': {'$sum': 1}}},
+                {'$sort': {'count': -1, '_id': 1}},
+                {'$limit': cls.STATS_TOP_CITIES},
+            ],
+        }}]
+    
+    @classmethod
+    def stats_from_result(cls, result):
+        """Shape the $facet result of stats_pipeline() into the stats payload"""
+        totals = result['totals'][0] if result['totals'] else {}
+        return {
+            'total_properties': totals.get('total_properties', 0),
+            'for_sale': totals.get('for_sale', 0),
+            'for_rent': totals.get('for_rent', 0),
+            'featured': totals.get('featured', 0),
+            'by_property_type': {row['_id']: row['count'] for row in result['by_property_type']},
+            'by_city': {row['_id']: row['count'] for row in result['by_city']},
         }
+    
+    @classmethod
+    def invalidate_stats(cls):
+        stats_cache = cls.stats_cache()
+        stats_cache.add(cls.STATS_GENERATION_KEY, new_stats_generation(), None)
+        try:
+            stats_cache.incr(cls.STATS_GENERATION_KEY)
+        except ValueError:
+            # Evicted since add(); whoever reads next starts a new generation
+            pass
+    
+    @classmethod
+    def clusters(cls, filters, precision, max_points, limit=1000):
+        """
+        Group matching listings into map clusters by geohash prefix.
+        
+        Each cluster carries its count, centroid and price range. Up to
+        ``max_points`` member listings are attached so the caller can show
+        small clusters as individual markers without a second query.
+        
+        Returns ``(clusters, truncated)``: the ``limit`` largest clusters, and
+        whether smaller ones were left out.
+        """
+        pipeline = [
+            {'$match': dict(filters, geohash={'$ne': None})},
+            {'$group': {
+                '_id': {'$substrCP': ['$geohash', 0, precision]},
+                'count': {'$sum': 1},
+                'latitude': {'$avg': '$latitude'},
+                'longitude': {'$avg': '$longitude'},
+                'min_price': {'$min': '$price'},
+                'max_price': {'$max': '$price'},
+                'points': {'$firstN': {'n': max_points, 'input': {
+                    '_id': '$_id',
+                    'title': '$title',
+                    'property_type': '$property_type',
+                    'status': '$status',
+                    'price': '$price',
+                    'latitude': '$latitude',
+                    'longitude': '$longitude',
+                }}},
+            }},
+            {'$sort': {'count': -1, '_id': 1}},
+            # One more than asked for tells whether any were left out
+            {'$limit': limit + 1},
+        ]
+        clusters = list(cls.get_collection().aggregate(pipeline))
+        return clusters[:limit], len(clusters) > limit
+    
+    @classmethod
+    def search_filters(cls, search_term):
+        """Build the query used to search properties by text (served by the text_search index)"""
+        return {'$text': {'$search': search_term}}
+    
+    @classmethod
+    def search(cls, search_term, filters=None, limit=None):
+        """Search properties by title, description, city, or state, best matches first"""
+        if not search_term:
+            return cls.find_all(filters, limit=limit)
+        
+        query = dict(filters or {})
+        query.update(cls.search_filters(search_term))
         
-        return cls.find_all(filters)
+        return cls.find_all(query, sort=[('score', {'$meta': 'textScore'})], limit=limit)
     
     def __str__(self):
         return self.title
\ No newline at end of file
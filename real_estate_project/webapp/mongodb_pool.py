@@ -0,0 +1,140 @@
+import threading
+from django.conf import settings
+from pymongo import monitoring
+
+# MONGODB_SETTINGS keys and the MongoClient options they map to. Keys left
+# unset (None) keep the driver default.
+CLIENT_OPTIONS = {
+    'max_pool_size': 'maxPoolSize',
+    'min_pool_size': 'minPoolSize',
+    'max_idle_time_ms': 'maxIdleTimeMS',
+    'wait_queue_timeout_ms': 'waitQueueTimeoutMS',
+    'server_selection_timeout_ms': 'serverSelectionTimeoutMS',
+    'connect_timeout_ms': 'connectTimeoutMS',
+    'socket_timeout_ms': 'socketTimeoutMS',
+    'read_concern': 'readConcernLevel',
+    'read_preference': 'readPreference',
+    'write_concern': 'w',
+    'write_concern_timeout_ms': 'wTimeoutMS',
+    'journal': 'journal',
+    'app_name': 'appname',
+}
+
+
+def client_options(mongo_settings=None):
+    """Return the MongoClient keyword arguments configured in MONGODB_SETTINGS"""
+    mongo_settings = settings.MONGODB_SETTINGS if mongo_settings is None else mongo_settings
+    options = {
+        option: mongo_settings[key]
+        for key, option in CLIENT_OPTIONS.items()
+        if mongo_settings.get(key) is not None
+    }
+    # w=1 from the environment arrives as '1', which the driver would read
+    # as a tag set name rather than a node count
+    if isinstance(options.get('w'), str) and options['w'].isdigit():
+        options['w'] = int(options['w'])
+    # Compressors are negotiated with the server; the first one both sides
+    # support is used, and none at all when the list is empty
+    compressors = mongo_settings.get('compressors')
+    if compressors:
+        options['compressors'] = compressors
+    return options
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """
+    Connection pool counters for the current process.
+
+    Registered as an event listener on the shared client. Wait times cover
+    the whole checkout, including time spent queued for a free connection,
+    which is the number to watch when sizing ``max_pool_size`` against the
+    number of worker threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checked_out = 0
+            self.max_checked_out = 0
+            self.checkouts = 0
+            self.checkout_failures = {}
+            self.wait_time_total = 0.0
+            self.wait_time_max = 0.0
+            self.connections_open = 0
+            self.connections_created = 0
+            self.connections_closed = 0
+            self.pool_clears = 0
+
+    def snapshot(self):
+        """Return the counters as a JSON-serializable dict"""
+        with self._lock:
+            attempts = self.checkouts + sum(self.checkout_failures.values())
+            return {
+                'checked_out': self.checked_out,
+                'max_checked_out': self.max_checked_out,
+                'checkouts': self.checkouts,
+                'checkout_failures': dict(self.checkout_failures),
+                'wait_ms_avg': round(self.wait_time_total * 1000 / attempts, 3) if attempts else 0.0,
+                'wait_ms_max': round(self.wait_time_max * 1000, 3),
+                'connections_open': self.connections_open,
+                'connections_created': self.connections_created,
+                'connections_closed': self.connections_closed,
+                'pool_clears': self.pool_clears,
+            }
+
+    def _record_wait(self, duration):
+        self.wait_time_total += duration
+        self.wait_time_max = max(self.wait_time_max, duration)
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self.checked_out += 1
+            self.max_checked_out = max(self.max_checked_out, self.checked_out)
+            self.checkouts += 1
+            self._record_wait(event.duration)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            reason = str(event.reason)
+            self.checkout_failures[reason] = self.checkout_failures.get(reason, 0) + 1
+            self._record_wait(event.duration)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out = max(self.checked_out - 1, 0)
+
+    def connection_created(self, event):
+        with self._lock:
+            self.connections_open += 1
+            self.connections_created += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.connections_open = max(self.connections_open - 1, 0)
+            self.connections_closed += 1
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.pool_clears += 1
+
+    # Remaining pool events carry nothing worth counting
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+
+pool_stats = PoolStats()
@@ -0,0 +1,101 @@
+"""
+Storage engines behind PropertyMongoDB.
+
+The models never talk to a MongoClient directly; they ask the engine named
+by ``MONGODB_SETTINGS['engine']`` for a collection:
+
+    'mongo'   the configured mongod, through MongoDBConnection (default)
+    'memory'  an in-process store (webapp/mongodb_memory.py), for the test
+              and benchmark suites and for development without a server
+
+A dotted path to a StorageEngine subclass is accepted as well. Whatever the
+engine returns must behave like the subset of pymongo's Collection the
+models, views and management commands use: find (projection, sort, skip,
+limit, batch_size), find_one, count_documents, estimated_document_count,
+aggregate, insert_one/insert_many, update_one, bulk_write, delete_one/
+delete_many, drop, create_index, drop_index and index_information, with the
+same result types and errors.
+"""
+import threading
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+ENGINES = {
+    'mongo': 'webapp.mongodb_storage.MongoEngine',
+    'memory': 'webapp.mongodb_memory.MemoryEngine',
+}
+
+# Called as listener(command_name, collection_name, command, duration_ms, failed)
+# for every command an engine without driver monitoring runs
+command_listeners = []
+
+
+def register_command_listener(listener):
+    if listener not in command_listeners:
+        command_listeners.append(listener)
+
+
+class StorageEngine:
+    """Hands out collections of the database in MONGODB_SETTINGS['db']"""
+
+    name = None
+    # Whether slow queries can be explained through the MongoDB client
+    supports_explain = False
+
+    def get_collection(self, name):
+        raise NotImplementedError
+
+    def get_async_collection(self, name):
+        """Same collection with awaitable methods, for webapp/mongodb_async.py"""
+        raise NotImplementedError
+
+    def ping(self):
+        raise NotImplementedError
+
+    def drop_database(self, name=None):
+        raise NotImplementedError
+
+
+class MongoEngine(StorageEngine):
+    """The configured MongoDB server"""
+
+    name = 'mongo'
+    supports_explain = True
+
+    def get_collection(self, name):
+        from .mongodb_models import MongoDBConnection
+        return MongoDBConnection().get_collection(name)
+
+    def get_async_collection(self, name):
+        from .mongodb_async import AsyncMongoDBConnection
+        return AsyncMongoDBConnection.get_collection(name)
+
+    def ping(self):
+        from .mongodb_models import MongoDBConnection
+        return MongoDBConnection().get_database().command('ping')
+
+    def drop_database(self, name=None):
+        from .mongodb_models import MongoDBConnection
+        MongoDBConnection().get_client().drop_database(name or settings.MONGODB_SETTINGS['db'])
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(name=None):
+    """
+    The engine selected in MONGODB_SETTINGS (or ``name``).
+
+    Settings are read on every call, so override_settings switches engines;
+    each engine is created once per process and keeps its state.
+    """
+    name = name or settings.MONGODB_SETTINGS.get('engine', 'mongo')
+    path = ENGINES.get(name, name)
+    engine = _engines.get(path)
+    if engine is None:
+        with _engines_lock:
+            engine = _engines.get(path)
+            if engine is None:
+                engine = _engines[path] = import_string(path)()
+    return engine
@@ -1,3 +1,562 @@
-from django.test import TestCase
+import asyncio
+import random
+import threading
+import unittest
+from io import StringIO
+from unittest import mock
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+from pymongo import ASCENDING, DESCENDING, TEXT, InsertOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from api.testing import mongo_available
+from .checks import check_invalidation_channels, check_mongo_indexes
+from .mongodb_async import AsyncMongoDBConnection
+from .mongodb_cache import DocumentCache, InvalidationLog
+from .mongodb_indexes import REBUILD_SUFFIX, get_index_drift, normalize_keys
+from .mongodb_memory import WALK_MIN_CANDIDATES
+from .mongodb_storage import get_engine
 
-# Create your tests here.
+# Shared by the engine tests below
+LISTINGS = [
+    {'_id': 1, 'price': 100, 'city': 'Austin', 'tags': ['pool', 'garage']},
+    {'_id': 2, 'price': 250, 'city': 'Denver', 'tags': ['garden']},
+    {'_id': 3, 'price': 250, 'city': 'austin'},
+    {'_id': 4, 'city': None},
+    {'_id': 5, 'price': 'cheap'},
+]
+
+
+def point(lng, lat):
+    return {'type': 'Point', 'coordinates': [lng, lat]}
+
+
+def square(west, south, east, north):
+    return {'type': 'Polygon', 'coordinates': [[
+        [west, south], [east, south], [east, north], [west, north], [west, south]
+    ]]}
+
+
+class InvalidationLogTests(SimpleTestCase):
+
+    def setUp(self):
+        caches['invalidation'].clear()
+        self.reader = InvalidationLog('tests', 'invalidation', poll_interval=0)
+        self.reader.mark()
+
+    def test_concurrent_publishers(self):
+        # Every publisher gets its own sequence number: nothing is overwritten
+        def publish(worker):
+            log = InvalidationLog('tests', 'invalidation', poll_interval=0)
+            for n in range(50):
+                log.publish(f'{worker}:{n}')
+
+        threads = [threading.Thread(target=publish, args=(worker,)) for worker in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.reader.max_replay = 1000
+        self.assertEqual(
+            sorted(self.reader.poll()),
+            sorted(f'{worker}:{n}' for worker in range(8) for n in range(50))
+        )
+
+    def test_counter_lost(self):
+        self.reader.publish('a')
+        self.assertEqual(self.reader.poll(), ['a'])
+        caches['invalidation'].clear()
+        self.reader.publish('b')
+        self.assertIs(self.reader.poll(), InvalidationLog.ALL)
+
+    @override_settings(CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        'invalidation': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': '/tmp/x'},
+    })
+    def test_check_non_atomic_channel(self):
+        self.assertEqual([error.id for error in check_invalidation_channels(None)], ['webapp.W003'])
+
+    def test_check_channel(self):
+        self.assertEqual(check_invalidation_channels(None), [])
+
+
+class DocumentCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        caches['invalidation'].clear()
+
+    def make_cache(self, **kwargs):
+        kwargs = dict({'max_entries': 3, 'ttl': 60, 'channel': 'invalidation', 'poll_interval': 0}, **kwargs)
+        return DocumentCache('tests_documents', **kwargs)
+
+    def test_lru(self):
+        cache = self.make_cache()
+        for key in 'abc':
+            cache.set(key, {'_id': key})
+        # Reading "a" makes "b" the least recently used
+        self.assertEqual(cache.get('a'), {'_id': 'a'})
+        cache.set('d', {'_id': 'd'})
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual([key for key in 'acd' if cache.get(key)], ['a', 'c', 'd'])
+        cache.set('e', {'_id': 'e'})
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['evictions'], 2)
+
+    def test_ttl(self):
+        cache = self.make_cache(ttl=10)
+        with mock.patch('webapp.mongodb_cache.time.monotonic', return_value=1000):
+            cache.set('a', {'_id': 'a'})
+        with mock.patch('webapp.mongodb_cache.time.monotonic', return_value=1009.9):
+            self.assertEqual(cache.get('a'), {'_id': 'a'})
+        with mock.patch('webapp.mongodb_cache.time.monotonic', return_value=1010):
+            self.assertIsNone(cache.get('a'))
+        stats = cache.stats()
+        self.assertEqual((stats['entries'], stats['expirations'], stats['hits'], stats['misses']), (0, 1, 1, 1))
+
+    def test_stats(self):
+        cache = self.make_cache()
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', {'_id': 'a'})
+        cache.get('a')
+        cache.get('a')
+        cache.invalidate('a')
+        self.assertIsNone(cache.get('a'))
+        stats = cache.stats()
+        self.assertEqual(
+            (stats['hits'], stats['misses'], stats['invalidations'], stats['entries']), (2, 2, 1, 0)
+        )
+        cache.reset_stats()
+        self.assertEqual(cache.stats()['hits'], 0)
+
+    def test_disabled(self):
+        cache = self.make_cache(max_entries=0)
+        cache.set('a', {'_id': 'a'})
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['misses'], 0)
+
+    def test_invalidated_elsewhere(self):
+        cache, other = self.make_cache(), self.make_cache()
+        # Each process looks a document up, misses and loads it; the first
+        # lookup starts following the log before anything is loaded
+        for each in (cache, other):
+            for key in 'ab':
+                self.assertIsNone(each.get(key))
+                each.set(key, {'_id': key})
+
+        cache.invalidate('a')
+        self.assertIsNone(other.get('a'))
+        self.assertEqual(other.get('b'), {'_id': 'b'})
+
+        cache.invalidate_all()
+        self.assertIsNone(other.get('b'))
+        self.assertEqual(other.stats()['entries'], 0)
+
+    def test_copies(self):
+        cache = self.make_cache()
+        document = {'_id': 'a', 'features': ['pool']}
+        cache.set('a', document)
+        document['features'].append('garage')
+        cached = cache.get('a')
+        cached['features'].append('view')
+        cached['price'] = 1
+        self.assertEqual(cache.get('a'), {'_id': 'a', 'features': ['pool']})
+
+
+class AsyncConnectionTests(SimpleTestCase):
+
+    def test_client_per_loop(self):
+        clients = []
+
+        async def use_client():
+            client = AsyncMongoDBConnection.get_client()
+            self.assertIs(AsyncMongoDBConnection.get_client(), client)
+            clients.append(client)
+
+        # A loop per call, as when the async views run under WSGI
+        async_to_sync(use_client)()
+        async_to_sync(use_client)()
+        asyncio.run(use_client())
+        self.assertEqual(len({id(client) for client in clients}), 3)
+        # ... each client closed with its loop
+        self.assertTrue(all(client._closed for client in clients))
+        self.assertEqual(len(AsyncMongoDBConnection._clients), 0)
+
+
+# Declared indexes for the index tests, on their own collection
+TEST_INDEXES = [
+    {'name': 'price_id', 'keys': [('price', ASCENDING), ('_id', ASCENDING)]},
+    {'name': 'city', 'keys': [('city', ASCENDING)]},
+]
+
+
+@override_settings(MONGODB_SETTINGS=dict(
+    settings.MONGODB_SETTINGS, engine='memory', db=settings.MONGODB_SETTINGS['db'] + '_index_test'
+))
+class IndexTests(SimpleTestCase):
+
+    def setUp(self):
+        self.collection = get_engine().get_collection('index_test')
+        self.collection.drop()
+        self.addCleanup(get_engine().drop_database)
+        specs = mock.patch(
+            'webapp.management.commands.ensure_mongo_indexes.INDEX_SPECS', {'index_test': TEST_INDEXES}
+        )
+        specs.start()
+        self.addCleanup(specs.stop)
+
+    def ensure(self, *args, usage=None):
+        out = StringIO()
+        with mock.patch(
+            'webapp.management.commands.ensure_mongo_indexes.Command.get_index_usage', return_value=usage or {}
+        ):
+            call_command('ensure_mongo_indexes', *args, stdout=out)
+        return out.getvalue()
+
+    def names(self):
+        return sorted(name for name in self.collection.index_information() if name != '_id_')
+
+    def test_normalize_keys(self):
+        self.assertEqual(normalize_keys([('price', 1), ('_id', 1)]), [('price', 1), ('_id', 1)])
+        # Text fields fold into the server's _fts/_ftsx pair, as index_information reports them
+        declared = [('status', ASCENDING), ('title', TEXT), ('description', TEXT)]
+        reported = [('status', ASCENDING), ('_fts', TEXT), ('_ftsx', 1)]
+        self.assertEqual(normalize_keys(declared), reported)
+        self.assertEqual(normalize_keys(reported), reported)
+
+    def test_drift(self):
+        self.collection.create_index([('price', ASCENDING)], name='price_id')
+        self.collection.create_index([('area', ASCENDING)], name='area')
+        missing, changed, unused = get_index_drift(self.collection, TEST_INDEXES)
+        self.assertEqual([spec['name'] for spec in missing], ['city'])
+        self.assertEqual([spec['name'] for spec in changed], ['price_id'])
+        self.assertEqual(unused, ['area'])
+
+        # A rebuilt index carries the other name and still serves its spec
+        self.collection.drop_index('price_id')
+        self.collection.create_index([('price', ASCENDING), ('_id', ASCENDING)], name='price_id' + REBUILD_SUFFIX)
+        missing, changed, unused = get_index_drift(self.collection, TEST_INDEXES)
+        self.assertEqual(([spec['name'] for spec in missing], changed, unused), (['city'], [], ['area']))
+
+    def test_check(self):
+        with self.assertRaises(CommandError):
+            self.ensure('--check')
+        self.assertEqual(self.names(), [])
+        self.ensure()
+        self.assertEqual(self.names(), ['city', 'price_id'])
+        self.assertIn('up to date', self.ensure('--check'))
+
+    def test_rebuild(self):
+        self.collection.create_index([('price', ASCENDING)], name='price_id')
+        self.collection.create_index([('city', ASCENDING)], name='city', unique=True)
+        built = []
+        create_index = self.collection.create_index
+
+        def record(keys, **kwargs):
+            # What exists while each replacement is built
+            built.append((kwargs['name'], self.names()))
+            return create_index(keys, **kwargs)
+
+        with mock.patch.object(self.collection, 'create_index', side_effect=record):
+            out = self.ensure()
+        # New keys: built next to the old index, which is dropped afterwards
+        self.assertIn(('price_id' + REBUILD_SUFFIX, ['city', 'price_id']), built)
+        self.assertIn('price_id as price_id__rebuilt, before dropping the old one', out)
+        # Same keys, other options: the server cannot hold both
+        self.assertIn('city as city__rebuilt, after dropping the old one', out)
+        self.assertEqual(self.names(), ['city' + REBUILD_SUFFIX, 'price_id' + REBUILD_SUFFIX])
+        self.assertIn('up to date', self.ensure('--check'))
+
+        # The next change goes back to the declared name
+        self.collection.drop_index('price_id' + REBUILD_SUFFIX)
+        self.collection.create_index([('price', DESCENDING)], name='price_id' + REBUILD_SUFFIX)
+        self.ensure()
+        self.assertEqual(self.names(), ['city' + REBUILD_SUFFIX, 'price_id'])
+
+    def test_drop_unused(self):
+        self.ensure()
+        self.collection.create_index([('area', ASCENDING)], name='area')
+        self.collection.create_index([('state', ASCENDING)], name='state')
+        # Without usage figures, or with accesses, undeclared indexes stay
+        self.assertIn('kept area', self.ensure('--drop-unused'))
+        self.ensure('--drop-unused', usage={'area': 3, 'state': 0})
+        self.assertEqual(self.names(), ['area', 'city', 'price_id'])
+        self.ensure('--drop-unused', '--force', usage={'area': 3})
+        self.assertEqual(self.names(), ['city', 'price_id'])
+
+    def test_check_warnings(self):
+        database = {'properties': self.collection}
+        self.collection.create_index([('city', ASCENDING)], name='city')
+        with override_settings(MONGODB_SETTINGS=dict(settings.MONGODB_SETTINGS, engine='mongo')):
+            with mock.patch('webapp.checks.MongoClient') as client, \
+                    mock.patch('webapp.checks.INDEX_SPECS', {'properties': TEST_INDEXES}):
+                client.return_value.__getitem__.return_value = database
+                self.assertEqual([error.id for error in check_mongo_indexes(None)], ['webapp.W001'])
+                self.collection.create_index([('price', ASCENDING), ('_id', ASCENDING)], name='price_id')
+                self.assertEqual(check_mongo_indexes(None), [])
+
+            # An unreachable server is reported, quickly
+            with override_settings(MONGODB_SETTINGS=dict(
+                settings.MONGODB_SETTINGS, engine='mongo', host='mongodb://127.0.0.1:9/', index_check_timeout_ms=50
+            )):
+                self.assertEqual([error.id for error in check_mongo_indexes(None)], ['webapp.W002'])
+
+    @override_settings(MONGODB_SETTINGS=dict(settings.MONGODB_SETTINGS, engine='mongo'))
+    def test_check_deploy_only(self):
+        # Only "check --deploy" reaches the server
+        with mock.patch('webapp.checks.MongoClient') as client:
+            call_command('check', stdout=StringIO())
+            client.assert_not_called()
+
+
+class StorageEngineTests:
+    """
+    What the models rely on from a storage engine, run against each one.
+
+    MongoEngineTests runs the same tests against the mongod at
+    MONGODB_SETTINGS['host'] when it answers, which keeps the in-memory
+    engine honest about the server's behaviour.
+    """
+    engine = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls._mongo_settings = override_settings(MONGODB_SETTINGS=dict(
+            settings.MONGODB_SETTINGS, engine=cls.engine, db=settings.MONGODB_SETTINGS['db'] + '_engine_test'
+        ))
+        cls._mongo_settings.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        get_engine().drop_database()
+        cls._mongo_settings.disable()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.collection = self.get_collection('listings')
+        self.collection.insert_many([dict(doc) for doc in LISTINGS])
+
+    def get_collection(self, name):
+        collection = get_engine().get_collection(name)
+        collection.drop()
+        return collection
+
+    def ids(self, query, **kwargs):
+        return [doc['_id'] for doc in self.collection.find(query, {'_id': 1}, **kwargs)]
+
+    def assertFinds(self, query, expected):
+        self.assertEqual(sorted(self.ids(query)), expected, query)
+
+    def test_filters(self):
+        self.assertFinds({'price': {'$gte': 100, '$lt': 300}}, [1, 2, 3])
+        # Missing fields match $ne and null; comparisons stay within a type
+        self.assertFinds({'price': {'$ne': 250}}, [1, 4, 5])
+        self.assertFinds({'city': None}, [4, 5])
+        self.assertFinds({'city': {'$exists': False}}, [5])
+        self.assertFinds({'price': {'$not': {'$gt': 100}}}, [1, 4, 5])
+        self.assertFinds({'price': {'$type': 'string'}}, [5])
+        self.assertFinds({'city': {'$regex': '^aus', '$options': 'i'}}, [1, 3])
+        self.assertFinds({'$or': [{'price': 100}, {'city': 'Denver'}]}, [1, 2])
+        self.assertFinds({'$nor': [{'price': 250}, {'city': None}]}, [1])
+        # Across types, $expr compares in BSON order: strings after numbers
+        self.assertFinds({'$expr': {'$gt': ['$price', 200]}}, [2, 3, 5])
+
+    def test_array_filters(self):
+        self.assertFinds({'tags': 'pool'}, [1])
+        self.assertFinds({'tags': {'$in': ['garden', 'sauna']}}, [2])
+        self.assertFinds({'tags': {'$nin': ['pool']}}, [2, 3, 4, 5])
+        self.assertFinds({'tags': {'$all': ['pool', 'garage']}}, [1])
+        self.assertFinds({'tags': {'$size': 1}}, [2])
+
+    def test_sort_skip_limit(self):
+        # Missing sorts first, then numbers, then strings
+        self.assertEqual(self.ids({}, sort=[('price', ASCENDING), ('_id', DESCENDING)]), [4, 1, 3, 2, 5])
+        self.assertEqual(self.ids({}, sort=[('price', DESCENDING), ('_id', ASCENDING)]), [5, 2, 3, 1, 4])
+        self.assertEqual(self.ids({}, sort=[('price', ASCENDING), ('_id', DESCENDING)], skip=1, limit=2), [1, 3])
+        self.assertEqual(self.collection.count_documents({'price': {'$exists': True}}, skip=1, limit=2), 2)
+
+    def test_projection(self):
+        self.assertEqual(self.collection.find_one({'_id': 1}, {'city': 1}), {'_id': 1, 'city': 'Austin'})
+        self.assertEqual(self.collection.find_one({'_id': 1}, {'city': 1, '_id': 0}), {'city': 'Austin'})
+        self.assertEqual(self.collection.find_one({'_id': 1}, {'tags': 0, '_id': 0}), {'price': 100, 'city': 'Austin'})
+
+    def test_results_are_copies(self):
+        self.collection.find_one({'_id': 1})['tags'].append('sauna')
+        doc = {'city': 'Boise'}
+        self.collection.insert_one(doc)
+        # The _id is set on the inserted document, as the driver does
+        self.assertIn('_id', doc)
+        doc['city'] = 'Reno'
+        self.assertEqual(self.collection.find_one({'_id': 1})['tags'], ['pool', 'garage'])
+        self.assertEqual(self.collection.find_one({'_id': doc['_id']})['city'], 'Boise')
+
+    def test_update(self):
+        result = self.collection.update_one({'_id': 1}, {'$set': {'price': 100}})
+        self.assertEqual((result.matched_count, result.modified_count), (1, 0))
+        self.collection.update_one({'_id': 1}, {
+            '$set': {'contact.email': 'owner@example.com'}, '$inc': {'views': 2}, '$unset': {'tags': ''}
+        })
+        self.assertEqual(self.collection.find_one({'_id': 1}), {
+            '_id': 1, 'price': 100, 'city': 'Austin', 'contact': {'email': 'owner@example.com'}, 'views': 2
+        })
+        self.assertEqual(self.collection.update_many({'price': 250}, {'$inc': {'price': 1}}).modified_count, 2)
+        self.assertFinds({'price': 251}, [2, 3])
+
+    def test_upsert(self):
+        update = {'$set': {'price': 5}, '$setOnInsert': {'created': 1}}
+        result = self.collection.update_one({'external_id': 'x'}, update, upsert=True)
+        self.assertIsNotNone(result.upserted_id)
+        update = {'$set': {'price': 6}, '$setOnInsert': {'created': 2}}
+        result = self.collection.update_one({'external_id': 'x'}, update, upsert=True)
+        self.assertEqual((result.matched_count, result.upserted_id), (1, None))
+        self.assertEqual(
+            self.collection.find_one({'external_id': 'x'}, {'_id': 0}),
+            {'external_id': 'x', 'price': 6, 'created': 1}
+        )
+
+    def test_unique_index(self):
+        collection = self.get_collection('codes')
+        collection.create_index('code', unique=True)
+        collection.insert_one({'code': 'a'})
+        with self.assertRaises(DuplicateKeyError) as raised:
+            collection.insert_one({'code': 'a'})
+        self.assertEqual(raised.exception.code, 11000)
+
+        with self.assertRaises(BulkWriteError) as raised:
+            collection.bulk_write(
+                [InsertOne({'code': 'b'}), InsertOne({'code': 'a'}), InsertOne({'code': 'c'})], ordered=False
+            )
+        details = raised.exception.details
+        self.assertEqual(details['nInserted'], 2)
+        self.assertEqual([(error['index'], error['code']) for error in details['writeErrors']], [(1, 11000)])
+
+        # Ordered writes stop at the first error
+        with self.assertRaises(BulkWriteError) as raised:
+            collection.bulk_write([InsertOne({'code': 'd'}), InsertOne({'code': 'a'}), InsertOne({'code': 'e'})])
+        self.assertEqual(raised.exception.details['nInserted'], 1)
+        self.assertIsNone(collection.find_one({'code': 'e'}))
+
+    def test_aggregate(self):
+        groups = list(self.collection.aggregate([
+            {'$match': {'price': {'$type': 'number'}}},
+            {'$group': {
+                '_id': '$city', 'count': {'$sum': 1}, 'average': {'$avg': '$price'}, 'highest': {'$max': '$price'}
+            }},
+            {'$sort': {'_id': 1}},
+        ]))
+        self.assertEqual(groups, [
+            {'_id': 'Austin', 'count': 1, 'average': 100, 'highest': 100},
+            {'_id': 'Denver', 'count': 1, 'average': 250, 'highest': 250},
+            {'_id': 'austin', 'count': 1, 'average': 250, 'highest': 250},
+        ])
+        self.assertEqual(list(self.collection.aggregate([{'$facet': {
+            'total': [{'$count': 'n'}],
+            'last': [{'$sort': {'_id': -1}}, {'$limit': 1}, {'$project': {'_id': 1}}],
+        }}])), [{'total': [{'n': 5}], 'last': [{'_id': 5}]}])
+        tags = list(self.collection.aggregate([
+            {'$unwind': '$tags'}, {'$group': {'_id': None, 'tags': {'$addToSet': '$tags'}}},
+        ]))
+        self.assertEqual(sorted(tags[0]['tags']), ['garage', 'garden', 'pool'])
+
+    def test_text_search(self):
+        collection = self.get_collection('text')
+        collection.create_index([('title', 'text'), ('description', 'text')])
+        collection.insert_many([
+            {'_id': 1, 'title': 'Pool house', 'description': 'Near the park'},
+            {'_id': 2, 'title': 'Spacious condo', 'description': 'Two pools and a gym'},
+            {'_id': 3, 'title': 'Cottage', 'description': 'Garden and pool'},
+        ])
+
+        def search(terms):
+            return sorted(doc['_id'] for doc in collection.find({'$text': {'$search': terms}}, {'_id': 1}))
+
+        # Words are stemmed, phrases matched as written, -words excluded
+        self.assertEqual(search('pool'), [1, 2, 3])
+        self.assertEqual(search('"spacious condo"'), [2])
+        self.assertEqual(search('pool -garden'), [1, 2])
+
+    def test_geo(self):
+        collection = self.get_collection('geo')
+        collection.create_index([('location', '2dsphere')])
+        collection.insert_many([
+            {'_id': 'a', 'location': point(0, 0)},
+            {'_id': 'b', 'location': point(1, 0)},
+            {'_id': 'c', 'location': point(5, 0)},
+        ])
+
+        def find(query):
+            return [doc['_id'] for doc in collection.find({'location': query}, {'_id': 1})]
+
+        # Nearest first, within 200 km
+        self.assertEqual(find({'$nearSphere': {'$geometry': point(0.9, 0), '$maxDistance': 200000}}), ['b', 'a'])
+        self.assertEqual(sorted(find({'$geoWithin': {'$centerSphere': [[0, 0], 200 / 6378.1]}})), ['a', 'b'])
+        self.assertEqual(sorted(find({'$geoWithin': {'$geometry': square(-0.5, -0.5, 1.5, 0.5)}})), ['a', 'b'])
+
+    def test_invalid_loop(self):
+        collection = self.get_collection('geo')
+        collection.create_index([('location', '2dsphere')])
+        collection.insert_one({'location': point(0, 0)})
+        bowtie = {'type': 'Polygon', 'coordinates': [[[0, 0], [1, 1], [1, 0], [0, 1], [0, 0]]]}
+        with self.assertRaises(OperationFailure) as raised:
+            list(collection.find({'location': {'$geoWithin': {'$geometry': bowtie}}}))
+        self.assertEqual(raised.exception.code, 2)
+        self.assertIn('Loop is not valid', str(raised.exception))
+
+
+class MemoryEngineTests(StorageEngineTests, SimpleTestCase):
+    engine = 'memory'
+
+    def test_unsupported_operator(self):
+        # Refused rather than answered wrongly
+        with self.assertRaises(OperationFailure):
+            list(self.collection.find({'tags': {'$elemMatch': {'$eq': 'pool'}}}))
+
+    def test_indexes_match_scan(self):
+        # Enough documents for index walks, checked against a collection
+        # without indexes, before and after writes move them
+        rng = random.Random(7)
+        docs = [
+            {'_id': i, 'price': rng.choice([rng.randrange(1000), None, 'n/a']), 'city': rng.choice('ABCD'),
+             'location': point(rng.uniform(-5, 5), rng.uniform(-5, 5))}
+            for i in range(WALK_MIN_CANDIDATES * 4)
+        ]
+        for doc in docs:
+            if rng.random() < 0.1:
+                del doc['price']
+        indexed, scanned = self.get_collection('indexed'), self.get_collection('scanned')
+        indexed.create_index([('price', ASCENDING), ('_id', ASCENDING)])
+        indexed.create_index('city')
+        indexed.create_index([('location', '2dsphere')])
+        indexed.insert_many([dict(doc) for doc in docs])
+        scanned.insert_many([dict(doc) for doc in docs])
+
+        queries = [
+            ({'price': {'$gte': 100, '$lt': 400}}, [('price', ASCENDING), ('_id', ASCENDING)], 0, 50),
+            ({'city': {'$in': ['A', 'C']}}, [('price', DESCENDING), ('_id', DESCENDING)], 20, 30),
+            ({'city': 'B', 'price': {'$gt': 900}}, [('_id', ASCENDING)], 0, 0),
+            ({}, [('price', ASCENDING), ('_id', ASCENDING)], 1000, 25),
+            ({'location': {'$geoWithin': {'$geometry': square(-1, -1, 2, 2)}}}, [('_id', ASCENDING)], 0, 0),
+        ]
+
+        def check():
+            for query, sort, skip, limit in queries:
+                with self.subTest(query=query, sort=sort):
+                    self.assertEqual(
+                        list(indexed.find(query, sort=sort, skip=skip, limit=limit)),
+                        list(scanned.find(query, sort=sort, skip=skip, limit=limit))
+                    )
+
+        check()
+        for collection in (indexed, scanned):
+            collection.update_many({'city': 'A', 'price': {'$type': 'number'}}, {'$inc': {'price': 500}})
+            collection.update_many({'price': {'$lt': 50}}, {'$set': {'city': 'A', 'location': point(0.1, 0.1)}})
+            collection.delete_many({'city': 'D'})
+        check()
+
+
+@unittest.skipUnless(mongo_available(), f'MongoDB is not reachable at {settings.MONGODB_SETTINGS["host"]}')
+class MongoEngineTests(StorageEngineTests, SimpleTestCase):
+    engine = 'mongo'